@@ -2,8 +2,13 @@
 query requests.
 """
 import os
+import json
+import time
+import asyncio
 import logging
-from typing import Dict, Optional, Any
+import threading
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Any
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,90 +24,185 @@ except ImportError:
         "manually."
     )
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.concurrency import run_in_threadpool
 
-from utils import enums
+from utils import enums, metrics
 from models.query import Query
-from services.chromadb import ChromaDB
-from services.generative_llm import GenerativeLLM
-from services.document_processor import DocumentProcessor
-from services.embedding_generator import EmbeddingGenerator
-from services.embedding_function import GeminiEmbeddingFunction
+from services import dependencies
+from services.indexing import IndexState, IngestionWorker
+from services.index_coordinator import IndexCoordinator
+from services.prompt_builder import build_prompt
+from services.embedding_client import estimate_tokens
 
-# Initialize FastAPI app
-app = FastAPI()
-
-# Initialize embedding function
-embedding_function = GeminiEmbeddingFunction(model_name=enums.EMBEDDING_MODEL)
-
-# Initialize Gemini model
-model = GenerativeLLM.get_model(model_name=enums.LLM_MODEL)
-
-# Static variables
-GAME_SYSTEM_FOLDERS = [
-    "Dragonbane",
-    # "Kids on Bikes 2e",
-    # "Star Wars 5e",
-    # "Risus The Anything RPG",
-    # "Gamma Wolves",
-]
-# PATH_TO_TTRPG_PDFS = "/app/data"
-PATH_TO_TTRPG_PDFS = os.path.join(
-    "..", "..", "Documents", "Tabletop RPGs"
-)
 
-# Initialize Chroma client and get the collection
-chroma_db = ChromaDB(
-    embedding_function=embedding_function,
-    chroma_db_path=enums.CHROMA_DB_PATH,
-    collection_name=enums.COLLECTION_NAME,
-)
+def _env_flag(name: str, default: bool) -> bool:
+    """Whether an environment variable, or else its default, is true."""
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
 
 
-# Initial document processing and embedding generation
-if chroma_db.collection.count() == 0:
-    logger.warning(
-        "No documents found in the ChromaDB collection. Processing and "
-        "generating embeddings for TTRPG rulebooks..."
+# Run the ingestion in the background at startup, unless the index is built
+# separately with `python ingest.py`
+INGEST_ON_STARTUP = _env_flag("INGEST_ON_STARTUP", enums.INGEST_ON_STARTUP)
+
+# Keep ingesting the pdf files added, changed or removed after startup
+WATCH_FOLDERS = _env_flag("WATCH_FOLDERS", enums.WATCH_FOLDERS)
+
+# Share one ingestion leader and read-only index snapshots between the
+# worker processes of the server, e.g. `gunicorn -w 4`
+MULTI_WORKER = _env_flag("MULTI_WORKER", enums.MULTI_WORKER)
+
+# State of the index, reported by the health and readiness probes
+index_state = IndexState()
+coordinator = (
+    IndexCoordinator(
+        index_state, ingest=INGEST_ON_STARTUP, watch=WATCH_FOLDERS
     )
-    for folder in GAME_SYSTEM_FOLDERS:
-        # Process documents
-        processor = DocumentProcessor(
-            base_folder=os.path.join(PATH_TO_TTRPG_PDFS, folder)
-        )
-        documents = processor.process_documents()
-        # Generate embeddings
-        embedding_generator = EmbeddingGenerator(
-            embedding_function=embedding_function
+    if MULTI_WORKER
+    else None
+)
+ingestion_worker = IngestionWorker(index_state, watch=WATCH_FOLDERS)
+
+
+def warm_up_and_ingest() -> None:
+    """Construct the clients, then sync the index if ingestion on startup is
+    enabled, and keep it in sync with the watched pdf folders. Runs in a
+    background thread, so that the server starts accepting connections
+    immediately.
+
+    In the multi-worker mode, the worker elected leader does the same and
+    publishes the index, while the others serve its published snapshots.
+    """
+    if coordinator is not None:
+        coordinator.run()
+        return
+    try:
+        dependencies.get_retriever()
+        dependencies.get_model()
+        index_state.set_clients_ready(
+            documents=dependencies.count_documents()
         )
-        embeddings = embedding_generator.generate_embeddings(
-            documents=documents
+    except Exception as e:
+        logger.exception("Error constructing the clients: %s" % e)
+        index_state.fail(e)
+        return
+    if INGEST_ON_STARTUP:
+        ingestion_worker.run()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Start warming up the clients and indexing in the background."""
+    threading.Thread(
+        target=warm_up_and_ingest, name="ingestion", daemon=True
+    ).start()
+    yield
+    if coordinator is not None:
+        coordinator.stop()
+    ingestion_worker.stop()
+
+
+def check_serving() -> None:
+    """Reject queries with a 503 while a follower worker waits for the
+    first index generation.
+
+    Raises
+    ------
+    HTTPException
+        If no index can be searched yet
+    """
+    if coordinator is not None and not coordinator.serving:
+        raise HTTPException(
+            status_code=503, detail="The index is not published yet"
         )
-        # Store embeddings in ChromaDB vector collection
-        if len(embeddings) > 0:
-            chroma_db.collection.add(
-                ids=[doc.id for doc in documents],
-                embeddings=embeddings,
-                metadatas=[doc.metadata for doc in documents],
-                documents=[doc.page_content for doc in documents],
-            )
-            logger.info(
-                "ChromaDB collection now contains %s documents." % (
-                    chroma_db.collection.count()
-                )
-            )
+
+
+# Initialize FastAPI app
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_timings(
+    request: Request, call_next: Callable[[Request], Awaitable[Response]]
+) -> Response:
+    """Time every request, and report the time spent in each stage of it
+    in a `Server-Timing` header. The background ingestion yields to queries
+    while they are handled.
+    """
+    start = time.perf_counter()
+    with metrics.collect_timings() as timings:
+        if request.url.path.startswith("/query"):
+            traffic = dependencies.get_query_traffic()
+            # Queries are only held back while the index is republished, so
+            # the event loop waits in a thread only then
+            if not traffic.begin(blocking=False):
+                await run_in_threadpool(traffic.begin)
+            try:
+                response = await call_next(request)
+            finally:
+                traffic.end()
         else:
-            logger.warning(
-                "No embeddings generated for the %s documents." % (
-                    len(documents)
-                )
-            )
-else:
-    logger.info(
-        "ChromaDB collection already contains %s documents." % (
-            chroma_db.collection.count()
-        )
+            response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(
+        elapsed,
+        method=request.method,
+        # The route template, so that the number of series stays bounded
+        path=route.path if route is not None else "unmatched",
+        status=response.status_code,
     )
+    timings["total"] = elapsed
+    response.headers["Server-Timing"] = metrics.format_server_timing(timings)
+    return response
+
+
+@app.get("/metrics")
+def get_metrics() -> PlainTextResponse:
+    """Expose the latency histograms and counters of the API and the
+    ingestion in the Prometheus text format.
+
+    Returns
+    -------
+    PlainTextResponse
+        The metrics
+    """
+    return PlainTextResponse(
+        metrics.REGISTRY.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+@app.get("/healthz")
+def healthz() -> Dict[str, Any]:
+    """Liveness probe, answering as soon as the server is up.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The state and progress of the index
+    """
+    return index_state.to_dict()
+
+
+@app.get("/readyz")
+def readyz() -> JSONResponse:
+    """Readiness probe, answering 200 once queries can be served and 503
+    until then.
+
+    Returns
+    -------
+    JSONResponse
+        The state and progress of the index
+    """
+    state = index_state.to_dict()
+    return JSONResponse(state, status_code=200 if state["ready"] else 503)
 
 
 @app.post("/query")
@@ -123,49 +223,167 @@ def handle_query(query: Query) -> Optional[Dict[str, Any]]:
     Raises
     ------
     HTTPException
-        If no relevant documents are found
+        If no relevant documents are found, the index is not published yet,
+        or the model does not answer before the deadline
     """
-    # Query the ChromaDB collection for the most similar documents
-    results = chroma_db.collection.query(
-        query_texts=[query.query],
-        n_results=query.top_k,  # Return the top 10 results
-    )
+    check_serving()
+    # Retrieve the most similar document chunks in a single round trip
+    retriever = dependencies.get_retriever()
+    with metrics.span("retrieve"):
+        chunks = retriever.retrieve(
+            query_text=query.query, top_k=query.top_k, where=query.to_where()
+        )
 
     # No relevant documents are found
-    if not results["ids"][0]:
+    if not chunks:
         raise HTTPException(
             status_code=404, detail="No relevant documents found"
         )
 
-    # Retrieve document chunks
-    document_ids = results["ids"][0]
-    documents = [
-        chroma_db.collection.get(
-            ids=[doc_id], include=["documents", "metadatas"]
-        ) for doc_id in document_ids
-    ]
-    relevant_chunks = [doc["documents"][0] for doc in documents]
-
-    # Context formation
-    context = f"User query: {query.query}\n\nRelevant document chunks:\n"
-    for chunk in relevant_chunks:
-        context += f"- {chunk}\n"
+    # Context formation, deduplicated and packed to the token budget
+    with metrics.span("context"):
+        context = dependencies.get_context_builder().build(
+            query.query, chunks
+        )
     logger.debug("Context: %s" % context)
 
     # Response generation
-    contents = f"""
-You are a helpful AI assistant providing information based on tabletop role-playing game (TTRPG) rulebooks.
-Answer the following question using only the context provided. If you don't have enough information to answer, say you don't know.
-Context: {context}
-Question: {query.query}
-Answer:"""
+    contents = build_prompt(query.query, context)
     logger.debug("Contents: %s" % contents)
-    response = model.generate_content(contents=contents)
+    metrics.TOKENS.inc(estimate_tokens(contents), kind="prompt")
+    model = dependencies.get_model()
+    with metrics.span("generate"):
+        try:
+            response = model.generate_content(contents=contents)
+        except TimeoutError:
+            raise HTTPException(
+                status_code=504, detail="The model did not answer in time"
+            )
+    metrics.TOKENS.inc(estimate_tokens(response.text), kind="answer")
 
     # Format and return response
     return {"answer": response.text}
 
 
+def format_sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format a Server-Sent Event.
+
+    Parameters
+    ----------
+    data : Dict[str, Any]
+        The JSON payload of the event.
+    event : Optional[str], optional
+        The event type. If None, the client receives a `message` event, by
+        default None.
+
+    Returns
+    -------
+    str
+        The encoded event.
+    """
+    message = f"data: {json.dumps(data)}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
+
+@app.post("/query/stream")
+async def handle_query_stream(
+    query: Query, request: Request
+) -> StreamingResponse:
+    """Handles a query request like `/query`, but without blocking a worker
+    thread, and streams the answer to the client as Server-Sent Events while
+    the generative model produces it.
+
+    Each `message` event carries a `{"text": ...}` fragment of the answer,
+    followed by a final `done` event, or an `error` event if generation
+    fails. Generation is cancelled as soon as the client disconnects.
+
+    Parameters
+    ----------
+    query : Query
+        A Pydantic model representing the query text
+    request : Request
+        The incoming request, used to detect client disconnects
+
+    Returns
+    -------
+    StreamingResponse
+        The `text/event-stream` response
+
+    Raises
+    ------
+    HTTPException
+        If no relevant documents are found, or the index is not published
+        yet
+    """
+    check_serving()
+    # Retrieval is blocking, so run it in the threadpool
+    retriever = await run_in_threadpool(dependencies.get_retriever)
+    with metrics.span("retrieve"):
+        chunks = await run_in_threadpool(
+            retriever.retrieve,
+            query_text=query.query,
+            top_k=query.top_k,
+            where=query.to_where(),
+        )
+    if not chunks:
+        raise HTTPException(
+            status_code=404, detail="No relevant documents found"
+        )
+    # Deduplicating and counting tokens is CPU bound, so run it in the
+    # threadpool as well
+    builder = await run_in_threadpool(dependencies.get_context_builder)
+    with metrics.span("context"):
+        context = await run_in_threadpool(builder.build, query.query, chunks)
+    contents = build_prompt(query.query, context)
+    metrics.TOKENS.inc(estimate_tokens(contents), kind="prompt")
+    model = await run_in_threadpool(dependencies.get_model)
+
+    async def generate(fragments: asyncio.Queue) -> None:
+        try:
+            # Recorded in the metrics only, since the headers are sent first
+            with metrics.span("generate"):
+                response = await model.generate_content_async(
+                    contents=contents, stream=True
+                )
+                async for response_chunk in response:
+                    metrics.TOKENS.inc(
+                        estimate_tokens(response_chunk.text), kind="answer"
+                    )
+                    await fragments.put(
+                        format_sse({"text": response_chunk.text})
+                    )
+            await fragments.put(format_sse({}, event="done"))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Error generating streamed answer: %s" % e)
+            await fragments.put(format_sse({"detail": str(e)}, event="error"))
+        finally:
+            await fragments.put(None)
+
+    async def event_stream() -> AsyncIterator[str]:
+        fragments = asyncio.Queue()
+        generation = asyncio.create_task(generate(fragments))
+        try:
+            while True:
+                fragment = await fragments.get()
+                if fragment is None:
+                    break
+                if await request.is_disconnected():
+                    logger.info("Client disconnected, cancelling generation")
+                    break
+                yield fragment
+        finally:
+            # Also reached when the server cancels the stream on disconnect
+            generation.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,151 @@
+"""Benchmark the local sentence-transformers embedding backend: the chunks
+per second it embeds at ingestion, and the latency of embedding a single
+query, for several torch thread counts.
+
+Chunks are synthetic rulebook text of about CHUNK_MAX_TOKENS tokens. The
+thread count is global to the process, so every count runs in a process of
+its own.
+
+Usage: python -m benchmarks.bench_local_embedding [--model NAME]
+    [--chunks 512] [--queries 50] [--threads 1 2 4] [--quantize]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+from typing import Any, Dict, List
+
+from utils import enums
+from benchmarks.corpus import WORDS
+
+
+def _percentile(latencies: List[float], p: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def run(
+    model: str,
+    chunks: int,
+    queries: int,
+    threads: int,
+    quantize: bool = False,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Time the embedding of chunks and of single queries.
+
+    Parameters
+    ----------
+    model : str
+        The name or path of the sentence-transformers model.
+    chunks : int
+        The number of chunks embedded in one call.
+    queries : int
+        The number of queries embedded one at a time.
+    threads : int
+        The number of torch threads.
+    quantize : bool, optional
+        Whether to quantize the linear layers to int8, by default False.
+    seed : int, optional
+        The seed of the texts, by default 0.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The chunks per second, and the query latency percentiles in
+        milliseconds.
+    """
+    from services.local_embedding_function import (
+        SentenceTransformerEmbeddingFunction,
+    )
+
+    function = SentenceTransformerEmbeddingFunction(
+        model_name=model, num_threads=threads, quantize=quantize
+    )
+    rng = random.Random(seed)
+    tokens = enums.CHUNK_MAX_TOKENS
+    texts = [
+        " ".join(rng.choices(WORDS, k=rng.randint(tokens // 2, tokens)))
+        for _ in range(chunks)
+    ]
+    query_texts = [
+        " ".join(rng.choices(WORDS, k=rng.randint(3, 12)))
+        for _ in range(queries)
+    ]
+    # Warm up the model
+    function.embed_matrix(query_texts[:1])
+
+    start = time.perf_counter()
+    function.embed_matrix(texts)
+    elapsed = time.perf_counter() - start
+    latencies = []
+    for query_text in query_texts:
+        start = time.perf_counter()
+        function.embed_matrix([query_text])
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    return {
+        "threads": function.num_threads,
+        "chunks_per_second": chunks / elapsed,
+        "p50_ms": _percentile(latencies, 0.5),
+        "p99_ms": _percentile(latencies, 0.99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=enums.LOCAL_EMBEDDING_MODEL)
+    parser.add_argument("--chunks", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument(
+        "--child", action="store_true", help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.child:
+        result = run(
+            args.model,
+            args.chunks,
+            args.queries,
+            args.threads[0],
+            args.quantize,
+        )
+        print(json.dumps(result))
+        return
+
+    print(
+        f"{'threads':<9}{'chunks/s':>10}{'query p50 ms':>14}"
+        f"{'query p99 ms':>14}"
+    )
+    for threads in args.threads:
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.bench_local_embedding",
+            "--child",
+            "--model",
+            args.model,
+            "--chunks",
+            str(args.chunks),
+            "--queries",
+            str(args.queries),
+            "--threads",
+            str(threads),
+        ]
+        if args.quantize:
+            command.append("--quantize")
+        output = subprocess.run(
+            command, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{result['threads']:<9}{result['chunks_per_second']:>10.1f}"
+            f"{result['p50_ms']:>14.1f}{result['p99_ms']:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""Benchmark every stage of ingestion and querying on a synthetic corpus,
+without any network access: rulebook PDFs are generated with pymupdf,
+embeddings come from a deterministic hashing function and answers from a
+stub model.
+
+Results are written as JSON, and compared with a previous run if given, so
+that regressions show up run over run.
+
+Usage: python -m benchmarks.bench_pipeline [--books 4] [--pages 40]
+    [--queries 200] [--output results.json] [--baseline previous.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import platform
+import statistics
+from itertools import batched
+from unittest import mock
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from chromadb import EphemeralClient
+from chromadb.config import Settings
+
+from utils import enums
+from models.query import Query
+from services import dependencies
+from services.retriever import Retriever
+from services.chunker import MarkdownChunker
+from services.chromadb import BulkWriter
+from services.lexical_index import LexicalIndex
+from services.extraction_cache import ExtractionCache
+from services.context_builder import ContextBuilder
+from services.document_processor import DocumentProcessor
+from services.embedding_generator import EmbeddingGenerator
+from benchmarks.corpus import WORDS, generate_rulebooks
+from benchmarks.fakes import HashingEmbeddingFunction, StubGenerativeModel
+
+GAME_SYSTEM = "Dragonbane"
+
+
+def _stage(name: str, seconds: float, items: int, unit: str) -> Dict:
+    """The timing of a stage, with its throughput."""
+    return {
+        "name": name,
+        "seconds": seconds,
+        unit: items,
+        f"{unit}_per_second": items / seconds if seconds else 0.0,
+    }
+
+
+def _latencies(name: str, latencies: List[float]) -> Dict[str, Any]:
+    """The distribution of per-query latencies, in milliseconds."""
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    return {
+        "name": name,
+        "queries": len(latencies),
+        "mean_ms": statistics.fmean(latencies),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def run(
+    books: int = 4,
+    pages: int = 40,
+    queries: int = 200,
+    seed: int = 0,
+    workdir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Generate a corpus and time every stage of ingesting and querying it.
+
+    Parameters
+    ----------
+    books : int, optional
+        The number of PDFs, by default 4.
+    pages : int, optional
+        The number of pages per PDF, by default 40.
+    queries : int, optional
+        The number of queries answered end to end, by default 200.
+    seed : int, optional
+        The seed of the corpus and the queries, by default 0.
+    workdir : Optional[str], optional
+        The folder the PDFs and the lexical index are written to. If None, a
+        temporary folder is used, by default None.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The configuration, environment and results of the run.
+    """
+    with tempfile.TemporaryDirectory(dir=workdir) as root:
+        folder = os.path.join(root, GAME_SYSTEM)
+        start = time.perf_counter()
+        filepaths = generate_rulebooks(
+            folder, GAME_SYSTEM, books=books, pages=pages, seed=seed
+        )
+        generation = time.perf_counter() - start
+
+        stages = []
+        processor = DocumentProcessor(base_folder=folder)
+        for parallel in (False, True):
+            start = time.perf_counter()
+            documents = processor.process_documents(parallel=parallel)
+            stages.append(
+                _stage(
+                    "process_documents" + (" (parallel)" if parallel else ""),
+                    time.perf_counter() - start,
+                    len(documents),
+                    "pages",
+                )
+            )
+
+        # The fast plain text mode, then a rerun read from a filled
+        # extraction cache
+        cache = ExtractionCache(path=os.path.join(root, "extraction_cache"))
+        DocumentProcessor(base_folder=folder, cache=cache).process_documents()
+        for name, processor in (
+            ("text", DocumentProcessor(base_folder=folder, mode="text")),
+            ("cached", DocumentProcessor(base_folder=folder, cache=cache)),
+        ):
+            start = time.perf_counter()
+            count = len(processor.process_documents())
+            stages.append(
+                _stage(
+                    f"process_documents ({name})",
+                    time.perf_counter() - start,
+                    count,
+                    "pages",
+                )
+            )
+
+        start = time.perf_counter()
+        chunks = list(MarkdownChunker().chunk_documents(documents))
+        stages.append(
+            _stage(
+                "chunking", time.perf_counter() - start, len(chunks), "chunks"
+            )
+        )
+
+        embedding_function = HashingEmbeddingFunction()
+        generator = EmbeddingGenerator(embedding_function=embedding_function)
+        start = time.perf_counter()
+        embeddings = np.concatenate(
+            [
+                generator.generate_embeddings(list(batch))
+                for batch in batched(chunks, enums.INGESTION_BATCH_SIZE)
+            ]
+        )
+        stages.append(
+            _stage(
+                "generate_embeddings",
+                time.perf_counter() - start,
+                len(embeddings),
+                "chunks",
+            )
+        )
+
+        client = EphemeralClient(
+            settings=Settings(anonymized_telemetry=False)
+        )
+        collection = client.create_collection(
+            name="bench_pipeline", embedding_function=embedding_function
+        )
+        start = time.perf_counter()
+        with BulkWriter(collection) as writer:
+            writer.write(
+                ids=[chunk.id for chunk in chunks],
+                embeddings=embeddings,
+                metadatas=[chunk.metadata for chunk in chunks],
+                documents=[chunk.page_content for chunk in chunks],
+            )
+        stages.append(
+            _stage(
+                "chroma_upsert",
+                time.perf_counter() - start,
+                collection.count(),
+                "chunks",
+            )
+        )
+
+        index_path = os.path.join(root, "lexical_index")
+        start = time.perf_counter()
+        LexicalIndex.build(
+            index_path,
+            ((chunk.id, chunk.page_content) for chunk in chunks),
+        )
+        stages.append(
+            _stage(
+                "lexical_index_build",
+                time.perf_counter() - start,
+                len(chunks),
+                "chunks",
+            )
+        )
+
+        # Answer queries through the endpoint, with the clients it gets from
+        # the dependencies replaced by the benchmark's
+        import app
+
+        lexical_index = LexicalIndex.load(index_path)
+        retriever = Retriever(
+            collection=collection, lexical_index=lexical_index
+        )
+        model = StubGenerativeModel()
+        rng = random.Random(seed + 1)
+        query_texts = [
+            " ".join(rng.choices(WORDS, k=rng.randint(2, 8)))
+            for _ in range(queries)
+        ]
+        latencies = []
+        with mock.patch.multiple(
+            dependencies,
+            get_retriever=lambda: retriever,
+            get_context_builder=lambda: ContextBuilder(),
+            get_model=lambda: model,
+        ):
+            for query_text in query_texts:
+                start = time.perf_counter()
+                app.handle_query(Query(query=query_text))
+                latencies.append((time.perf_counter() - start) * 1000.0)
+        lexical_index.close()
+
+    return {
+        "config": {
+            "books": books,
+            "pages": pages,
+            "queries": queries,
+            "seed": seed,
+            "chunk_max_tokens": enums.CHUNK_MAX_TOKENS,
+            "ingestion_batch_size": enums.INGESTION_BATCH_SIZE,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "corpus": {
+            "files": len(filepaths),
+            "pages": len(documents),
+            "chunks": len(chunks),
+            "generation_seconds": generation,
+        },
+        "stages": stages,
+        "queries": _latencies("handle_query", latencies),
+        "prompt_characters_per_query": (
+            model.prompt_characters / model.calls if model.calls else 0
+        ),
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Describe the change of every timing relative to a previous run.
+
+    Parameters
+    ----------
+    results : Dict[str, Any]
+        The results of this run.
+    baseline : Dict[str, Any]
+        The results of the previous run.
+
+    Returns
+    -------
+    List[str]
+        One line per stage and latency percentile found in both runs.
+    """
+    lines = []
+    if results["config"] != baseline.get("config"):
+        lines.append("warning: the runs have different configurations")
+    previous = {stage["name"]: stage for stage in baseline.get("stages", [])}
+    for stage in results["stages"]:
+        before = previous.get(stage["name"])
+        if before and before["seconds"]:
+            change = stage["seconds"] / before["seconds"] - 1.0
+            lines.append(
+                f"{stage['name']:<28}{before['seconds']:>10.3f}s"
+                f"{stage['seconds']:>10.3f}s{change:>+9.1%}"
+            )
+    for key in ("mean_ms", "p50_ms", "p95_ms", "p99_ms"):
+        before = baseline.get("queries", {}).get(key)
+        if before:
+            after = results["queries"][key]
+            lines.append(
+                f"{'handle_query ' + key:<28}{before:>9.2f}ms"
+                f"{after:>9.2f}ms{after / before - 1.0:>+9.1%}"
+            )
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--books", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="Write the results to this JSON file."
+    )
+    parser.add_argument(
+        "--baseline",
+        help="Compare the results with those of a previous JSON file.",
+    )
+    args = parser.parse_args(argv)
+
+    results = run(
+        books=args.books,
+        pages=args.pages,
+        queries=args.queries,
+        seed=args.seed,
+    )
+    print(f"{'stage':<28}{'seconds':>10}{'throughput':>22}")
+    for stage in results["stages"]:
+        unit = "pages" if "pages" in stage else "chunks"
+        print(
+            f"{stage['name']:<28}{stage['seconds']:>10.3f}"
+            f"{stage[f'{unit}_per_second']:>14.0f} {unit}/s"
+        )
+    queries = results["queries"]
+    print(
+        f"{'handle_query':<28}mean {queries['mean_ms']:.2f}ms, "
+        f"p50 {queries['p50_ms']:.2f}ms, p95 {queries['p95_ms']:.2f}ms, "
+        f"p99 {queries['p99_ms']:.2f}ms"
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\n{'compared to ' + args.baseline:<28}")
+        for line in compare(results, baseline):
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    # The parallel extraction spawns workers, which import this module
+    sys.exit(main())
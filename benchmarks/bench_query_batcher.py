@@ -0,0 +1,216 @@
+"""Benchmark the throughput and tail latency of vector searches made by many
+concurrent users, with the QueryBatcher coalescing them into multi-query
+searches and without it.
+
+Every user sends its queries one after the other, as `/query` requests
+would. The query texts are embedded by a simulated remote embedding API with
+a round trip per call and a cap on the calls in flight, which is where
+batching saves time; the search itself runs in a local Chroma collection.
+
+Usage: python -m benchmarks.bench_query_batcher [--chunks 2000]
+    [--users 1 10 50 100] [--queries-per-user 10] [--round-trip-ms 20]
+    [--max-in-flight 8]
+"""
+
+import time
+import random
+import argparse
+import threading
+from typing import Any, Callable, Dict, List
+
+from chromadb import EphemeralClient
+from chromadb.config import Settings
+
+from services.query_batcher import QueryBatcher
+from benchmarks.bench_retrieval import WORDS
+from benchmarks.fakes import HashingEmbeddingFunction, RemoteEmbeddingFunction
+
+
+def build_collection(
+    chunks: int, embedding_function: RemoteEmbeddingFunction, seed: int = 0
+) -> Any:
+    """Create an in-memory collection of synthetic chunks, embedding them
+    without the simulated latency.
+    """
+    rng = random.Random(seed)
+    client = EphemeralClient(settings=Settings(anonymized_telemetry=False))
+    collection = client.get_or_create_collection(
+        name="bench_query_batcher", embedding_function=embedding_function
+    )
+    local = embedding_function.embedding_function
+    for start in range(0, chunks, 500):
+        ids = [f"chunk-{i}" for i in range(start, min(start + 500, chunks))]
+        documents = [" ".join(rng.choices(WORDS, k=120)) for _ in ids]
+        collection.upsert(
+            ids=ids,
+            documents=documents,
+            embeddings=local(documents),
+            metadatas=[{"page_number": i} for i in range(len(ids))],
+        )
+    return collection
+
+
+def _percentile(latencies: List[float], p: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def run(
+    name: str,
+    search: Callable[[str], Any],
+    users: int,
+    queries_per_user: int,
+    seed: int = 0,
+) -> Dict[str, Any]:
+    """Time the searches of concurrent users.
+
+    Parameters
+    ----------
+    name : str
+        The name of the configuration.
+    search : Callable[[str], Any]
+        Searches the collection for a query text.
+    users : int
+        The number of concurrent users.
+    queries_per_user : int
+        The number of queries every user sends in sequence.
+    seed : int, optional
+        The seed of the query texts, by default 0.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The throughput in queries per second, and the latency percentiles
+        in milliseconds.
+    """
+    rng = random.Random(seed)
+    queries = [
+        [" ".join(rng.choices(WORDS, k=6)) for _ in range(queries_per_user)]
+        for _ in range(users)
+    ]
+    latencies: List[float] = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(users + 1)
+
+    def user(query_texts: List[str]) -> None:
+        barrier.wait()
+        for query_text in query_texts:
+            start = time.perf_counter()
+            search(query_text)
+            elapsed = (time.perf_counter() - start) * 1000.0
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [
+        threading.Thread(target=user, args=(query_texts,))
+        for query_texts in queries
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "name": name,
+        "users": users,
+        "queries_per_second": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 0.5),
+        "p99_ms": _percentile(latencies, 0.99),
+    }
+
+
+def compare(
+    chunks: int = 2000,
+    users: List[int] = (1, 10, 50, 100),
+    queries_per_user: int = 10,
+    round_trip_ms: float = 20.0,
+    max_in_flight: int = 8,
+    top_k: int = 10,
+) -> List[Dict[str, Any]]:
+    """Run every number of users with batching off, then on.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The results of every run.
+    """
+    embedding_function = RemoteEmbeddingFunction(
+        HashingEmbeddingFunction(),
+        round_trip_ms=round_trip_ms,
+        max_in_flight=max_in_flight,
+    )
+    collection = build_collection(chunks, embedding_function)
+    results = []
+    for count in users:
+        results.append(
+            run(
+                "unbatched",
+                lambda query_text: collection.query(
+                    query_texts=[query_text], n_results=top_k
+                ),
+                count,
+                queries_per_user,
+            )
+        )
+        batcher = QueryBatcher(collection)
+        try:
+            results.append(
+                run(
+                    "batched",
+                    lambda query_text: batcher.query(
+                        query_text, n_results=top_k
+                    ),
+                    count,
+                    queries_per_user,
+                )
+            )
+        finally:
+            batcher.close()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[1, 10, 50, 100]
+    )
+    parser.add_argument("--queries-per-user", type=int, default=10)
+    parser.add_argument(
+        "--round-trip-ms",
+        type=float,
+        default=20.0,
+        help="Simulated latency of every call to the embedding API.",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=8,
+        help="Simulated cap on the embedding calls served at once.",
+    )
+    args = parser.parse_args()
+
+    results = compare(
+        chunks=args.chunks,
+        users=args.users,
+        queries_per_user=args.queries_per_user,
+        round_trip_ms=args.round_trip_ms,
+        max_in_flight=args.max_in_flight,
+    )
+    print(
+        f"{'path':<12}{'users':>7}{'queries/s':>11}"
+        f"{'p50 ms':>10}{'p99 ms':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['name']:<12}{result['users']:>7}"
+            f"{result['queries_per_second']:>11.1f}"
+            f"{result['p50_ms']:>10.1f}"
+            f"{result['p99_ms']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Benchmark the latency of the cross-encoder rerank stage, and the prompt
+tokens it saves by passing fewer chunks to the generative model.
+
+Candidates are synthetic chunks of rulebook text. Every query is reranked
+twice: the first call runs the model, the second is answered from the pair
+score cache.
+
+Usage: python -m benchmarks.bench_reranker [--model NAME] [--queries 20]
+    [--top-n 5] [--oversample 2 4 8]
+"""
+import time
+import random
+import argparse
+import statistics
+from typing import List
+
+from utils import enums
+from models.retrieval import RetrievedChunk
+from services.context_builder import ContextBuilder
+from services.embedding_client import estimate_tokens
+from services.prompt_builder import build_prompt
+from services.reranker import CrossEncoderReranker
+from benchmarks.corpus import WORDS
+
+
+def make_chunks(
+    count: int, rng: random.Random, tokens: int = enums.CHUNK_MAX_TOKENS
+) -> List[RetrievedChunk]:
+    """Generate candidate chunks of about `tokens` tokens each."""
+    chunks = []
+    for i in range(count):
+        words = rng.choices(WORDS, k=rng.randint(tokens // 2, tokens))
+        chunks.append(
+            RetrievedChunk(
+                id=f"chunk-{i}",
+                text=" ".join(words),
+                title="Rulebook",
+                page_number=i + 1,
+            )
+        )
+    return chunks
+
+
+def _percentile(latencies: List[float], p: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default=enums.RERANK_MODEL)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--top-n", type=int, default=enums.RERANK_TOP_N)
+    parser.add_argument(
+        "--oversample", type=int, nargs="+", default=[2, 4, 8]
+    )
+    args = parser.parse_args()
+
+    reranker = CrossEncoderReranker(model_name=args.model, top_n=args.top_n)
+    builder = ContextBuilder(token_budget=None)
+    rng = random.Random(0)
+    print(
+        f"{'candidates':<12}{'p50 ms':>10}{'p95 ms':>10}{'cached ms':>11}"
+        f"{'prompt tokens':>15}{'reranked':>10}"
+    )
+    for oversample in args.oversample:
+        candidates = args.top_n * oversample
+        cold = []
+        cached = []
+        tokens = []
+        reranked_tokens = []
+        for _ in range(args.queries):
+            query_text = " ".join(rng.choices(WORDS, k=rng.randint(3, 8)))
+            chunks = make_chunks(candidates, rng)
+            start = time.perf_counter()
+            best = reranker.rerank(query_text, chunks)
+            cold.append((time.perf_counter() - start) * 1000.0)
+            start = time.perf_counter()
+            reranker.rerank(query_text, chunks)
+            cached.append((time.perf_counter() - start) * 1000.0)
+            for selected, counts in (
+                (chunks, tokens),
+                (best, reranked_tokens),
+            ):
+                prompt = build_prompt(
+                    query_text, builder.build(query_text, selected)
+                )
+                counts.append(estimate_tokens(prompt))
+        print(
+            f"{candidates:<12}{_percentile(cold, 0.5):>10.1f}"
+            f"{_percentile(cold, 0.95):>10.1f}"
+            f"{_percentile(cached, 0.5):>11.2f}"
+            f"{statistics.fmean(tokens):>15.0f}"
+            f"{statistics.fmean(reranked_tokens):>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Benchmark the number of storage calls and the latency of retrieving the
+chunks of a query, comparing the per-chunk `get` loop `handle_query` used to
+run with the single round trip of the Retriever.
+
+Usage: python -m benchmarks.bench_retrieval [--chunks 2000] [--queries 200]
+"""
+import time
+import random
+import argparse
+import statistics
+from typing import Any, Callable, Dict, List
+
+from chromadb import EphemeralClient
+from chromadb.config import Settings
+
+from services.retriever import Retriever
+from benchmarks.fakes import HashingEmbeddingFunction
+
+WORDS = (
+    "dragon bane boon roll skill attack parry dodge weapon armor spell "
+    "magic monster treasure journey camp rest heal damage critical "
+    "initiative round turn movement ranged melee shield helmet bow sword "
+    "torch rope ration coin silver gold kin human elf dwarf halfling mallard"
+).split()
+
+
+class CountingCollection:
+    """Wraps a collection to count, and optionally delay, every call made to
+    the storage layer.
+    """
+
+    def __init__(self, collection: Any, round_trip_ms: float = 0.0) -> None:
+        self.collection = collection
+        self.round_trip = round_trip_ms / 1000.0
+        self.calls = 0
+
+    def _call(self, method: Callable, **kwargs: Any) -> Any:
+        self.calls += 1
+        if self.round_trip:
+            time.sleep(self.round_trip)
+        return method(**kwargs)
+
+    def query(self, **kwargs: Any) -> Dict[str, Any]:
+        return self._call(self.collection.query, **kwargs)
+
+    def get(self, **kwargs: Any) -> Dict[str, Any]:
+        return self._call(self.collection.get, **kwargs)
+
+
+def build_collection(chunks: int, seed: int = 0) -> Any:
+    """Create an in-memory collection of synthetic rulebook chunks."""
+    rng = random.Random(seed)
+    client = EphemeralClient(settings=Settings(anonymized_telemetry=False))
+    collection = client.create_collection(
+        name="bench_retrieval",
+        embedding_function=HashingEmbeddingFunction(),
+    )
+    for start in range(0, chunks, 500):
+        ids = [f"chunk-{i}" for i in range(start, min(start + 500, chunks))]
+        collection.add(
+            ids=ids,
+            documents=[" ".join(rng.choices(WORDS, k=120)) for _ in ids],
+            metadatas=[
+                {
+                    "title": "Core Rules",
+                    "game_system": "Dragonbane",
+                    "edition": "1e",
+                    "filepath": "Dragonbane - Core Rules.pdf",
+                    "page_number": i,
+                }
+                for i in range(start, start + len(ids))
+            ],
+        )
+    return collection
+
+
+def retrieve_per_chunk(
+    collection: CountingCollection, query_text: str, top_k: int
+) -> List[str]:
+    """The retrieval loop `handle_query` used to run."""
+    results = collection.query(query_texts=[query_text], n_results=top_k)
+    documents = []
+    for doc_id in results["ids"][0]:
+        document = collection.get(
+            ids=[doc_id], include=["documents", "metadatas"]
+        )
+        documents.append(document["documents"][0])
+    return documents
+
+
+def retrieve_single_round_trip(
+    collection: CountingCollection, query_text: str, top_k: int
+) -> List[str]:
+    """The Retriever's single query call."""
+    retriever = Retriever(collection=collection)
+    return [
+        chunk.text
+        for chunk in retriever.retrieve(query_text=query_text, top_k=top_k)
+    ]
+
+
+def run(
+    name: str,
+    retrieve: Callable,
+    collection: CountingCollection,
+    queries: List[str],
+    top_k: int,
+) -> Dict[str, Any]:
+    """Time a retrieval function over every query."""
+    collection.calls = 0
+    latencies = []
+    for query_text in queries:
+        start = time.perf_counter()
+        retrieve(collection, query_text, top_k)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    latencies.sort()
+    return {
+        "name": name,
+        "storage_calls_per_query": collection.calls / len(queries),
+        "mean_ms": statistics.fmean(latencies),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=15)
+    parser.add_argument(
+        "--round-trip-ms",
+        type=float,
+        default=0.0,
+        help="Simulated latency of each storage call, e.g. for a remote "
+        "Chroma server.",
+    )
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    collection = CountingCollection(
+        build_collection(args.chunks), round_trip_ms=args.round_trip_ms
+    )
+    queries = [" ".join(rng.choices(WORDS, k=6)) for _ in range(args.queries)]
+    results = [
+        run(
+            "per-chunk get (before)",
+            retrieve_per_chunk,
+            collection,
+            queries,
+            args.top_k,
+        ),
+        run(
+            "single round trip (after)",
+            retrieve_single_round_trip,
+            collection,
+            queries,
+            args.top_k,
+        ),
+    ]
+    print(
+        f"{'path':<28}{'calls/query':>12}{'mean ms':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['name']:<28}"
+            f"{result['storage_calls_per_query']:>12.1f}"
+            f"{result['mean_ms']:>10.2f}"
+            f"{result['p50_ms']:>10.2f}"
+            f"{result['p95_ms']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
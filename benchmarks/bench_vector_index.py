@@ -0,0 +1,133 @@
+"""Benchmark the recall, latency and memory of the two-stage VectorIndex
+against exact search over the full-precision embeddings.
+
+The synthetic embeddings are clustered, and their variance decays along the
+dimensions as in Matryoshka-trained models, whose leading dimensions carry
+most of the signal. Queries are noisy copies of indexed embeddings.
+
+Usage: python -m benchmarks.bench_vector_index [--chunks 50000]
+    [--dimensions 768] [--queries 200] [--top-k 15]
+"""
+import time
+import tempfile
+import argparse
+import statistics
+from typing import Any, Dict, List
+
+import numpy as np
+
+from services.vector_index import VectorIndex
+
+
+def make_embeddings(
+    count: int, dimensions: int, clusters: int = 200, seed: int = 0
+) -> np.ndarray:
+    """Generate clustered unit-length embeddings with a decaying spectrum."""
+    rng = np.random.default_rng(seed)
+    spectrum = 1.0 / np.sqrt(1.0 + np.arange(dimensions) / 16.0)
+    centers = rng.normal(size=(clusters, dimensions)) * spectrum
+    labels = rng.integers(0, clusters, size=count)
+    vectors = (
+        centers[labels]
+        + 0.5 * rng.normal(size=(count, dimensions)) * spectrum
+    )
+    vectors = vectors.astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def exact_search(vectors: np.ndarray, query: np.ndarray, k: int) -> List[int]:
+    """The rows of the k nearest neighbors by cosine similarity."""
+    scores = vectors @ (query / np.linalg.norm(query))
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])].tolist()
+
+
+def run(
+    index: VectorIndex,
+    queries: np.ndarray,
+    truth: List[List[int]],
+    k: int,
+    oversample: int,
+) -> Dict[str, Any]:
+    """Measure the recall@k and latency of the index."""
+    rows = {chunk_id: row for row, chunk_id in enumerate(index.ids)}
+    recalls = []
+    latencies = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        hits = index.search(query, k=k, oversample=oversample)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        found = {rows[hit.id] for hit in hits}
+        recalls.append(len(found.intersection(expected)) / k)
+    latencies.sort()
+    return {
+        "recall": statistics.fmean(recalls),
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=15)
+    args = parser.parse_args()
+
+    vectors = make_embeddings(args.chunks, args.dimensions)
+    rng = np.random.default_rng(1)
+    targets = rng.integers(0, args.chunks, size=args.queries)
+    queries = vectors[targets] + 0.05 * rng.normal(
+        size=(args.queries, args.dimensions)
+    ).astype(np.float32)
+
+    latencies = []
+    truth = []
+    for query in queries:
+        start = time.perf_counter()
+        truth.append(exact_search(vectors, query, args.top_k))
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    latencies.sort()
+    print(
+        f"{'search':<28}{'memory MB':>10}{'recall@k':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}"
+    )
+    print(
+        f"{'exact float32':<28}{vectors.nbytes / 1e6:>10.1f}{1.0:>10.3f}"
+        f"{latencies[len(latencies) // 2]:>10.2f}"
+        f"{latencies[int(len(latencies) * 0.95) - 1]:>10.2f}"
+    )
+
+    ids = [f"chunk-{i}" for i in range(args.chunks)]
+    with tempfile.TemporaryDirectory() as root:
+        for dimensions in (64, 128, 256):
+            for quantize in (False, True):
+                path = f"{root}/{dimensions}-{quantize}"
+                VectorIndex.build(
+                    path,
+                    zip(ids, vectors),
+                    prefilter_dimensions=dimensions,
+                    quantize=quantize,
+                )
+                index = VectorIndex.load(path)
+                for oversample in (1, 4, 10):
+                    result = run(
+                        index, queries, truth, args.top_k, oversample
+                    )
+                    name = (
+                        f"{dimensions}-d {'int8' if quantize else 'f32'}"
+                        f" x{oversample}"
+                    )
+                    print(
+                        f"{name:<28}{index.prefilter_bytes / 1e6:>10.1f}"
+                        f"{result['recall']:>10.3f}"
+                        f"{result['p50_ms']:>10.2f}"
+                        f"{result['p95_ms']:>10.2f}"
+                    )
+                index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Generate synthetic rulebook PDFs with headings, paragraphs and tables, so
+that the benchmarks exercise extraction and chunking on realistic layouts
+without shipping any real rulebook.
+"""
+import os
+import random
+from typing import List
+
+import pymupdf
+
+WORDS = (
+    "dragon bane boon roll skill attack parry dodge weapon armor spell "
+    "magic monster treasure journey camp rest heal damage critical "
+    "initiative round turn movement ranged melee shield helmet bow sword "
+    "torch rope ration coin silver gold kin human elf dwarf halfling mallard "
+    "willpower strength agility constitution intelligence charisma mech "
+    "reactor pilot squadron hangar salvage sensor thruster"
+).split()
+SECTIONS = (
+    "Combat",
+    "Magic",
+    "Skills",
+    "Equipment",
+    "Bestiary",
+    "Journeys",
+    "Characters",
+    "Advancement",
+)
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 56
+LINE_HEIGHT = 14
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(8, 18))
+    return " ".join(words).capitalize() + "."
+
+
+def _write_page(page: pymupdf.Page, rng: random.Random, number: int) -> None:
+    """Fill a page with a heading, paragraphs and sometimes a table."""
+    y = MARGIN + 20
+    page.insert_text(
+        (MARGIN, y), f"{rng.choice(SECTIONS)} {number}", fontsize=20
+    )
+    y += 32
+    while y < PAGE_HEIGHT - MARGIN - 6 * LINE_HEIGHT:
+        if rng.random() < 0.2:
+            # A subheading
+            page.insert_text(
+                (MARGIN, y), rng.choice(SECTIONS).upper(), fontsize=14
+            )
+            y += 22
+        if rng.random() < 0.15:
+            # A two-column table
+            for row in range(rng.randint(3, 6)):
+                page.insert_text((MARGIN, y), f"{row + 1}", fontsize=10)
+                page.insert_text(
+                    (MARGIN + 60, y),
+                    " ".join(rng.choices(WORDS, k=5)),
+                    fontsize=10,
+                )
+                y += LINE_HEIGHT
+            y += LINE_HEIGHT
+            continue
+        paragraph = " ".join(_sentence(rng) for _ in range(rng.randint(2, 5)))
+        words = paragraph.split()
+        line = []
+        for word in words:
+            line.append(word)
+            if len(" ".join(line)) > 85:
+                page.insert_text((MARGIN, y), " ".join(line), fontsize=10)
+                y += LINE_HEIGHT
+                line = []
+        if line:
+            page.insert_text((MARGIN, y), " ".join(line), fontsize=10)
+            y += LINE_HEIGHT
+        y += LINE_HEIGHT
+
+
+def generate_rulebooks(
+    folder: str,
+    game_system: str = "Dragonbane",
+    books: int = 2,
+    pages: int = 20,
+    seed: int = 0,
+) -> List[str]:
+    """Write synthetic rulebook PDFs into a game system folder.
+
+    Parameters
+    ----------
+    folder : str
+        The game system folder to write the PDFs into.
+    game_system : str, optional
+        The game system named in the filenames, by default "Dragonbane".
+    books : int, optional
+        The number of PDFs, by default 2.
+    pages : int, optional
+        The number of pages per PDF, by default 20.
+    seed : int, optional
+        The seed of the generated text, by default 0.
+
+    Returns
+    -------
+    List[str]
+        The filepaths of the PDFs.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    filepaths = []
+    for book in range(books):
+        document = pymupdf.open()
+        for number in range(pages):
+            page = document.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+            _write_page(page, rng, number + 1)
+        filepath = os.path.join(
+            folder, f"{game_system} - Rulebook {book + 1} - 1e.pdf"
+        )
+        document.save(filepath)
+        document.close()
+        filepaths.append(filepath)
+    return filepaths
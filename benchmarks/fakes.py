@@ -0,0 +1,120 @@
+"""Deterministic stand-ins for the remote services used by the benchmarks."""
+
+import re
+import math
+import time
+import hashlib
+import threading
+from typing import List
+
+from chromadb import Documents, EmbeddingFunction, Embeddings
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbeddingFunction(EmbeddingFunction):
+    """Embeds texts by hashing their lowercased tokens into a fixed number of
+    buckets, so that texts sharing words have similar vectors without calling
+    any remote API.
+    """
+
+    def __init__(self, dimensions: int = 768) -> None:
+        """Initializes the HashingEmbeddingFunction.
+
+        Parameters
+        ----------
+        dimensions : int, optional
+            The size of the output embeddings, by default 768.
+        """
+        self.dimensions = dimensions
+        self.calls = 0
+        self.texts = 0
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8)
+            value = int.from_bytes(digest.digest(), "little")
+            sign = 1.0 if value & 1 else -1.0
+            vector[(value >> 1) % self.dimensions] += sign
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def __call__(self, input: Documents) -> Embeddings:
+        self.calls += 1
+        self.texts += len(input)
+        return [self._embed(text) for text in input]
+
+
+class RemoteEmbeddingFunction(EmbeddingFunction):
+    """Wraps an embedding function to simulate a remote embedding API: every
+    call takes a fixed round trip plus a time per text, and at most
+    `max_in_flight` calls run at once, like requests to a rate-limited
+    endpoint.
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        round_trip_ms: float = 20.0,
+        per_text_ms: float = 0.2,
+        max_in_flight: int = 8,
+    ) -> None:
+        """Initializes the RemoteEmbeddingFunction.
+
+        Parameters
+        ----------
+        embedding_function : EmbeddingFunction
+            The function computing the embeddings.
+        round_trip_ms : float, optional
+            The simulated latency of every call, by default 20.0.
+        per_text_ms : float, optional
+            The simulated latency added per embedded text, by default 0.2.
+        max_in_flight : int, optional
+            The maximum number of calls served at once, by default 8.
+        """
+        self.embedding_function = embedding_function
+        self.round_trip = round_trip_ms / 1000.0
+        self.per_text = per_text_ms / 1000.0
+        self.calls = 0
+        self._slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._lock = threading.Lock()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        with self._slots:
+            with self._lock:
+                self.calls += 1
+            time.sleep(self.round_trip + self.per_text * len(input))
+            return self.embedding_function(input)
+
+
+class StubResponse:
+    """A generated response, or a fragment of a streamed one."""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class StubGenerativeModel:
+    """Answers every prompt with a fixed-length summary of it, after an
+    optional simulated latency, in place of the Gemini model.
+    """
+
+    def __init__(self, latency_ms: float = 0.0) -> None:
+        """Initializes the StubGenerativeModel.
+
+        Parameters
+        ----------
+        latency_ms : float, optional
+            The simulated generation latency, by default 0.0.
+        """
+        self.latency = latency_ms / 1000.0
+        self.calls = 0
+        self.prompt_characters = 0
+
+    def generate_content(self, contents: str, **kwargs) -> StubResponse:
+        self.calls += 1
+        self.prompt_characters += len(contents)
+        if self.latency:
+            time.sleep(self.latency)
+        return StubResponse(f"Answer from a prompt of {len(contents)} chars.")
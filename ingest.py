@@ -0,0 +1,91 @@
+"""Command line entry point to index the TTRPG rulebooks into the ChromaDB
+collection without starting the API.
+
+Usage: python ingest.py [--folder "Dragonbane"] [--pdf-root PATH] [--publish]
+"""
+import sys
+import logging
+import argparse
+from typing import List, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+try:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+except ImportError:
+    logger.warning(
+        "python-dotenv is not installed. Environment variables must be set "
+        "manually."
+    )
+
+from utils import enums
+from utils.file_lock import FileLock
+from services import dependencies
+from services.indexing import IndexState, run_ingestion
+from services.index_generations import IndexGenerations
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Index the pdf files of the game system folders.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]], optional
+        The command line arguments, by default `sys.argv[1:]`.
+
+    Returns
+    -------
+    int
+        The exit code, 0 if the ingestion succeeded.
+    """
+    parser = argparse.ArgumentParser(
+        description="Index the TTRPG rulebooks into the ChromaDB collection."
+    )
+    parser.add_argument(
+        "--folder",
+        action="append",
+        dest="folders",
+        help="A game system folder to index, may be repeated (default: "
+        "every folder in GAME_SYSTEM_FOLDERS).",
+    )
+    parser.add_argument(
+        "--pdf-root",
+        default=enums.PATH_TO_TTRPG_PDFS,
+        help="The folder containing the game system folders.",
+    )
+    parser.add_argument(
+        "--publish",
+        action="store_true",
+        help="Publish the index as a new generation for the workers of a "
+        "multi-worker server.",
+    )
+    args = parser.parse_args(argv)
+
+    # The index is written by the holder of the leader lock only, so this
+    # waits for a server ingesting into the same index
+    lock = FileLock(enums.INDEX_LEADER_LOCK_PATH)
+    if not lock.acquire(blocking=False):
+        logger.info("Waiting for the ingestion leader lock %s..." % lock.path)
+        lock.acquire()
+    try:
+        state = run_ingestion(
+            IndexState(), folders=args.folders, pdf_root=args.pdf_root
+        )
+        logger.info("Ingestion finished: %s" % state.to_dict())
+        if state.status != IndexState.READY:
+            return 1
+        if args.publish:
+            # No client may hold the index open while it is copied
+            dependencies.close_index()
+            IndexGenerations().publish(enums.CHROMA_DB_PATH)
+    finally:
+        lock.release()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
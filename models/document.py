@@ -1,11 +1,65 @@
 """Module to define the Document class."""
+import os
+import hashlib
 from uuid import uuid4
 from typing import Optional, Union, List
 
 
-class Document:
-    """Class to represent a document object.
+def relative_filepath(filepath: str) -> str:
+    """Normalize the filepath of a pdf file to its game system folder and
+    file name, so that it does not depend on where the pdf folder is
+    mounted.
+
+    Parameters
+    ----------
+    filepath : str
+        The filepath of the pdf file.
+
+    Returns
+    -------
+    str
+        The `<game system>/<file name>` path of the file.
+    """
+    path = os.path.normpath(os.path.abspath(filepath))
+    return "/".join(
+        (os.path.basename(os.path.dirname(path)), os.path.basename(path))
+    )
+
+
+def make_document_id(
+    file_hash: str, filepath: str, page_number: int, chunk_index: int = 0
+) -> str:
+    """Derive a stable document ID from the content and path of its source
+    file and its position in that file.
+
+    The path is part of the ID, so that identical files stored under
+    different paths do not overwrite each other's chunks.
+
+    Parameters
+    ----------
+    file_hash : str
+        The SHA-256 hex digest of the source file.
+    filepath : str
+        The filepath of the source file.
+    page_number : int
+        The page number of the document.
+    chunk_index : int, optional
+        The index of the chunk within the page, by default 0.
+
+    Returns
+    -------
+    str
+        The document ID.
     """
+    digest = hashlib.sha256(
+        f"{file_hash}\x1f{relative_filepath(filepath)}".encode("utf-8")
+    ).hexdigest()
+    return f"{digest[:32]}-p{page_number}-c{chunk_index}"
+
+
+class Document:
+    """Class to represent a document object."""
+
     @property
     def filepath(self) -> str:
         """The filepath of the document."""
@@ -31,6 +85,21 @@ class Document:
         """The page number of the document."""
         return self.metadata["page_number"]
 
+    @property
+    def file_hash(self) -> Optional[str]:
+        """The SHA-256 hex digest of the source file, if known."""
+        return self.metadata.get("file_hash")
+
+    @property
+    def chunk_index(self) -> int:
+        """The index of the chunk within the page."""
+        return self.metadata.get("chunk_index", 0)
+
+    @property
+    def heading_path(self) -> Optional[str]:
+        """The headings the chunk belongs to, outermost first, if known."""
+        return self.metadata.get("heading_path")
+
     def __init__(
         self,
         filepath: str,
@@ -39,6 +108,11 @@ class Document:
         game_system: str,
         edition: Optional[str] = "1e",
         page_number: int = 1,
+        file_hash: Optional[str] = None,
+        chunk_index: int = 0,
+        heading_path: Optional[str] = None,
+        start_offset: Optional[int] = None,
+        end_offset: Optional[int] = None,
     ) -> None:
         """Initialize a Document object with the specified attributes.
 
@@ -56,13 +130,42 @@ class Document:
             The edition of the game system, by default "1e".
         page_number : int, optional
             The page number of the document, by default 1.
+        file_hash : Optional[str], optional
+            The SHA-256 hex digest of the source file. If given, the ID of the
+            document is derived from it, the filepath, the page number and
+            the chunk index, otherwise a random ID is used, by default None.
+        chunk_index : int, optional
+            The index of the chunk within the page, by default 0.
+        heading_path : Optional[str], optional
+            The headings the chunk belongs to, outermost first, by default
+            None.
+        start_offset : Optional[int], optional
+            The offset of the first character of the chunk within the page,
+            by default None.
+        end_offset : Optional[int], optional
+            The offset after the last character of the chunk within the page,
+            by default None.
         """
         self.page_content = page_content
-        self.id = str(uuid4())
         self.metadata = {
             "title": title,
             "game_system": game_system,
             "edition": edition,
             "filepath": filepath,
             "page_number": page_number,
+            "chunk_index": chunk_index,
         }
+        # ChromaDB does not accept None metadata values
+        if heading_path is not None:
+            self.metadata["heading_path"] = heading_path
+        if start_offset is not None:
+            self.metadata["start_offset"] = start_offset
+        if end_offset is not None:
+            self.metadata["end_offset"] = end_offset
+        if file_hash:
+            self.metadata["file_hash"] = file_hash
+            self.id = make_document_id(
+                file_hash, filepath, page_number, chunk_index
+            )
+        else:
+            self.id = str(uuid4())
@@ -1,10 +1,55 @@
 """Module to define the Query class."""
-from typing import Optional
+from typing import Any, Dict, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
+
+from utils import enums
 
 
 class Query(BaseModel):
-    """A Pydantic model representing a query text."""
+    """A Pydantic model representing a query text, optionally restricted to
+    the documents of a game system, edition or title.
+    """
+
     query: str
     top_k: Optional[int] = 15
+    game_system: Optional[str] = None
+    edition: Optional[str] = None
+    title: Optional[str] = None
+
+    @field_validator("game_system")
+    @classmethod
+    def match_game_system(cls, game_system: Optional[str]) -> Optional[str]:
+        """Match the game system to its folder name, ignoring case, since
+        filters only match exact metadata values.
+        """
+        if game_system is None:
+            return None
+        for folder in enums.GAME_SYSTEM_FOLDERS:
+            if folder.casefold() == game_system.strip().casefold():
+                return folder
+        return game_system.strip()
+
+    def to_where(self) -> Optional[Dict[str, Any]]:
+        """Build the ChromaDB metadata filter of the query.
+
+        Returns
+        -------
+        Optional[Dict[str, Any]]
+            The filter matching every given field, or None if no field is
+            given.
+        """
+        conditions = [
+            {field: value}
+            for field, value in (
+                ("game_system", self.game_system),
+                ("edition", self.edition),
+                ("title", self.title),
+            )
+            if value
+        ]
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return {"$and": conditions}
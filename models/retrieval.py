@@ -0,0 +1,80 @@
+"""Module to define the RetrievedChunk class."""
+from typing import Any, Dict, Optional
+
+import numpy as np
+from pydantic import BaseModel, ConfigDict, field_validator
+
+
+class RetrievedChunk(BaseModel):
+    """A Pydantic model representing a document chunk retrieved for a query,
+    with the provenance of the chunk.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    id: str
+    text: str
+    distance: Optional[float] = None
+    # The cross-encoder score of the chunk, if reranked
+    rerank_score: Optional[float] = None
+    title: Optional[str] = None
+    game_system: Optional[str] = None
+    edition: Optional[str] = None
+    filepath: Optional[str] = None
+    page_number: Optional[int] = None
+    metadata: Dict[str, Any] = {}
+    # A float32 vector, often a row of the matrix of its result set
+    embedding: Optional[np.ndarray] = None
+
+    @field_validator("embedding", mode="before")
+    @classmethod
+    def as_float32(cls, embedding: Any) -> Optional[np.ndarray]:
+        """Convert the embedding to a float32 vector, without copying it if
+        it is one already.
+        """
+        if embedding is None:
+            return None
+        return np.asarray(embedding, dtype=np.float32)
+
+    @classmethod
+    def from_result(
+        cls,
+        id: str,
+        text: Optional[str],
+        metadata: Optional[Dict[str, Any]],
+        distance: Optional[float] = None,
+        embedding: Optional[np.ndarray] = None,
+    ) -> "RetrievedChunk":
+        """Create a RetrievedChunk from the fields of a ChromaDB result.
+
+        Parameters
+        ----------
+        id : str
+            The ID of the chunk.
+        text : Optional[str]
+            The text of the chunk.
+        metadata : Optional[Dict[str, Any]]
+            The metadata stored with the chunk.
+        distance : Optional[float], optional
+            The distance of the chunk to the query, by default None.
+        embedding : Optional[np.ndarray], optional
+            The stored embedding of the chunk, by default None.
+
+        Returns
+        -------
+        RetrievedChunk
+            The retrieved chunk.
+        """
+        metadata = metadata or {}
+        return cls(
+            id=id,
+            text=text or "",
+            distance=distance,
+            title=metadata.get("title"),
+            game_system=metadata.get("game_system"),
+            edition=metadata.get("edition"),
+            filepath=metadata.get("filepath"),
+            page_number=metadata.get("page_number"),
+            metadata=metadata,
+            embedding=embedding,
+        )
@@ -1,27 +1,82 @@
-"""Module to define the ChromaDB class."""
-from typing import Optional
+"""Module to define the ChromaDB class, and the BulkWriter class, which
+writes large sets of chunks into a collection in right-sized batches.
+"""
+import re
+import json
+import time
+import queue
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Union
 
-from chromadb import EmbeddingFunction, PersistentClient
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import chromadb
+from chromadb import Collection, EmbeddingFunction, PersistentClient
 from chromadb.config import Settings
+from chromadb.api.shared_system_client import SharedSystemClient
+
+from utils import enums, metrics
+from services.embedding_function import create_embedding_function
+
+# Estimated bytes of an embedding value in a request, as a JSON float
+_BYTES_PER_FLOAT = 12
+# Used when the client does not report its maximum batch size
+_DEFAULT_MAX_BATCH_SIZE = 5000
+# Marks the end of the writes in the queue of a background writer
+_STOP = object()
+# ChromaDB shares one system per path between the clients of a process,
+# and only exposes clearing them all, which breaks the clients left open.
+# The versions below keep them in a registry, where the system of a single
+# client can be stopped
+_CHROMA_VERSION = tuple(
+    int(part) for part in re.findall(r"\d+", chromadb.__version__)[:2]
+)
+_STOPPABLE_SYSTEMS = (0, 4) <= _CHROMA_VERSION < (0, 6) and isinstance(
+    getattr(SharedSystemClient, "_identifier_to_system", None), dict
+)
+# The error ChromaDB raises when a write holds more records than it accepts
+_BATCH_SIZE_ERROR = re.compile(r"exceeds (the )?maximum batch size", re.I)
+
 
-from utils import enums
-from services.embedding_function import GeminiEmbeddingFunction
+def shard_collection_name(collection_name: str, game_system: str) -> str:
+    """Name the collection holding the chunks of a single game system.
+
+    Parameters
+    ----------
+    collection_name : str
+        The name of the unsharded collection.
+    game_system : str
+        The game system of the shard.
+
+    Returns
+    -------
+    str
+        A valid ChromaDB collection name.
+    """
+    slug = re.sub(r"[^a-z0-9]+", "-", game_system.lower()).strip("-")
+    # ChromaDB names are at most 63 characters and end alphanumerically
+    return f"{collection_name}_{slug}"[:63].rstrip("-_")
 
 
 class ChromaDB:
+    """Opens the persistent ChromaDB client and the collection of document
+    chunks, embedded with the configured embedding backend.
+    """
 
     def __init__(
         self,
         embedding_function: Optional[EmbeddingFunction] = None,
         chroma_db_path: Optional[str] = enums.CHROMA_DB_PATH,
         collection_name: Optional[str] = enums.COLLECTION_NAME,
-        settings: Optional[Settings] = None
+        settings: Optional[Settings] = None,
     ) -> None:
-        if not embedding_function:
-            self.embedding_function = GeminiEmbeddingFunction(
-                model=enums.EMBEDDING_MODEL,
-                output_dimensionality=enums.OUTPUT_DIMENSIONALITY,
-            )
+        self.embedding_function = (
+            embedding_function or create_embedding_function()
+        )
 
         if not settings:
             self.settings = Settings(anonymized_telemetry=False)
@@ -32,6 +87,383 @@ class ChromaDB:
             path=chroma_db_path,
             settings=self.settings,
         )
+        self.collection_name = collection_name
         self.collection = self.chroma_client.get_or_create_collection(
-            name=enums.COLLECTION_NAME, embedding_function=embedding_function
+            name=collection_name,
+            embedding_function=self.embedding_function,
+        )
+        self.shards: Dict[str, Collection] = {}
+
+    def get_shard(self, game_system: str) -> Collection:
+        """Get or create the collection holding the chunks of a single game
+        system.
+
+        Parameters
+        ----------
+        game_system : str
+            The game system of the shard.
+
+        Returns
+        -------
+        Collection
+            The shard collection.
+        """
+        if game_system not in self.shards:
+            name = shard_collection_name(self.collection_name, game_system)
+            client = self.chroma_client
+            self.shards[game_system] = client.get_or_create_collection(
+                name=name, embedding_function=self.embedding_function
+            )
+        return self.shards[game_system]
+
+    def bulk_writer(
+        self, game_system: Optional[str] = None, background: bool = False
+    ) -> "BulkWriter":
+        """Create a writer upserting into the collection, or into the shard
+        of a game system, in batches the client accepts.
+
+        Parameters
+        ----------
+        game_system : Optional[str], optional
+            The game system of the shard, or None for the single collection,
+            by default None.
+        background : bool, optional
+            Whether to write in a background thread, by default False.
+
+        Returns
+        -------
+        BulkWriter
+            The writer.
+        """
+        collection = (
+            self.collection
+            if game_system is None
+            else self.get_shard(game_system)
         )
+        return BulkWriter(
+            collection=collection,
+            max_batch_size=self.chroma_client.get_max_batch_size(),
+            background=background,
+        )
+
+    def bulk_upsert(
+        self,
+        ids: List[str],
+        embeddings: Union[np.ndarray, List[List[float]]],
+        metadatas: Optional[List[Dict[str, Any]]] = None,
+        documents: Optional[List[str]] = None,
+        game_system: Optional[str] = None,
+    ) -> Dict[str, float]:
+        """Upsert any number of chunks, split into batches the client
+        accepts.
+
+        Parameters
+        ----------
+        ids : List[str]
+            The IDs of the chunks.
+        embeddings : Union[np.ndarray, List[List[float]]]
+            The embeddings of the chunks, one row per chunk.
+        metadatas : Optional[List[Dict[str, Any]]], optional
+            The metadata of the chunks, by default None.
+        documents : Optional[List[str]], optional
+            The texts of the chunks, by default None.
+        game_system : Optional[str], optional
+            The game system of the shard, or None for the single collection,
+            by default None.
+
+        Returns
+        -------
+        Dict[str, float]
+            The write statistics, see `BulkWriter.stats`.
+        """
+        with self.bulk_writer(game_system=game_system) as writer:
+            writer.write(ids, embeddings, metadatas, documents)
+        return writer.stats()
+
+    def close(self) -> None:
+        """Stop the client, releasing its database connections, its file
+        handles and the vector indexes it loaded in memory.
+
+        With a ChromaDB version whose systems cannot be stopped one at a
+        time, the client is only dropped.
+        """
+        if _STOPPABLE_SYSTEMS:
+            identifier = getattr(self.chroma_client, "_identifier", None)
+            system = SharedSystemClient._identifier_to_system.pop(
+                identifier, None
+            )
+            if system is not None:
+                system.stop()
+        else:
+            logger.warning(
+                "Cannot stop the ChromaDB client of %s with chromadb %s"
+                % (self.settings.persist_directory, chromadb.__version__)
+            )
+        self.shards = {}
+
+
+class BulkWriter:
+    """Upserts chunks into a collection in batches bounded both by the
+    maximum batch size of the client and by an estimate of their payload
+    bytes, so that no write is rejected or holds too much in memory.
+
+    Writes are upserts of stable IDs, so retrying a write, or replaying an
+    interrupted ingestion, never duplicates chunks. A batch the client
+    still rejects is split in halves. In the background mode, batches are
+    written by a thread fed through a bounded queue, so that the caller can
+    embed the next batch meanwhile.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        max_batch_size: Optional[int] = None,
+        max_batch_bytes: Optional[int] = enums.CHROMA_MAX_BATCH_BYTES,
+        background: bool = False,
+        queue_size: int = enums.CHROMA_WRITE_QUEUE_SIZE,
+    ) -> None:
+        """Initializes the BulkWriter for a collection.
+
+        Parameters
+        ----------
+        collection : Collection
+            The ChromaDB collection to write to.
+        max_batch_size : Optional[int], optional
+            The maximum number of chunks per write. If None, the maximum
+            reported by the client of the collection is used, by default
+            None.
+        max_batch_bytes : Optional[int], optional
+            The maximum estimated payload bytes per write, by default
+            CHROMA_MAX_BATCH_BYTES.
+        background : bool, optional
+            Whether to write in a background thread, by default False.
+        queue_size : int, optional
+            The number of batches waiting for the background thread before
+            `write` blocks, by default CHROMA_WRITE_QUEUE_SIZE.
+        """
+        self.collection = collection
+        self.max_batch_size = max(
+            1, max_batch_size or self._client_max_batch_size(collection)
+        )
+        self.max_batch_bytes = max_batch_bytes
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self._error: Optional[BaseException] = None
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        if background:
+            self._queue = queue.Queue(maxsize=max(1, queue_size))
+            self._thread = threading.Thread(
+                target=self._run, name="chroma-writer", daemon=True
+            )
+            self._thread.start()
+
+    @staticmethod
+    def _client_max_batch_size(collection: Collection) -> int:
+        """The maximum batch size reported by the client of a collection."""
+        try:
+            return collection._client.get_max_batch_size()
+        except Exception:
+            return _DEFAULT_MAX_BATCH_SIZE
+
+    @staticmethod
+    def _row_bytes(
+        chunk_id: str,
+        dimensions: int,
+        metadata: Optional[Dict[str, Any]],
+        document: Optional[str],
+    ) -> int:
+        """Estimate the bytes a chunk adds to a write request."""
+        size = len(chunk_id) + dimensions * _BYTES_PER_FLOAT
+        if metadata:
+            size += len(json.dumps(metadata))
+        if document:
+            size += len(document.encode("utf-8"))
+        return size
+
+    def _split(
+        self,
+        ids: Sequence[str],
+        dimensions: int,
+        metadatas: Optional[Sequence[Dict[str, Any]]],
+        documents: Optional[Sequence[str]],
+    ) -> List[slice]:
+        """Split the chunks into batches under both limits."""
+        batches = []
+        start = 0
+        size = 0
+        for i, chunk_id in enumerate(ids):
+            row_bytes = self._row_bytes(
+                chunk_id,
+                dimensions,
+                metadatas[i] if metadatas else None,
+                documents[i] if documents else None,
+            )
+            if i > start and (
+                i - start >= self.max_batch_size
+                or (
+                    self.max_batch_bytes
+                    and size + row_bytes > self.max_batch_bytes
+                )
+            ):
+                batches.append(slice(start, i))
+                start = i
+                size = 0
+            size += row_bytes
+        if start < len(ids):
+            batches.append(slice(start, len(ids)))
+        return batches
+
+    def _upsert(
+        self,
+        ids: Sequence[str],
+        embeddings: Union[np.ndarray, Sequence[List[float]]],
+        metadatas: Optional[Sequence[Dict[str, Any]]],
+        documents: Optional[Sequence[str]],
+    ) -> None:
+        """Upsert one batch, splitting it if the client rejects its size."""
+        start = time.perf_counter()
+        try:
+            with metrics.span("chroma_write"):
+                self.collection.upsert(
+                    ids=list(ids),
+                    # ChromaDB only accepts lists, so each batch is
+                    # converted just before it is written
+                    embeddings=(
+                        embeddings.tolist()
+                        if isinstance(embeddings, np.ndarray)
+                        else list(embeddings)
+                    ),
+                    metadatas=list(metadatas) if metadatas else None,
+                    documents=list(documents) if documents else None,
+                )
+        except ValueError as e:
+            # Other invalid writes fail the same way at any size
+            if len(ids) <= 1 or not _BATCH_SIZE_ERROR.search(str(e)):
+                raise
+            logger.warning(
+                "Splitting a rejected write of %s chunks: %s" % (len(ids), e)
+            )
+            half = len(ids) // 2
+            for part in (slice(0, half), slice(half, len(ids))):
+                self._upsert(
+                    ids[part],
+                    embeddings[part],
+                    metadatas[part] if metadatas else None,
+                    documents[part] if documents else None,
+                )
+            return
+        self.seconds += time.perf_counter() - start
+        self.rows += len(ids)
+        self.batches += 1
+        metrics.BATCH_SIZE.observe(len(ids), batch="chroma_write")
+
+    def _run(self) -> None:
+        """Write the queued batches until the writer is closed."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if self._error is None:
+                    self._upsert(*item)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self) -> None:
+        """Raise the error of a failed background write, once."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(
+        self,
+        ids: Sequence[str],
+        embeddings: Union[np.ndarray, Sequence[List[float]]],
+        metadatas: Optional[Sequence[Dict[str, Any]]] = None,
+        documents: Optional[Sequence[str]] = None,
+    ) -> None:
+        """Upsert chunks, in as many batches as needed.
+
+        Parameters
+        ----------
+        ids : Sequence[str]
+            The IDs of the chunks.
+        embeddings : Union[np.ndarray, Sequence[List[float]]]
+            The embeddings of the chunks, one row per chunk.
+        metadatas : Optional[Sequence[Dict[str, Any]]], optional
+            The metadata of the chunks, by default None.
+        documents : Optional[Sequence[str]], optional
+            The texts of the chunks, by default None.
+
+        Raises
+        ------
+        Exception
+            The error of a failed background write, if any.
+        """
+        self._raise_error()
+        if len(ids) == 0:
+            return
+        dimensions = len(embeddings[0])
+        for batch in self._split(ids, dimensions, metadatas, documents):
+            item = (
+                ids[batch],
+                embeddings[batch],
+                metadatas[batch] if metadatas else None,
+                documents[batch] if documents else None,
+            )
+            if self._queue is None:
+                self._upsert(*item)
+            else:
+                self._queue.put(item)
+
+    def flush(self) -> None:
+        """Wait until every queued batch is written.
+
+        Raises
+        ------
+        Exception
+            The error of a failed background write, if any.
+        """
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        """Write the queued batches and stop the background thread."""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+
+    def __enter__(self) -> "BulkWriter":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    @property
+    def rows_per_second(self) -> float:
+        """The write throughput, excluding the time spent waiting for
+        batches.
+        """
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Report the rows and batches written and the write throughput.
+
+        Returns
+        -------
+        Dict[str, float]
+            The rows, batches, seconds and rows per second.
+        """
+        return {
+            "rows": self.rows,
+            "batches": self.batches,
+            "seconds": self.seconds,
+            "rows_per_second": self.rows_per_second,
+        }
@@ -0,0 +1,384 @@
+"""Module to define the MarkdownChunker class, which splits the markdown of
+the pdf pages into token-bounded chunks along their structure.
+"""
+import re
+import logging
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums
+from models.document import Document
+from services.embedding_client import estimate_tokens
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+WORD_PATTERN = re.compile(r"\S+\s*")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\|(\s*:?-+:?\s*\|)+\s*$")
+# Separates the headings of a heading path
+HEADING_SEPARATOR = " > "
+
+
+class _Unit:
+    """A span of the page text that is never split: a heading, a table row,
+    a paragraph or, for long paragraphs, a sentence or a run of words.
+
+    The rows of a split table carry the span of the table header, which is
+    repeated before them when they start a chunk.
+    """
+
+    __slots__ = (
+        "start",
+        "end",
+        "tokens",
+        "heading_path",
+        "is_heading",
+        "header",
+        "header_tokens",
+    )
+
+    def __init__(
+        self,
+        start: int,
+        end: int,
+        tokens: int,
+        heading_path: Tuple[str, ...],
+        is_heading: bool = False,
+        header: Optional[Tuple[int, int]] = None,
+        header_tokens: int = 0,
+    ) -> None:
+        self.start = start
+        self.end = end
+        self.tokens = tokens
+        self.heading_path = heading_path
+        self.is_heading = is_heading
+        self.header = header
+        self.header_tokens = header_tokens
+
+
+class MarkdownChunker:
+    """Splits the markdown of a page on headings, tables and paragraphs into
+    chunks of at most `max_tokens` tokens.
+
+    A chunk never spans two sections unless the first one is shorter than
+    `min_tokens`. Sections too long for a single chunk are split between
+    paragraphs, table rows or sentences, and each chunk repeats the last
+    `overlap_tokens` tokens of the previous one. The chunks of a split table
+    start with its header row. Headings are carried over
+    from one page to the next of the same file, so that every chunk knows
+    the heading path it belongs to.
+
+    The chunker is stateful and expects the pages of a file in order, as
+    produced by `DocumentProcessor.iter_documents`.
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = enums.CHUNK_MAX_TOKENS,
+        overlap_tokens: Optional[int] = enums.CHUNK_OVERLAP_TOKENS,
+        min_tokens: Optional[int] = enums.CHUNK_MIN_TOKENS,
+    ) -> None:
+        """Initializes the MarkdownChunker.
+
+        Parameters
+        ----------
+        max_tokens : Optional[int], optional
+            The maximum number of tokens per chunk, by default
+            CHUNK_MAX_TOKENS.
+        overlap_tokens : Optional[int], optional
+            The maximum number of tokens repeated from the previous chunk
+            when a section is split, by default CHUNK_OVERLAP_TOKENS.
+        min_tokens : Optional[int], optional
+            Sections shorter than this are merged with the next section, by
+            default CHUNK_MIN_TOKENS.
+        """
+        self.max_tokens = max(1, max_tokens or 1)
+        self.overlap_tokens = max(
+            0, min(overlap_tokens or 0, self.max_tokens)
+        )
+        self.min_tokens = max(0, min_tokens or 0)
+        self._filepath = None
+        self._headings: List[Tuple[int, str]] = []
+
+    def _heading_path(self) -> Tuple[str, ...]:
+        """The titles of the current headings, outermost first."""
+        return tuple(title for _, title in self._headings)
+
+    def _enter_heading(self, level: int, title: str) -> None:
+        """Replace the current headings of the same or a deeper level."""
+        while self._headings and self._headings[-1][0] >= level:
+            self._headings.pop()
+        self._headings.append((level, title))
+
+    def _split_long(
+        self, text: str, start: int, end: int, heading_path: Tuple[str, ...]
+    ) -> Iterator[_Unit]:
+        """Split a block longer than `max_tokens` into sentences, and
+        sentences that are still too long into runs of words.
+        """
+        bounds = [start]
+        for match in SENTENCE_END_PATTERN.finditer(text, start, end):
+            bounds.append(match.end())
+        bounds.append(end)
+        for sentence_start, sentence_end in zip(bounds, bounds[1:]):
+            if sentence_start >= sentence_end:
+                continue
+            tokens = estimate_tokens(text[sentence_start:sentence_end])
+            if tokens <= self.max_tokens:
+                yield _Unit(
+                    sentence_start, sentence_end, tokens, heading_path
+                )
+                continue
+            run_start = run_end = sentence_start
+            for word in WORD_PATTERN.finditer(
+                text, sentence_start, sentence_end
+            ):
+                if (
+                    run_end > run_start
+                    and estimate_tokens(text[run_start : word.end()])
+                    > self.max_tokens
+                ):
+                    yield _Unit(
+                        run_start,
+                        run_end,
+                        estimate_tokens(text[run_start:run_end]),
+                        heading_path,
+                    )
+                    run_start = run_end
+                run_end = word.end()
+            if run_end > run_start:
+                yield _Unit(
+                    run_start,
+                    run_end,
+                    estimate_tokens(text[run_start:run_end]),
+                    heading_path,
+                )
+
+    def _block_units(
+        self, text: str, start: int, end: int, heading_path: Tuple[str, ...]
+    ) -> Iterator[_Unit]:
+        """Turn a paragraph, table or code block into units."""
+        tokens = estimate_tokens(text[start:end])
+        if tokens <= self.max_tokens:
+            yield _Unit(start, end, tokens, heading_path)
+        elif text[start] == "|":
+            # Split tables between rows, and repeat the header row and its
+            # separator before the rows that start a chunk, unless the
+            # header alone takes half of the budget
+            header, header_tokens = None, 0
+            header_end = text.find("\n", start, end) + 1
+            separator_end = header_end and (
+                text.find("\n", header_end, end) + 1 or end
+            )
+            if header_end and TABLE_SEPARATOR_PATTERN.match(
+                text[header_end:separator_end].strip()
+            ):
+                header_tokens = estimate_tokens(text[start:separator_end])
+                if header_tokens * 2 <= self.max_tokens:
+                    header = (start, separator_end)
+                else:
+                    header_tokens = 0
+            row_start = start
+            while row_start < end:
+                row_end = text.find("\n", row_start, end) + 1 or end
+                row_tokens = estimate_tokens(text[row_start:row_end])
+                if header is not None and row_start >= header[1]:
+                    if row_tokens + header_tokens <= self.max_tokens:
+                        yield _Unit(
+                            row_start,
+                            row_end,
+                            row_tokens,
+                            heading_path,
+                            header=header,
+                            header_tokens=header_tokens,
+                        )
+                    else:
+                        yield from self._split_long(
+                            text, row_start, row_end, heading_path
+                        )
+                elif row_tokens <= self.max_tokens:
+                    yield _Unit(row_start, row_end, row_tokens, heading_path)
+                else:
+                    yield from self._split_long(
+                        text, row_start, row_end, heading_path
+                    )
+                row_start = row_end
+        else:
+            yield from self._split_long(text, start, end, heading_path)
+
+    def _units(self, text: str) -> Iterator[_Unit]:
+        """Parse the markdown of a page into headings and blocks, tracking
+        the heading path of every unit.
+        """
+        lines = text.splitlines(keepends=True)
+        block_start = None
+        block_kind = None
+        offset = 0
+
+        def flush(block_end: int) -> Iterator[_Unit]:
+            nonlocal block_start, block_kind
+            if block_start is not None:
+                end = block_end
+                while end > block_start and text[end - 1].isspace():
+                    end -= 1
+                if end > block_start:
+                    yield from self._block_units(
+                        text, block_start, end, self._heading_path()
+                    )
+            block_start = block_kind = None
+
+        for line in lines:
+            line_start = offset
+            offset += len(line)
+            stripped = line.strip()
+            if block_kind == "code":
+                if stripped.startswith("```"):
+                    yield from flush(offset)
+                continue
+            if stripped.startswith("```"):
+                yield from flush(line_start)
+                block_start, block_kind = line_start, "code"
+                continue
+            heading = HEADING_PATTERN.match(stripped)
+            if heading:
+                yield from flush(line_start)
+                title = re.sub(r"[*_`]", "", heading.group(2)).strip()
+                if title:
+                    self._enter_heading(len(heading.group(1)), title)
+                yield _Unit(
+                    line_start + (len(line) - len(line.lstrip())),
+                    line_start + len(line.rstrip()),
+                    estimate_tokens(stripped),
+                    self._heading_path(),
+                    is_heading=True,
+                )
+                continue
+            if not stripped:
+                yield from flush(line_start)
+                continue
+            kind = "table" if stripped.startswith("|") else "paragraph"
+            if block_kind != kind:
+                yield from flush(line_start)
+                block_start = line_start + (len(line) - len(line.lstrip()))
+                block_kind = kind
+        yield from flush(offset)
+
+    def _pack(self, units: Iterable[_Unit]) -> Iterator[List[_Unit]]:
+        """Greedily group consecutive units into chunks under the token
+        budget, starting a new chunk at every section of at least
+        `min_tokens` tokens.
+        """
+        chunk: List[_Unit] = []
+        tokens = 0
+        has_content = False
+        for unit in units:
+            section_break = (
+                unit.is_heading and has_content and tokens >= self.min_tokens
+            )
+            if chunk and (
+                section_break or tokens + unit.tokens > self.max_tokens
+            ):
+                yield chunk
+                overlap: List[_Unit] = []
+                if not section_break:
+                    # Repeat the tail of the previous chunk within the section
+                    overlap_tokens = 0
+                    for previous in reversed(chunk[1:]):
+                        overlap_tokens += previous.tokens
+                        if (
+                            overlap_tokens > self.overlap_tokens
+                            or overlap_tokens
+                            + previous.header_tokens
+                            + unit.tokens
+                            > self.max_tokens
+                        ):
+                            break
+                        overlap.insert(0, previous)
+                chunk = overlap
+                tokens = sum(u.tokens for u in chunk)
+                if chunk:
+                    tokens += chunk[0].header_tokens
+                has_content = any(not u.is_heading for u in chunk)
+            if not chunk:
+                tokens = unit.header_tokens
+            chunk.append(unit)
+            tokens += unit.tokens
+            has_content = has_content or not unit.is_heading
+        if chunk:
+            yield chunk
+
+    def __call__(self, document: Document) -> List[Document]:
+        """Split a page Document into chunk Documents.
+
+        Parameters
+        ----------
+        document : Document
+            The Document of a pdf page.
+
+        Returns
+        -------
+        List[Document]
+            The chunks of the page, in order. Each carries the page metadata
+            along with its chunk index, heading path and character offsets
+            within the page. The chunks of a split table, except the first,
+            start with the table header, which precedes the span of the
+            offsets.
+        """
+        if document.filepath != self._filepath:
+            self._filepath = document.filepath
+            self._headings = []
+        text = document.page_content
+        if isinstance(text, list):
+            text = "\n\n".join(text)
+
+        chunks = []
+        for units in self._pack(self._units(text)):
+            start, end = units[0].start, units[-1].end
+            content = text[start:end]
+            if not content.strip():
+                continue
+            if units[0].header is not None:
+                header_start, header_end = units[0].header
+                content = text[header_start:header_end] + content
+            # The section of the first paragraph, rather than of any parent
+            # heading the chunk starts with
+            heading_path = next(
+                (u.heading_path for u in units if not u.is_heading),
+                units[-1].heading_path,
+            )
+            chunks.append(
+                Document(
+                    filepath=document.filepath,
+                    page_content=content,
+                    title=document.title,
+                    game_system=document.game_system,
+                    edition=document.edition,
+                    page_number=document.page_number,
+                    file_hash=document.file_hash,
+                    chunk_index=len(chunks),
+                    heading_path=HEADING_SEPARATOR.join(heading_path),
+                    start_offset=start,
+                    end_offset=end,
+                )
+            )
+        return chunks
+
+    def chunk_documents(
+        self, documents: Iterable[Document]
+    ) -> Iterator[Document]:
+        """Split the pages of a whole corpus into chunks in a single pass.
+
+        Parameters
+        ----------
+        documents : Iterable[Document]
+            The page Documents, with the pages of each file in order.
+
+        Yields
+        ------
+        Document
+            The chunk Documents, in order.
+        """
+        for document in documents:
+            yield from self(document)
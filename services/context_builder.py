@@ -0,0 +1,284 @@
+"""Module to define the ContextBuilder class, which packs the retrieved chunks
+into a deduplicated, diverse context block under a token budget.
+"""
+import re
+import logging
+from typing import FrozenSet, List, Optional
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums
+from models.retrieval import RetrievedChunk
+from services.embedding_client import estimate_tokens
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def _jaccard_similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """The Jaccard similarity of two sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class ContextBuilder:
+    """Assembles the context block of a prompt from the retrieved chunks.
+
+    Exact duplicates are dropped, chunks overlapping on the same page are
+    merged, and chunks whose word shingles mostly match a more relevant
+    chunk are dropped. The remaining chunks are ordered by maximal marginal
+    relevance, trading their retrieval rank against their similarity to the
+    chunks already selected, and packed under a token budget, each with a
+    `[title, p. N]` provenance header.
+    """
+
+    def __init__(
+        self,
+        token_budget: Optional[int] = enums.CONTEXT_TOKEN_BUDGET,
+        mmr_lambda: float = enums.CONTEXT_MMR_LAMBDA,
+        shingle_size: int = enums.CONTEXT_SHINGLE_SIZE,
+        duplicate_threshold: float = enums.CONTEXT_DUPLICATE_THRESHOLD,
+    ) -> None:
+        """Initializes the ContextBuilder.
+
+        Parameters
+        ----------
+        token_budget : Optional[int], optional
+            The maximum number of tokens of the context block. If None, every
+            chunk is kept, by default CONTEXT_TOKEN_BUDGET.
+        mmr_lambda : float, optional
+            The weight of relevance against diversity, from 0 to 1, by
+            default CONTEXT_MMR_LAMBDA.
+        shingle_size : int, optional
+            The number of words per shingle when detecting near duplicates,
+            by default CONTEXT_SHINGLE_SIZE.
+        duplicate_threshold : float, optional
+            The Jaccard similarity of shingles above which a chunk is a near
+            duplicate, by default CONTEXT_DUPLICATE_THRESHOLD.
+        """
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.shingle_size = max(1, shingle_size)
+        self.duplicate_threshold = duplicate_threshold
+
+    def _shingles(self, text: str) -> FrozenSet[str]:
+        """The set of word n-grams of a text."""
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return frozenset([" ".join(words)]) if words else frozenset()
+        return frozenset(
+            " ".join(words[i : i + self.shingle_size])
+            for i in range(len(words) - self.shingle_size + 1)
+        )
+
+    @staticmethod
+    def _merge_overlapping(
+        chunks: List[RetrievedChunk],
+    ) -> List[RetrievedChunk]:
+        """Merge chunks of the same page whose character ranges overlap or
+        touch into the position of the most relevant one.
+        """
+        merged: List[RetrievedChunk] = []
+        for chunk in chunks:
+            start = chunk.metadata.get("start_offset")
+            end = chunk.metadata.get("end_offset")
+            target = None
+            if start is not None and end is not None:
+                for i, kept in enumerate(merged):
+                    kept_start = kept.metadata.get("start_offset")
+                    kept_end = kept.metadata.get("end_offset")
+                    if (
+                        kept.filepath == chunk.filepath
+                        and kept.page_number == chunk.page_number
+                        and kept_start is not None
+                        and kept_end is not None
+                        and start <= kept_end
+                        and kept_start <= end
+                    ):
+                        target = i
+                        break
+            if target is None:
+                merged.append(chunk)
+                continue
+
+            # The texts end with slices of the same page, and any table
+            # header repeated before a slice stays at the front
+            kept = merged[target]
+            kept_start = kept.metadata["start_offset"]
+            kept_end = kept.metadata["end_offset"]
+            if start < kept_start:
+                first, second = chunk, kept
+            else:
+                first, second = kept, chunk
+            first_end = first.metadata["end_offset"]
+            second_end = second.metadata["end_offset"]
+            if second_end <= first_end:
+                text = first.text
+            else:
+                text = first.text + second.text[first_end - second_end :]
+            metadata = {
+                **kept.metadata,
+                "start_offset": min(start, kept_start),
+                "end_offset": max(end, kept_end),
+            }
+            merged[target] = kept.model_copy(
+                update={"text": text, "metadata": metadata}
+            )
+        return merged
+
+    def deduplicate(
+        self, chunks: List[RetrievedChunk]
+    ) -> List[RetrievedChunk]:
+        """Drop exact and near duplicates and merge overlapping chunks,
+        keeping the most relevant copy.
+
+        Parameters
+        ----------
+        chunks : List[RetrievedChunk]
+            The retrieved chunks, most relevant first.
+
+        Returns
+        -------
+        List[RetrievedChunk]
+            The distinct chunks, most relevant first.
+        """
+        seen = set()
+        unique = []
+        for chunk in chunks:
+            normalized = " ".join(chunk.text.lower().split())
+            if not normalized or normalized in seen:
+                continue
+            seen.add(normalized)
+            unique.append(chunk)
+
+        distinct = []
+        kept_shingles = []
+        for chunk in self._merge_overlapping(unique):
+            shingles = self._shingles(chunk.text)
+            if any(
+                _jaccard_similarity(shingles, kept)
+                >= self.duplicate_threshold
+                for kept in kept_shingles
+            ):
+                continue
+            distinct.append(chunk)
+            kept_shingles.append(shingles)
+        return distinct
+
+    def select(self, chunks: List[RetrievedChunk]) -> List[RetrievedChunk]:
+        """Order distinct chunks by maximal marginal relevance.
+
+        The relevance of a chunk is derived from its retrieval rank, and its
+        similarity to other chunks from their stored embeddings, or their
+        word shingles when embeddings are missing.
+
+        Parameters
+        ----------
+        chunks : List[RetrievedChunk]
+            The distinct chunks, most relevant first.
+
+        Returns
+        -------
+        List[RetrievedChunk]
+            The chunks in selection order.
+        """
+        count = len(chunks)
+        if count <= 1:
+            return list(chunks)
+        relevance = 1.0 - np.arange(count, dtype=np.float32) / count
+        similarity = self._similarity_matrix(chunks)
+
+        selected = [0]
+        remaining = np.ones(count, dtype=bool)
+        remaining[0] = False
+        # The highest similarity of every candidate to a selected chunk
+        redundancy = similarity[0].copy()
+        for _ in range(count - 1):
+            scores = (
+                self.mmr_lambda * relevance
+                - (1.0 - self.mmr_lambda) * redundancy
+            )
+            scores[~remaining] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            remaining[best] = False
+            np.maximum(redundancy, similarity[best], out=redundancy)
+        return [chunks[i] for i in selected]
+
+    def _similarity_matrix(self, chunks: List[RetrievedChunk]) -> np.ndarray:
+        """The pairwise cosine similarities of the embeddings of the chunks,
+        or the Jaccard similarities of their shingles if any embedding is
+        missing.
+        """
+        if all(chunk.embedding is not None for chunk in chunks):
+            vectors = np.stack([chunk.embedding for chunk in chunks])
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms > 0, norms, 1.0)
+            return vectors @ vectors.T
+        shingles = [self._shingles(chunk.text) for chunk in chunks]
+        similarity = np.eye(len(chunks), dtype=np.float32)
+        for i in range(len(chunks)):
+            for j in range(i + 1, len(chunks)):
+                similarity[i, j] = similarity[j, i] = _jaccard_similarity(
+                    shingles[i], shingles[j]
+                )
+        return similarity
+
+    @staticmethod
+    def format_chunk(chunk: RetrievedChunk) -> str:
+        """Format a chunk with its provenance header.
+
+        Parameters
+        ----------
+        chunk : RetrievedChunk
+            The chunk.
+
+        Returns
+        -------
+        str
+            The `[title, p. N]` header followed by the text of the chunk.
+        """
+        header = chunk.title or "Unknown source"
+        if chunk.page_number is not None:
+            header += f", p. {chunk.page_number}"
+        return f"[{header}]\n{chunk.text.strip()}\n"
+
+    def build(self, query_text: str, chunks: List[RetrievedChunk]) -> str:
+        """Build the context block of a query from its retrieved chunks.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        chunks : List[RetrievedChunk]
+            The retrieved chunks, most relevant first.
+
+        Returns
+        -------
+        str
+            The context block.
+        """
+        context = f"User query: {query_text}\n\nRelevant document chunks:\n"
+        tokens = estimate_tokens(context)
+        candidates = self.select(self.deduplicate(chunks))
+        packed = []
+        for chunk in candidates:
+            block = self.format_chunk(chunk)
+            block_tokens = estimate_tokens(block)
+            if (
+                self.token_budget is not None
+                and tokens + block_tokens > self.token_budget
+            ):
+                # A shorter chunk further down may still fit
+                continue
+            packed.append(block)
+            tokens += block_tokens
+        logger.debug(
+            "Packed %s of %s retrieved chunks (%s distinct) into %s tokens"
+            % (len(packed), len(chunks), len(candidates), tokens)
+        )
+        return context + "\n".join(packed)
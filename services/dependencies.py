@@ -0,0 +1,457 @@
+"""Module to lazily construct the clients shared by the API and the ingestion
+command.
+
+Every getter imports its dependencies and builds its client on first use, so
+importing this module, or the API that uses it, stays fast.
+"""
+import os
+import inspect
+import threading
+from functools import wraps
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+from utils import enums
+
+if TYPE_CHECKING:
+    from chromadb import Collection, EmbeddingFunction
+
+    from services.chromadb import ChromaDB
+    from services.generative_llm import GenerativeLLM
+    from services.retriever import Retriever
+    from services.reranker import CrossEncoderReranker, RerankingRetriever
+    from services.shard_router import ShardRouter
+    from services.vector_index import VectorIndex
+    from services.query_batcher import QueryBatcher
+    from services.context_builder import ContextBuilder
+    from services.embedding_cache import EmbeddingCache
+    from services.extraction_cache import ExtractionCache
+    from services.incremental_indexer import IncrementalIndexer
+    from utils.priority import QueryTraffic
+
+T = TypeVar("T")
+
+# Reentrant, since getters call each other while constructing clients
+_lock = threading.RLock()
+
+
+def _singleton(factory: Callable[..., T]) -> Callable[..., T]:
+    """Make a factory return the same instance on every call with the same
+    arguments, constructing it once even if called from several threads at
+    the same time.
+    """
+    signature = inspect.signature(factory)
+    instances: Dict[tuple, T] = {}
+
+    @wraps(factory)
+    def get(*args, **kwargs) -> T:
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = tuple(bound.arguments.items())
+        if key not in instances:
+            with _lock:
+                if key not in instances:
+                    instances[key] = factory(*args, **kwargs)
+        return instances[key]
+
+    def cache_clear() -> None:
+        with _lock:
+            instances.clear()
+
+    def cached() -> List[T]:
+        with _lock:
+            return list(instances.values())
+
+    get.cache_clear = cache_clear
+    get.cached = cached
+    return get
+
+
+# The folder the index is read from instead of CHROMA_DB_PATH, such as a
+# generation published by the ingestion leader of a multi-worker server
+_index_root: Optional[str] = None
+# The query batchers and ChromaDB clients of the previous index folder,
+# closed at the next switch, once the requests still using them are done
+_retired: List[Union["QueryBatcher", "ChromaDB"]] = []
+
+
+def index_root() -> str:
+    """Get the folder the index is read from."""
+    return _index_root or enums.CHROMA_DB_PATH
+
+
+def index_path(path: str) -> str:
+    """Get the path of a file of the index, such as the manifest or the
+    search indexes, in the folder the index is read from.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file in CHROMA_DB_PATH.
+
+    Returns
+    -------
+    str
+        The path of the file in the current index folder.
+    """
+    if _index_root is None:
+        return path
+    relative_path = os.path.relpath(path, enums.CHROMA_DB_PATH)
+    if relative_path.startswith(os.pardir):
+        return path
+    return os.path.normpath(os.path.join(_index_root, relative_path))
+
+
+def use_index(path: Optional[str]) -> None:
+    """Read the index from another folder, reconstructing the clients
+    bound to it on their next use.
+
+    Parameters
+    ----------
+    path : Optional[str]
+        The index folder, such as a published generation, or None for
+        CHROMA_DB_PATH.
+    """
+    global _index_root
+    with _lock:
+        if path == _index_root:
+            return
+        for client in _retired:
+            client.close()
+        # Batchers first, since they search the collections of the clients
+        _retired[:] = get_query_batcher.cached() + get_chroma_db.cached()
+        _clear_index_clients()
+        _index_root = path
+
+
+def close_index() -> None:
+    """Close the clients bound to the index folder, including the retired
+    ones, so that no file of the index is open, such as while it is copied.
+    The clients are reconstructed on their next use.
+    """
+    with _lock:
+        clients = (
+            _retired + get_query_batcher.cached() + get_chroma_db.cached()
+        )
+        _retired.clear()
+        for client in clients:
+            client.close()
+        _clear_index_clients()
+
+
+def _clear_index_clients() -> None:
+    """Forget the clients bound to the index folder."""
+    for getter in (
+        get_chroma_db,
+        get_query_batcher,
+        get_shard_retriever,
+        get_retriever,
+        get_indexer,
+    ):
+        getter.cache_clear()
+
+
+def shard_of(folder: str) -> Optional[str]:
+    """Get the shard holding the chunks of a game system folder.
+
+    Parameters
+    ----------
+    folder : str
+        The game system folder.
+
+    Returns
+    -------
+    Optional[str]
+        The game system of the folder if the corpus is sharded by game
+        system, otherwise None for the single collection.
+    """
+    if not enums.SHARD_BY_GAME_SYSTEM:
+        return None
+    return os.path.basename(os.path.normpath(folder))
+
+
+def shards() -> List[Optional[str]]:
+    """Get every shard of the corpus."""
+    return list(dict.fromkeys(shard_of(f) for f in enums.GAME_SYSTEM_FOLDERS))
+
+
+def collection_name() -> str:
+    """Get the name of the collection of the configured embedding backend,
+    since embeddings of different backends cannot share a collection.
+    """
+    if enums.EMBEDDING_BACKEND == "gemini":
+        return enums.COLLECTION_NAME
+    return f"{enums.COLLECTION_NAME}_{enums.EMBEDDING_BACKEND}"
+
+
+def shard_path(path: str, shard: Optional[str] = None) -> str:
+    """Get the path of a file kept per collection, such as the index
+    manifest or the search indexes.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file for the single collection of the default
+        embedding backend.
+    shard : Optional[str], optional
+        The shard, by default None.
+
+    Returns
+    -------
+    str
+        The path of the file in a folder named after the collection of the
+        shard and embedding backend, in the folder the index is read from.
+    """
+    name = collection_name()
+    if shard is not None:
+        from services.chromadb import shard_collection_name
+
+        name = shard_collection_name(name, shard)
+    elif name == enums.COLLECTION_NAME:
+        return index_path(path)
+    return index_path(
+        os.path.join(os.path.dirname(path), name, os.path.basename(path))
+    )
+
+
+@_singleton
+def get_embedding_cache() -> "EmbeddingCache":
+    """Get the persistent embedding cache."""
+    from services.embedding_cache import EmbeddingCache
+
+    return EmbeddingCache(
+        path=enums.EMBEDDING_CACHE_PATH,
+        max_entries=enums.EMBEDDING_CACHE_MAX_ENTRIES,
+    )
+
+
+@_singleton
+def get_extraction_cache() -> "ExtractionCache":
+    """Get the persistent cache of the text extracted from pdf files."""
+    from services.extraction_cache import ExtractionCache
+
+    return ExtractionCache(
+        path=enums.EXTRACTION_CACHE_PATH,
+        max_bytes=enums.EXTRACTION_CACHE_MAX_BYTES,
+    )
+
+
+@_singleton
+def get_embedding_function() -> "EmbeddingFunction":
+    """Get the embedding function of the configured backend."""
+    from services.embedding_function import create_embedding_function
+
+    return create_embedding_function(
+        backend=enums.EMBEDDING_BACKEND, cache=get_embedding_cache()
+    )
+
+
+@_singleton
+def get_chroma_db() -> "ChromaDB":
+    """Get the ChromaDB client and collection."""
+    from services.chromadb import ChromaDB
+
+    return ChromaDB(
+        embedding_function=get_embedding_function(),
+        chroma_db_path=index_root(),
+        collection_name=collection_name(),
+    )
+
+
+@_singleton
+def get_model() -> "GenerativeLLM":
+    """Get the client of the generative model, shared by every request so
+    that its concurrency limit applies to the whole process.
+    """
+    from services.generative_llm import create_generative_llm
+
+    return create_generative_llm(
+        backend=enums.LLM_BACKEND, model_name=enums.LLM_MODEL
+    )
+
+
+def get_collection(shard: Optional[str] = None) -> "Collection":
+    """Get the collection of a shard.
+
+    Parameters
+    ----------
+    shard : Optional[str], optional
+        The shard, or None for the single collection, by default None.
+
+    Returns
+    -------
+    Collection
+        The collection.
+    """
+    chroma_db = get_chroma_db()
+    if shard is None:
+        return chroma_db.collection
+    return chroma_db.get_shard(shard)
+
+
+def count_documents() -> int:
+    """Count the chunks stored in every shard."""
+    return sum(get_collection(shard).count() for shard in shards())
+
+
+@_singleton
+def get_query_batcher(shard: Optional[str] = None) -> "QueryBatcher":
+    """Get the batcher coalescing concurrent queries to a shard."""
+    from services.query_batcher import QueryBatcher
+
+    return QueryBatcher(
+        collection=get_collection(shard),
+        window_ms=enums.QUERY_BATCH_WINDOW_MS,
+        max_batch_size=enums.QUERY_MAX_BATCH_SIZE,
+    )
+
+
+@_singleton
+def get_shard_retriever(shard: Optional[str] = None) -> "Retriever":
+    """Get the retriever of a shard."""
+    from services.retriever import Retriever
+    from services.lexical_index import LexicalIndex
+
+    return Retriever(
+        collection=get_collection(shard),
+        query_batcher=get_query_batcher(shard),
+        lexical_index=LexicalIndex.load(
+            shard_path(enums.LEXICAL_INDEX_PATH, shard)
+        ),
+        vector_index=_load_vector_index(shard),
+        embedding_function=get_embedding_function(),
+        # The reranker keeps the best candidates instead of the hybrid cut
+        hybrid_top_k=None if enums.RERANK_ENABLED else enums.HYBRID_TOP_K,
+    )
+
+
+def _load_vector_index(
+    shard: Optional[str] = None,
+) -> Optional["VectorIndex"]:
+    """Open the vector index of a shard, if two-stage search is enabled."""
+    if not enums.VECTOR_INDEX_ENABLED:
+        return None
+    from services.vector_index import VectorIndex
+
+    return VectorIndex.load(shard_path(enums.VECTOR_INDEX_PATH, shard))
+
+
+@_singleton
+def get_reranker() -> "CrossEncoderReranker":
+    """Get the cross-encoder reranker."""
+    from services.reranker import CrossEncoderReranker
+
+    return CrossEncoderReranker(
+        model_name=enums.RERANK_MODEL,
+        top_n=enums.RERANK_TOP_N,
+        cache_size=enums.RERANK_CACHE_SIZE,
+    )
+
+
+@_singleton
+def get_retriever() -> (
+    Union["Retriever", "ShardRouter", "RerankingRetriever"]
+):
+    """Get the retriever used by the query endpoints, which routes queries
+    to the relevant shards if the corpus is sharded, and reranks the chunks
+    if reranking is enabled.
+    """
+    if not enums.SHARD_BY_GAME_SYSTEM:
+        retriever = get_shard_retriever()
+    else:
+        from services.shard_router import ShardRouter
+
+        retriever = ShardRouter(
+            retrievers={
+                shard: get_shard_retriever(shard) for shard in shards()
+            }
+        )
+    if not enums.RERANK_ENABLED:
+        return retriever
+    from services.reranker import RerankingRetriever
+
+    return RerankingRetriever(
+        retriever=retriever,
+        reranker=get_reranker(),
+        oversample=enums.RERANK_OVERSAMPLE,
+    )
+
+
+@_singleton
+def get_context_builder() -> "ContextBuilder":
+    """Get the builder packing retrieved chunks into the prompt context."""
+    from services.context_builder import ContextBuilder
+
+    return ContextBuilder(token_budget=enums.CONTEXT_TOKEN_BUDGET)
+
+
+def reload_search_indexes() -> None:
+    """Swap the lexical and vector indexes of every shard retriever for the
+    ones last built.
+    """
+    from services.lexical_index import LexicalIndex
+
+    for shard in shards():
+        retriever = get_shard_retriever(shard)
+        retriever.lexical_index = LexicalIndex.load(
+            shard_path(enums.LEXICAL_INDEX_PATH, shard)
+        )
+        retriever.vector_index = _load_vector_index(shard)
+
+
+@_singleton
+def get_query_traffic() -> "QueryTraffic":
+    """Get the tracker of the queries in flight, which the ingestion yields
+    to.
+    """
+    from utils.priority import QueryTraffic
+
+    return QueryTraffic()
+
+
+@_singleton
+def get_indexer(shard: Optional[str] = None) -> "IncrementalIndexer":
+    """Get the incremental indexer of a shard."""
+    from services.index_manifest import IndexManifest
+    from services.embedding_generator import EmbeddingGenerator
+    from services.incremental_indexer import IncrementalIndexer
+
+    return IncrementalIndexer(
+        collection=get_collection(shard),
+        embedding_generator=EmbeddingGenerator(
+            embedding_function=get_embedding_function()
+        ),
+        manifest=IndexManifest(
+            path=shard_path(enums.INDEX_MANIFEST_PATH, shard)
+        ),
+        extraction_cache=get_extraction_cache(),
+        # Yield to the queries served meanwhile
+        throttle=get_query_traffic().wait_idle,
+    )
+
+
+def reset() -> None:
+    """Forget every constructed client, so the next call to a getter builds
+    a new one.
+    """
+    for getter in (
+        get_embedding_cache,
+        get_extraction_cache,
+        get_embedding_function,
+        get_chroma_db,
+        get_model,
+        get_query_batcher,
+        get_shard_retriever,
+        get_reranker,
+        get_retriever,
+        get_context_builder,
+        get_indexer,
+    ):
+        getter.cache_clear()
@@ -1,30 +1,108 @@
 """Module to process documents and extract text from them."""
+import os
 import re
+import time
 import logging
-from typing import List, Optional
+import multiprocessing
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
+from contextlib import nullcontext
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 import pymupdf
-from pymupdf4llm import to_markdown
+import pymupdf4llm
+from pymupdf4llm import IdentifyHeaders, to_markdown
 
-from utils.file_utils import get_pdf_filepaths
+from utils import enums, metrics
+from utils.file_utils import get_pdf_filepaths, hash_file
 from models.document import Document
+from services.extraction_cache import ExtractionCache
 
+# The extractor versions, part of the extraction cache keys
+EXTRACTOR = (
+    f"pymupdf4llm {pymupdf4llm.__version__}, pymupdf {pymupdf.VersionBind}"
+)
+# "markdown" keeps headings and tables, "text" skips the layout analysis
+# of the pages
+EXTRACTION_MODES = ("markdown", "text")
 
-class DocumentProcessor:
-    """Class to process documents and extract text from them.
+
+def _extract_page_range(
+    filepath: str,
+    pages: List[int],
+    hdr_info: Optional[IdentifyHeaders] = None,
+    mode: str = "markdown",
+) -> Tuple[List[Tuple[int, str]], float]:
+    """Extract the text of a range of pages from a pdf file.
+
+    This function lives at module level so that it can be pickled and run
+    inside a worker process.
+
+    Parameters
+    ----------
+    filepath : str
+        The filepath of the pdf file.
+    pages : List[int]
+        The 0-based page numbers to extract.
+    hdr_info : Optional[IdentifyHeaders], optional
+        Header information computed over the whole document, so that every
+        page range uses the same heading levels, by default None.
+    mode : str, optional
+        "markdown" to extract markdown with headings and tables, or "text"
+        to extract the plain text of every page without analysing its
+        layout, by default "markdown".
+
+    Returns
+    -------
+    Tuple[List[Tuple[int, str]], float]
+        A list of `(page_number, text)` tuples with 1-based page numbers, and
+        the number of seconds spent extracting them.
     """
+    start = time.perf_counter()
+    doc = pymupdf.open(filepath)
+    try:
+        if mode == "text":
+            document_pages = [
+                {"text": doc[page].get_text("text", sort=True)}
+                for page in pages
+            ]
+        else:
+            document_pages = to_markdown(
+                doc, pages=pages, hdr_info=hdr_info, page_chunks=True
+            )
+    finally:
+        doc.close()
+    if type(document_pages) is str:
+        document_pages = [{"text": document_pages}]
+    extracted = [
+        (page + 1, page_content["text"])
+        for page, page_content in zip(pages, document_pages)
+    ]
+    return extracted, time.perf_counter() - start
+
+
+class DocumentProcessor:
+    """Class to process documents and extract text from them."""
 
     # Regular expression patterns to extract edition and title from the
     # filepath
     FOLDER_EDITION_PATTERN = r"([1-9]{1}[e]{1}$)"
     DOCUMENT_TITLE_PATTERN = r"(?<=- )(['\s\w]+)(?!-)"
 
-    def __init__(self, base_folder: str) -> None:
+    def __init__(
+        self,
+        base_folder: str,
+        max_workers: Optional[int] = enums.EXTRACTION_MAX_WORKERS,
+        pages_per_task: Optional[int] = enums.EXTRACTION_PAGES_PER_TASK,
+        mode: str = enums.EXTRACTION_MODE,
+        cache: Optional[ExtractionCache] = None,
+        file_hashes: Optional[Dict[str, str]] = None,
+    ) -> None:
         """Initialize a DocumentProcessor object with the specified base
         folder.
 
@@ -32,10 +110,45 @@ class DocumentProcessor:
         ----------
         base_folder : str
             The base folder containing the documents to be processed.
+        max_workers : Optional[int], optional
+            The number of worker processes used by the parallel extraction
+            mode. If None, one worker per CPU core is used, by default
+            EXTRACTION_MAX_WORKERS.
+        pages_per_task : Optional[int], optional
+            The number of pages each worker extracts per task in the
+            parallel extraction mode, by default EXTRACTION_PAGES_PER_TASK.
+        mode : str, optional
+            "markdown" to extract markdown with headings and tables, or
+            "text" for a faster extraction of the plain text, by default
+            EXTRACTION_MODE.
+        cache : Optional[ExtractionCache], optional
+            The cache of the pages already extracted, checked before parsing
+            a pdf file and filled afterwards. If None, every file is parsed,
+            by default None.
+        file_hashes : Optional[Dict[str, str]], optional
+            The SHA-256 hex digests of pdf files already hashed by the
+            caller, by filepath, so that they are not read again, by default
+            None.
+
+        Raises
+        ------
+        ValueError
+            If `mode` is not one of EXTRACTION_MODES.
         """
+        if mode not in EXTRACTION_MODES:
+            raise ValueError(
+                f"Unknown extraction mode {mode!r}, expected one of "
+                f"{EXTRACTION_MODES}"
+            )
         self.base_folder = base_folder
         self.game_system = Path(self.base_folder).name
         self.edition = self._extract_edition()
+        self.max_workers = max_workers
+        self.pages_per_task = max(1, pages_per_task or 1)
+        self.mode = mode
+        self.cache = cache
+        self.extraction_stats: Dict[str, Dict[str, float]] = {}
+        self.file_hashes: Dict[str, str] = dict(file_hashes or {})
 
     def _extract_edition(self) -> str:
         """Extract the edition of the game system from the base folder name.
@@ -64,68 +177,388 @@ class DocumentProcessor:
         match = re.search(self.DOCUMENT_TITLE_PATTERN, filepath)
         return match.group(1) if match else "1e"
 
-    def process_documents(
-        self, folder: Optional[str] = None
-    ) -> Optional[List[Document]]:
-        """Process the documents in the base folder and extract text from them.
+    def get_file_hash(self, filepath: str) -> str:
+        """Get the SHA-256 hex digest of a pdf file, hashing it only once.
+
+        Parameters
+        ----------
+        filepath : str
+            The filepath of the pdf file.
+
+        Returns
+        -------
+        str
+            The SHA-256 hex digest of the file.
+        """
+        if filepath not in self.file_hashes:
+            self.file_hashes[filepath] = hash_file(filepath)
+        return self.file_hashes[filepath]
+
+    def get_cache_key(self, filepath: str) -> str:
+        """Get the extraction cache key of a pdf file.
+
+        Parameters
+        ----------
+        filepath : str
+            The filepath of the pdf file.
+
+        Returns
+        -------
+        str
+            The key of the file content extracted by this processor.
+        """
+        return ExtractionCache.make_key(
+            self.get_file_hash(filepath), EXTRACTOR, {"mode": self.mode}
+        )
+
+    def _build_documents(
+        self, filepath: str, pages: Iterable[Tuple[int, str]]
+    ) -> Iterator[Document]:
+        """Lazily create one Document per extracted page of a pdf file.
+
+        Parameters
+        ----------
+        filepath : str
+            The filepath of the pdf file.
+        pages : Iterable[Tuple[int, str]]
+            The `(page_number, text)` tuples extracted from the file, in
+            page order.
+
+        Yields
+        ------
+        Document
+            The Document objects, in page order.
+        """
+        title = self._extract_title(filepath=filepath)
+        file_hash = self.get_file_hash(filepath)
+        for page_number, page_content in pages:
+            document = Document(
+                filepath=filepath,
+                page_content=page_content,
+                title=title,
+                game_system=self.game_system,
+                edition=self.edition,
+                page_number=page_number,
+                file_hash=file_hash,
+            )
+            logger.debug(
+                f"Extracted text from {document.title} page "
+                f"{document.page_number}"
+            )
+            yield document
+
+    def _record_stats(
+        self, filepath: str, pages: int, seconds: float, cpu_seconds: float
+    ) -> None:
+        """Record and log the extraction throughput of a single file.
+
+        Parameters
+        ----------
+        filepath : str
+            The filepath of the pdf file.
+        pages : int
+            The number of pages extracted from the file.
+        seconds : float
+            The wall-clock seconds spent extracting the file.
+        cpu_seconds : float
+            The seconds spent extracting summed over all workers.
+        """
+        pages_per_second = pages / seconds if seconds > 0 else 0.0
+        metrics.STAGE_SECONDS.observe(seconds, stage="extract_file")
+        self.extraction_stats[filepath] = {
+            "pages": pages,
+            "seconds": seconds,
+            "cpu_seconds": cpu_seconds,
+            "pages_per_second": pages_per_second,
+        }
+        logger.info(
+            f"Completed extracting {pages} pages from document in "
+            f"{filepath} in {seconds:.2f}s ({pages_per_second:.2f} pages/s)"
+        )
+
+    def _iter_serial(
+        self, filepaths: List[str]
+    ) -> Iterator[Tuple[str, List[Tuple[int, str]]]]:
+        """Extract the text of the pdf files one file at a time in the current
+        process.
+
+        Parameters
+        ----------
+        filepaths : List[str]
+            The filepaths of the pdf files.
+
+        Yields
+        ------
+        Tuple[str, List[Tuple[int, str]]]
+            The filepath and `(page_number, text)` tuples of every file, in
+            file order.
+        """
+        for filepath in filepaths:
+            logger.info(f"Extracting text from {filepath}...")
+            start = time.perf_counter()
+            with pymupdf.open(filepath) as doc:
+                page_count = doc.page_count
+            pages, cpu_seconds = _extract_page_range(
+                filepath, list(range(page_count)), mode=self.mode
+            )
+            logger.info(f"Found {len(pages)} pages in {filepath}")
+            self._record_stats(
+                filepath,
+                len(pages),
+                time.perf_counter() - start,
+                cpu_seconds,
+            )
+            yield filepath, pages
+
+    def _plan_tasks(
+        self,
+        filepaths: List[str],
+        started: Dict[str, float],
+        pending: Dict[str, int],
+    ) -> Iterator[Tuple[str, List[int], Optional[IdentifyHeaders]]]:
+        """Lazily split every pdf file into page range extraction tasks.
+
+        Parameters
+        ----------
+        filepaths : List[str]
+            The filepaths of the pdf files.
+        started : Dict[str, float]
+            Updated with the time each file was planned.
+        pending : Dict[str, int]
+            Updated with the number of page ranges planned for each file.
+
+        Yields
+        ------
+        Tuple[str, List[int], Optional[IdentifyHeaders]]
+            The filepath, 0-based page numbers and header information of a
+            single task.
+        """
+        for filepath in filepaths:
+            logger.info(f"Extracting text from {filepath}...")
+            started[filepath] = time.perf_counter()
+            with pymupdf.open(filepath) as doc:
+                page_count = doc.page_count
+                # Heading levels depend on font sizes across the whole
+                # document, so compute them once for every page range
+                hdr_info = None
+                if self.mode == "markdown":
+                    hdr_info = IdentifyHeaders(doc)
+            logger.info(f"Found {page_count} pages in {filepath}")
+            ranges = [
+                list(
+                    range(start, min(start + self.pages_per_task, page_count))
+                )
+                for start in range(0, page_count, self.pages_per_task)
+            ]
+            pending[filepath] = len(ranges)
+            if not ranges:
+                self._record_stats(filepath, 0, 0.0, 0.0)
+            for pages in ranges:
+                yield filepath, pages, hdr_info
+
+    def _iter_parallel(
+        self, filepaths: List[str]
+    ) -> Iterator[Tuple[str, List[Tuple[int, str]]]]:
+        """Extract the text of the pdf files by fanning page ranges of every
+        file out across a pool of worker processes.
+
+        Only a bounded number of page ranges are submitted or held in memory
+        at once, and pages are yielded as soon as every page range of a
+        file, and of all files before it, is done.
+
+        Parameters
+        ----------
+        filepaths : List[str]
+            The filepaths of the pdf files.
+
+        Yields
+        ------
+        Tuple[str, List[Tuple[int, str]]]
+            The filepath and `(page_number, text)` tuples of every file, in
+            file order.
+        """
+        extracted: Dict[str, List[Tuple[int, str]]] = defaultdict(list)
+        ranges: Dict[str, int] = defaultdict(int)
+        pending: Dict[str, int] = {}
+        started: Dict[str, float] = {}
+        cpu_seconds: Dict[str, float] = defaultdict(float)
+        tasks = self._plan_tasks(filepaths, started, pending)
+        max_in_flight = 2 * (self.max_workers or os.cpu_count() or 1)
+        in_flight = {}
+        buffered = 0
+        next_index = 0
+
+        # Spawn rather than fork, since the caller may already run threads
+        context = multiprocessing.get_context("spawn")
+        executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=context
+        )
+        try:
+            while True:
+                # Keep the pool busy without buffering unbounded results,
+                # but always make progress on the file being merged
+                while not in_flight or len(in_flight) + buffered < (
+                    max_in_flight
+                ):
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    future = executor.submit(
+                        _extract_page_range, *task, mode=self.mode
+                    )
+                    in_flight[future] = task[0]
+
+                # Merge finished files back in deterministic order
+                while (
+                    next_index < len(filepaths)
+                    and pending.get(filepaths[next_index]) == 0
+                ):
+                    filepath = filepaths[next_index]
+                    buffered -= ranges.pop(filepath, 0)
+                    yield filepath, extracted.pop(filepath, [])
+                    next_index += 1
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filepath = in_flight.pop(future)
+                    pages, seconds = future.result()
+                    extracted[filepath].extend(pages)
+                    cpu_seconds[filepath] += seconds
+                    ranges[filepath] += 1
+                    buffered += 1
+                    pending[filepath] -= 1
+                    if pending[filepath] == 0:
+                        self._record_stats(
+                            filepath,
+                            len(extracted[filepath]),
+                            time.perf_counter() - started[filepath],
+                            cpu_seconds[filepath],
+                        )
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def iter_documents(
+        self,
+        folder: Optional[str] = None,
+        parallel: bool = False,
+        filepaths: Optional[List[str]] = None,
+    ) -> Iterator[Document]:
+        """Lazily extract text from the documents in the base folder, one
+        Document per page.
 
         Parameters
         ----------
         folder : Optional[str], optional
             The folder containing the documents to be processed. If not
             specified, the base folder will be used, by default None.
+        parallel : bool, optional
+            Whether to extract page ranges of every file concurrently in a
+            pool of worker processes, by default False.
+        filepaths : Optional[List[str]], optional
+            The pdf files to process instead of every pdf file in the folder,
+            by default None.
 
-        Returns
-        -------
-        Optional[List[Document]]
-            A list of Document objects with text content extracted from the
-            documents.
+        Yields
+        ------
+        Document
+            The extracted Document objects, in file and page order.
         """
         # Determine the folder to process
         folder = folder if folder else self.base_folder
 
         # Get the filepaths of the pdf files in the base folder
-        logger.info(f"Processing documents in {folder}...")
-        filepaths = get_pdf_filepaths(folder)
-        documents = []
+        if filepaths is None:
+            logger.info(f"Processing documents in {folder}...")
+            filepaths = get_pdf_filepaths(folder)
 
         # Check if any pdf files were found
         if filepaths == []:
             logger.error(f"No pdf files found in {folder}")
-            return documents
+            return
 
-        # Extract text content from each pdf file
-        for filepath in filepaths:
-            # Create a Document object and add it to the list
-            logger.info(f"Extracting text from {filepath}...")
-            title = self._extract_title(filepath=filepath)
-            doc = pymupdf.open(filepath)
-            document_pages = to_markdown(
-                doc, pages=list(range(doc.page_count)), page_chunks=True
-            )
-            if type(document_pages) is str:
-                document_pages = [document_pages]
-            logger.info(
-                f"Found {len(document_pages)} pages in {filepath}"
-            )
-            for idx, page_content in enumerate(document_pages):
-                logger.debug(f"Extracting text from page {idx + 1}...")
-                document = Document(
-                    filepath=filepath,
-                    page_content=page_content["text"],
-                    title=title,
-                    game_system=self.game_system,
-                    edition=self.edition,
-                    page_number=idx + 1,
-                )
-                documents.append(document)
-                logger.debug(
-                    f"Extracted text from {document.title} page "
-                    f"{document.page_number}"
-                )
-            logger.info(
-                f"Completed extracting {len(document_pages)} pages from "
-                f"document in {filepath}"
-            )
+        # Extract text content from each pdf file, parsing only the files
+        # missing from the extraction cache. Cached files are only checked
+        # here, and opened one at a time as their turn comes
+        start = time.perf_counter()
+        count = 0
+        keys = {}
+        if self.cache is not None:
+            keys = {
+                filepath: self.get_cache_key(filepath)
+                for filepath in filepaths
+            }
+        cached = {
+            filepath
+            for filepath, key in keys.items()
+            if self.cache.lookup(key)
+        }
+        missing = [
+            filepath for filepath in filepaths if filepath not in cached
+        ]
+        if self.cache is not None:
+            metrics.EXTRACTION_CACHE.inc(len(missing), result="miss")
+        if parallel:
+            extracted = self._iter_parallel(missing)
+        else:
+            extracted = self._iter_serial(missing)
+        try:
+            for filepath in filepaths:
+                extraction = None
+                if filepath in cached:
+                    extraction = self.cache.get(keys[filepath])
+                    metrics.EXTRACTION_CACHE.inc(
+                        result="miss" if extraction is None else "hit"
+                    )
+                if extraction is not None:
+                    # Cached pages are streamed from the cache file
+                    logger.info(
+                        f"Loading {len(extraction)} pages of {filepath} from "
+                        "the extraction cache"
+                    )
+                else:
+                    if filepath in cached:
+                        # Evicted or unreadable since it was checked
+                        _, pages = next(self._iter_serial([filepath]))
+                    else:
+                        _, pages = next(extracted)
+                    # Page ranges extracted in parallel finish in any order
+                    pages.sort()
+                    if self.cache is not None:
+                        self.cache.put(keys[filepath], pages)
+                    extraction = nullcontext(pages)
+                with extraction as pages:
+                    for document in self._build_documents(filepath, pages):
+                        count += 1
+                        yield document
+        finally:
+            extracted.close()
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Extracted {count} pages from {len(filepaths)} files in "
+            f"{elapsed:.2f}s"
+        )
 
-        return documents
+    def process_documents(
+        self, folder: Optional[str] = None, parallel: bool = False
+    ) -> Optional[List[Document]]:
+        """Process the documents in the base folder and extract text from them.
+
+        Parameters
+        ----------
+        folder : Optional[str], optional
+            The folder containing the documents to be processed. If not
+            specified, the base folder will be used, by default None.
+        parallel : bool, optional
+            Whether to extract page ranges of every file concurrently in a
+            pool of worker processes, by default False.
+
+        Returns
+        -------
+        Optional[List[Document]]
+            A list of Document objects with text content extracted from the
+            documents.
+        """
+        return list(self.iter_documents(folder=folder, parallel=parallel))
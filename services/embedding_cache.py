@@ -0,0 +1,328 @@
+"""Module to define the EmbeddingCache class, a persistent content-addressed
+store of embedding vectors.
+"""
+import os
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums, metrics
+
+# SQLite limits the number of host parameters in a single statement
+_MAX_VARIABLES = 500
+
+
+class EmbeddingCache:
+    """Caches embedding vectors on disk in SQLite, keyed by a hash of the
+    text and every setting that changes its embedding.
+
+    Vectors are stored as packed float32 blobs. When the cache grows past
+    `max_entries`, the least recently used entries are evicted.
+
+    Lookups only read the database: the access times they update are kept
+    in memory and written with the next store, once `flush_size` keys were
+    looked up, or when the cache is flushed or closed, so that a query
+    embedding found in the cache does not wait for a write.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = enums.EMBEDDING_CACHE_PATH,
+        max_entries: Optional[int] = enums.EMBEDDING_CACHE_MAX_ENTRIES,
+        flush_size: int = enums.EMBEDDING_CACHE_FLUSH_SIZE,
+    ) -> None:
+        """Initializes the EmbeddingCache, creating the database if needed.
+
+        Parameters
+        ----------
+        path : Optional[str], optional
+            The filepath of the SQLite database, by default
+            EMBEDDING_CACHE_PATH.
+        max_entries : Optional[int], optional
+            The maximum number of cached vectors. If None, the cache is
+            unbounded, by default EMBEDDING_CACHE_MAX_ENTRIES.
+        flush_size : int, optional
+            The number of keys looked up whose access times are buffered
+            before they are written, by default EMBEDDING_CACHE_FLUSH_SIZE.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_size = max(1, flush_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # The access times not yet written, by key
+        self._accessed: Dict[bytes, int] = {}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, vector BLOB NOT NULL, "
+            "accessed INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed "
+            "ON embeddings (accessed)"
+        )
+        self._connection.commit()
+        self._count, self._clock = self._connection.execute(
+            "SELECT COUNT(*), COALESCE(MAX(accessed), 0) FROM embeddings"
+        ).fetchone()
+
+    @staticmethod
+    def make_key(
+        text: str,
+        model_name: str,
+        output_dimensionality: Optional[int],
+        task_type: Optional[str],
+        quantized: bool = False,
+        normalized: bool = False,
+    ) -> bytes:
+        """Compute the cache key of a text embedded with the given settings.
+
+        Parameters
+        ----------
+        text : str
+            The embedded text.
+        model_name : str
+            The name of the embedding model.
+        output_dimensionality : Optional[int]
+            The size of the output embeddings.
+        task_type : Optional[str]
+            The task type the embedding was generated for.
+        quantized : bool, optional
+            Whether the model was quantized, by default False.
+        normalized : bool, optional
+            Whether the embedding was normalized to unit length, by default
+            False.
+
+        Returns
+        -------
+        bytes
+            The SHA-256 digest identifying the embedding.
+        """
+        digest = hashlib.sha256()
+        settings = (
+            model_name,
+            output_dimensionality,
+            task_type,
+            quantized,
+            normalized,
+        )
+        for part in settings:
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\x1f")
+        digest.update(text.encode("utf-8"))
+        return digest.digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Look up the vectors of many keys at once.
+
+        Parameters
+        ----------
+        keys : List[bytes]
+            The keys to look up.
+
+        Returns
+        -------
+        Dict[bytes, np.ndarray]
+            The cached float32 vectors of the keys that were found, as
+            read-only views of the stored blobs.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            self._clock += 1
+            for start in range(0, len(unique_keys), _MAX_VARIABLES):
+                batch = unique_keys[start : start + _MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    "SELECT key, vector FROM embeddings "
+                    f"WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                    self._accessed[key] = self._clock
+            if len(self._accessed) >= self.flush_size:
+                self._flush()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items: Iterable[Tuple[bytes, np.ndarray]]) -> None:
+        """Store many vectors at once, evicting the least recently used
+        entries if the cache grows past its maximum size.
+
+        Parameters
+        ----------
+        items : Iterable[Tuple[bytes, np.ndarray]]
+            The `(key, vector)` pairs to store.
+        """
+        with self._lock:
+            self._clock += 1
+            rows = [
+                (
+                    key,
+                    np.asarray(vector, dtype=np.float32).tobytes(),
+                    self._clock,
+                )
+                for key, vector in items
+            ]
+            if not rows:
+                return
+            # Evict by up-to-date access times
+            self._flush(commit=False)
+            before = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, accessed) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            self._count += self._connection.total_changes - before
+            if self.max_entries and self._count > self.max_entries:
+                excess = self._count - self.max_entries
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM "
+                    "embeddings ORDER BY accessed LIMIT ?)",
+                    (excess,),
+                )
+                self._count -= excess
+                self.evictions += excess
+            self._connection.commit()
+
+    def _flush(self, commit: bool = True) -> None:
+        """Write the buffered access times, with the lock held."""
+        if not self._accessed:
+            return
+        self._connection.executemany(
+            "UPDATE embeddings SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self._accessed.items()],
+        )
+        self._accessed.clear()
+        if commit:
+            self._connection.commit()
+
+    def flush(self) -> None:
+        """Write the access times of the keys looked up since the last
+        write.
+        """
+        with self._lock:
+            self._flush()
+
+    def __len__(self) -> int:
+        """The number of cached vectors."""
+        return self._count
+
+    def stats(self) -> Dict[str, int]:
+        """Report the size and hit/miss counters of the cache.
+
+        Returns
+        -------
+        Dict[str, int]
+            The entries, hits, misses and evictions of the cache.
+        """
+        return {
+            "entries": self._count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        """Write the buffered access times and close the database
+        connection.
+        """
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+
+def embed_with_cache(
+    cache: EmbeddingCache,
+    texts: List[str],
+    embed: Callable[[List[str]], np.ndarray],
+    model_name: str,
+    output_dimensionality: Optional[int] = None,
+    task_type: Optional[str] = None,
+    quantized: bool = False,
+    normalized: bool = False,
+) -> np.ndarray:
+    """Generate embeddings for the texts, only calling `embed` for the texts
+    missing from the cache.
+
+    Parameters
+    ----------
+    cache : EmbeddingCache
+        The cache checked before embedding and filled afterwards.
+    texts : List[str]
+        The texts to generate embeddings for.
+    embed : Callable[[List[str]], np.ndarray]
+        Generates the embedding matrix of the missing texts.
+    model_name : str
+        The name of the embedding model.
+    output_dimensionality : Optional[int], optional
+        The size of the output embeddings, by default None.
+    task_type : Optional[str], optional
+        The task type the embeddings are generated for, by default None.
+    quantized : bool, optional
+        Whether the model is quantized, by default False.
+    normalized : bool, optional
+        Whether the embeddings are normalized to unit length, by default
+        False.
+
+    Returns
+    -------
+    np.ndarray
+        The float32 matrix of the embeddings of the texts, one row per text
+        in input order.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    keys = [
+        EmbeddingCache.make_key(
+            text,
+            model_name,
+            output_dimensionality,
+            task_type,
+            quantized=quantized,
+            normalized=normalized,
+        )
+        for text in texts
+    ]
+    found = cache.get_many(keys)
+    hits = sum(1 for key in keys if key in found)
+    metrics.EMBEDDING_CACHE.inc(hits, result="hit")
+    metrics.EMBEDDING_CACHE.inc(len(keys) - hits, result="miss")
+
+    # Embed each missing text once, even if it is repeated in the input
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found:
+            missing.setdefault(key, text)
+    if missing:
+        embeddings = np.asarray(
+            embed(list(missing.values())), dtype=np.float32
+        )
+        computed = dict(zip(missing.keys(), embeddings))
+        cache.put_many(computed.items())
+        found.update(computed)
+    logger.debug(
+        "Embedded %s texts with %s cache misses" % (len(texts), len(missing))
+    )
+
+    # A single copy of the cached and computed rows into one matrix
+    return np.stack([found[key] for key in keys])
@@ -0,0 +1,223 @@
+"""Module to define the EmbeddingClient class, which sends texts to a remote
+embedding API in right-sized, concurrent, rate-limited batches.
+"""
+import time
+import logging
+import threading
+from typing import Callable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums, metrics
+from utils.retry import call_with_retry
+from utils.rate_limit import TokenBucket
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text, at roughly four characters
+    per token.
+
+    Parameters
+    ----------
+    text : str
+        The text to estimate.
+
+    Returns
+    -------
+    int
+        The estimated number of tokens.
+    """
+    return len(text) // 4 + 1
+
+
+class EmbeddingClient:
+    """Embeds texts through a batch embedding callable, splitting the input
+    into batches that respect the provider's limits and running them
+    concurrently under an in-flight cap and a token bucket rate limit.
+    Transient failures are retried with jittered backoff, and the vectors are
+    returned in input order.
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], List[List[float]]],
+        batch_size: Optional[int] = enums.EMBEDDING_BATCH_SIZE,
+        max_batch_tokens: Optional[int] = enums.EMBEDDING_MAX_BATCH_TOKENS,
+        max_in_flight: Optional[int] = enums.EMBEDDING_MAX_IN_FLIGHT,
+        requests_per_minute: Optional[float] = (
+            enums.EMBEDDING_REQUESTS_PER_MINUTE
+        ),
+        max_retries: Optional[int] = enums.EMBEDDING_MAX_RETRIES,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ) -> None:
+        """Initializes the EmbeddingClient with a batch embedding callable and
+        its limits.
+
+        Parameters
+        ----------
+        embed_batch : Callable[[List[str]], List[List[float]]]
+            Sends a single batch request and returns one vector per text.
+        batch_size : Optional[int], optional
+            The maximum number of texts per request, by default
+            EMBEDDING_BATCH_SIZE.
+        max_batch_tokens : Optional[int], optional
+            The maximum estimated number of tokens per request, by default
+            EMBEDDING_MAX_BATCH_TOKENS.
+        max_in_flight : Optional[int], optional
+            The maximum number of concurrent requests, by default
+            EMBEDDING_MAX_IN_FLIGHT.
+        requests_per_minute : Optional[float], optional
+            The maximum request rate. If None, requests are not rate limited,
+            by default EMBEDDING_REQUESTS_PER_MINUTE.
+        max_retries : Optional[int], optional
+            The maximum number of retries of a failed request, by default
+            EMBEDDING_MAX_RETRIES.
+        base_delay : float, optional
+            The backoff delay cap of the first retry in seconds, by default
+            0.5.
+        max_delay : float, optional
+            The maximum backoff delay in seconds, by default 30.0.
+        """
+        self.embed_batch = embed_batch
+        self.batch_size = max(1, batch_size or 1)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_in_flight = max(1, max_in_flight or 1)
+        self.rate_limiter = (
+            TokenBucket(
+                rate=requests_per_minute / 60.0,
+                capacity=self.max_in_flight,
+            )
+            if requests_per_minute
+            else None
+        )
+        self.max_retries = max_retries or 0
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Lazily create the thread pool shared by every call."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_in_flight,
+                    thread_name_prefix="embedding-client",
+                )
+            return self._executor
+
+    def _split_batches(self, texts: List[str]) -> List[List[int]]:
+        """Split the texts into batches of indices under the count and token
+        limits.
+
+        Parameters
+        ----------
+        texts : List[str]
+            The texts to split.
+
+        Returns
+        -------
+        List[List[int]]
+            The indices of the texts in each batch, in input order.
+        """
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for index, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            if batch and (
+                len(batch) >= self.batch_size
+                or (
+                    self.max_batch_tokens
+                    and batch_tokens + tokens > self.max_batch_tokens
+                )
+            ):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(index)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _send(self, texts: List[str]) -> List[List[float]]:
+        """Send a single rate-limited batch request."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        metrics.BATCH_SIZE.observe(len(texts), batch="embedding")
+        metrics.TOKENS.inc(
+            sum(estimate_tokens(text) for text in texts), kind="embedding"
+        )
+        embeddings = self.embed_batch(texts)
+        if len(embeddings) != len(texts):
+            raise ValueError(
+                "Expected %s embeddings, got %s"
+                % (len(texts), len(embeddings))
+            )
+        return embeddings
+
+    def _send_with_retry(self, texts: List[str]) -> List[List[float]]:
+        """Send a single batch request, retrying transient failures."""
+        return call_with_retry(
+            self._send,
+            texts,
+            max_retries=self.max_retries,
+            base_delay=self.base_delay,
+            max_delay=self.max_delay,
+        )
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed the texts, returning one vector per text in input order.
+
+        Parameters
+        ----------
+        texts : List[str]
+            The texts to embed.
+
+        Returns
+        -------
+        np.ndarray
+            The float32 matrix of the embeddings of the texts, one row per
+            text in input order.
+        """
+        if len(texts) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        start = time.perf_counter()
+        batches = self._split_batches(texts)
+        with metrics.span("embed"):
+            if len(batches) == 1:
+                results = [self._send_with_retry(texts)]
+            else:
+                results = self._get_executor().map(
+                    self._send_with_retry,
+                    [[texts[index] for index in batch] for batch in batches],
+                )
+            # Each batch is packed as soon as it arrives, so the boxed
+            # floats of the API response are freed batch by batch
+            embeddings = None
+            for batch, batch_embeddings in zip(batches, results):
+                vectors = np.asarray(batch_embeddings, dtype=np.float32)
+                if embeddings is None:
+                    embeddings = np.empty(
+                        (len(texts), vectors.shape[1]), dtype=np.float32
+                    )
+                embeddings[batch] = vectors
+        logger.debug(
+            "Embedded %s texts in %s batches in %.2fs"
+            % (len(texts), len(batches), time.perf_counter() - start)
+        )
+        return embeddings
+
+    def close(self) -> None:
+        """Shut down the thread pool of the client."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
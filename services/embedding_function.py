@@ -2,6 +2,8 @@
 import logging
 from typing import Optional, Union, List
 
+import numpy as np
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,16 +20,21 @@ from chromadb import EmbeddingFunction, Documents
 
 from utils import enums
 from models.document import Document
+from services.embedding_cache import EmbeddingCache, embed_with_cache
+from services.embedding_client import EmbeddingClient
 
 
 class GeminiEmbeddingFunction(EmbeddingFunction):
     """Generates embeddings for text documents using Google's Text Embedding
     API and stores them in a ChromaDB collection.
     """
+
     def __init__(
         self,
         model_name: Optional[str] = enums.EMBEDDING_MODEL,
         output_dimensionality: Optional[int] = enums.OUTPUT_DIMENSIONALITY,
+        client: Optional[EmbeddingClient] = None,
+        cache: Optional[EmbeddingCache] = None,
     ) -> None:
         """Initializes the EmbeddingGenerator with a GenerativeModel instance
         and a PersistentClient instance for storing embeddings.
@@ -39,19 +46,49 @@ class GeminiEmbeddingFunction(EmbeddingFunction):
             "models/text-embedding-004"
         output_dimensionality : Optional[int], optional
             The size of the output embeddings, by default 768
+        client : Optional[EmbeddingClient], optional
+            The client batching, rate limiting and retrying requests to the
+            embedding API. If None, a client with the default limits is
+            created, by default None.
+        cache : Optional[EmbeddingCache], optional
+            The persistent cache checked before calling the embedding API. If
+            None, every text is sent to the API, by default None.
         """
         super().__init__()
         self.model_name = model_name
         self.output_dimensionality = output_dimensionality
+        self.task_type = enums.EMBEDDING_TASK_TYPE
+        self.cache = cache
         self.embedding_function = GoogleGenerativeAIEmbeddings(
             model=model_name,
-            task_type="retrieval_document",
+            task_type=self.task_type,
         )
+        self.client = client or EmbeddingClient(embed_batch=self._embed_batch)
 
-    def __call__(
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Sends a single batch embedding request to the API.
+
+        Parameters
+        ----------
+        texts : List[str]
+            The texts of the batch, already sized by the EmbeddingClient.
+
+        Returns
+        -------
+        List[List[float]]
+            The embeddings for the texts.
+        """
+        return self.embedding_function.embed_documents(
+            texts=texts,
+            batch_size=len(texts),
+            output_dimensionality=self.output_dimensionality,
+        )
+
+    def embed_matrix(
         self, input: Union[Documents, List[Document], List[str], str]
-    ) -> List[List[float]]:
-        """Generates embeddings for the input text documents.
+    ) -> np.ndarray:
+        """Generates embeddings for the input text documents as a single
+        float32 matrix.
 
         Parameters
         ----------
@@ -60,8 +97,9 @@ class GeminiEmbeddingFunction(EmbeddingFunction):
 
         Returns
         -------
-        List[List[float]]
-            The embeddings for the input text documents.
+        np.ndarray
+            The embeddings for the input text documents, one row per
+            document.
         """
         # Convert input to a list of strings
         if isinstance(input, str):
@@ -73,11 +111,35 @@ class GeminiEmbeddingFunction(EmbeddingFunction):
         ):
             input = [doc.page_content for doc in input]
 
-        return self.embedding_function.embed_documents(
-            texts=input,
+        if self.cache is None:
+            return self.client.embed(list(input))
+        return embed_with_cache(
+            self.cache,
+            list(input),
+            self.client.embed,
+            model_name=self.model_name,
             output_dimensionality=self.output_dimensionality,
+            task_type=self.task_type,
         )
 
+    def __call__(
+        self, input: Union[Documents, List[Document], List[str], str]
+    ) -> List[List[float]]:
+        """Generates embeddings for the input text documents, as the lists
+        ChromaDB expects from an embedding function.
+
+        Parameters
+        ----------
+        input : Union[Documents, List[Document], List[str], str]
+            The input text documents to generate embeddings for.
+
+        Returns
+        -------
+        List[List[float]]
+            The embeddings for the input text documents.
+        """
+        return self.embed_matrix(input).tolist()
+
     def embed_documents(
         self, documents: Union[Documents, List[Document], List[str], str]
     ) -> List[List[float]]:
@@ -94,3 +156,45 @@ class GeminiEmbeddingFunction(EmbeddingFunction):
             The embeddings for the input text documents.
         """
         return self(documents)
+
+
+def create_embedding_function(
+    backend: Optional[str] = enums.EMBEDDING_BACKEND,
+    cache: Optional[EmbeddingCache] = None,
+) -> EmbeddingFunction:
+    """Create the embedding function of the configured backend.
+
+    Parameters
+    ----------
+    backend : Optional[str], optional
+        `"gemini"` to embed with Google's Text Embedding API, or `"local"`
+        to embed with a sentence-transformers model on the CPU, by default
+        EMBEDDING_BACKEND.
+    cache : Optional[EmbeddingCache], optional
+        The persistent cache of embeddings, by default None.
+
+    Returns
+    -------
+    EmbeddingFunction
+        The embedding function.
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown.
+    """
+    if backend == "gemini":
+        return GeminiEmbeddingFunction(
+            model_name=enums.EMBEDDING_MODEL,
+            output_dimensionality=enums.OUTPUT_DIMENSIONALITY,
+            cache=cache,
+        )
+    if backend == "local":
+        from services.local_embedding_function import (
+            SentenceTransformerEmbeddingFunction,
+        )
+
+        return SentenceTransformerEmbeddingFunction(
+            model_name=enums.LOCAL_EMBEDDING_MODEL, cache=cache
+        )
+    raise ValueError(f"Unknown embedding backend: {backend}")
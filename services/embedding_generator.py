@@ -16,11 +16,16 @@ try:
 except ImportError:
     pass
 
+import numpy as np
 from chromadb import EmbeddingFunction, Documents
 
 from models.document import Document
 from utils import enums
-from services.embedding_function import GeminiEmbeddingFunction
+from utils.priority import background
+from services.embedding_function import (
+    GeminiEmbeddingFunction,
+    create_embedding_function,
+)
 
 
 class EmbeddingGenerator:
@@ -39,70 +44,42 @@ class EmbeddingGenerator:
 
         Parameters
         ----------
+        embedding_function : Optional[EmbeddingFunction], optional
+            The embedding function to use. If None, the function of the
+            EMBEDDING_BACKEND is created, by default None.
         model_name : Optional[str], optional
-            The name of the text embedding model to use, by default
-            "models/text-embedding-004"
+            The name of the text embedding model to use with the gemini
+            backend, by default "models/text-embedding-004"
+        output_dimensionality : Optional[int], optional
+            The size of the output embeddings of the gemini backend, by
+            default 768
         """
-        self.embedding_function = (
-            embedding_function or GeminiEmbeddingFunction(
-                model=model_name, output_dimensionality=output_dimensionality
+        if embedding_function is None and enums.EMBEDDING_BACKEND == "gemini":
+            embedding_function = GeminiEmbeddingFunction(
+                model_name=model_name,
+                output_dimensionality=output_dimensionality,
             )
+        self.embedding_function = (
+            embedding_function or create_embedding_function()
         )
 
-    def _chunkify_text(
-        self, text: str,
-        chunk_size: Optional[int] = 1000,
-        chunk_overlap: Optional[int] = 100
-    ) -> List[str]:
-        """Splits a text into chunks of a specified size with a specified
-        overlap.
-
-        Parameters
-        ----------
-        text : str
-            The text to split into chunks.
-        chunk_size : Optional[int], optional
-            The size of each text chunk, by default 1000.
-        chunk_overlap : Optional[int], optional
-            The overlap between chunks, by default 100.
-
-        Returns
-        -------
-        List[str]
-            A list of text chunks.
-        """
-        # Initialize variables
-        chunks = []
-        start = 0
-        end = chunk_size
-        chunk_overlap = (
-            0 if chunk_overlap is None or chunk_overlap < 0 else chunk_overlap
-        )
-
-        # Split the text into chunks
-        while start < len(text):
-            chunks.append(text[start:end])
-            start = end - chunk_overlap
-            end = start + chunk_size
-
-        return chunks
-
     def generate_embeddings(
         self,
         documents: Union[Documents, List[Document], List[str], str],
-        chunk_size: Optional[int] = None,
-        chunk_overlap: Optional[int] = 100,
-    ) -> None:
+    ) -> np.ndarray:
         """Generates embeddings for the input text documents.
 
         Parameters
         ----------
         documents : Union[Documents, List[Document], List[str], str]
-            The input text documents to generate embeddings for.
-        chunk_size : Optional[int], optional
-            The size of each text chunk, by default None.
-        chunk_overlap : Optional[int], optional
-            The overlap between chunks, by default 100.
+            The input text documents to generate embeddings for. Documents
+            are embedded as they are, so they should already be chunked.
+
+        Returns
+        -------
+        np.ndarray
+            The float32 matrix of the embeddings, one row per input document,
+            in order.
         """
         # Convert input to a list of strings
         if isinstance(documents, str):
@@ -114,22 +91,17 @@ class EmbeddingGenerator:
         ):
             documents = [doc.page_content for doc in documents]
 
-        # Get chunks of text if chunk_size is specified
-        if chunk_size is not None and chunk_size > 0 and chunk_overlap > 0:
-            logger.info(
-                "Chunking text into chunks of size %s with an overlap of %s..."
-                % (chunk_size, chunk_overlap)
-            )
-            documents = [
-                self._chunkify_text(doc, chunk_size, chunk_overlap)
-                for doc in documents
-            ]
-
         # Generate embeddings for the input text documents
         logger.info(
             "Generating embeddings for %s documents..." % (len(documents))
         )
-        if len(documents) > 0:
-            return self.embedding_function(documents)
-        else:
-            return []
+        if len(documents) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        # Embedding functions of this package produce the matrix directly,
+        # without the lists ChromaDB expects from __call__
+        # Embedding the chunks is the ingestion, which queries go ahead of
+        embed_matrix = getattr(self.embedding_function, "embed_matrix", None)
+        with background():
+            if embed_matrix is not None:
+                return embed_matrix(documents)
+            return np.asarray(self.embedding_function(documents), np.float32)
@@ -0,0 +1,366 @@
+"""Module to define the ExtractionCache class, a persistent store of the text
+extracted from pdf files, so that re-chunking and re-embedding never parse
+the same pdf twice.
+"""
+import os
+import json
+import mmap
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from utils import enums
+
+
+class CachedExtraction:
+    """The cached pages of one pdf file, read lazily from a memory-mapped
+    JSONL file through its offsets file, so pages can be streamed or looked
+    up by position without loading the whole file.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Opens the cached pages stored at `path`.
+
+        Parameters
+        ----------
+        path : str
+            The folder of the cache entry.
+
+        Raises
+        ------
+        OSError
+            If the entry is missing or unreadable.
+        ValueError
+            If the entry is truncated.
+        """
+        self.path = path
+        self._offsets = np.fromfile(
+            os.path.join(path, ExtractionCache.OFFSETS_FILE), dtype="<u8"
+        )
+        if len(self._offsets) == 0:
+            raise ValueError(f"Truncated offsets file in {path}")
+        self._mmap: Optional[mmap.mmap] = None
+        self._data: Any = b""
+        pages_path = os.path.join(path, ExtractionCache.PAGES_FILE)
+        with open(pages_path, "rb") as file:
+            # Empty files cannot be memory-mapped
+            if os.fstat(file.fileno()).st_size:
+                self._mmap = mmap.mmap(
+                    file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+                self._data = self._mmap
+        if len(self._data) != self._offsets[-1]:
+            self.close()
+            raise ValueError(f"Truncated pages file in {path}")
+
+    def __len__(self) -> int:
+        """The number of cached pages."""
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> Tuple[int, str]:
+        """Read the `(page_number, text)` tuple of the page at a position."""
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        index %= len(self)
+        start, end = self._offsets[index], self._offsets[index + 1]
+        page = json.loads(self._data[start:end])
+        return page["page"], page["text"]
+
+    def __iter__(self) -> Iterator[Tuple[int, str]]:
+        """Stream the `(page_number, text)` tuples of the pages in order."""
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self) -> None:
+        """Unmap the pages file."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._data = b""
+
+    def __enter__(self) -> "CachedExtraction":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+class ExtractionCache:
+    """Caches the text extracted from pdf files on disk, keyed by the content
+    hash of the file, the version of the extractor and the extraction
+    options, so a file is parsed again only if one of them changes.
+
+    Every entry is a folder holding a JSONL file with one
+    `{"page": ..., "text": ...}` line per page and a binary file of the
+    little-endian uint64 byte offsets of the lines. Entries are written to a
+    temporary folder and renamed into place, so a reader never sees a
+    partial entry.
+
+    Reading an entry updates the modification time of its offsets file, and
+    when the entries grow past `max_bytes`, the least recently used ones are
+    deleted.
+    """
+
+    # Bumped when the layout of the entries changes. Version 2 entries hold
+    # their pages in page order, so they can be streamed
+    VERSION = 2
+    PAGES_FILE = "pages.jsonl"
+    OFFSETS_FILE = "offsets.u64"
+
+    def __init__(
+        self,
+        path: str = enums.EXTRACTION_CACHE_PATH,
+        max_bytes: Optional[int] = enums.EXTRACTION_CACHE_MAX_BYTES,
+    ) -> None:
+        """Initializes the ExtractionCache, creating its folder if needed.
+
+        Parameters
+        ----------
+        path : str, optional
+            The folder of the cache, by default EXTRACTION_CACHE_PATH.
+        max_bytes : Optional[int], optional
+            The maximum size of the cached entries. If None, the cache is
+            unbounded, by default EXTRACTION_CACHE_MAX_BYTES.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def make_key(
+        cls, file_hash: str, extractor: str, options: Dict[str, Any]
+    ) -> str:
+        """Compute the cache key of a pdf file extracted with the given
+        extractor and options.
+
+        Parameters
+        ----------
+        file_hash : str
+            The content hash of the pdf file.
+        extractor : str
+            The name and version of the extractor.
+        options : Dict[str, Any]
+            The JSON-serializable options changing the extracted text.
+
+        Returns
+        -------
+        str
+            The SHA-256 hex digest identifying the extraction.
+        """
+        digest = hashlib.sha256()
+        for part in (
+            cls.VERSION,
+            file_hash,
+            extractor,
+            json.dumps(options, sort_keys=True),
+        ):
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\x1f")
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        """The folder of a cache entry, fanned out by key prefix."""
+        return os.path.join(self.path, key[:2], key)
+
+    def __contains__(self, key: str) -> bool:
+        """Whether the pages of a key are cached."""
+        return os.path.exists(
+            os.path.join(self._entry_path(key), self.OFFSETS_FILE)
+        )
+
+    def lookup(self, key: str) -> bool:
+        """Check whether the pages of a key are cached without opening
+        them, counting a miss if they are not.
+
+        Parameters
+        ----------
+        key : str
+            The cache key.
+
+        Returns
+        -------
+        bool
+            Whether the pages are cached, to be opened with `get`.
+        """
+        if key in self:
+            return True
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def get(self, key: str) -> Optional[CachedExtraction]:
+        """Open the cached pages of a key.
+
+        Parameters
+        ----------
+        key : str
+            The cache key.
+
+        Returns
+        -------
+        Optional[CachedExtraction]
+            The cached pages, to be closed by the caller, or None if they are
+            missing or unreadable.
+        """
+        try:
+            extraction = CachedExtraction(self._entry_path(key))
+        except FileNotFoundError:
+            extraction = None
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "Ignoring unreadable extraction cache entry %s: %s" % (key, e)
+            )
+            extraction = None
+        if extraction is not None:
+            try:
+                os.utime(os.path.join(extraction.path, self.OFFSETS_FILE))
+            except OSError:
+                # A read-only cache is still usable, without eviction order
+                pass
+        with self._lock:
+            if extraction is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return extraction
+
+    def put(self, key: str, pages: Iterable[Tuple[int, str]]) -> int:
+        """Store the pages extracted for a key, replacing any cached ones.
+
+        Parameters
+        ----------
+        key : str
+            The cache key.
+        pages : Iterable[Tuple[int, str]]
+            The `(page_number, text)` tuples, in page order.
+
+        Returns
+        -------
+        int
+            The number of bytes of text written.
+        """
+        path = self._entry_path(key)
+        # Write to a sibling folder, then swap it in
+        suffix = f"{os.getpid()}-{threading.get_ident()}"
+        temporary_path = f"{path}.tmp-{suffix}"
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+        offsets = [0]
+        pages_path = os.path.join(temporary_path, self.PAGES_FILE)
+        with open(pages_path, "wb") as file:
+            for page_number, text in pages:
+                line = json.dumps(
+                    {"page": page_number, "text": text}, ensure_ascii=False
+                ).encode("utf-8")
+                file.write(line + b"\n")
+                offsets.append(offsets[-1] + len(line) + 1)
+        np.asarray(offsets, dtype="<u8").tofile(
+            os.path.join(temporary_path, self.OFFSETS_FILE)
+        )
+        previous_path = f"{path}.old-{suffix}"
+        try:
+            if os.path.exists(path):
+                os.replace(path, previous_path)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            # Another process stored the same pages first
+            logger.debug("Discarding extraction of %s: %s" % (key, e))
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        shutil.rmtree(previous_path, ignore_errors=True)
+        logger.debug(
+            "Cached %s extracted pages in %s" % (len(offsets) - 1, path)
+        )
+        self.evict(keep=key)
+        return offsets[-1]
+
+    def _entries(self) -> List[Tuple[int, int, str]]:
+        """The last use, size and key of every complete entry."""
+        entries = []
+        for prefix in os.scandir(self.path):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                # Skip the folders of writes in progress
+                if not entry.is_dir() or "." in entry.name:
+                    continue
+                try:
+                    offsets = os.stat(
+                        os.path.join(entry.path, self.OFFSETS_FILE)
+                    )
+                    pages = os.stat(os.path.join(entry.path, self.PAGES_FILE))
+                except OSError:
+                    continue
+                entries.append(
+                    (
+                        offsets.st_mtime_ns,
+                        offsets.st_size + pages.st_size,
+                        entry.name,
+                    )
+                )
+        return entries
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Delete the least recently used entries until the cache fits in
+        `max_bytes`.
+
+        Readers holding an evicted entry open keep reading it, since its
+        files are only unlinked.
+
+        Parameters
+        ----------
+        keep : Optional[str], optional
+            The key of an entry never evicted, such as the one just stored,
+            by default None.
+
+        Returns
+        -------
+        int
+            The number of entries evicted.
+        """
+        if not self.max_bytes:
+            return 0
+        entries = sorted(self._entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        evicted = 0
+        for _, entry_size, key in entries:
+            if size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            size -= entry_size
+            evicted += 1
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+            logger.info(
+                "Evicted %s extraction cache entries, keeping %s bytes"
+                % (evicted, size)
+            )
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        """Report the counters of the cache.
+
+        Returns
+        -------
+        Dict[str, int]
+            The hits, misses and evictions of the cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
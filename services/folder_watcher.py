@@ -0,0 +1,189 @@
+"""Module to define the FolderWatcher class, which detects the pdf files
+added, changed or removed in the game system folders while the API runs.
+"""
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums
+from utils.file_utils import scan_pdf_files
+
+# The (size, mtime_ns) tuple of every pdf file of a folder, by filepath
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+class FolderChanges(NamedTuple):
+    """The pdf files added, changed and removed in a folder."""
+
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+
+
+def diff_snapshots(before: Snapshot, after: Snapshot) -> FolderChanges:
+    """Compare two snapshots of a folder.
+
+    Parameters
+    ----------
+    before : Snapshot
+        The earlier snapshot.
+    after : Snapshot
+        The later snapshot.
+
+    Returns
+    -------
+    FolderChanges
+        The pdf files added, changed and removed between the snapshots.
+    """
+    return FolderChanges(
+        added=sorted(after.keys() - before.keys()),
+        changed=sorted(
+            filepath
+            for filepath in after.keys() & before.keys()
+            if after[filepath] != before[filepath]
+        ),
+        removed=sorted(before.keys() - after.keys()),
+    )
+
+
+class FolderWatcher:
+    """Polls folders for added, changed and removed pdf files, with one
+    `os.scandir` per folder and poll, and reports the changes of a folder
+    once its files stopped changing for `debounce_seconds`, so that a pdf
+    file still being copied is not ingested half-written.
+
+    Polling works on every platform and on mounted volumes, such as the
+    bind mount of the pdf folder into the container, where file system
+    events are often not delivered.
+    """
+
+    def __init__(
+        self,
+        folders: List[str],
+        on_change: Callable[[str, FolderChanges], None],
+        poll_seconds: float = enums.WATCH_POLL_SECONDS,
+        debounce_seconds: float = enums.WATCH_DEBOUNCE_SECONDS,
+    ) -> None:
+        """Initializes the FolderWatcher, without scanning the folders.
+
+        Parameters
+        ----------
+        folders : List[str]
+            The folders to watch.
+        on_change : Callable[[str, FolderChanges], None]
+            Called from the watcher thread with a folder and its changes,
+            once they settled.
+        poll_seconds : float, optional
+            The interval between two scans of the folders, by default
+            WATCH_POLL_SECONDS.
+        debounce_seconds : float, optional
+            How long the files of a folder must stay unchanged before its
+            changes are reported, by default WATCH_DEBOUNCE_SECONDS.
+        """
+        self.folders = list(folders)
+        self.on_change = on_change
+        self.poll_seconds = poll_seconds
+        self.debounce_seconds = debounce_seconds
+        # The snapshots last reported, and last scanned, per folder
+        self._reported: Dict[str, Snapshot] = {}
+        self._scanned: Dict[str, Snapshot] = {}
+        # When the files of a folder last changed, if not reported yet
+        self._changed_at: Dict[str, float] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _scan(self, folder: str) -> Snapshot:
+        """Take a snapshot of a folder, empty if it cannot be read."""
+        try:
+            return scan_pdf_files(folder)
+        except OSError as e:
+            logger.debug("Error scanning %s: %s" % (folder, e))
+            return {}
+
+    def scan(self) -> None:
+        """Take the snapshots the next changes are reported against, such as
+        the state of the folders before they are first ingested.
+        """
+        for folder in self.folders:
+            snapshot = self._scan(folder)
+            self._reported[folder] = snapshot
+            self._scanned[folder] = snapshot
+            self._changed_at.pop(folder, None)
+
+    def poll(self) -> List[Tuple[str, FolderChanges]]:
+        """Scan every folder once, and report the changes that settled.
+
+        Returns
+        -------
+        List[Tuple[str, FolderChanges]]
+            The folders reported to `on_change`, with their changes.
+        """
+        reported = []
+        for folder in self.folders:
+            snapshot = self._scan(folder)
+            now = time.monotonic()
+            if snapshot != self._scanned.get(folder, {}):
+                # Still changing, wait until it settles
+                self._scanned[folder] = snapshot
+                self._changed_at[folder] = now
+                continue
+            changed_at = self._changed_at.get(folder)
+            if changed_at is None or now - changed_at < self.debounce_seconds:
+                continue
+            del self._changed_at[folder]
+            changes = diff_snapshots(self._reported.get(folder, {}), snapshot)
+            self._reported[folder] = snapshot
+            if not (changes.added or changes.changed or changes.removed):
+                continue
+            logger.info(
+                "Detected %s added, %s changed and %s removed pdf files in "
+                "%s"
+                % (
+                    len(changes.added),
+                    len(changes.changed),
+                    len(changes.removed),
+                    folder,
+                )
+            )
+            reported.append((folder, changes))
+            try:
+                self.on_change(folder, changes)
+            except Exception as e:
+                logger.exception(
+                    "Error handling the changes of %s: %s" % (folder, e)
+                )
+        return reported
+
+    def run(self) -> None:
+        """Poll the folders until stopped."""
+        while not self._stop.wait(self.poll_seconds):
+            self.poll()
+
+    def start(self) -> None:
+        """Start polling the folders in a background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self.run, name="folder-watcher", daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            "Watching %s folders for pdf files every %ss"
+            % (len(self.folders), self.poll_seconds)
+        )
+
+    def stop(self) -> None:
+        """Stop polling the folders."""
+        self._stop.set()
+        if (
+            self._thread is not None
+            and self._thread is not threading.current_thread()
+        ):
+            self._thread.join()
+        self._thread = None
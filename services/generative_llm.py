@@ -1,24 +1,375 @@
-"""Module to define the GenerativeLLM class for generating text using Google's
-Large Language Models.
+"""Module to define the GenerativeLLM class, a managed client generating text
+with Google's Large Language Models, and the backends it sends requests
+through.
 """
+import os
+import json
+import time
+import asyncio
+import logging
+import weakref
+import threading
+import http.client
+from collections import deque
+from urllib.parse import urlsplit
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Union,
+)
 
-from typing import Optional
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-import google.generativeai as genai
+from utils import enums
+from utils.retry import call_with_retry
 
-from utils.enums import LLM_MODEL
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
+# Number of recent latencies the hedging delay is computed from
+_LATENCY_WINDOW = 200
+
+
+class GeneratedText(NamedTuple):
+    """A response of the generative model."""
+
+    text: str
+
+
+class GenerationError(Exception):
+    """An error response of the generative model API."""
+
+    def __init__(self, message: str, code: Optional[int] = None) -> None:
+        super().__init__(message)
+        # The HTTP status, used to tell transient failures apart
+        self.code = code
+
+
+class GenerationBackend:
+    """Sends a single generation request to a generative model."""
+
+    def generate(
+        self, contents: str, timeout: Optional[float], **kwargs: Any
+    ) -> Any:
+        """Generate a response to a prompt.
+
+        Parameters
+        ----------
+        contents : str
+            The prompt.
+        timeout : Optional[float]
+            The number of seconds the request may take, or None to wait
+            indefinitely.
+        **kwargs : Any
+            Backend-specific options.
+
+        Returns
+        -------
+        Any
+            The response, with the generated text in `text`.
+        """
+        raise NotImplementedError
+
+    async def generate_async(
+        self,
+        contents: str,
+        timeout: Optional[float],
+        stream: bool = False,
+        **kwargs: Any,
+    ) -> Any:
+        """Generate a response to a prompt without blocking the event loop.
+
+        Backends without native asynchronous calls run `generate` in a
+        thread, and stream the whole response as a single fragment.
+
+        Parameters
+        ----------
+        contents : str
+            The prompt.
+        timeout : Optional[float]
+            The number of seconds the request may take, or None to wait
+            indefinitely.
+        stream : bool, optional
+            Whether to return an async iterator of response fragments, by
+            default False.
+        **kwargs : Any
+            Backend-specific options.
+
+        Returns
+        -------
+        Any
+            The response, or an async iterator of its fragments if streamed.
+        """
+        response = await asyncio.to_thread(
+            self.generate, contents, timeout, **kwargs
+        )
+        if not stream:
+            return response
+
+        async def fragments() -> AsyncIterator[Any]:
+            yield response
+
+        return fragments()
+
+    def close(self) -> None:
+        """Release the connections of the backend."""
+
+
+class GeminiBackend(GenerationBackend):
+    """Sends requests through the google-generativeai SDK, whose client
+    keeps its connections open between requests.
+    """
+
+    def __init__(self, model_name: Optional[str] = enums.LLM_MODEL) -> None:
+        """Initializes the GeminiBackend with the specified model.
+
+        Parameters
+        ----------
+        model_name : Optional[str], optional
+            The name of the generative model to use, by default LLM_MODEL
+        """
+        self.model = GenerativeLLM.get_model(model_name=model_name)
+
+    def generate(
+        self, contents: str, timeout: Optional[float], **kwargs: Any
+    ) -> Any:
+        try:
+            return self.model.generate_content(
+                contents=contents,
+                request_options={"timeout": timeout},
+                **kwargs,
+            )
+        except Exception as e:
+            # Surfaced like the other deadlines of the client
+            if type(e).__name__ == "DeadlineExceeded":
+                raise TimeoutError(str(e)) from e
+            raise
+
+    async def generate_async(
+        self,
+        contents: str,
+        timeout: Optional[float],
+        stream: bool = False,
+        **kwargs: Any,
+    ) -> Any:
+        return await self.model.generate_content_async(
+            contents=contents,
+            stream=stream,
+            request_options={"timeout": timeout},
+            **kwargs,
+        )
+
+
+class RestBackend(GenerationBackend):
+    """Sends requests to the `generateContent` method of the Gemini REST
+    API, over a pool of persistent HTTP connections shared by every thread.
+    """
+
+    def __init__(
+        self,
+        model_name: Optional[str] = enums.LLM_MODEL,
+        endpoint: Optional[str] = enums.LLM_ENDPOINT,
+        api_key: Optional[str] = None,
+        pool_size: Optional[int] = enums.LLM_MAX_CONCURRENCY,
+    ) -> None:
+        """Initializes the RestBackend.
+
+        Parameters
+        ----------
+        model_name : Optional[str], optional
+            The name of the generative model to use, by default LLM_MODEL
+        endpoint : Optional[str], optional
+            The base URL of the API, by default LLM_ENDPOINT.
+        api_key : Optional[str], optional
+            The API key. If None, the GOOGLE_API_KEY environment variable is
+            used, by default None.
+        pool_size : Optional[int], optional
+            The maximum number of idle connections kept open, by default
+            LLM_MAX_CONCURRENCY.
+        """
+        url = urlsplit(endpoint)
+        self.model_name = model_name
+        self.api_key = api_key or os.getenv("GOOGLE_API_KEY", "")
+        self.path = f"{url.path.rstrip('/')}/v1beta/{model_name}"
+        self.pool_size = max(1, pool_size or 1)
+        self._host = url.netloc
+        self._connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def _acquire(
+        self, timeout: Optional[float]
+    ) -> http.client.HTTPConnection:
+        """Take an idle connection, or open a new one."""
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._connection_class(self._host, timeout=timeout)
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection
+
+    def _release(self, connection: http.client.HTTPConnection) -> None:
+        """Return a connection to the pool, or close it if the pool is
+        full.
+        """
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def generate(
+        self,
+        contents: str,
+        timeout: Optional[float],
+        generation_config: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> GeneratedText:
+        body = {"contents": [{"role": "user", "parts": [{"text": contents}]}]}
+        if generation_config:
+            body["generationConfig"] = generation_config
+        connection = self._acquire(timeout)
+        try:
+            connection.request(
+                "POST",
+                f"{self.path}:generateContent",
+                body=json.dumps(body),
+                headers={
+                    "Content-Type": "application/json",
+                    "x-goog-api-key": self.api_key,
+                },
+            )
+            response = connection.getresponse()
+            payload = response.read()
+        except BaseException:
+            # The connection may be left mid-response
+            connection.close()
+            raise
+        self._release(connection)
+        if response.status != 200:
+            raise GenerationError(
+                "Generation failed with status %s: %s"
+                % (response.status, payload[:200].decode(errors="replace")),
+                code=response.status,
+            )
+        try:
+            candidate = json.loads(payload)["candidates"][0]
+            parts = candidate.get("content", {}).get("parts", [])
+        except (ValueError, KeyError, IndexError) as e:
+            raise GenerationError(f"Unexpected response: {e}") from e
+        return GeneratedText(
+            text="".join(part.get("text", "") for part in parts)
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
 
 
 class GenerativeLLM:
-    """Class to define the GenerativeModel for generating text using Google's
-    Large Language Models.
+    """A managed client generating text with Google's Large Language Models.
+
+    At most `max_concurrency` requests run at the same time in the process,
+    so that bursts of queries queue instead of overrunning the quota. Every
+    call has a deadline, covering the wait for a slot, every attempt and
+    the backoff between them, and transient failures are retried until the
+    deadline. With hedging, a call still running after the `hedge_quantile`
+    of recent latencies sends a duplicate request if a slot is free, and
+    the first response wins.
     """
+
+    def __init__(
+        self,
+        backend: Optional[GenerationBackend] = None,
+        model_name: Optional[str] = enums.LLM_MODEL,
+        max_concurrency: Optional[int] = enums.LLM_MAX_CONCURRENCY,
+        timeout: Optional[float] = enums.LLM_TIMEOUT_SECONDS,
+        max_retries: Optional[int] = enums.LLM_MAX_RETRIES,
+        hedge: bool = enums.LLM_HEDGE_ENABLED,
+        hedge_quantile: float = enums.LLM_HEDGE_QUANTILE,
+        hedge_min_samples: int = enums.LLM_HEDGE_MIN_SAMPLES,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+    ) -> None:
+        """Initializes the GenerativeLLM.
+
+        Parameters
+        ----------
+        backend : Optional[GenerationBackend], optional
+            Sends the requests. If None, requests go through the
+            google-generativeai SDK, by default None.
+        model_name : Optional[str], optional
+            The name of the generative model of the default backend, by
+            default LLM_MODEL.
+        max_concurrency : Optional[int], optional
+            The maximum number of requests in flight, by default
+            LLM_MAX_CONCURRENCY.
+        timeout : Optional[float], optional
+            The deadline of a call in seconds, by default
+            LLM_TIMEOUT_SECONDS.
+        max_retries : Optional[int], optional
+            The maximum number of retries of a failed call, by default
+            LLM_MAX_RETRIES.
+        hedge : bool, optional
+            Whether to send a duplicate of slow requests, by default
+            LLM_HEDGE_ENABLED.
+        hedge_quantile : float, optional
+            The quantile of recent latencies after which a request is
+            duplicated, by default LLM_HEDGE_QUANTILE.
+        hedge_min_samples : int, optional
+            The number of latencies recorded before requests are hedged, by
+            default LLM_HEDGE_MIN_SAMPLES.
+        base_delay : float, optional
+            The backoff delay cap of the first retry in seconds, by default
+            0.5.
+        max_delay : float, optional
+            The maximum backoff delay in seconds, by default 8.0.
+        """
+        self.backend = backend or GeminiBackend(model_name=model_name)
+        self.max_concurrency = max(1, max_concurrency or 1)
+        self.timeout = timeout
+        self.max_retries = max_retries or 0
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = max(1, hedge_min_samples)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedged = 0
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._latencies: deque = deque(maxlen=_LATENCY_WINDOW)
+        self._executor = None
+        self._lock = threading.Lock()
+
     @classmethod
     def get_model(
-        cls, model_name: Optional[str] = LLM_MODEL
-    ) -> genai.GenerativeModel:
+        cls, model_name: Optional[str] = enums.LLM_MODEL
+    ) -> "genai.GenerativeModel":
         """Initializes the GenerativeModel instance with the specified model.
 
+        Kept for callers that need the bare SDK model, without the limits
+        of the managed client.
+
         Parameters
         ----------
         model_name : Optional[str], optional
@@ -29,4 +380,255 @@ class GenerativeLLM:
         genai.GenerativeModel
             The initialized GenerativeModel instance
         """
+        import google.generativeai as genai
+
         return genai.GenerativeModel(model_name=model_name)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Lazily create the thread pool running hedged requests."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    thread_name_prefix="generative-llm",
+                )
+            return self._executor
+
+    def _remaining(self, deadline: Optional[float]) -> Optional[float]:
+        """The seconds left before a deadline, raising once it has passed."""
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("The generation deadline was exceeded")
+        return remaining
+
+    def _acquire_slot(self, deadline: Optional[float]) -> None:
+        """Wait for a free concurrency slot until the deadline."""
+        if not self._slots.acquire(timeout=self._remaining(deadline)):
+            raise TimeoutError(
+                "No generation slot freed up before the deadline"
+            )
+
+    def hedge_delay(self) -> Optional[float]:
+        """The latency after which a request is hedged, or None if too few
+        latencies were recorded.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[int(self.hedge_quantile * (len(latencies) - 1))]
+
+    def _send(
+        self, contents: str, deadline: Optional[float], **kwargs: Any
+    ) -> Any:
+        """Send one request in an acquired slot, and release the slot."""
+        try:
+            start = time.perf_counter()
+            response = self.backend.generate(
+                contents, self._remaining(deadline), **kwargs
+            )
+            with self._lock:
+                self._latencies.append(time.perf_counter() - start)
+            return response
+        finally:
+            self._slots.release()
+
+    def _send_hedged(
+        self, contents: str, deadline: Optional[float], **kwargs: Any
+    ) -> Any:
+        """Send a request, and a duplicate if it is slower than usual."""
+        self._acquire_slot(deadline)
+        delay = self.hedge_delay() if self.hedge else None
+        if delay is None:
+            return self._send(contents, deadline, **kwargs)
+
+        executor = self._get_executor()
+        futures: List[Future] = [
+            executor.submit(self._send, contents, deadline, **kwargs)
+        ]
+        done, _ = wait(futures, timeout=delay)
+        # Only hedge with a free slot, so hedging never exceeds the cap
+        if not done and self._slots.acquire(blocking=False):
+            with self._lock:
+                self.hedged += 1
+            logger.debug("Hedging a request slower than %.2fs" % delay)
+            futures.append(
+                executor.submit(self._send, contents, deadline, **kwargs)
+            )
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=self._remaining(deadline),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                raise TimeoutError("The generation deadline was exceeded")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def generate_content(
+        self, contents: str, timeout: Optional[float] = None, **kwargs: Any
+    ) -> Any:
+        """Generate a response to a prompt.
+
+        Parameters
+        ----------
+        contents : str
+            The prompt.
+        timeout : Optional[float], optional
+            The deadline of the call in seconds. If None, the timeout of the
+            client is used, by default None.
+        **kwargs : Any
+            Backend-specific options.
+
+        Returns
+        -------
+        Any
+            The response, with the generated text in `text`.
+
+        Raises
+        ------
+        TimeoutError
+            If no response is received before the deadline.
+        Exception
+            The error of the last attempt, if it is not transient or the
+            retries are exhausted.
+        """
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        return call_with_retry(
+            self._send_hedged,
+            contents,
+            deadline,
+            max_retries=self.max_retries,
+            base_delay=self.base_delay,
+            max_delay=self.max_delay,
+            # No retry starts after the deadline, nor sleeps past it
+            deadline=deadline,
+            **kwargs,
+        )
+
+    async def generate_content_async(
+        self,
+        contents: str,
+        stream: bool = False,
+        timeout: Optional[float] = None,
+        **kwargs: Any,
+    ) -> Union[Any, AsyncIterator[Any]]:
+        """Generate a response to a prompt without blocking the event loop.
+
+        The call waits for a concurrency slot and is bounded by the deadline
+        like `generate_content`. A streamed response holds its slot until it
+        is consumed, and only the start of the stream is bounded, since
+        the client reads it at its own pace. Asynchronous calls are neither
+        retried nor hedged.
+
+        Parameters
+        ----------
+        contents : str
+            The prompt.
+        stream : bool, optional
+            Whether to return an async iterator of response fragments, by
+            default False.
+        timeout : Optional[float], optional
+            The deadline of the call in seconds. If None, the timeout of the
+            client is used, by default None.
+        **kwargs : Any
+            Backend-specific options.
+
+        Returns
+        -------
+        Union[Any, AsyncIterator[Any]]
+            The response, or an async iterator of its fragments if streamed.
+
+        Raises
+        ------
+        TimeoutError
+            If no response is received before the deadline.
+        """
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout if timeout else None
+        # Polled, so that a cancelled call never takes a slot
+        while not self._slots.acquire(blocking=False):
+            self._remaining(deadline)
+            await asyncio.sleep(0.005)
+        try:
+            response = await asyncio.wait_for(
+                self.backend.generate_async(
+                    contents, self._remaining(deadline), stream, **kwargs
+                ),
+                timeout=self._remaining(deadline),
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        if not stream:
+            self._slots.release()
+            return response
+
+        released = threading.Event()
+
+        def release() -> None:
+            if not released.is_set():
+                released.set()
+                self._slots.release()
+
+        async def fragments() -> AsyncIterator[Any]:
+            try:
+                async for fragment in response:
+                    yield fragment
+            finally:
+                release()
+
+        iterator = fragments()
+        # A stream dropped before it is read still frees its slot
+        weakref.finalize(iterator, release)
+        return iterator
+
+    def close(self) -> None:
+        """Shut down the thread pool and the connections of the client."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        # Outside the lock, which the requests still running take
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self.backend.close()
+
+
+def create_generative_llm(
+    backend: Optional[str] = enums.LLM_BACKEND,
+    model_name: Optional[str] = enums.LLM_MODEL,
+) -> GenerativeLLM:
+    """Create the generative model client of the configured backend.
+
+    Parameters
+    ----------
+    backend : Optional[str], optional
+        `"gemini"` to send requests through the google-generativeai SDK, or
+        `"rest"` to send them to the REST API over pooled connections, by
+        default LLM_BACKEND.
+    model_name : Optional[str], optional
+        The name of the generative model, by default LLM_MODEL.
+
+    Returns
+    -------
+    GenerativeLLM
+        The client.
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown.
+    """
+    if backend == "gemini":
+        return GenerativeLLM(backend=GeminiBackend(model_name=model_name))
+    if backend == "rest":
+        return GenerativeLLM(backend=RestBackend(model_name=model_name))
+    raise ValueError(f"Unknown generative model backend: {backend}")
@@ -0,0 +1,229 @@
+"""Module to define the IncrementalIndexer class, which keeps a ChromaDB
+collection in sync with the pdf files of the game system folders.
+"""
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from chromadb import Collection
+
+from models.document import Document
+from utils.file_utils import get_pdf_filepaths, hash_file
+from services.index_manifest import IndexManifest
+from services.extraction_cache import ExtractionCache
+from services.page_deduplicator import parse_aliases
+from services.document_processor import DocumentProcessor
+from services.embedding_generator import EmbeddingGenerator
+from services.ingestion_pipeline import IngestionPipeline
+
+
+class IncrementalIndexer:
+    """Indexes only the new or changed pdf files of a folder and deletes the
+    vectors of removed ones, using an IndexManifest to detect changes.
+
+    Files whose size and modification time are unchanged are skipped without
+    being read, and files that were touched but have the same content hash
+    are skipped without being re-extracted.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        embedding_generator: EmbeddingGenerator,
+        manifest: IndexManifest,
+        chunker: Optional[Callable[[Document], Iterable[Document]]] = None,
+        parallel: bool = True,
+        extraction_cache: Optional[ExtractionCache] = None,
+        throttle: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        """Initializes the IncrementalIndexer.
+
+        Parameters
+        ----------
+        collection : Collection
+            The ChromaDB collection to keep in sync.
+        embedding_generator : EmbeddingGenerator
+            The generator embedding the chunks of new or changed files.
+        manifest : IndexManifest
+            The manifest of the files already indexed into the collection.
+        chunker : Optional[Callable[[Document], Iterable[Document]]], optional
+            Splits each page Document into chunk Documents. If None, pages
+            are split by a MarkdownChunker, by default None.
+        parallel : bool, optional
+            Whether to extract pdf pages in a pool of worker processes, by
+            default True.
+        extraction_cache : Optional[ExtractionCache], optional
+            The cache of the text extracted from pdf files, so files already
+            parsed are not parsed again when their chunks are rebuilt, by
+            default None.
+        throttle : Optional[Callable[[], Any]], optional
+            Called between the batches of the ingestion, and blocking while
+            it must yield to queries, by default None.
+        """
+        self.collection = collection
+        self.embedding_generator = embedding_generator
+        self.manifest = manifest
+        self.chunker = chunker
+        self.parallel = parallel
+        self.extraction_cache = extraction_cache
+        self.throttle = throttle
+        # The chunks deleted and the files indexed by the last sync, which
+        # the search indexes are updated with
+        self.removed_ids: List[str] = []
+        self.indexed_filepaths: List[str] = []
+
+        # A collection rebuilt from scratch invalidates the manifest
+        if self.collection.count() == 0 and self.manifest.files:
+            logger.warning(
+                "ChromaDB collection is empty, discarding the index manifest."
+            )
+            self.manifest.clear()
+            self.manifest.save()
+
+    def _delete_file(self, filepath: str) -> None:
+        """Delete every vector stored for a pdf file."""
+        results = self.collection.get(
+            where={"filepath": filepath}, include=[]
+        )
+        if results["ids"]:
+            self.collection.delete(ids=results["ids"])
+            self.removed_ids.extend(results["ids"])
+
+    def _alias_filepaths(self, filepath: str) -> Set[str]:
+        """Get the other pdf files with pages skipped as duplicates of the
+        pages of a pdf file, which lose their only copy if it is deleted.
+        """
+        results = self.collection.get(
+            where={"filepath": filepath}, include=["metadatas"]
+        )
+        return {
+            alias_filepath
+            for metadata in results["metadatas"]
+            for alias_filepath, _ in parse_aliases(metadata.get("aliases"))
+            if alias_filepath != filepath
+        }
+
+    def sync(
+        self, folder: str, filepaths: Optional[List[str]] = None
+    ) -> Dict[str, int]:
+        """Bring the collection in sync with the pdf files of a folder.
+
+        Parameters
+        ----------
+        folder : str
+            The game system folder containing the pdf files.
+        filepaths : Optional[List[str]], optional
+            The current pdf files of the folder. If None, the folder is
+            listed, by default None.
+
+        Returns
+        -------
+        Dict[str, int]
+            The number of `added`, `changed`, `removed` and `unchanged` files,
+            the number of `chunks` written, and the number of `pages_saved`
+            by skipping empty and duplicate pages.
+        """
+        start = time.perf_counter()
+        if filepaths is None:
+            filepaths = get_pdf_filepaths(folder)
+        stats = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+        self.removed_ids = []
+        self.indexed_filepaths = []
+
+        # Files whose skipped duplicate pages must be indexed again
+        dependents = set()
+
+        # Delete the vectors of removed files
+        for filepath in set(self.manifest.filepaths(folder)) - set(filepaths):
+            logger.info(f"Removing {filepath} from the index...")
+            dependents |= self._alias_filepaths(filepath)
+            self._delete_file(filepath)
+            self.manifest.remove(filepath)
+            stats["removed"] += 1
+
+        # Find the new or changed files
+        to_index = []
+        file_stats = {}
+        # Hashed once here, and passed to the processor for its cache keys
+        file_hashes = {}
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            file_stats[filepath] = stat
+            entry = self.manifest.get(filepath)
+            if (
+                entry is not None
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime
+            ):
+                file_hashes[filepath] = entry["sha256"]
+                stats["unchanged"] += 1
+                continue
+            file_hash = hash_file(filepath)
+            file_hashes[filepath] = file_hash
+            if entry is not None and entry["sha256"] == file_hash:
+                # Touched but not modified
+                self.manifest.set(
+                    filepath,
+                    stat.st_size,
+                    stat.st_mtime,
+                    file_hash,
+                    entry["chunks"],
+                )
+                stats["unchanged"] += 1
+                continue
+            stats["changed" if entry is not None else "added"] += 1
+            to_index.append(filepath)
+
+        for filepath in to_index:
+            dependents |= self._alias_filepaths(filepath)
+        to_index.extend(
+            sorted(dependents.intersection(filepaths) - set(to_index))
+        )
+
+        # Replace the vectors of new or changed files
+        chunks = 0
+        pages_saved = 0
+        if to_index:
+            for filepath in to_index:
+                # Also clears vectors stored before the manifest existed
+                self._delete_file(filepath)
+            processor = DocumentProcessor(
+                base_folder=folder,
+                cache=self.extraction_cache,
+                file_hashes=file_hashes,
+            )
+            pipeline = IngestionPipeline(
+                processor=processor,
+                embedding_generator=self.embedding_generator,
+                collection=self.collection,
+                chunker=self.chunker,
+                parallel=self.parallel,
+                throttle=self.throttle,
+            )
+            chunks = pipeline.run(filepaths=to_index)
+            self.indexed_filepaths = list(to_index)
+            if pipeline.deduplicator is not None:
+                pages_saved = pipeline.deduplicator.pages_saved
+            for filepath in to_index:
+                stat = file_stats[filepath]
+                self.manifest.set(
+                    filepath,
+                    stat.st_size,
+                    stat.st_mtime,
+                    file_hashes[filepath],
+                    pipeline.chunks_per_file.get(filepath, 0),
+                )
+        self.manifest.save()
+
+        stats["chunks"] = chunks
+        stats["pages_saved"] = pages_saved
+        logger.info(
+            "Synced %s in %.2fs: %s"
+            % (folder, time.perf_counter() - start, stats)
+        )
+        return stats
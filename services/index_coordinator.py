@@ -0,0 +1,206 @@
+"""Module to define the IndexCoordinator class, which shares the ingestion and
+the index between the worker processes of a server.
+"""
+import os
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums
+from utils.file_lock import FileLock
+from services import dependencies
+from services.indexing import IndexState, IngestionWorker
+from services.index_generations import IndexGenerations
+
+
+class IndexCoordinator:
+    """Elects a single ingestion leader among the worker processes of a
+    server, so that the pdf files are ingested once however many workers
+    run.
+
+    The worker holding the leader lock ingests into CHROMA_DB_PATH, serves
+    queries from it, and publishes it as a new index generation whenever it
+    changed, including when the watched pdf folders change. The other
+    workers, the followers, serve queries from the current generation
+    without writing to it, switch to new generations as they are published,
+    and try to take the lock over on every poll, so a follower becomes the
+    leader if the leader dies. Followers hold a lease on the generations
+    their clients are open on, so the leader does not delete them. If
+    ingestion on startup
+    is disabled, no worker leads, and generations are published by
+    `python ingest.py --publish`.
+    """
+
+    LEADER = "leader"
+    FOLLOWER = "follower"
+
+    def __init__(
+        self,
+        state: IndexState,
+        generations: Optional[IndexGenerations] = None,
+        lock: Optional[FileLock] = None,
+        ingest: bool = True,
+        watch: bool = enums.WATCH_FOLDERS,
+        poll_seconds: float = enums.INDEX_GENERATION_POLL_SECONDS,
+    ) -> None:
+        """Initializes the IndexCoordinator.
+
+        Parameters
+        ----------
+        state : IndexState
+            The state of the index, updated with the role of the process.
+        generations : Optional[IndexGenerations], optional
+            The published index generations. If None, the generations in
+            INDEX_GENERATIONS_PATH are used, by default None.
+        lock : Optional[FileLock], optional
+            The lock held by the leader. If None, INDEX_LEADER_LOCK_PATH is
+            locked, by default None.
+        ingest : bool, optional
+            Whether to run for the leader role and ingest, by default True.
+        watch : bool, optional
+            Whether the leader keeps ingesting the pdf files that change
+            after the first ingestion, by default WATCH_FOLDERS.
+        poll_seconds : float, optional
+            The interval between checks for a new generation or a free
+            leader lock, by default INDEX_GENERATION_POLL_SECONDS.
+        """
+        self.state = state
+        self.generations = generations or IndexGenerations()
+        self.lock = lock or FileLock(enums.INDEX_LEADER_LOCK_PATH)
+        self.ingest = ingest
+        self.watch = watch
+        # The ingestion of the leader
+        self.worker: Optional[IngestionWorker] = None
+        self.poll_seconds = poll_seconds
+        self.role: Optional[str] = None
+        # The generation served by a follower
+        self.generation: Optional[str] = None
+        # The leases on the served and the previous generations, oldest
+        # first
+        self._leases: List[Tuple[str, FileLock]] = []
+        self._stop = threading.Event()
+
+    @property
+    def serving(self) -> bool:
+        """Whether queries can be served, which followers only do once a
+        generation is published.
+        """
+        return self.role == self.LEADER or self.generation is not None
+
+    def run(self) -> None:
+        """Follow the published generations until the leader lock is free,
+        then lead, or until stopped.
+        """
+        while not self._stop.is_set():
+            if self.ingest and self.lock.acquire(blocking=False):
+                self.lead()
+                return
+            self.follow()
+            self._stop.wait(self.poll_seconds)
+
+    def stop(self) -> None:
+        """Stop following the published generations, or watching the pdf
+        folders if leading.
+        """
+        self._stop.set()
+        if self.worker is not None:
+            self.worker.stop()
+
+    def follow(self) -> bool:
+        """Switch to the current generation, if a new one was published.
+
+        Returns
+        -------
+        bool
+            Whether the process switched to a new generation.
+        """
+        path = self.generations.current()
+        if path is None or path == self.generation:
+            return False
+        if not self._leases or self._leases[-1][0] != path:
+            lease = self.generations.lease(path)
+            if lease is None:
+                return False
+            self._leases.append((path, lease))
+        dependencies.use_index(path)
+        # The clients of the previous generation are closed at the next
+        # switch, so its lease is kept until then
+        self._release_leases(keep=2)
+        try:
+            dependencies.get_retriever()
+            documents = dependencies.count_documents()
+        except Exception as e:
+            logger.exception(
+                "Error opening index generation %s: %s" % (path, e)
+            )
+            return False
+        self.role = self.FOLLOWER
+        self.generation = path
+        self.state.set_role(self.FOLLOWER, os.path.basename(path))
+        self.state.set_clients_ready(documents=documents)
+        logger.info(
+            "Serving index generation %s with %s documents"
+            % (path, documents)
+        )
+        return True
+
+    def lead(self) -> None:
+        """Ingest into CHROMA_DB_PATH, serving queries from it meanwhile, and
+        publish it as a new generation after every ingestion.
+        """
+        logger.info("Elected ingestion leader (pid %s)" % os.getpid())
+        self.role = self.LEADER
+        self.generation = None
+        self.state.set_role(self.LEADER, None)
+        dependencies.use_index(None)
+        self._release_leases(keep=1)
+        try:
+            dependencies.get_retriever()
+            dependencies.get_model()
+            self.state.set_clients_ready(
+                documents=dependencies.count_documents()
+            )
+        except Exception as e:
+            logger.exception("Error constructing the clients: %s" % e)
+            self.state.fail(e)
+            return
+        self.worker = IngestionWorker(
+            self.state, watch=self.watch, on_ingested=self.publish
+        )
+        if not self._stop.is_set():
+            self.worker.run()
+
+    def _release_leases(self, keep: int) -> None:
+        """Release the leases on generations, except the last `keep`."""
+        while len(self._leases) > keep:
+            _, lease = self._leases.pop(0)
+            lease.release()
+
+    def publish(self) -> Optional[str]:
+        """Publish CHROMA_DB_PATH as a new generation, if the last ingestion
+        changed it or no generation was published yet.
+
+        Returns
+        -------
+        Optional[str]
+            The folder of the new generation, or None if nothing changed.
+        """
+        files = self.state.to_dict()["files"]
+        changed = files["added"] or files["changed"] or files["removed"]
+        path = self.generations.current()
+        if not changed and path is not None:
+            self.state.set_role(self.role, os.path.basename(path))
+            return None
+        # No client may hold the index open while it is copied, so queries
+        # are held back until the copy is done, the clients the leader
+        # serves them with are closed once every query in flight is done,
+        # and they are reopened by the next queries
+        with dependencies.get_query_traffic().paused():
+            dependencies.close_index()
+            path = self.generations.publish(enums.CHROMA_DB_PATH)
+        self.state.set_role(self.role, os.path.basename(path))
+        return path
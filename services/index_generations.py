@@ -0,0 +1,192 @@
+"""Module to define the IndexGenerations class, which publishes read-only
+snapshots of the index folder for the worker processes of a server.
+"""
+import os
+import time
+import shutil
+import sqlite3
+import logging
+import tempfile
+from typing import List, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums, metrics
+from utils.file_lock import FileLock
+
+
+def _copy_file(source: str, destination: str) -> str:
+    """Copy a file of the index folder, copying SQLite databases through
+    the backup API, so that the copy is consistent even if a connection to
+    the database is open.
+    """
+    if source.endswith(".sqlite3"):
+        connection = sqlite3.connect(source)
+        copy = sqlite3.connect(destination)
+        try:
+            connection.backup(copy)
+        finally:
+            copy.close()
+            connection.close()
+        return destination
+    return shutil.copy2(source, destination)
+
+
+class IndexGenerations:
+    """Publishes snapshots of the index folder, the ChromaDB database with
+    its manifest and search indexes, as numbered generation folders, and
+    points to the latest one with a `CURRENT` file that is atomically
+    replaced.
+
+    A single writer, the ingestion leader, publishes generations, and any
+    number of processes read the current one without writing to it. The
+    last `keep` generations are kept, and so are older ones a reader still
+    holds a lease on, a shared lock on the `<generation>.lease` file, so
+    readers can finish the requests they were serving from a generation
+    however late they switch.
+    """
+
+    CURRENT_FILE = "CURRENT"
+    LEASE_SUFFIX = ".lease"
+    # Left behind by a rebuild of the search indexes in progress
+    IGNORED_PATTERNS = ("*.tmp-*", "*.old-*")
+
+    def __init__(
+        self,
+        path: str = enums.INDEX_GENERATIONS_PATH,
+        keep: int = enums.INDEX_GENERATIONS_KEEP,
+    ) -> None:
+        """Initializes the IndexGenerations.
+
+        Parameters
+        ----------
+        path : str, optional
+            The folder of the generations, by default INDEX_GENERATIONS_PATH.
+        keep : int, optional
+            The number of generations kept, by default
+            INDEX_GENERATIONS_KEEP.
+        """
+        self.path = path
+        self.keep = max(2, keep)
+
+    def generations(self) -> List[str]:
+        """List the names of the published generations, oldest first."""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name.isdigit())
+
+    def current(self) -> Optional[str]:
+        """Get the folder of the current generation.
+
+        Returns
+        -------
+        Optional[str]
+            The folder of the latest published generation, or None if none
+            was published.
+        """
+        try:
+            with open(os.path.join(self.path, self.CURRENT_FILE)) as file:
+                name = file.read().strip()
+        except FileNotFoundError:
+            return None
+        path = os.path.join(self.path, name)
+        return path if name and os.path.isdir(path) else None
+
+    def _lease_path(self, name: str) -> str:
+        """The lease file of a generation."""
+        return os.path.join(self.path, name + self.LEASE_SUFFIX)
+
+    def lease(self, path: str) -> Optional[FileLock]:
+        """Take a lease on a generation, so that it is not deleted until
+        the lease is released.
+
+        Parameters
+        ----------
+        path : str
+            The folder of the generation.
+
+        Returns
+        -------
+        Optional[FileLock]
+            The lease, to be released by the caller, or None if the
+            generation is deleted or being deleted.
+        """
+        lease = FileLock(
+            self._lease_path(os.path.basename(os.path.normpath(path))),
+            shared=True,
+        )
+        if not lease.acquire(blocking=False):
+            return None
+        # The generation may have been pruned before the lease was taken
+        if not os.path.isdir(path):
+            lease.release()
+            return None
+        return lease
+
+    def publish(self, source: str) -> str:
+        """Snapshot an index folder as a new generation and make it the
+        current one.
+
+        The folder must not be written to while it is copied.
+
+        Parameters
+        ----------
+        source : str
+            The index folder written by the ingestion.
+
+        Returns
+        -------
+        str
+            The folder of the new generation.
+        """
+        start = time.perf_counter()
+        os.makedirs(self.path, exist_ok=True)
+        generations = self.generations()
+        number = int(generations[-1]) + 1 if generations else 1
+        name = "%08d" % number
+        path = os.path.join(self.path, name)
+        temporary_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        with metrics.span("publish_generation"):
+            shutil.copytree(
+                source,
+                temporary_path,
+                copy_function=_copy_file,
+                ignore=shutil.ignore_patterns(*self.IGNORED_PATTERNS),
+            )
+            os.replace(temporary_path, path)
+
+            # Point readers to the new generation in a single rename
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path, delete=False
+            ) as file:
+                file.write(name)
+            os.replace(file.name, os.path.join(self.path, self.CURRENT_FILE))
+        logger.info(
+            "Published index generation %s in %.2fs"
+            % (path, time.perf_counter() - start)
+        )
+        self.prune()
+        return path
+
+    def prune(self) -> None:
+        """Delete the generations older than the last `keep` that no
+        reader holds a lease on.
+        """
+        for name in self.generations()[: -self.keep]:
+            lock = FileLock(self._lease_path(name))
+            if not lock.acquire(blocking=False):
+                logger.debug("Keeping leased index generation %s" % name)
+                continue
+            try:
+                logger.info("Deleting index generation %s" % name)
+                shutil.rmtree(
+                    os.path.join(self.path, name), ignore_errors=True
+                )
+                os.remove(lock.path)
+            finally:
+                lock.release()
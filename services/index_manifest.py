@@ -0,0 +1,148 @@
+"""Module to define the IndexManifest class, which records the pdf files that
+have been indexed into a ChromaDB collection.
+"""
+import os
+import json
+import logging
+import tempfile
+from typing import Any, Dict, List, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class IndexManifest:
+    """Records the size, modification time and content hash of every indexed
+    pdf file in a JSON file, so that only new, changed or removed files need
+    to be re-indexed.
+    """
+
+    # Bumped whenever the way files are chunked or their chunks are
+    # identified changes, so that every file is re-indexed
+    VERSION = 3
+
+    def __init__(self, path: str) -> None:
+        """Initializes the IndexManifest, loading the manifest file if it
+        exists.
+
+        Parameters
+        ----------
+        path : str
+            The filepath of the JSON manifest file.
+        """
+        self.path = path
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.load()
+
+    def load(self) -> None:
+        """Load the manifest file, starting empty if it is missing or was
+        written by an incompatible version.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error("Error reading manifest %s: %s" % (self.path, e))
+            return
+        if manifest.get("version") != self.VERSION:
+            logger.warning(
+                "Ignoring manifest %s with version %s"
+                % (self.path, manifest.get("version"))
+            )
+            return
+        self.files = manifest.get("files", {})
+
+    def save(self) -> None:
+        """Atomically write the manifest file."""
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=directory, delete=False
+        ) as file:
+            json.dump(
+                {"version": self.VERSION, "files": self.files},
+                file,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(file.name, self.path)
+
+    def get(self, filepath: str) -> Optional[Dict[str, Any]]:
+        """Get the recorded entry of a pdf file.
+
+        Parameters
+        ----------
+        filepath : str
+            The filepath of the pdf file.
+
+        Returns
+        -------
+        Optional[Dict[str, Any]]
+            The recorded `size`, `mtime`, `sha256` and `chunks` of the file,
+            or None if the file has not been indexed.
+        """
+        return self.files.get(filepath)
+
+    def set(
+        self, filepath: str, size: int, mtime: float, sha256: str, chunks: int
+    ) -> None:
+        """Record a pdf file as indexed.
+
+        Parameters
+        ----------
+        filepath : str
+            The filepath of the pdf file.
+        size : int
+            The size of the file in bytes.
+        mtime : float
+            The modification time of the file.
+        sha256 : str
+            The SHA-256 hex digest of the file.
+        chunks : int
+            The number of chunks stored for the file.
+        """
+        self.files[filepath] = {
+            "size": size,
+            "mtime": mtime,
+            "sha256": sha256,
+            "chunks": chunks,
+        }
+
+    def remove(self, filepath: str) -> None:
+        """Forget a pdf file.
+
+        Parameters
+        ----------
+        filepath : str
+            The filepath of the pdf file.
+        """
+        self.files.pop(filepath, None)
+
+    def clear(self) -> None:
+        """Forget every pdf file."""
+        self.files = {}
+
+    def filepaths(self, folder: Optional[str] = None) -> List[str]:
+        """List the recorded pdf files.
+
+        Parameters
+        ----------
+        folder : Optional[str], optional
+            Only list the files directly inside this folder, by default None.
+
+        Returns
+        -------
+        List[str]
+            The recorded filepaths.
+        """
+        if folder is None:
+            return list(self.files)
+        folder = os.path.normpath(folder)
+        return [
+            filepath
+            for filepath in self.files
+            if os.path.dirname(os.path.normpath(filepath)) == folder
+        ]
@@ -0,0 +1,535 @@
+"""Module to run the ingestion of the TTRPG rulebooks and track the state of
+the index while it runs.
+"""
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums, metrics
+from utils.priority import lower_thread_priority
+from services import dependencies
+from services.folder_watcher import FolderChanges, FolderWatcher
+from services.vector_index import VectorIndex
+from services.lexical_index import LexicalIndex
+
+
+class IndexState:
+    """Thread-safe record of the state and progress of the index, reported
+    by the health and readiness endpoints.
+    """
+
+    IDLE = "idle"
+    INDEXING = "indexing"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self) -> None:
+        """Initializes an IndexState that has not started indexing."""
+        self._lock = threading.Lock()
+        self.status = self.IDLE
+        self.clients_ready = False
+        self.documents = 0
+        # The role of the process and the index generation it serves, in the
+        # multi-worker mode
+        self.role: Optional[str] = None
+        self.generation: Optional[str] = None
+        self.folders: List[str] = []
+        self.folders_done = 0
+        self.current_folder: Optional[str] = None
+        self.files: Dict[str, int] = {
+            "added": 0,
+            "changed": 0,
+            "removed": 0,
+            "unchanged": 0,
+        }
+        self.chunks = 0
+        self.pages_saved = 0
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        """Whether queries can be served, which is the case as soon as the
+        clients are constructed and the collection has documents, even while
+        new documents are still being indexed.
+        """
+        return self.clients_ready and self.documents > 0
+
+    def set_clients_ready(self, documents: int) -> None:
+        """Record that the clients are constructed."""
+        with self._lock:
+            self.clients_ready = True
+            self.documents = documents
+
+    def set_role(self, role: str, generation: Optional[str]) -> None:
+        """Record the role of the process in the multi-worker mode, and the
+        index generation it serves.
+        """
+        with self._lock:
+            self.role = role
+            self.generation = generation
+
+    def start(self, folders: List[str]) -> None:
+        """Record the start of an ingestion run."""
+        with self._lock:
+            self.status = self.INDEXING
+            self.folders = list(folders)
+            self.folders_done = 0
+            self.files = {key: 0 for key in self.files}
+            self.chunks = 0
+            self.pages_saved = 0
+            self.error = None
+            self.started_at = time.time()
+            self.finished_at = None
+
+    def start_folder(self, folder: str) -> None:
+        """Record that a folder is being synced."""
+        with self._lock:
+            self.current_folder = folder
+
+    def finish_folder(self, stats: Dict[str, int], documents: int) -> None:
+        """Record that the current folder was synced."""
+        with self._lock:
+            self.folders_done += 1
+            self.current_folder = None
+            for key in self.files:
+                self.files[key] += stats.get(key, 0)
+            self.chunks += stats.get("chunks", 0)
+            self.pages_saved += stats.get("pages_saved", 0)
+            self.documents = documents
+
+    def finish(self) -> None:
+        """Record the end of an ingestion run."""
+        with self._lock:
+            self.status = self.READY
+            self.finished_at = time.time()
+
+    def fail(self, error: BaseException) -> None:
+        """Record that an ingestion run failed."""
+        with self._lock:
+            self.status = self.FAILED
+            self.current_folder = None
+            self.error = f"{type(error).__name__}: {error}"
+            self.finished_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Report the state as a JSON-serializable dictionary."""
+        with self._lock:
+            return {
+                "status": self.status,
+                "ready": self.ready,
+                "documents": self.documents,
+                "role": self.role,
+                "generation": self.generation,
+                "folders_total": len(self.folders),
+                "folders_done": self.folders_done,
+                "current_folder": self.current_folder,
+                "files": dict(self.files),
+                "chunks": self.chunks,
+                "pages_saved": self.pages_saved,
+                "error": self.error,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+
+def iter_collection_texts(
+    collection: Any,
+    page_size: int = enums.LEXICAL_INDEX_PAGE_SIZE,
+    throttle: Optional[Callable[[], Any]] = None,
+    where: Optional[Dict[str, Any]] = None,
+) -> Iterator[Tuple[str, str]]:
+    """Page through the chunk texts stored in a collection.
+
+    Parameters
+    ----------
+    collection : Collection
+        The ChromaDB collection.
+    page_size : int, optional
+        The number of chunks fetched per request, by default
+        LEXICAL_INDEX_PAGE_SIZE.
+    throttle : Optional[Callable[[], Any]], optional
+        Called before every request, and blocking while the rebuild must
+        yield to queries, by default None.
+    where : Optional[Dict[str, Any]], optional
+        The metadata filter of the chunks, by default None.
+
+    Yields
+    ------
+    Tuple[str, str]
+        The `(chunk ID, text)` pairs of the collection.
+    """
+    offset = 0
+    while True:
+        if throttle is not None:
+            throttle()
+        page = collection.get(
+            limit=page_size,
+            offset=offset,
+            where=where,
+            include=["documents"],
+        )
+        yield from zip(page["ids"], page["documents"])
+        if len(page["ids"]) < page_size:
+            return
+        offset += page_size
+
+
+def iter_collection_embeddings(
+    collection: Any,
+    page_size: int = enums.LEXICAL_INDEX_PAGE_SIZE,
+    throttle: Optional[Callable[[], Any]] = None,
+    where: Optional[Dict[str, Any]] = None,
+) -> Iterator[Tuple[str, List[float]]]:
+    """Page through the chunk embeddings stored in a collection.
+
+    Parameters
+    ----------
+    collection : Collection
+        The ChromaDB collection.
+    page_size : int, optional
+        The number of chunks fetched per request, by default
+        LEXICAL_INDEX_PAGE_SIZE.
+    throttle : Optional[Callable[[], Any]], optional
+        Called before every request, and blocking while the rebuild must
+        yield to queries, by default None.
+    where : Optional[Dict[str, Any]], optional
+        The metadata filter of the chunks, by default None.
+
+    Yields
+    ------
+    Tuple[str, List[float]]
+        The `(chunk ID, embedding)` pairs of the collection.
+    """
+    offset = 0
+    while True:
+        if throttle is not None:
+            throttle()
+        page = collection.get(
+            limit=page_size,
+            offset=offset,
+            where=where,
+            include=["embeddings"],
+        )
+        yield from zip(page["ids"], page["embeddings"])
+        if len(page["ids"]) < page_size:
+            return
+        offset += page_size
+
+
+def rebuild_lexical_index(shard: Optional[str] = None) -> int:
+    """Rebuild the lexical index of a shard from the chunks stored in its
+    collection.
+
+    Parameters
+    ----------
+    shard : Optional[str], optional
+        The shard, or None for the single collection, by default None.
+
+    Returns
+    -------
+    int
+        The number of indexed chunks.
+    """
+    collection = dependencies.get_collection(shard)
+    with metrics.span("lexical_index_build"):
+        return LexicalIndex.build(
+            dependencies.shard_path(enums.LEXICAL_INDEX_PATH, shard),
+            iter_collection_texts(
+                collection,
+                throttle=dependencies.get_query_traffic().wait_idle,
+            ),
+        )
+
+
+def rebuild_vector_index(shard: Optional[str] = None) -> int:
+    """Rebuild the vector index of a shard from the chunk embeddings stored
+    in its collection.
+
+    Parameters
+    ----------
+    shard : Optional[str], optional
+        The shard, or None for the single collection, by default None.
+
+    Returns
+    -------
+    int
+        The number of indexed chunks.
+    """
+    collection = dependencies.get_collection(shard)
+    with metrics.span("vector_index_build"):
+        return VectorIndex.build(
+            dependencies.shard_path(enums.VECTOR_INDEX_PATH, shard),
+            iter_collection_embeddings(
+                collection,
+                throttle=dependencies.get_query_traffic().wait_idle,
+            ),
+        )
+
+
+def update_search_indexes(
+    shard: Optional[str],
+    removed_ids: List[str],
+    filepaths: List[str],
+) -> None:
+    """Update the lexical and vector indexes of a shard with the chunks
+    removed from its collection and those of the pdf files indexed into it,
+    without reading the other chunks from the collection. Indexes missing
+    or unreadable are rebuilt instead.
+
+    Parameters
+    ----------
+    shard : Optional[str]
+        The shard, or None for the single collection.
+    removed_ids : List[str]
+        The IDs of the chunks removed from the collection.
+    filepaths : List[str]
+        The pdf files whose chunks were written to the collection.
+    """
+    collection = dependencies.get_collection(shard)
+    throttle = dependencies.get_query_traffic().wait_idle
+    where = {"filepath": {"$in": filepaths}}
+
+    path = dependencies.shard_path(enums.LEXICAL_INDEX_PATH, shard)
+    lexical_index = LexicalIndex.load(path)
+    if lexical_index is None:
+        rebuild_lexical_index(shard)
+    else:
+        texts = []
+        if filepaths:
+            texts = iter_collection_texts(
+                collection, throttle=throttle, where=where
+            )
+        try:
+            with metrics.span("lexical_index_update"):
+                lexical_index.update(path, removed_ids, texts)
+        finally:
+            lexical_index.close()
+
+    if not enums.VECTOR_INDEX_ENABLED:
+        return
+    path = dependencies.shard_path(enums.VECTOR_INDEX_PATH, shard)
+    vector_index = VectorIndex.load(path)
+    if vector_index is None:
+        rebuild_vector_index(shard)
+        return
+    embeddings = []
+    if filepaths:
+        embeddings = iter_collection_embeddings(
+            collection, throttle=throttle, where=where
+        )
+    try:
+        with metrics.span("vector_index_update"):
+            vector_index.update(path, removed_ids, embeddings)
+    finally:
+        vector_index.close()
+
+
+def run_ingestion(
+    state: IndexState,
+    folders: Optional[List[str]] = None,
+    pdf_root: Optional[str] = None,
+) -> IndexState:
+    """Sync the collection with the pdf files of every game system folder,
+    recording the progress in the given state.
+
+    Parameters
+    ----------
+    state : IndexState
+        The state updated as the ingestion progresses.
+    folders : Optional[List[str]], optional
+        The game system folders to sync, by default GAME_SYSTEM_FOLDERS.
+    pdf_root : Optional[str], optional
+        The folder containing the game system folders, by default
+        PATH_TO_TTRPG_PDFS.
+
+    Returns
+    -------
+    IndexState
+        The updated state.
+    """
+    folders = enums.GAME_SYSTEM_FOLDERS if folders is None else folders
+    pdf_root = pdf_root or enums.PATH_TO_TTRPG_PDFS
+    state.start(folders)
+    try:
+        # The chunks removed and the files indexed, by changed shard
+        changes: Dict[Optional[str], Tuple[List[str], List[str]]] = {}
+        for folder in folders:
+            state.start_folder(folder)
+            shard = dependencies.shard_of(folder)
+            indexer = dependencies.get_indexer(shard)
+            with metrics.span("ingest_folder"):
+                stats = indexer.sync(folder=os.path.join(pdf_root, folder))
+            if stats["added"] or stats["changed"] or stats["removed"]:
+                removed_ids, filepaths = changes.setdefault(shard, ([], []))
+                removed_ids.extend(indexer.removed_ids)
+                filepaths.extend(indexer.indexed_filepaths)
+            state.finish_folder(
+                stats, documents=dependencies.count_documents()
+            )
+        # Keep the search indexes of every shard in sync with its collection
+        for shard in dict.fromkeys(map(dependencies.shard_of, folders)):
+            if shard in changes:
+                update_search_indexes(shard, *changes[shard])
+                continue
+            path = dependencies.shard_path(enums.LEXICAL_INDEX_PATH, shard)
+            if LexicalIndex.load(path) is None:
+                rebuild_lexical_index(shard)
+            if not enums.VECTOR_INDEX_ENABLED:
+                continue
+            path = dependencies.shard_path(enums.VECTOR_INDEX_PATH, shard)
+            if VectorIndex.load(path) is None:
+                rebuild_vector_index(shard)
+    except Exception as e:
+        logger.exception("Ingestion failed: %s" % e)
+        state.fail(e)
+        return state
+    state.finish()
+    logger.info(
+        "ChromaDB collection contains %s documents." % (state.documents)
+    )
+    logger.info(
+        "Embedding cache stats: %s"
+        % dependencies.get_embedding_cache().stats()
+    )
+    logger.info(
+        "Extraction cache stats: %s"
+        % dependencies.get_extraction_cache().stats()
+    )
+    return state
+
+
+class IngestionWorker:
+    """Runs the ingestion in the calling thread at a low priority: a sync of
+    every game system folder, then, if watching is enabled, a sync of every
+    folder in which a FolderWatcher detects added, changed or removed pdf
+    files, so that they become searchable without a restart.
+
+    The ingestion yields to the queries served meanwhile: its thread, and
+    the threads and processes it starts, run with a raised niceness, and it
+    pauses between batches while queries are in flight.
+    """
+
+    def __init__(
+        self,
+        state: IndexState,
+        folders: Optional[List[str]] = None,
+        pdf_root: Optional[str] = None,
+        watch: bool = enums.WATCH_FOLDERS,
+        on_ingested: Optional[Callable[[], Any]] = None,
+        niceness: int = enums.INGEST_NICENESS,
+    ) -> None:
+        """Initializes the IngestionWorker.
+
+        Parameters
+        ----------
+        state : IndexState
+            The state updated as the ingestion progresses.
+        folders : Optional[List[str]], optional
+            The game system folders to sync, by default GAME_SYSTEM_FOLDERS.
+        pdf_root : Optional[str], optional
+            The folder containing the game system folders, by default
+            PATH_TO_TTRPG_PDFS.
+        watch : bool, optional
+            Whether to keep syncing the folders as their pdf files change,
+            by default WATCH_FOLDERS.
+        on_ingested : Optional[Callable[[], Any]], optional
+            Called after every successful sync, once the search indexes are
+            reloaded, by default None.
+        niceness : int, optional
+            The increment of the niceness of the ingestion thread, by
+            default INGEST_NICENESS.
+        """
+        self.state = state
+        self.folders = list(
+            enums.GAME_SYSTEM_FOLDERS if folders is None else folders
+        )
+        self.pdf_root = pdf_root or enums.PATH_TO_TTRPG_PDFS
+        self.on_ingested = on_ingested
+        self.niceness = niceness
+        # The game system folder of every watched folder
+        self._folders = {
+            os.path.join(self.pdf_root, folder): folder
+            for folder in self.folders
+        }
+        self.watcher = (
+            FolderWatcher(list(self._folders), on_change=self._on_change)
+            if watch
+            else None
+        )
+        # The folders waiting to be synced, in the order they changed
+        self._pending: List[str] = []
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def _on_change(self, path: str, changes: FolderChanges) -> None:
+        """Queue the sync of a folder reported by the watcher."""
+        self.submit(self._folders[path])
+
+    def submit(self, folder: str) -> None:
+        """Queue the sync of a game system folder, unless already queued.
+
+        Parameters
+        ----------
+        folder : str
+            The game system folder.
+        """
+        with self._condition:
+            if folder not in self._pending:
+                self._pending.append(folder)
+            self._condition.notify_all()
+
+    def ingest(self, folders: List[str]) -> None:
+        """Sync game system folders and serve their new chunks.
+
+        Parameters
+        ----------
+        folders : List[str]
+            The game system folders.
+        """
+        run_ingestion(self.state, folders=folders, pdf_root=self.pdf_root)
+        dependencies.reload_search_indexes()
+        if (
+            self.state.status == IndexState.READY
+            and self.on_ingested is not None
+        ):
+            self.on_ingested()
+
+    def run(self) -> None:
+        """Sync every folder, then, if watching, the folders that change,
+        until stopped.
+        """
+        lower_thread_priority(self.niceness)
+        if self.watcher is not None:
+            # Changes made during the first sync are caught up on after it
+            self.watcher.scan()
+        self.ingest(self.folders)
+        if self.watcher is None:
+            return
+        self.watcher.start()
+        try:
+            while True:
+                with self._condition:
+                    while not self._pending and not self._stopped:
+                        self._condition.wait()
+                    if self._stopped:
+                        return
+                    folders, self._pending = self._pending, []
+                self.ingest(folders)
+        finally:
+            self.watcher.stop()
+
+    def stop(self) -> None:
+        """Stop watching the folders, once the sync in progress, if any,
+        finishes.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
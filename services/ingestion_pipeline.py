@@ -0,0 +1,327 @@
+"""Module to define the IngestionPipeline class, which streams documents from
+extraction through chunking and embedding into a ChromaDB collection.
+"""
+import time
+import queue
+import logging
+import threading
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from itertools import batched
+from collections import defaultdict
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from chromadb import Collection
+
+from utils import enums, metrics
+from models.document import Document
+from services.chunker import MarkdownChunker
+from services.chromadb import BulkWriter
+from services.page_deduplicator import PageDeduplicator, format_aliases
+from services.document_processor import DocumentProcessor
+from services.embedding_generator import EmbeddingGenerator
+
+# Marks the end of a stage's output in the queue feeding the next stage
+_END_OF_STAGE = object()
+
+
+class _StageError:
+    """Wraps an exception raised inside a stage thread so that it can be
+    re-raised in the consuming thread.
+    """
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class IngestionPipeline:
+    """Streams documents through an extract, chunk, embed and store chain of
+    stages.
+
+    Every stage runs in its own thread and hands its output to the next stage
+    through a bounded queue, so stages overlap in time while at most a few
+    fixed-size batches are held in memory regardless of the corpus size.
+
+    Empty and near-duplicate pages are dropped after extraction, so they are
+    neither chunked nor embedded. The pages they duplicate are stored with
+    an `aliases` metadata value listing them.
+    """
+
+    def __init__(
+        self,
+        processor: DocumentProcessor,
+        embedding_generator: EmbeddingGenerator,
+        collection: Collection,
+        chunker: Optional[Callable[[Document], Iterable[Document]]] = None,
+        batch_size: Optional[int] = enums.INGESTION_BATCH_SIZE,
+        queue_size: Optional[int] = enums.INGESTION_QUEUE_SIZE,
+        parallel: bool = True,
+        deduplicate: bool = enums.DEDUP_PAGES,
+        throttle: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        """Initializes the IngestionPipeline with the services for each stage.
+
+        Parameters
+        ----------
+        processor : DocumentProcessor
+            The processor extracting one Document per pdf page.
+        embedding_generator : EmbeddingGenerator
+            The generator embedding each batch of chunks.
+        collection : Collection
+            The ChromaDB collection the embedded chunks are written to.
+        chunker : Optional[Callable[[Document], Iterable[Document]]], optional
+            Splits each page Document into chunk Documents. If None, pages
+            are split by a MarkdownChunker, by default None.
+        batch_size : Optional[int], optional
+            The number of chunks embedded and written per batch, by default
+            INGESTION_BATCH_SIZE.
+        queue_size : Optional[int], optional
+            The number of batches buffered between two stages, by default
+            INGESTION_QUEUE_SIZE.
+        parallel : bool, optional
+            Whether to extract pdf pages in a pool of worker processes, by
+            default True.
+        deduplicate : bool, optional
+            Whether to skip empty and near-duplicate pages, by default
+            DEDUP_PAGES.
+        throttle : Optional[Callable[[], Any]], optional
+            Called before every batch is embedded and stored, and blocking
+            while the ingestion must yield to queries, by default None.
+        """
+        self.processor = processor
+        self.embedding_generator = embedding_generator
+        self.collection = collection
+        self.chunker = chunker if chunker is not None else MarkdownChunker()
+        self.batch_size = max(1, batch_size or 1)
+        self.queue_size = max(1, queue_size or 1)
+        self.parallel = parallel
+        self.deduplicator = PageDeduplicator() if deduplicate else None
+        self.throttle = throttle
+        self.pages = 0
+        self.chunks = 0
+        self.stored = 0
+        self.chunks_per_file: Dict[str, int] = defaultdict(int)
+        self.writer: Optional[BulkWriter] = None
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _threaded(self, items: Iterable[Any], maxsize: int) -> Iterator[Any]:
+        """Run an upstream stage in a background thread and yield its output
+        through a bounded queue.
+
+        Parameters
+        ----------
+        items : Iterable[Any]
+            The output of the upstream stage.
+        maxsize : int
+            The maximum number of items buffered in the queue.
+
+        Yields
+        ------
+        Any
+            The items produced by the upstream stage, in order.
+        """
+        buffer = queue.Queue(maxsize=maxsize)
+
+        def put(item: Any) -> bool:
+            # Give up once the pipeline is stopped
+            while not self._stopped.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce() -> None:
+            try:
+                for item in items:
+                    if not put(item):
+                        return
+            except BaseException as e:
+                put(_StageError(e))
+                return
+            finally:
+                # Close the stage, and the stages it reads from, at once
+                # rather than whenever it is garbage collected
+                close = getattr(items, "close", None)
+                if close is not None:
+                    close()
+            put(_END_OF_STAGE)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+        while not self._stopped.is_set():
+            try:
+                item = buffer.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END_OF_STAGE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+
+    def _extract(
+        self, filepaths: Optional[List[str]] = None
+    ) -> Iterator[Document]:
+        """Extract one Document per pdf page, drop the empty and duplicate
+        pages, and split the others into chunks.
+        """
+        documents = self.processor.iter_documents(
+            parallel=self.parallel, filepaths=filepaths
+        )
+        pages = documents
+        if self.deduplicator is not None:
+            pages = self.deduplicator.deduplicate(documents)
+        try:
+            for document in pages:
+                self.pages += 1
+                for chunk in self.chunker(document):
+                    self.chunks += 1
+                    self.chunks_per_file[chunk.filepath] += 1
+                    yield chunk
+        finally:
+            # Shuts the extraction worker processes down if the pipeline
+            # stops early
+            documents.close()
+
+    def _embed(
+        self, batches: Iterable[Tuple[Document, ...]]
+    ) -> Iterator[Tuple[Tuple[Document, ...], np.ndarray]]:
+        """Embed each fixed-size batch of chunks."""
+        for batch in batches:
+            if self.throttle is not None:
+                self.throttle()
+            with metrics.span("ingest_embed"):
+                embeddings = self.embedding_generator.generate_embeddings(
+                    documents=list(batch)
+                )
+            yield batch, embeddings
+
+    def _store(
+        self, batch: Tuple[Document, ...], embeddings: np.ndarray
+    ) -> None:
+        """Upsert a batch of embedded chunks into the collection, in as
+        many writes as the client needs.
+        """
+        if len(embeddings) == 0:
+            logger.warning(
+                "No embeddings generated for the %s documents." % (len(batch))
+            )
+            return
+        metrics.BATCH_SIZE.observe(len(batch), batch="ingestion")
+        if self.throttle is not None:
+            self.throttle()
+        with metrics.span("ingest_store"):
+            self.writer.write(
+                ids=[doc.id for doc in batch],
+                embeddings=embeddings,
+                metadatas=[doc.metadata for doc in batch],
+                documents=[doc.page_content for doc in batch],
+            )
+        self.stored += len(batch)
+
+    def _store_aliases(self) -> None:
+        """Record on the chunks of every page the near-duplicate pages that
+        were skipped in its favor.
+        """
+        for page, aliases in self.deduplicator.aliases.items():
+            filepath, page_number = page
+            results = self.collection.get(
+                where={
+                    "$and": [
+                        {"filepath": filepath},
+                        {"page_number": page_number},
+                    ]
+                },
+                include=["metadatas"],
+            )
+            if not results["ids"]:
+                continue
+            value = format_aliases(aliases)
+            self.collection.update(
+                ids=results["ids"],
+                metadatas=[
+                    {**metadata, "aliases": value}
+                    for metadata in results["metadatas"]
+                ],
+            )
+
+    def run(self, filepaths: Optional[List[str]] = None) -> int:
+        """Stream the documents of the processor into the collection.
+
+        Parameters
+        ----------
+        filepaths : Optional[List[str]], optional
+            The pdf files to ingest instead of every pdf file in the
+            processor's base folder, by default None.
+
+        Returns
+        -------
+        int
+            The number of chunks written to the collection.
+        """
+        start = time.perf_counter()
+        self._stopped = threading.Event()
+        self._threads = []
+        # Writes run in this thread, while the embedding stage keeps
+        # embedding the next batches in its own
+        self.writer = BulkWriter(self.collection)
+        if self.deduplicator is not None:
+            self.deduplicator.reset()
+        chunks = self._threaded(
+            self._extract(filepaths), self.queue_size * self.batch_size
+        )
+        batches = self._threaded(
+            batched(chunks, self.batch_size), self.queue_size
+        )
+        embedded = self._threaded(self._embed(batches), self.queue_size)
+        try:
+            for batch, embeddings in embedded:
+                self._store(batch, embeddings)
+                logger.info(
+                    "Stored %s of %s chunks from %s pages..."
+                    % (self.stored, self.chunks, self.pages)
+                )
+        finally:
+            # Stop every stage, including on error, before returning
+            self._stopped.set()
+            for thread in self._threads:
+                thread.join()
+            self.writer.close()
+        if self.deduplicator is not None:
+            self._store_aliases()
+            logger.info(
+                "Skipped %s empty and %s duplicate pages of %s."
+                % (
+                    self.deduplicator.empty,
+                    self.deduplicator.duplicates,
+                    self.deduplicator.pages,
+                )
+            )
+        logger.info(
+            "Ingested %s chunks from %s pages of %s in %.2fs, writing %.0f"
+            " chunks/s."
+            % (
+                self.stored,
+                self.pages,
+                self.processor.base_folder,
+                time.perf_counter() - start,
+                self.writer.rows_per_second,
+            )
+        )
+        return self.stored
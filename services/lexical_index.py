@@ -0,0 +1,497 @@
+"""Module to define the LexicalIndex class, an in-process BM25 inverted index
+of the chunks stored in the ChromaDB collection.
+"""
+import os
+import re
+import mmap
+import json
+import math
+import shutil
+import logging
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    """a about an and are as at be by can do does for from how i if in into
+    is it its me my of on or so than that the their them then there these
+    they this to was what when where which who why will with you
+    your""".split()
+)
+# Term frequencies are stored as unsigned 16-bit integers
+_MAX_FREQUENCY = 0xFFFF
+
+
+def tokenize(text: str) -> List[str]:
+    """Split a text into lowercase alphanumeric terms, dropping stopwords.
+
+    Parameters
+    ----------
+    text : str
+        The text to tokenize.
+
+    Returns
+    -------
+    List[str]
+        The terms of the text, in order.
+    """
+    return [
+        term
+        for term in TOKEN_PATTERN.findall(text.lower())
+        if term not in STOPWORDS
+    ]
+
+
+class LexicalHit(NamedTuple):
+    """A chunk matching a lexical query."""
+
+    id: str
+    score: float
+    # The fraction of the distinct query terms found in the chunk
+    coverage: float
+
+
+class LexicalIndex:
+    """A BM25 inverted index over the chunk texts, stored on disk as a JSON
+    term dictionary and flat binary arrays of postings, which are
+    memory-mapped rather than read when the index is loaded.
+
+    The postings of a term are the indices of the chunks containing it, in
+    ascending order, with the frequency of the term in each chunk stored in
+    a parallel array.
+    """
+
+    VERSION = 1
+    META_FILE = "meta.json"
+    IDS_FILE = "ids.json"
+    POSTINGS_FILE = "postings.u32"
+    FREQUENCIES_FILE = "frequencies.u16"
+    LENGTHS_FILE = "lengths.u32"
+
+    def __init__(
+        self,
+        ids: List[str],
+        terms: Dict[str, Tuple[int, int]],
+        postings: memoryview,
+        frequencies: memoryview,
+        lengths: memoryview,
+        k1: float = enums.BM25_K1,
+        b: float = enums.BM25_B,
+        mmaps: Optional[List[mmap.mmap]] = None,
+    ) -> None:
+        """Initializes the LexicalIndex. Use `load` to open an index written
+        by `build`.
+
+        Parameters
+        ----------
+        ids : List[str]
+            The chunk IDs, indexed by chunk index.
+        terms : Dict[str, Tuple[int, int]]
+            The offset of the postings of every term and their number.
+        postings : memoryview
+            The chunk indices of all postings, as unsigned 32-bit integers.
+        frequencies : memoryview
+            The term frequencies of all postings, as unsigned 16-bit
+            integers.
+        lengths : memoryview
+            The number of terms of every chunk, as unsigned 32-bit integers.
+        k1 : float, optional
+            The BM25 term frequency saturation, by default BM25_K1.
+        b : float, optional
+            The BM25 length normalization, by default BM25_B.
+        mmaps : Optional[List[mmap.mmap]], optional
+            The memory maps backing the arrays, closed by `close`, by
+            default None.
+        """
+        self.ids = ids
+        self.terms = terms
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.k1 = k1
+        self.b = b
+        self.average_length = (
+            sum(lengths) / len(lengths) if len(lengths) else 0.0
+        )
+        self._mmaps = mmaps or []
+
+    def __len__(self) -> int:
+        """The number of indexed chunks."""
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        documents: Iterable[Tuple[str, str]],
+        k1: float = enums.BM25_K1,
+        b: float = enums.BM25_B,
+    ) -> int:
+        """Build an index and atomically replace the one stored at `path`.
+
+        Parameters
+        ----------
+        path : str
+            The folder the index is written to.
+        documents : Iterable[Tuple[str, str]]
+            The `(chunk ID, text)` pairs to index.
+        k1 : float, optional
+            The BM25 term frequency saturation, by default BM25_K1.
+        b : float, optional
+            The BM25 length normalization, by default BM25_B.
+
+        Returns
+        -------
+        int
+            The number of indexed chunks.
+        """
+        ids = []
+        lengths = array("I")
+        term_postings: Dict[str, Tuple[array, array]] = {}
+        for chunk_id, text in documents:
+            index = len(ids)
+            ids.append(chunk_id)
+            counts = Counter(tokenize(text or ""))
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                if term not in term_postings:
+                    term_postings[term] = (array("I"), array("H"))
+                chunk_indices, frequencies = term_postings[term]
+                chunk_indices.append(index)
+                frequencies.append(min(count, _MAX_FREQUENCY))
+
+        terms = {}
+        postings = array("I")
+        frequencies = array("H")
+        for term in sorted(term_postings):
+            chunk_indices, term_frequencies = term_postings[term]
+            terms[term] = (len(postings), len(chunk_indices))
+            postings.extend(chunk_indices)
+            frequencies.extend(term_frequencies)
+
+        cls._write(path, ids, terms, postings, frequencies, lengths, k1, b)
+        logger.info(
+            "Built lexical index of %s chunks and %s terms in %s"
+            % (len(ids), len(terms), path)
+        )
+        return len(ids)
+
+    def update(
+        self,
+        path: str,
+        removed_ids: Iterable[str],
+        documents: Iterable[Tuple[str, str]],
+    ) -> int:
+        """Write this index with some chunks removed and others added, and
+        atomically replace the one stored at `path`, tokenizing only the
+        added chunks.
+
+        Parameters
+        ----------
+        path : str
+            The folder the index is written to.
+        removed_ids : Iterable[str]
+            The IDs of the chunks to remove.
+        documents : Iterable[Tuple[str, str]]
+            The `(chunk ID, text)` pairs to add, replacing the chunks of the
+            same IDs.
+
+        Returns
+        -------
+        int
+            The number of indexed chunks.
+        """
+        added_ids = []
+        added_lengths = []
+        # The term, chunk index and frequency of the postings of the added
+        # chunks, in chunk order
+        added_terms = []
+        added_indices = []
+        added_frequencies = []
+        for chunk_id, text in documents:
+            counts = Counter(tokenize(text or ""))
+            added_lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                added_terms.append(term)
+                added_indices.append(len(added_ids))
+                added_frequencies.append(min(count, _MAX_FREQUENCY))
+            added_ids.append(chunk_id)
+
+        dropped = set(removed_ids).union(added_ids)
+        keep = np.array(
+            [chunk_id not in dropped for chunk_id in self.ids], dtype=bool
+        )
+        # The new index of every kept chunk, the added ones following them
+        renumber = np.cumsum(keep, dtype=np.int64) - 1
+        kept = int(keep.sum())
+
+        # The postings of a term are stored contiguously, in term order
+        entries = sorted(self.terms.items(), key=lambda item: item[1][0])
+        vocabulary = sorted({term for term, _ in entries}.union(added_terms))
+        positions = {term: i for i, term in enumerate(vocabulary)}
+        old_terms = np.repeat(
+            np.array([positions[term] for term, _ in entries], np.int64),
+            np.array([count for _, (_, count) in entries], np.int64),
+        )
+        old_postings = np.frombuffer(self.postings, dtype=np.uint32)
+        old_frequencies = np.frombuffer(self.frequencies, dtype=np.uint16)
+        mask = keep[old_postings]
+        term_ids = np.concatenate(
+            [
+                old_terms[mask],
+                np.array([positions[t] for t in added_terms], np.int64),
+            ]
+        )
+        postings = np.concatenate(
+            [
+                renumber[old_postings[mask]],
+                np.array(added_indices, np.int64) + kept,
+            ]
+        ).astype(np.uint32)
+        frequencies = np.concatenate(
+            [
+                old_frequencies[mask],
+                np.array(added_frequencies, np.uint16),
+            ]
+        )
+        # Stable, so the postings of every term stay in chunk order
+        order = np.argsort(term_ids, kind="stable")
+        counts = np.bincount(term_ids, minlength=len(vocabulary))
+        offsets = np.cumsum(counts) - counts
+        terms = {
+            term: (int(offsets[i]), int(counts[i]))
+            for i, term in enumerate(vocabulary)
+            if counts[i]
+        }
+        ids = [
+            chunk_id for chunk_id in self.ids if chunk_id not in dropped
+        ] + added_ids
+        lengths = np.concatenate(
+            [
+                np.frombuffer(self.lengths, dtype=np.uint32)[keep],
+                np.array(added_lengths, np.uint32),
+            ]
+        )
+
+        self._write(
+            path,
+            ids,
+            terms,
+            postings[order],
+            frequencies[order],
+            lengths,
+            self.k1,
+            self.b,
+        )
+        logger.info(
+            "Updated lexical index of %s chunks in %s, %s removed and %s "
+            "added" % (len(ids), path, len(self.ids) - kept, len(added_ids))
+        )
+        return len(ids)
+
+    @classmethod
+    def _write(
+        cls,
+        path: str,
+        ids: List[str],
+        terms: Dict[str, Tuple[int, int]],
+        postings: Any,
+        frequencies: Any,
+        lengths: Any,
+        k1: float,
+        b: float,
+    ) -> None:
+        """Write the files of an index to a sibling folder of `path`, then
+        swap it in. The arrays are arrays or NumPy arrays of the types of
+        the files.
+        """
+        temporary_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+        with open(os.path.join(temporary_path, cls.IDS_FILE), "w") as file:
+            json.dump(ids, file)
+        for filename, values in (
+            (cls.POSTINGS_FILE, postings),
+            (cls.FREQUENCIES_FILE, frequencies),
+            (cls.LENGTHS_FILE, lengths),
+        ):
+            with open(os.path.join(temporary_path, filename), "wb") as file:
+                values.tofile(file)
+        with open(os.path.join(temporary_path, cls.META_FILE), "w") as file:
+            json.dump(
+                {"version": cls.VERSION, "k1": k1, "b": b, "terms": terms},
+                file,
+            )
+        previous_path = f"{path}.old-{os.getpid()}"
+        if os.path.exists(path):
+            os.replace(path, previous_path)
+        os.replace(temporary_path, path)
+        shutil.rmtree(previous_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """Open the index stored at `path`, memory-mapping its postings.
+
+        Parameters
+        ----------
+        path : str
+            The folder the index was written to.
+
+        Returns
+        -------
+        Optional[LexicalIndex]
+            The index, or None if it is missing or unreadable.
+        """
+        try:
+            with open(os.path.join(path, cls.META_FILE), "r") as file:
+                meta = json.load(file)
+            if meta.get("version") != cls.VERSION:
+                logger.warning(
+                    "Ignoring lexical index %s with version %s"
+                    % (path, meta.get("version"))
+                )
+                return None
+            with open(os.path.join(path, cls.IDS_FILE), "r") as file:
+                ids = json.load(file)
+            mmaps = []
+            arrays = []
+            for filename, typecode in (
+                (cls.POSTINGS_FILE, "I"),
+                (cls.FREQUENCIES_FILE, "H"),
+                (cls.LENGTHS_FILE, "I"),
+            ):
+                with open(os.path.join(path, filename), "rb") as file:
+                    if os.fstat(file.fileno()).st_size == 0:
+                        # Empty files cannot be memory-mapped
+                        arrays.append(memoryview(array(typecode)))
+                        continue
+                    mapped = mmap.mmap(
+                        file.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+                mmaps.append(mapped)
+                arrays.append(memoryview(mapped).cast(typecode))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error("Error loading lexical index %s: %s" % (path, e))
+            return None
+        return cls(
+            ids=ids,
+            terms={
+                term: tuple(entry) for term, entry in meta["terms"].items()
+            },
+            postings=arrays[0],
+            frequencies=arrays[1],
+            lengths=arrays[2],
+            k1=meta["k1"],
+            b=meta["b"],
+            mmaps=mmaps,
+        )
+
+    def document_frequency(self, term: str) -> int:
+        """The number of chunks containing a term."""
+        return self.terms.get(term, (0, 0))[1]
+
+    def search(self, query_text: str, k: int = 10) -> List[LexicalHit]:
+        """Rank the chunks by their BM25 score for a query.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        k : int, optional
+            The maximum number of hits, by default 10.
+
+        Returns
+        -------
+        List[LexicalHit]
+            The best matching chunks, highest score first.
+        """
+        query_terms = list(dict.fromkeys(tokenize(query_text)))
+        if not query_terms or not self.ids:
+            return []
+        count = len(self.ids)
+        average_length = self.average_length or 1
+        scores: Dict[int, float] = {}
+        matches: Dict[int, int] = {}
+        for term in query_terms:
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            offset, frequency = entry
+            idf = math.log(
+                1.0 + (count - frequency + 0.5) / (frequency + 0.5)
+            )
+            for position in range(offset, offset + frequency):
+                index = self.postings[position]
+                tf = self.frequencies[position]
+                length = self.lengths[index] / average_length
+                norm = self.k1 * (1.0 - self.b + self.b * length)
+                scores[index] = scores.get(index, 0.0) + (
+                    idf * tf * (self.k1 + 1.0) / (tf + norm)
+                )
+                matches[index] = matches.get(index, 0) + 1
+        best = sorted(scores, key=scores.__getitem__, reverse=True)[:k]
+        return [
+            LexicalHit(
+                id=self.ids[index],
+                score=scores[index],
+                coverage=matches[index] / len(query_terms),
+            )
+            for index in best
+        ]
+
+    def is_exact_match(
+        self,
+        query_text: str,
+        hits: List[LexicalHit],
+        max_terms: int = enums.EXACT_MATCH_MAX_TERMS,
+        max_document_ratio: float = enums.EXACT_MATCH_MAX_DOCUMENT_RATIO,
+    ) -> bool:
+        """Whether a query is a lookup of a few specific terms that the best
+        lexical hit contains, so that dense retrieval can be skipped.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        hits : List[LexicalHit]
+            The lexical hits of the query.
+        max_terms : int, optional
+            The maximum number of distinct query terms, by default
+            EXACT_MATCH_MAX_TERMS.
+        max_document_ratio : float, optional
+            The maximum fraction of chunks a query term may appear in, by
+            default EXACT_MATCH_MAX_DOCUMENT_RATIO.
+
+        Returns
+        -------
+        bool
+            True if the query is an exact-match lookup.
+        """
+        query_terms = set(tokenize(query_text))
+        if not hits or not query_terms or len(query_terms) > max_terms:
+            return False
+        if hits[0].coverage < 1.0:
+            return False
+        limit = max(1, max_document_ratio * len(self.ids))
+        return all(
+            self.document_frequency(term) <= limit for term in query_terms
+        )
+
+    def close(self) -> None:
+        """Release the memory maps of the index."""
+        for view in (self.postings, self.frequencies, self.lengths):
+            view.release()
+        for mapped in self._mmaps:
+            mapped.close()
+        self._mmaps = []
@@ -0,0 +1,268 @@
+"""Module to define the SentenceTransformerEmbeddingFunction class, which
+generates embeddings on the CPU with a local sentence-transformers model.
+"""
+import time
+import logging
+from typing import List, Optional, Union
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from chromadb import EmbeddingFunction, Documents
+
+from utils import enums, metrics
+from models.document import Document
+from utils.priority import PriorityLock
+from utils.torch_threads import set_torch_threads
+from services.embedding_client import estimate_tokens
+from services.embedding_cache import EmbeddingCache, embed_with_cache
+
+
+class SentenceTransformerEmbeddingFunction(EmbeddingFunction):
+    """Generates embeddings with a sentence-transformers model running on the
+    CPU, so that neither ingestion nor queries depend on a remote API.
+
+    Texts are sorted by length and grouped into batches bounded both in
+    number of texts and in padded tokens, so that short texts are not padded
+    to the length of long ones. Inference runs on `num_threads` cores and,
+    optionally, with the linear layers dynamically quantized to int8.
+    """
+
+    def __init__(
+        self,
+        model_name: Optional[str] = enums.LOCAL_EMBEDDING_MODEL,
+        batch_size: Optional[int] = enums.LOCAL_EMBEDDING_BATCH_SIZE,
+        max_batch_tokens: Optional[int] = (
+            enums.LOCAL_EMBEDDING_MAX_BATCH_TOKENS
+        ),
+        num_threads: Optional[int] = enums.TORCH_THREADS,
+        quantize: bool = enums.LOCAL_EMBEDDING_QUANTIZE,
+        normalize: bool = True,
+        cache: Optional[EmbeddingCache] = None,
+    ) -> None:
+        """Initializes the SentenceTransformerEmbeddingFunction, loading the
+        model.
+
+        Parameters
+        ----------
+        model_name : Optional[str], optional
+            The name or path of the sentence-transformers model, by default
+            LOCAL_EMBEDDING_MODEL.
+        batch_size : Optional[int], optional
+            The maximum number of texts per batch, by default
+            LOCAL_EMBEDDING_BATCH_SIZE.
+        max_batch_tokens : Optional[int], optional
+            The maximum number of padded tokens per batch, by default
+            LOCAL_EMBEDDING_MAX_BATCH_TOKENS.
+        num_threads : Optional[int], optional
+            The number of CPU threads torch runs inference on, unless it was
+            already set in the process. If None, the cores are divided among
+            the server workers, by default TORCH_THREADS.
+        quantize : bool, optional
+            Whether to dynamically quantize the linear layers to int8, by
+            default LOCAL_EMBEDDING_QUANTIZE.
+        normalize : bool, optional
+            Whether to normalize the embeddings to unit length, by default
+            True.
+        cache : Optional[EmbeddingCache], optional
+            The persistent cache checked before running the model, by default
+            None.
+
+        Raises
+        ------
+        ImportError
+            If sentence-transformers is not installed.
+        """
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "sentence-transformers is required for the local embedding "
+                "backend. Install it or set EMBEDDING_BACKEND to 'gemini'."
+            ) from e
+
+        super().__init__()
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size or 1)
+        self.max_batch_tokens = max_batch_tokens
+        self.normalize = normalize
+        self.quantize = quantize
+        self.cache = cache
+        self.num_threads = set_torch_threads(num_threads)
+
+        start = time.perf_counter()
+        self.model = SentenceTransformer(model_name, device="cpu")
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        self.model.eval()
+        self.output_dimensionality = (
+            self.model.get_sentence_embedding_dimension()
+        )
+        # Torch inference is not safe to run concurrently on one model, so
+        # batches take turns, the ones of queries ahead of the ingestion
+        self._lock = PriorityLock()
+        logger.info(
+            "Loaded %s (%s dimensions, %s threads%s) in %.2fs"
+            % (
+                model_name,
+                self.output_dimensionality,
+                self.num_threads,
+                ", int8" if quantize else "",
+                time.perf_counter() - start,
+            )
+        )
+
+    def _batches(self, texts: List[str]) -> List[List[int]]:
+        """Group the indices of the texts into batches of similar length.
+
+        Parameters
+        ----------
+        texts : List[str]
+            The texts to embed.
+
+        Returns
+        -------
+        List[List[int]]
+            The indices of the texts of each batch, longest texts first.
+        """
+        order = sorted(
+            range(len(texts)), key=lambda i: len(texts[i]), reverse=True
+        )
+        max_length = self.model.max_seq_length
+        batches = []
+        batch = []
+        for i in order:
+            # Sorted longest first, so the first text sets the padded length
+            padded_length = min(
+                estimate_tokens(texts[batch[0] if batch else i]), max_length
+            )
+            if batch and (
+                len(batch) >= self.batch_size
+                or (
+                    self.max_batch_tokens
+                    and padded_length * (len(batch) + 1)
+                    > self.max_batch_tokens
+                )
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Run the model on the texts, batched by length.
+
+        Parameters
+        ----------
+        texts : List[str]
+            The texts to embed.
+
+        Returns
+        -------
+        np.ndarray
+            The float32 matrix of the embeddings, one row per text in input
+            order.
+        """
+        embeddings = np.empty(
+            (len(texts), self.output_dimensionality), dtype=np.float32
+        )
+        with metrics.span("embed"):
+            for batch in self._batches(texts):
+                metrics.BATCH_SIZE.observe(len(batch), batch="embedding")
+                metrics.TOKENS.inc(
+                    sum(estimate_tokens(texts[i]) for i in batch),
+                    kind="embedding",
+                )
+                with self._lock.hold():
+                    vectors = self.model.encode(
+                        [texts[i] for i in batch],
+                        batch_size=len(batch),
+                        convert_to_numpy=True,
+                        normalize_embeddings=self.normalize,
+                        show_progress_bar=False,
+                    )
+                embeddings[batch] = vectors
+        return embeddings
+
+    def embed_matrix(
+        self, input: Union[Documents, List[Document], List[str], str]
+    ) -> np.ndarray:
+        """Generates embeddings for the input text documents as a single
+        float32 matrix.
+
+        Parameters
+        ----------
+        input : Union[Documents, List[Document], List[str], str]
+            The input text documents to generate embeddings for.
+
+        Returns
+        -------
+        np.ndarray
+            The embeddings for the input text documents, one row per
+            document.
+        """
+        # Convert input to a list of strings
+        if isinstance(input, str):
+            input = [input]
+        elif (
+            isinstance(input, list)
+            and len(input) > 0
+            and isinstance(input[0], Document)
+        ):
+            input = [doc.page_content for doc in input]
+
+        if not input:
+            return np.empty((0, self.output_dimensionality), dtype=np.float32)
+        if self.cache is None:
+            return self._embed(list(input))
+        return embed_with_cache(
+            self.cache,
+            list(input),
+            self._embed,
+            model_name=self.model_name,
+            output_dimensionality=self.output_dimensionality,
+            quantized=self.quantize,
+            normalized=self.normalize,
+        )
+
+    def __call__(
+        self, input: Union[Documents, List[Document], List[str], str]
+    ) -> List[List[float]]:
+        """Generates embeddings for the input text documents, as the lists
+        ChromaDB expects from an embedding function.
+
+        Parameters
+        ----------
+        input : Union[Documents, List[Document], List[str], str]
+            The input text documents to generate embeddings for.
+
+        Returns
+        -------
+        List[List[float]]
+            The embeddings for the input text documents.
+        """
+        return self.embed_matrix(input).tolist()
+
+    def embed_documents(
+        self, documents: Union[Documents, List[Document], List[str], str]
+    ) -> List[List[float]]:
+        """Generates embeddings for the input text documents.
+
+        Parameters
+        ----------
+        documents : Union[Documents, List[Document], List[str], str]
+            The input text documents to generate embeddings for.
+
+        Returns
+        -------
+        List[List[float]]
+            The embeddings for the input text documents.
+        """
+        return self(documents)
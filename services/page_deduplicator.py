@@ -0,0 +1,254 @@
+"""Module to define the PageDeduplicator class, which drops empty and
+near-duplicate pdf pages before they are chunked and embedded.
+"""
+import re
+import json
+import zlib
+import hashlib
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from utils import enums, metrics
+from models.document import Document
+
+WORD_PATTERN = re.compile(r"\w+")
+# The Mersenne prime 2**31 - 1, small enough for `a * x + b` to fit in 64
+# bits for any 32-bit shingle hash `x`
+_PRIME = np.uint64((1 << 31) - 1)
+
+# A page, as its filepath and page number
+PageKey = Tuple[str, int]
+# The game system, edition and title pages are deduplicated within
+Scope = Tuple[str, str, str]
+# An LSH bucket, as a scope, a band and the signature values of the band
+BucketKey = Tuple[Scope, int, bytes]
+
+
+def format_aliases(aliases: List[PageKey]) -> str:
+    """Encode the pages aliased to a page as a metadata value, since
+    ChromaDB metadata values cannot be lists.
+    """
+    return json.dumps([[filepath, page] for filepath, page in aliases])
+
+
+def parse_aliases(value: Optional[str]) -> List[PageKey]:
+    """Decode the pages aliased to a page from its metadata value."""
+    if not value:
+        return []
+    return [(filepath, page) for filepath, page in json.loads(value)]
+
+
+class PageDeduplicator:
+    """Filters a stream of pdf pages, dropping the pages with almost no text
+    and the pages nearly identical to a page already seen, such as legal
+    boilerplate, character sheets and tables repeated across books and
+    printings.
+
+    Near duplicates are found with MinHash signatures of the word shingles
+    of every page, indexed by locality-sensitive hashing: signatures are cut
+    into bands, and pages sharing a band are compared by the share of equal
+    signature values, which estimates the Jaccard similarity of their
+    shingles. The first page of every cluster is kept as its representative,
+    and the others are recorded as its aliases.
+
+    Pages are only compared with pages of the same game system, edition and
+    title, such as the printings of a book, so that every page stays
+    reachable by the metadata filters of queries.
+    """
+
+    def __init__(
+        self,
+        num_permutations: int = enums.DEDUP_NUM_PERMUTATIONS,
+        bands: int = enums.DEDUP_BANDS,
+        shingle_size: int = enums.DEDUP_SHINGLE_SIZE,
+        threshold: float = enums.DEDUP_THRESHOLD,
+        min_words: int = enums.DEDUP_MIN_WORDS,
+        seed: int = 0,
+    ) -> None:
+        """Initializes the PageDeduplicator.
+
+        Parameters
+        ----------
+        num_permutations : int, optional
+            The number of values of every MinHash signature, by default
+            DEDUP_NUM_PERMUTATIONS.
+        bands : int, optional
+            The number of LSH bands the signatures are cut into, which must
+            divide `num_permutations`, by default DEDUP_BANDS.
+        shingle_size : int, optional
+            The number of words per shingle, by default DEDUP_SHINGLE_SIZE.
+        threshold : float, optional
+            The estimated Jaccard similarity above which a page is a near
+            duplicate, by default DEDUP_THRESHOLD.
+        min_words : int, optional
+            The number of words below which a page is dropped as empty, by
+            default DEDUP_MIN_WORDS.
+        seed : int, optional
+            The seed of the hash permutations, by default 0.
+
+        Raises
+        ------
+        ValueError
+            If `bands` does not divide `num_permutations`.
+        """
+        if num_permutations % bands:
+            raise ValueError(
+                f"{bands} bands do not divide {num_permutations} "
+                "permutations"
+            )
+        self.num_permutations = num_permutations
+        self.bands = bands
+        self.rows = num_permutations // bands
+        self.shingle_size = max(1, shingle_size)
+        self.threshold = threshold
+        self.min_words = min_words
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(
+            1, _PRIME, size=num_permutations, dtype=np.uint64
+        )
+        self._b = rng.integers(
+            0, _PRIME, size=num_permutations, dtype=np.uint64
+        )
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the pages seen, to deduplicate a new set of pages."""
+        self.pages = 0
+        self.empty = 0
+        self.duplicates = 0
+        # Per representative, the pages found to duplicate it
+        self.aliases: Dict[PageKey, List[PageKey]] = defaultdict(list)
+        self._exact: Dict[Tuple[Scope, bytes], PageKey] = {}
+        self._signatures: Dict[PageKey, np.ndarray] = {}
+        self._buckets: Dict[BucketKey, List[PageKey]] = defaultdict(list)
+
+    @property
+    def pages_saved(self) -> int:
+        """The number of pages dropped, which are neither chunked nor
+        embedded.
+        """
+        return self.empty + self.duplicates
+
+    def _shingle_hashes(self, words: List[str]) -> np.ndarray:
+        """The 32-bit hashes of the distinct word shingles of a page."""
+        size = min(self.shingle_size, len(words))
+        shingles = {
+            " ".join(words[i : i + size])
+            for i in range(len(words) - size + 1)
+        }
+        return np.fromiter(
+            (zlib.crc32(shingle.encode()) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+
+    def signature(self, text: str) -> np.ndarray:
+        """Compute the MinHash signature of a text.
+
+        Parameters
+        ----------
+        text : str
+            The text.
+
+        Returns
+        -------
+        np.ndarray
+            The minimum of every hash permutation over the shingles of the
+            text.
+        """
+        words = WORD_PATTERN.findall(text.lower())
+        hashes = self._shingle_hashes(words)
+        if len(hashes) == 0:
+            return np.full(self.num_permutations, _PRIME, dtype=np.uint64)
+        permuted = (np.outer(hashes, self._a) + self._b) % _PRIME
+        return permuted.min(axis=0)
+
+    def _find_duplicate(
+        self, key: PageKey, scope: Scope, signature: np.ndarray
+    ) -> Optional[PageKey]:
+        """Find a representative of the same scope similar to a page, or
+        index the page as a new representative.
+        """
+        bands = [
+            (band, signature[band * self.rows : (band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+        for band, values in bands:
+            bucket = self._buckets.get((scope, band, values.tobytes()), ())
+            for candidate in bucket:
+                similarity = np.mean(self._signatures[candidate] == signature)
+                if similarity >= self.threshold:
+                    return candidate
+        self._signatures[key] = signature
+        for band, values in bands:
+            self._buckets[(scope, band, values.tobytes())].append(key)
+        return None
+
+    def deduplicate(self, pages: Iterable[Document]) -> Iterator[Document]:
+        """Drop the empty and near-duplicate pages of a stream of pages.
+
+        Parameters
+        ----------
+        pages : Iterable[Document]
+            The pages, as extracted.
+
+        Yields
+        ------
+        Document
+            The pages with enough text that do not duplicate an earlier
+            page of the same game system, edition and title, in order.
+        """
+        for page in pages:
+            self.pages += 1
+            key = (page.filepath, page.page_number)
+            scope = (page.game_system, page.edition, page.title)
+            text = page.page_content
+            if isinstance(text, list):
+                text = "\n".join(text)
+            words = WORD_PATTERN.findall(text.lower())
+            if len(words) < self.min_words:
+                self.empty += 1
+                metrics.DEDUP_PAGES.inc(result="empty")
+                continue
+
+            digest = hashlib.sha1(" ".join(words).encode()).digest()
+            representative = self._exact.get((scope, digest))
+            if representative is None:
+                representative = self._find_duplicate(
+                    key, scope, self.signature(text)
+                )
+            if representative is not None:
+                self.duplicates += 1
+                self.aliases[representative].append(key)
+                metrics.DEDUP_PAGES.inc(result="duplicate")
+                logger.debug(
+                    "Page %s of %s duplicates page %s of %s"
+                    % (key[1], key[0], representative[1], representative[0])
+                )
+                continue
+            self._exact[(scope, digest)] = key
+            metrics.DEDUP_PAGES.inc(result="kept")
+            yield page
+
+    def stats(self) -> Dict[str, int]:
+        """Report the pages seen, dropped and kept.
+
+        Returns
+        -------
+        Dict[str, int]
+            The number of `pages` seen, `empty` and `duplicate` pages
+            dropped, and `pages_saved` in total.
+        """
+        return {
+            "pages": self.pages,
+            "empty": self.empty,
+            "duplicate": self.duplicates,
+            "pages_saved": self.pages_saved,
+        }
@@ -0,0 +1,25 @@
+"""Module to build the prompt sent to the generative model for a query."""
+
+
+def build_prompt(query_text: str, context: str) -> str:
+    """Build the prompt asking the generative model to answer a query using
+    only the given context.
+
+    Parameters
+    ----------
+    query_text : str
+        The query text.
+    context : str
+        The context block of relevant document chunks.
+
+    Returns
+    -------
+    str
+        The prompt.
+    """
+    return f"""
+You are a helpful AI assistant providing information based on tabletop role-playing game (TTRPG) rulebooks.
+Answer the following question using only the context provided. If you don't have enough information to answer, say you don't know.
+Context: {context}
+Question: {query_text}
+Answer:"""
@@ -0,0 +1,244 @@
+"""Module to define the QueryBatcher class, which coalesces concurrent queries
+into batched ChromaDB searches.
+"""
+import json
+import time
+import queue
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from chromadb import Collection
+
+from utils import enums, metrics
+
+DEFAULT_INCLUDE = ("metadatas", "documents", "distances")
+# Fields of a ChromaDB query result holding one list per query text
+PER_QUERY_FIELDS = (
+    "ids",
+    "embeddings",
+    "documents",
+    "uris",
+    "data",
+    "metadatas",
+    "distances",
+)
+# Marks the end of the queries in the queue of a closed batcher
+_STOP = object()
+
+
+class _PendingQuery:
+    """A query waiting to be sent in a batch."""
+
+    def __init__(
+        self,
+        query_text: str,
+        n_results: int,
+        include: Tuple[str, ...],
+        where: Optional[Dict[str, Any]],
+    ) -> None:
+        self.query_text = query_text
+        self.n_results = n_results
+        self.include = include
+        self.where = where
+        self.future = Future()
+        # The timings of the request waiting for the query, if any
+        self.timings = metrics.current_timings()
+
+    @property
+    def group_key(self) -> Tuple[Tuple[str, ...], str]:
+        """Queries can only share a search if they include the same fields
+        and use the same filter.
+        """
+        return self.include, json.dumps(self.where, sort_keys=True)
+
+
+class QueryBatcher:
+    """Collects the queries arriving within a short window, or up to a
+    maximum batch size, and sends them to the collection as a single
+    multi-query search, so that the query texts are embedded in one batched
+    call. The results are fanned back out to the waiting callers.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        window_ms: Optional[float] = enums.QUERY_BATCH_WINDOW_MS,
+        max_batch_size: Optional[int] = enums.QUERY_MAX_BATCH_SIZE,
+        max_concurrent_batches: Optional[int] = (
+            enums.QUERY_MAX_CONCURRENT_BATCHES
+        ),
+    ) -> None:
+        """Initializes the QueryBatcher for a collection.
+
+        Parameters
+        ----------
+        collection : Collection
+            The ChromaDB collection to search.
+        window_ms : Optional[float], optional
+            How long to wait for more queries after the first query of a
+            batch arrives, by default QUERY_BATCH_WINDOW_MS.
+        max_batch_size : Optional[int], optional
+            The maximum number of queries per batch, by default
+            QUERY_MAX_BATCH_SIZE.
+        max_concurrent_batches : Optional[int], optional
+            The maximum number of batches searched at the same time, by
+            default QUERY_MAX_CONCURRENT_BATCHES.
+        """
+        self.collection = collection
+        self.window = max(0.0, (window_ms or 0.0) / 1000.0)
+        self.max_batch_size = max(1, max_batch_size or 1)
+        self.max_concurrent_batches = max(1, max_concurrent_batches or 1)
+        self.batches = 0
+        self.queries = 0
+        self._queue = queue.Queue()
+        self._executor = None
+        self._thread = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _enqueue(self, pending: _PendingQuery) -> None:
+        """Queue a query, lazily starting the thread collecting queries into
+        batches.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The query batcher is closed")
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrent_batches,
+                    thread_name_prefix="query-batcher",
+                )
+                self._thread = threading.Thread(
+                    target=self._collect, name="query-batcher", daemon=True
+                )
+                self._thread.start()
+            self._queue.put(pending)
+
+    def _collect(self) -> None:
+        """Group queued queries into batches and dispatch them."""
+        stopping = False
+        while not stopping:
+            pending = self._queue.get()
+            if pending is _STOP:
+                break
+            batch = [pending]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if pending is _STOP:
+                    stopping = True
+                    break
+                batch.append(pending)
+
+            groups: Dict[Any, List[_PendingQuery]] = {}
+            for pending in batch:
+                groups.setdefault(pending.group_key, []).append(pending)
+            for group in groups.values():
+                self._executor.submit(self._search, group)
+        self._executor.shutdown(wait=True)
+
+    def _search(self, group: List[_PendingQuery]) -> None:
+        """Run one multi-query search for a group of compatible queries and
+        resolve their futures.
+        """
+        query_texts = list(dict.fromkeys(p.query_text for p in group))
+        n_results = max(p.n_results for p in group)
+        metrics.BATCH_SIZE.observe(len(group), batch="query")
+        try:
+            # Shared by every query of the batch, embedding included
+            with metrics.collect_timings() as timings:
+                with metrics.span("vector_search"):
+                    results = self.collection.query(
+                        query_texts=query_texts,
+                        n_results=n_results,
+                        where=group[0].where,
+                        include=list(group[0].include),
+                    )
+        except Exception as e:
+            for pending in group:
+                pending.future.set_exception(e)
+            return
+        for pending in group:
+            metrics.add_timings(pending.timings, timings)
+        with self._lock:
+            self.batches += 1
+            self.queries += len(group)
+        logger.debug(
+            "Searched %s queries (%s unique) in one batch"
+            % (len(group), len(query_texts))
+        )
+
+        positions = {text: i for i, text in enumerate(query_texts)}
+        for pending in group:
+            i = positions[pending.query_text]
+            result = {}
+            for key, value in results.items():
+                if key in PER_QUERY_FIELDS and value is not None:
+                    value = [value[i][: pending.n_results]]
+                result[key] = value
+            pending.future.set_result(result)
+
+    def close(self) -> None:
+        """Search the queries already queued, then stop the background
+        thread. Queries made afterwards raise a RuntimeError.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(_STOP)
+        if thread is not None:
+            thread.join()
+
+    def query(
+        self,
+        query_text: str,
+        n_results: int = 10,
+        include: Optional[List[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """Search the collection for a single query text, sharing the search
+        with other queries arriving at the same time.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        n_results : int, optional
+            The number of results to return, by default 10.
+        include : Optional[List[str]], optional
+            The fields to include in the results, by default metadatas,
+            documents and distances.
+        where : Optional[Dict[str, Any]], optional
+            A ChromaDB metadata filter, by default None.
+        timeout : Optional[float], optional
+            The maximum number of seconds to wait for the results, by default
+            None.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The results in the same shape as `Collection.query` returns for a
+            single query text.
+        """
+        pending = _PendingQuery(
+            query_text=query_text,
+            n_results=n_results,
+            include=tuple(include or DEFAULT_INCLUDE),
+            where=where,
+        )
+        self._enqueue(pending)
+        return pending.future.result(timeout=timeout)
@@ -0,0 +1,303 @@
+"""Module to define the CrossEncoderReranker class, which reorders retrieved
+chunks by the score a local cross-encoder gives each (query, chunk) pair,
+and the RerankingRetriever class, which adds it as a stage of retrieval.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from utils import enums, metrics
+from models.retrieval import RetrievedChunk
+from services.retriever import Retriever
+from utils.torch_threads import set_torch_threads
+from services.shard_router import ShardRouter
+
+
+class CrossEncoderReranker:
+    """Scores (query, chunk) pairs with a cross-encoder from
+    sentence-transformers running on the CPU.
+
+    Dense retrieval ranks chunks by comparing embeddings computed
+    separately, while a cross-encoder reads the query and the chunk
+    together, so it ranks the candidates more precisely and fewer of them
+    need to be sent to the generative model. Pairs are scored in batches,
+    sorted by length to limit padding, and their scores are kept in an LRU
+    cache, so repeated queries skip the model.
+    """
+
+    def __init__(
+        self,
+        model_name: Optional[str] = enums.RERANK_MODEL,
+        top_n: Optional[int] = enums.RERANK_TOP_N,
+        batch_size: Optional[int] = enums.RERANK_BATCH_SIZE,
+        max_length: Optional[int] = enums.RERANK_MAX_LENGTH,
+        cache_size: Optional[int] = enums.RERANK_CACHE_SIZE,
+        num_threads: Optional[int] = enums.TORCH_THREADS,
+        model: Optional[Any] = None,
+    ) -> None:
+        """Initializes the CrossEncoderReranker, loading the model.
+
+        Parameters
+        ----------
+        model_name : Optional[str], optional
+            The name or path of the cross-encoder model, by default
+            RERANK_MODEL.
+        top_n : Optional[int], optional
+            The number of chunks kept by `rerank`, by default RERANK_TOP_N.
+        batch_size : Optional[int], optional
+            The maximum number of pairs per batch, by default
+            RERANK_BATCH_SIZE.
+        max_length : Optional[int], optional
+            The number of tokens pairs are truncated to, by default
+            RERANK_MAX_LENGTH.
+        cache_size : Optional[int], optional
+            The maximum number of pair scores cached. If 0 or None, scores
+            are not cached, by default RERANK_CACHE_SIZE.
+        num_threads : Optional[int], optional
+            The number of CPU threads torch runs inference on, unless it was
+            already set in the process. If None, the cores are divided among
+            the server workers, by default TORCH_THREADS.
+        model : Optional[Any], optional
+            A loaded model with the `predict` method of a CrossEncoder, used
+            instead of loading `model_name`, by default None.
+
+        Raises
+        ------
+        ImportError
+            If no model is given and sentence-transformers is not installed.
+        """
+        self.model_name = model_name
+        self.top_n = max(1, top_n or 1)
+        self.batch_size = max(1, batch_size or 1)
+        self.cache_size = cache_size or 0
+        self._cache: "OrderedDict[Tuple[str, str, int], float]" = (
+            OrderedDict()
+        )
+        # Torch inference is not safe to run concurrently on one model
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        if model is not None:
+            self.model = model
+            return
+
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "sentence-transformers is required for reranking. Install "
+                "it or set RERANK_ENABLED to False."
+            ) from e
+
+        set_torch_threads(num_threads)
+        start = time.perf_counter()
+        self.model = CrossEncoder(
+            model_name, max_length=max_length, device="cpu"
+        )
+        logger.info(
+            "Loaded %s in %.2fs" % (model_name, time.perf_counter() - start)
+        )
+
+    @staticmethod
+    def _cache_key(
+        query_text: str, chunk: RetrievedChunk
+    ) -> Tuple[str, str, int]:
+        """The cache key of a pair, which changes with the chunk text."""
+        return (query_text, chunk.id, hash(chunk.text))
+
+    def _cached_scores(
+        self, keys: List[Tuple[str, str, int]]
+    ) -> Dict[int, float]:
+        """Look up the cached scores of pairs, by position."""
+        if not self.cache_size:
+            return {}
+        found = {}
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                score = self._cache.get(key)
+                if score is not None:
+                    self._cache.move_to_end(key)
+                    found[i] = score
+        return found
+
+    def _cache_scores(
+        self, keys: List[Tuple[str, str, int]], scores: np.ndarray
+    ) -> None:
+        """Cache the scores of pairs, evicting the least recently used."""
+        if not self.cache_size:
+            return
+        with self._cache_lock:
+            for key, score in zip(keys, scores):
+                self._cache[key] = float(score)
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _predict(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        """Run the model on pairs, batched by length.
+
+        Parameters
+        ----------
+        pairs : List[Tuple[str, str]]
+            The (query, chunk text) pairs.
+
+        Returns
+        -------
+        np.ndarray
+            The score of every pair, in input order.
+        """
+        # Sorted by length, so that each batch is padded to similar lengths
+        order = sorted(
+            range(len(pairs)), key=lambda i: len(pairs[i][1]), reverse=True
+        )
+        scores = np.empty(len(pairs), dtype=np.float32)
+        metrics.BATCH_SIZE.observe(len(pairs), batch="rerank")
+        with self._lock, metrics.span("rerank_model"):
+            scores[order] = np.asarray(
+                self.model.predict(
+                    [pairs[i] for i in order],
+                    batch_size=self.batch_size,
+                    show_progress_bar=False,
+                    convert_to_numpy=True,
+                ),
+                dtype=np.float32,
+            ).reshape(-1)
+        return scores
+
+    def score(
+        self, query_text: str, chunks: List[RetrievedChunk]
+    ) -> np.ndarray:
+        """Score the relevance of chunks to a query.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        chunks : List[RetrievedChunk]
+            The chunks to score.
+
+        Returns
+        -------
+        np.ndarray
+            The score of every chunk, higher is more relevant.
+        """
+        keys = [self._cache_key(query_text, chunk) for chunk in chunks]
+        scores = np.empty(len(chunks), dtype=np.float32)
+        cached = self._cached_scores(keys)
+        for i, score in cached.items():
+            scores[i] = score
+        missing = [i for i in range(len(chunks)) if i not in cached]
+        metrics.RERANK_CACHE.inc(len(cached), result="hit")
+        metrics.RERANK_CACHE.inc(len(missing), result="miss")
+        if missing:
+            predicted = self._predict(
+                [(query_text, chunks[i].text) for i in missing]
+            )
+            scores[missing] = predicted
+            self._cache_scores([keys[i] for i in missing], predicted)
+        return scores
+
+    def rerank(
+        self,
+        query_text: str,
+        chunks: List[RetrievedChunk],
+        top_n: Optional[int] = None,
+    ) -> List[RetrievedChunk]:
+        """Keep the chunks most relevant to a query, by cross-encoder score.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        chunks : List[RetrievedChunk]
+            The candidate chunks.
+        top_n : Optional[int], optional
+            The number of chunks kept. If None, the `top_n` of the reranker
+            is used, by default None.
+
+        Returns
+        -------
+        List[RetrievedChunk]
+            The best chunks, highest score first, with their
+            `rerank_score` set.
+        """
+        if not chunks:
+            return []
+        scores = self.score(query_text, chunks)
+        # Stable, so that ties keep their retrieval order
+        best = np.argsort(-scores, kind="stable")[: top_n or self.top_n]
+        return [
+            chunks[i].model_copy(update={"rerank_score": float(scores[i])})
+            for i in best
+        ]
+
+
+class RerankingRetriever:
+    """Retrieves an oversampled set of candidate chunks and keeps the best
+    few by cross-encoder score, so that the prompt gets fewer, more relevant
+    chunks.
+    """
+
+    def __init__(
+        self,
+        retriever: Union[Retriever, ShardRouter],
+        reranker: CrossEncoderReranker,
+        oversample: int = enums.RERANK_OVERSAMPLE,
+    ) -> None:
+        """Initializes the RerankingRetriever.
+
+        Parameters
+        ----------
+        retriever : Union[Retriever, ShardRouter]
+            The retriever of the candidate chunks.
+        reranker : CrossEncoderReranker
+            The reranker keeping the best candidates.
+        oversample : int, optional
+            The number of candidates retrieved per chunk kept, by default
+            RERANK_OVERSAMPLE.
+        """
+        self.retriever = retriever
+        self.reranker = reranker
+        self.oversample = max(1, oversample)
+
+    def retrieve(
+        self,
+        query_text: str,
+        top_k: int = 15,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> List[RetrievedChunk]:
+        """Retrieve the chunks most relevant to a query text.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        top_k : int, optional
+            The maximum number of chunks to retrieve, which is further
+            limited by the `top_n` of the reranker, by default 15.
+        where : Optional[Dict[str, Any]], optional
+            A ChromaDB metadata filter, by default None.
+
+        Returns
+        -------
+        List[RetrievedChunk]
+            The retrieved chunks, most relevant first.
+        """
+        top_n = min(top_k, self.reranker.top_n)
+        candidates = self.retriever.retrieve(
+            query_text=query_text, top_k=top_n * self.oversample, where=where
+        )
+        with metrics.span("rerank"):
+            chunks = self.reranker.rerank(query_text, candidates, top_n)
+        logger.debug(
+            "Reranked %s candidates to %s chunks"
+            % (len(candidates), len(chunks))
+        )
+        return chunks
@@ -0,0 +1,324 @@
+"""Module to define the Retriever class, which fetches the chunks relevant to
+a query from a ChromaDB collection in a single round trip, fusing them with
+the hits of a lexical index.
+"""
+import logging
+from typing import Any, Dict, List, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+from chromadb import Collection, EmbeddingFunction
+
+from utils import enums, metrics
+from models.retrieval import RetrievedChunk
+from services.query_batcher import QueryBatcher
+from services.vector_index import VectorIndex
+from services.lexical_index import LexicalIndex
+
+# The embeddings are used to diversify the context of the prompt
+RESULT_INCLUDE = ["documents", "metadatas", "distances", "embeddings"]
+
+
+def _result_field(results: Dict[str, Any], field: str, default: Any) -> Any:
+    """Get a field of a ChromaDB result, or a default if it was not
+    included. Compared with None, since recent ChromaDB versions return
+    embeddings as NumPy arrays, whose truth value is ambiguous.
+    """
+    value = results.get(field)
+    return default if value is None else value
+
+
+def _embedding_rows(embeddings: Any, count: int) -> List[Any]:
+    """Convert the embeddings of a result set to the float32 rows of a single
+    matrix, or to Nones if they were not included.
+    """
+    if embeddings is None:
+        return [None] * count
+    if count == 0:
+        return []
+    return list(np.asarray(embeddings, dtype=np.float32).reshape(count, -1))
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[str]], k: int = enums.RRF_K
+) -> List[str]:
+    """Merge several rankings of IDs, scoring every ID by the sum of
+    `1 / (k + rank)` over the rankings it appears in.
+
+    Parameters
+    ----------
+    rankings : List[List[str]]
+        The rankings to merge, best first.
+    k : int, optional
+        Dampens the weight of the top ranks, by default RRF_K.
+
+    Returns
+    -------
+    List[str]
+        The fused ranking, best first.
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.__getitem__, reverse=True)
+
+
+class Retriever:
+    """Retrieves the chunks most similar to a query, returning their text,
+    provenance and distance from a single query call, instead of fetching
+    each chunk separately after the search.
+
+    With a lexical index, the dense results are fused with the BM25 hits by
+    reciprocal rank fusion, and fewer chunks are returned when the query
+    has lexical hits. Lookups of a few rare terms are answered from the
+    lexical index alone, without embedding the query.
+
+    With a vector index, unfiltered dense searches run in two stages on the
+    compact index instead of the ChromaDB collection, which is then only
+    asked for the chunks found.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        query_batcher: Optional[QueryBatcher] = None,
+        lexical_index: Optional[LexicalIndex] = None,
+        vector_index: Optional[VectorIndex] = None,
+        embedding_function: Optional[EmbeddingFunction] = None,
+        hybrid_top_k: Optional[int] = enums.HYBRID_TOP_K,
+        exact_match_top_k: Optional[int] = enums.EXACT_MATCH_TOP_K,
+        rrf_k: int = enums.RRF_K,
+    ) -> None:
+        """Initializes the Retriever for a collection.
+
+        Parameters
+        ----------
+        collection : Collection
+            The ChromaDB collection to search.
+        query_batcher : Optional[QueryBatcher], optional
+            Coalesces concurrent searches into batched queries. If None, the
+            collection is queried directly, by default None.
+        lexical_index : Optional[LexicalIndex], optional
+            The BM25 index of the chunks. If None, only dense retrieval is
+            used, by default None.
+        vector_index : Optional[VectorIndex], optional
+            The two-stage index of the chunk embeddings. If None, or without
+            an embedding function, dense searches query the collection, by
+            default None.
+        embedding_function : Optional[EmbeddingFunction], optional
+            The embedding function of the collection, used to embed queries
+            searched in the vector index, by default None.
+        hybrid_top_k : Optional[int], optional
+            The maximum number of chunks returned when the query has lexical
+            hits, by default HYBRID_TOP_K.
+        exact_match_top_k : Optional[int], optional
+            The number of chunks returned for exact-match lookups, by default
+            EXACT_MATCH_TOP_K.
+        rrf_k : int, optional
+            The reciprocal rank fusion constant, by default RRF_K.
+        """
+        self.collection = collection
+        self.query_batcher = query_batcher
+        self.lexical_index = lexical_index
+        self.vector_index = vector_index
+        self.embedding_function = embedding_function
+        self.hybrid_top_k = hybrid_top_k
+        self.exact_match_top_k = exact_match_top_k
+        self.rrf_k = rrf_k
+
+    def _query(
+        self,
+        query_text: str,
+        n_results: int,
+        include: List[str],
+        where: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Search the collection for a single query text."""
+        if self.query_batcher is not None:
+            return self.query_batcher.query(
+                query_text=query_text,
+                n_results=n_results,
+                include=include,
+                where=where,
+            )
+        with metrics.span("vector_search"):
+            return self.collection.query(
+                query_texts=[query_text],
+                n_results=n_results,
+                include=include,
+                where=where,
+            )
+
+    def _search_vector_index(
+        self, vector_index: VectorIndex, query_text: str, top_k: int
+    ) -> List[RetrievedChunk]:
+        """Retrieve the chunks most similar to a query embedding from the
+        vector index.
+        """
+        embed_matrix = getattr(self.embedding_function, "embed_matrix", None)
+        if embed_matrix is not None:
+            query = embed_matrix([query_text])[0]
+        else:
+            query = np.asarray(self.embedding_function([query_text])[0])
+        with metrics.span("vector_search"):
+            hits = vector_index.search(query, k=top_k)
+        chunks = self.get_chunks([hit.id for hit in hits])
+        scores = {hit.id: hit.score for hit in hits}
+        # Squared L2 distance of unit vectors, as the collection reports
+        return [
+            chunk.model_copy(
+                update={"distance": 2.0 - 2.0 * scores[chunk.id]}
+            )
+            for chunk in chunks
+        ]
+
+    def _retrieve_dense(
+        self,
+        query_text: str,
+        top_k: int = 15,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> List[RetrievedChunk]:
+        """Retrieve the chunks most similar to a query embedding."""
+        # Keep using the same index if it is swapped while searching
+        vector_index = self.vector_index
+        if (
+            vector_index is not None
+            and self.embedding_function is not None
+            and where is None
+        ):
+            # The vector index has no metadata to filter on
+            return self._search_vector_index(vector_index, query_text, top_k)
+        results = self._query(
+            query_text=query_text,
+            n_results=top_k,
+            include=RESULT_INCLUDE,
+            where=where,
+        )
+        ids = results["ids"][0]
+        missing = [[None] * len(ids)]
+        documents = _result_field(results, "documents", missing)[0]
+        metadatas = _result_field(results, "metadatas", missing)[0]
+        distances = _result_field(results, "distances", missing)[0]
+        embeddings = _embedding_rows(
+            _result_field(results, "embeddings", [None])[0], len(ids)
+        )
+        return [
+            RetrievedChunk.from_result(
+                id=chunk_id,
+                text=text,
+                metadata=metadata,
+                distance=distance,
+                embedding=embedding,
+            )
+            for chunk_id, text, metadata, distance, embedding in zip(
+                ids, documents, metadatas, distances, embeddings
+            )
+        ]
+
+    def retrieve(
+        self,
+        query_text: str,
+        top_k: int = 15,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> List[RetrievedChunk]:
+        """Retrieve the chunks most relevant to a query text.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        top_k : int, optional
+            The number of chunks to retrieve, by default 15.
+        where : Optional[Dict[str, Any]], optional
+            A ChromaDB metadata filter, by default None.
+
+        Returns
+        -------
+        List[RetrievedChunk]
+            The retrieved chunks, most relevant first.
+        """
+        # Keep using the same index if it is swapped while searching
+        lexical_index = self.lexical_index
+        if lexical_index is None:
+            return self._retrieve_dense(query_text, top_k, where)
+
+        with metrics.span("lexical_search"):
+            hits = lexical_index.search(query_text, k=top_k)
+        if self.exact_match_top_k and lexical_index.is_exact_match(
+            query_text, hits
+        ):
+            chunks = self.get_chunks(
+                [hit.id for hit in hits[: self.exact_match_top_k]],
+                where=where,
+            )
+            if chunks:
+                logger.debug(
+                    "Answered exact-match lookup %r from the lexical index"
+                    % query_text
+                )
+                return chunks
+
+        dense = self._retrieve_dense(query_text, top_k, where)
+        if not hits:
+            return dense
+        found = {chunk.id: chunk for chunk in dense}
+        for chunk in self.get_chunks(
+            [hit.id for hit in hits if hit.id not in found], where=where
+        ):
+            found[chunk.id] = chunk
+        fused = reciprocal_rank_fusion(
+            [
+                [chunk.id for chunk in dense],
+                [hit.id for hit in hits if hit.id in found],
+            ],
+            k=self.rrf_k,
+        )
+        if self.hybrid_top_k:
+            fused = fused[: min(top_k, self.hybrid_top_k)]
+        return [found[chunk_id] for chunk_id in fused]
+
+    def get_chunks(
+        self, ids: List[str], where: Optional[Dict[str, Any]] = None
+    ) -> List[RetrievedChunk]:
+        """Fetch chunks by ID with one bulk get.
+
+        Parameters
+        ----------
+        ids : List[str]
+            The IDs of the chunks.
+        where : Optional[Dict[str, Any]], optional
+            A ChromaDB metadata filter the chunks must match, by default
+            None.
+
+        Returns
+        -------
+        List[RetrievedChunk]
+            The chunks that exist, in the order of `ids`.
+        """
+        if not ids:
+            return []
+        with metrics.span("fetch_chunks"):
+            results = self.collection.get(
+                ids=list(dict.fromkeys(ids)),
+                where=where,
+                include=["documents", "metadatas", "embeddings"],
+            )
+        embeddings = _embedding_rows(
+            results.get("embeddings"), len(results["ids"])
+        )
+        found = {
+            chunk_id: RetrievedChunk.from_result(
+                id=chunk_id, text=text, metadata=metadata, embedding=embedding
+            )
+            for chunk_id, text, metadata, embedding in zip(
+                results["ids"],
+                results["documents"],
+                results["metadatas"],
+                embeddings,
+            )
+        }
+        return [found[chunk_id] for chunk_id in ids if chunk_id in found]
@@ -0,0 +1,160 @@
+"""Module to define the ShardRouter class, which routes queries to the
+collections of the game systems they are restricted to.
+"""
+import logging
+import contextvars
+from typing import Any, Dict, List, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums
+from models.retrieval import RetrievedChunk
+from services.retriever import Retriever, reciprocal_rank_fusion
+
+
+def filtered_game_systems(
+    where: Optional[Dict[str, Any]],
+) -> Optional[Set[str]]:
+    """Find the game systems a ChromaDB metadata filter restricts the
+    results to.
+
+    Parameters
+    ----------
+    where : Optional[Dict[str, Any]]
+        The metadata filter.
+
+    Returns
+    -------
+    Optional[Set[str]]
+        The game systems matched by the filter, or None if it does not
+        restrict the game system.
+    """
+    if not where:
+        return None
+    if "$and" in where:
+        restricted = None
+        for condition in where["$and"]:
+            game_systems = filtered_game_systems(condition)
+            if game_systems is not None:
+                restricted = (
+                    game_systems
+                    if restricted is None
+                    else restricted & game_systems
+                )
+        return restricted
+    if "$or" in where:
+        game_systems = set()
+        for condition in where["$or"]:
+            condition_game_systems = filtered_game_systems(condition)
+            if condition_game_systems is None:
+                return None
+            game_systems |= condition_game_systems
+        return game_systems
+    value = where.get("game_system")
+    if isinstance(value, str):
+        return {value}
+    if isinstance(value, dict):
+        if isinstance(value.get("$eq"), str):
+            return {value["$eq"]}
+        if isinstance(value.get("$in"), list):
+            return set(value["$in"])
+    return None
+
+
+class ShardRouter:
+    """Retrieves chunks from a corpus sharded into one collection per game
+    system.
+
+    Queries filtered on game systems only search their shards, so the
+    latency of a filtered query does not grow with the number of game
+    systems. Unfiltered queries search every shard in parallel and fuse the
+    results by reciprocal rank fusion.
+    """
+
+    def __init__(
+        self,
+        retrievers: Dict[str, Retriever],
+        max_workers: Optional[int] = enums.QUERY_MAX_CONCURRENT_BATCHES,
+        rrf_k: int = enums.RRF_K,
+    ) -> None:
+        """Initializes the ShardRouter.
+
+        Parameters
+        ----------
+        retrievers : Dict[str, Retriever]
+            The retriever of the shard of every game system.
+        max_workers : Optional[int], optional
+            The maximum number of shards searched at the same time, by
+            default QUERY_MAX_CONCURRENT_BATCHES.
+        rrf_k : int, optional
+            The reciprocal rank fusion constant, by default RRF_K.
+        """
+        self.retrievers = retrievers
+        self.rrf_k = rrf_k
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers or 1),
+            thread_name_prefix="shard-router",
+        )
+
+    def retrieve(
+        self,
+        query_text: str,
+        top_k: int = 15,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> List[RetrievedChunk]:
+        """Retrieve the chunks most relevant to a query text from the shards
+        matching its filter.
+
+        Parameters
+        ----------
+        query_text : str
+            The query text.
+        top_k : int, optional
+            The number of chunks to retrieve, by default 15.
+        where : Optional[Dict[str, Any]], optional
+            A ChromaDB metadata filter, by default None.
+
+        Returns
+        -------
+        List[RetrievedChunk]
+            The retrieved chunks, most relevant first.
+        """
+        game_systems = filtered_game_systems(where)
+        shards = [
+            retriever
+            for game_system, retriever in self.retrievers.items()
+            if game_systems is None or game_system in game_systems
+        ]
+        logger.debug(
+            "Routing query to %s of %s shards"
+            % (len(shards), len(self.retrievers))
+        )
+        if not shards:
+            return []
+        if len(shards) == 1:
+            return shards[0].retrieve(
+                query_text=query_text, top_k=top_k, where=where
+            )
+
+        # Run each search in a copy of the caller's context, so that its
+        # spans add to the timings of the request
+        futures = [
+            self._executor.submit(
+                contextvars.copy_context().run,
+                retriever.retrieve,
+                query_text=query_text,
+                top_k=top_k,
+                where=where,
+            )
+            for retriever in shards
+        ]
+        results = [future.result() for future in futures]
+        found = {chunk.id: chunk for chunks in results for chunk in chunks}
+        fused = reciprocal_rank_fusion(
+            [[chunk.id for chunk in chunks] for chunks in results],
+            k=self.rrf_k,
+        )
+        return [found[chunk_id] for chunk_id in fused[:top_k]]
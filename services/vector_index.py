@@ -0,0 +1,416 @@
+"""Module to define the VectorIndex class, a two-stage exact vector index of
+the chunk embeddings stored in the ChromaDB collection.
+"""
+import os
+import json
+import shutil
+import logging
+import itertools
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+from utils import enums
+
+# Number of prefilter rows scored at once, which bounds the temporary
+# float32 copy made when the prefilter is quantized
+_SCORE_BLOCK_ROWS = 16384
+# Number of embeddings converted and written at once while building
+_BUILD_PAGE_ROWS = 1024
+
+
+class VectorHit(NamedTuple):
+    """A chunk matching a vector query."""
+
+    id: str
+    # The cosine similarity of the full-precision vectors
+    score: float
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale the rows of a matrix to unit length, in place."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    vectors /= np.where(norms > 0, norms, 1.0)
+    return vectors
+
+
+class VectorIndex:
+    """A brute-force cosine index searched in two stages.
+
+    A compact prefilter, holding the first `prefilter_dimensions` dimensions
+    of every embedding, renormalized and optionally quantized to int8, is
+    kept in memory and scored against the query to select an oversampled
+    set of candidates. Embedding models trained Matryoshka-style, such as
+    text-embedding-004, keep most of their information in their leading
+    dimensions, so the candidates contain the true nearest neighbors. The
+    candidates are then rescored with their full-precision embeddings,
+    which are memory-mapped, so that only the candidate rows are read.
+    """
+
+    VERSION = 1
+    META_FILE = "meta.json"
+    IDS_FILE = "ids.json"
+    VECTORS_FILE = "vectors.f32"
+    PREFILTER_FILE = "prefilter.bin"
+    SCALES_FILE = "scales.f32"
+
+    def __init__(
+        self,
+        ids: List[str],
+        vectors: np.ndarray,
+        prefilter: np.ndarray,
+        scales: Optional[np.ndarray] = None,
+        oversample: int = enums.VECTOR_OVERSAMPLE,
+    ) -> None:
+        """Initializes the VectorIndex. Use `load` to open an index written
+        by `build`.
+
+        Parameters
+        ----------
+        ids : List[str]
+            The chunk IDs, indexed by row.
+        vectors : np.ndarray
+            The unit-length full-precision embeddings, one row per chunk.
+        prefilter : np.ndarray
+            The truncated embeddings, as float32, or as int8 with `scales`.
+        scales : Optional[np.ndarray], optional
+            The dequantization scale of every int8 prefilter row, by default
+            None.
+        oversample : int, optional
+            The number of candidates rescored per result, by default
+            VECTOR_OVERSAMPLE.
+        """
+        self.ids = ids
+        self.vectors = vectors
+        self.prefilter = prefilter
+        self.scales = scales
+        self.oversample = max(1, oversample)
+
+    def __len__(self) -> int:
+        """The number of indexed chunks."""
+        return len(self.ids)
+
+    @property
+    def prefilter_dimensions(self) -> int:
+        """The number of dimensions of the prefilter."""
+        return self.prefilter.shape[1]
+
+    @property
+    def prefilter_bytes(self) -> int:
+        """The memory held by the prefilter."""
+        size = self.prefilter.nbytes
+        return size + (self.scales.nbytes if self.scales is not None else 0)
+
+    @staticmethod
+    def make_prefilter(
+        vectors: np.ndarray,
+        dimensions: Optional[int] = enums.VECTOR_PREFILTER_DIMENSIONS,
+        quantize: bool = enums.VECTOR_PREFILTER_INT8,
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Truncate, renormalize and optionally quantize embeddings.
+
+        Parameters
+        ----------
+        vectors : np.ndarray
+            The embeddings, one row per chunk.
+        dimensions : Optional[int], optional
+            The number of leading dimensions kept. If None, every dimension
+            is kept, by default VECTOR_PREFILTER_DIMENSIONS.
+        quantize : bool, optional
+            Whether to quantize the rows to int8 with a scale per row, by
+            default VECTOR_PREFILTER_INT8.
+
+        Returns
+        -------
+        Tuple[np.ndarray, Optional[np.ndarray]]
+            The prefilter rows and, if quantized, their scales.
+        """
+        truncated = _normalize(
+            np.array(vectors[:, :dimensions], dtype=np.float32)
+        )
+        if not quantize:
+            return truncated, None
+        scales = np.abs(truncated).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.rint(truncated / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        embeddings: Iterable[Tuple[str, np.ndarray]],
+        prefilter_dimensions: Optional[int] = (
+            enums.VECTOR_PREFILTER_DIMENSIONS
+        ),
+        quantize: bool = enums.VECTOR_PREFILTER_INT8,
+    ) -> int:
+        """Build an index and atomically replace the one stored at `path`.
+
+        Parameters
+        ----------
+        path : str
+            The folder the index is written to.
+        embeddings : Iterable[Tuple[str, np.ndarray]]
+            The `(chunk ID, embedding)` pairs to index.
+        prefilter_dimensions : Optional[int], optional
+            The number of leading dimensions of the prefilter, by default
+            VECTOR_PREFILTER_DIMENSIONS.
+        quantize : bool, optional
+            Whether to quantize the prefilter to int8, by default
+            VECTOR_PREFILTER_INT8.
+
+        Returns
+        -------
+        int
+            The number of indexed chunks.
+        """
+        # Write to a sibling folder, then swap it in
+        temporary_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+
+        ids = []
+        dimensions = None
+        files = {
+            filename: open(os.path.join(temporary_path, filename), "wb")
+            for filename in (
+                cls.VECTORS_FILE,
+                cls.PREFILTER_FILE,
+                cls.SCALES_FILE,
+            )
+        }
+        try:
+            # Rows are written in pages, so the corpus is never held in
+            # memory as a whole
+            page_ids = []
+            page_vectors = []
+
+            def write_page() -> None:
+                vectors = _normalize(np.array(page_vectors, dtype=np.float32))
+                prefilter, scales = cls.make_prefilter(
+                    vectors, prefilter_dimensions, quantize
+                )
+                vectors.tofile(files[cls.VECTORS_FILE])
+                prefilter.tofile(files[cls.PREFILTER_FILE])
+                if scales is not None:
+                    scales.tofile(files[cls.SCALES_FILE])
+                ids.extend(page_ids)
+                page_ids.clear()
+                page_vectors.clear()
+
+            for chunk_id, embedding in embeddings:
+                if dimensions is None:
+                    dimensions = len(embedding)
+                page_ids.append(chunk_id)
+                page_vectors.append(embedding)
+                if len(page_ids) >= _BUILD_PAGE_ROWS:
+                    write_page()
+            if page_ids:
+                write_page()
+        finally:
+            for file in files.values():
+                file.close()
+
+        with open(os.path.join(temporary_path, cls.IDS_FILE), "w") as file:
+            json.dump(ids, file)
+        with open(os.path.join(temporary_path, cls.META_FILE), "w") as file:
+            json.dump(
+                {
+                    "version": cls.VERSION,
+                    "dimensions": dimensions or 0,
+                    "prefilter_dimensions": min(
+                        prefilter_dimensions or dimensions or 0,
+                        dimensions or 0,
+                    ),
+                    "quantized": quantize,
+                },
+                file,
+            )
+        previous_path = f"{path}.old-{os.getpid()}"
+        if os.path.exists(path):
+            os.replace(path, previous_path)
+        os.replace(temporary_path, path)
+        shutil.rmtree(previous_path, ignore_errors=True)
+
+        logger.info(
+            "Built vector index of %s chunks with a %s-d%s prefilter in %s"
+            % (
+                len(ids),
+                prefilter_dimensions,
+                " int8" if quantize else "",
+                path,
+            )
+        )
+        return len(ids)
+
+    def update(
+        self,
+        path: str,
+        removed_ids: Iterable[str],
+        embeddings: Iterable[Tuple[str, np.ndarray]],
+    ) -> int:
+        """Write this index with some chunks removed and others added, and
+        atomically replace the one stored at `path`, keeping the prefilter
+        settings of this index.
+
+        Parameters
+        ----------
+        path : str
+            The folder the index is written to.
+        removed_ids : Iterable[str]
+            The IDs of the chunks to remove.
+        embeddings : Iterable[Tuple[str, np.ndarray]]
+            The `(chunk ID, embedding)` pairs to add, replacing the chunks of
+            the same IDs.
+
+        Returns
+        -------
+        int
+            The number of indexed chunks.
+        """
+        added = list(embeddings)
+        dropped = set(removed_ids).union(chunk_id for chunk_id, _ in added)
+        # The kept rows are read from the memory map, page by page
+        kept = (
+            (chunk_id, self.vectors[row])
+            for row, chunk_id in enumerate(self.ids)
+            if chunk_id not in dropped
+        )
+        return self.build(
+            path,
+            itertools.chain(kept, added),
+            prefilter_dimensions=self.prefilter_dimensions,
+            quantize=self.scales is not None,
+        )
+
+    @classmethod
+    def load(
+        cls, path: str, oversample: int = enums.VECTOR_OVERSAMPLE
+    ) -> Optional["VectorIndex"]:
+        """Open the index stored at `path`, reading its prefilter into
+        memory and memory-mapping its full-precision embeddings.
+
+        Parameters
+        ----------
+        path : str
+            The folder the index was written to.
+        oversample : int, optional
+            The number of candidates rescored per result, by default
+            VECTOR_OVERSAMPLE.
+
+        Returns
+        -------
+        Optional[VectorIndex]
+            The index, or None if it is missing, empty or unreadable.
+        """
+        try:
+            with open(os.path.join(path, cls.META_FILE), "r") as file:
+                meta = json.load(file)
+            if meta.get("version") != cls.VERSION:
+                logger.warning(
+                    "Ignoring vector index %s with version %s"
+                    % (path, meta.get("version"))
+                )
+                return None
+            with open(os.path.join(path, cls.IDS_FILE), "r") as file:
+                ids = json.load(file)
+            if not ids:
+                return None
+            vectors = np.memmap(
+                os.path.join(path, cls.VECTORS_FILE),
+                dtype=np.float32,
+                mode="r",
+                shape=(len(ids), meta["dimensions"]),
+            )
+            prefilter = np.fromfile(
+                os.path.join(path, cls.PREFILTER_FILE),
+                dtype=np.int8 if meta["quantized"] else np.float32,
+            ).reshape(len(ids), meta["prefilter_dimensions"])
+            scales = None
+            if meta["quantized"]:
+                scales = np.fromfile(
+                    os.path.join(path, cls.SCALES_FILE), dtype=np.float32
+                )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Error loading vector index %s: %s" % (path, e))
+            return None
+        return cls(
+            ids=ids,
+            vectors=vectors,
+            prefilter=prefilter,
+            scales=scales,
+            oversample=oversample,
+        )
+
+    def _prefilter_scores(self, query: np.ndarray) -> np.ndarray:
+        """Score every chunk against the truncated query."""
+        query = _normalize(
+            np.array(query[: self.prefilter_dimensions], dtype=np.float32)
+        )
+        if self.scales is None:
+            return self.prefilter @ query
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for start in range(0, len(self.ids), _SCORE_BLOCK_ROWS):
+            block = self.prefilter[start : start + _SCORE_BLOCK_ROWS]
+            scores[start : start + len(block)] = (
+                block.astype(np.float32) @ query
+            )
+        return scores * self.scales
+
+    def search(
+        self, query: np.ndarray, k: int = 10, oversample: Optional[int] = None
+    ) -> List[VectorHit]:
+        """Find the chunks whose embeddings are most similar to a query
+        embedding.
+
+        Parameters
+        ----------
+        query : np.ndarray
+            The query embedding.
+        k : int, optional
+            The maximum number of hits, by default 10.
+        oversample : Optional[int], optional
+            The number of candidates rescored per result. If None, the
+            oversampling of the index is used, by default None.
+
+        Returns
+        -------
+        List[VectorHit]
+            The most similar chunks, highest cosine similarity first.
+        """
+        count = len(self.ids)
+        k = min(k, count)
+        if k <= 0:
+            return []
+        candidates = min(count, k * (oversample or self.oversample))
+        scores = self._prefilter_scores(query)
+        if candidates < count:
+            rows = np.argpartition(-scores, candidates - 1)[:candidates]
+        else:
+            rows = np.arange(count)
+        # Reading the rows in file order keeps the memory map reads local
+        rows.sort()
+
+        query = _normalize(np.array(query, dtype=np.float32))
+        rescored = self.vectors[rows] @ query
+        best = np.argsort(-rescored)[:k]
+        return [
+            VectorHit(id=self.ids[rows[i]], score=float(rescored[i]))
+            for i in best
+        ]
+
+    def close(self) -> None:
+        """Release the prefilter and the memory map of the full-precision
+        embeddings, which is unmapped once no search still uses it.
+        """
+        self.ids = []
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.prefilter = np.empty((0, 0), dtype=np.float32)
+        self.scales = None
@@ -0,0 +1,38 @@
+"""Smoke test of the pipeline benchmark on a tiny synthetic corpus."""
+import unittest
+import importlib.util
+
+MISSING = [
+    name
+    for name in ("chromadb", "pymupdf4llm", "fastapi")
+    if importlib.util.find_spec(name) is None
+]
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestBenchPipeline(unittest.TestCase):
+    def test_run_times_every_stage(self):
+        from benchmarks.bench_pipeline import compare, run
+
+        results = run(books=1, pages=3, queries=5)
+        self.assertEqual(
+            [stage["name"] for stage in results["stages"]],
+            [
+                "process_documents",
+                "process_documents (parallel)",
+                "process_documents (text)",
+                "process_documents (cached)",
+                "chunking",
+                "generate_embeddings",
+                "chroma_upsert",
+                "lexical_index_build",
+            ],
+        )
+        self.assertEqual(results["corpus"]["pages"], 3)
+        self.assertGreater(results["corpus"]["chunks"], 0)
+        self.assertEqual(results["queries"]["queries"], 5)
+        self.assertEqual(len(compare(results, results)), 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Tests of the size-aware bulk writes into a ChromaDB collection."""
+import unittest
+import importlib.util
+
+import numpy as np
+
+MISSING = [
+    name
+    for name in ("chromadb", "langchain_google_genai")
+    if importlib.util.find_spec(name) is None
+]
+
+
+class FakeCollection:
+    """Records the upserts, rejects those above `limit` chunks or with an
+    empty document, and fails every upsert if `available` is False.
+    """
+
+    def __init__(self, limit: int = 1000, available: bool = True) -> None:
+        self.limit = limit
+        self.available = available
+        self.attempts = 0
+        self.writes = []
+        self.rows = {}
+
+    def upsert(self, ids, embeddings, metadatas=None, documents=None):
+        self.attempts += 1
+        if not self.available:
+            raise RuntimeError("The collection is unavailable")
+        if len(ids) > self.limit:
+            raise ValueError(
+                f"Batch size {len(ids)} exceeds maximum batch size "
+                f"{self.limit}"
+            )
+        if "" in documents:
+            raise ValueError("Expected document to be a non-empty str")
+        # Like ChromaDB, only lists of lists are accepted
+        if not isinstance(embeddings[0], list):
+            raise TypeError("Expected embeddings to be a list of lists")
+        self.writes.append(len(ids))
+        for i, chunk_id in enumerate(ids):
+            self.rows[chunk_id] = (embeddings[i], documents[i])
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestBulkWriter(unittest.TestCase):
+    def setUp(self):
+        from services.chromadb import BulkWriter
+
+        self.BulkWriter = BulkWriter
+        self.ids = [f"chunk-{i}" for i in range(25)]
+        self.embeddings = np.ones((25, 4), dtype=np.float32)
+        self.documents = [f"text {i}" for i in range(25)]
+
+    def write(self, writer):
+        with writer:
+            writer.write(
+                self.ids,
+                self.embeddings,
+                documents=self.documents,
+            )
+        return writer
+
+    def test_batches_are_bounded_by_count(self):
+        collection = FakeCollection()
+        writer = self.write(self.BulkWriter(collection, max_batch_size=10))
+        self.assertEqual(collection.writes, [10, 10, 5])
+        self.assertEqual(len(collection.rows), 25)
+        self.assertEqual(writer.stats()["rows"], 25)
+        self.assertEqual(writer.stats()["batches"], 3)
+
+    def test_batches_are_bounded_by_bytes(self):
+        collection = FakeCollection()
+        row_bytes = self.BulkWriter._row_bytes("chunk-10", 4, None, "text 10")
+        self.write(
+            self.BulkWriter(
+                collection,
+                max_batch_size=100,
+                max_batch_bytes=4 * row_bytes,
+            )
+        )
+        self.assertTrue(all(size <= 4 for size in collection.writes))
+        self.assertEqual(sum(collection.writes), 25)
+
+    def test_rejected_batches_are_split(self):
+        collection = FakeCollection(limit=4)
+        self.write(self.BulkWriter(collection, max_batch_size=10))
+        self.assertTrue(all(size <= 4 for size in collection.writes))
+        self.assertEqual(len(collection.rows), 25)
+
+    def test_invalid_batches_are_not_split(self):
+        collection = FakeCollection()
+        self.documents[3] = ""
+        with self.assertRaisesRegex(ValueError, "non-empty"):
+            self.write(self.BulkWriter(collection, max_batch_size=10))
+        # Only the invalid batch was attempted, and only once
+        self.assertEqual(collection.writes, [])
+        self.assertEqual(collection.attempts, 1)
+
+    def test_rewriting_is_idempotent(self):
+        collection = FakeCollection()
+        for _ in range(2):
+            self.write(self.BulkWriter(collection, max_batch_size=10))
+        self.assertEqual(len(collection.rows), 25)
+
+    def test_background_writes_and_errors(self):
+        collection = FakeCollection()
+        writer = self.write(
+            self.BulkWriter(collection, max_batch_size=10, background=True)
+        )
+        self.assertEqual(len(collection.rows), 25)
+        self.assertEqual(writer.rows, 25)
+
+        writer = self.BulkWriter(
+            FakeCollection(available=False),
+            max_batch_size=10,
+            background=True,
+        )
+        with self.assertRaises(RuntimeError):
+            self.write(writer)
+
+
+if __name__ == "__main__":
+    unittest.main()
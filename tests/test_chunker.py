@@ -0,0 +1,125 @@
+"""Tests of the structure-aware, token-bounded markdown chunker."""
+import unittest
+
+from models.document import Document
+from services.chunker import MarkdownChunker
+from services.embedding_client import estimate_tokens
+
+
+def page(text: str, page_number: int = 1) -> Document:
+    return Document(
+        filepath="Dragonbane/core.pdf",
+        page_content=text,
+        title="Core Rules",
+        game_system="Dragonbane",
+        page_number=page_number,
+    )
+
+
+def paragraph(topic: str, sentences: int) -> str:
+    return " ".join(
+        f"The {topic} rule number {i} applies on a roll of ten."
+        for i in range(sentences)
+    )
+
+
+class TestMarkdownChunker(unittest.TestCase):
+    def test_offsets_locate_every_chunk_in_the_page(self):
+        text = (
+            f"# Combat\n\n{paragraph('combat', 12)}\n\n"
+            f"## Dodge\n\n{paragraph('dodge', 12)}\n\n"
+            f"# Magic\n\n{paragraph('magic', 12)}\n"
+        )
+        chunks = MarkdownChunker(max_tokens=64, overlap_tokens=16)(page(text))
+
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(
+            [chunk.chunk_index for chunk in chunks], list(range(len(chunks)))
+        )
+        for chunk in chunks:
+            start = chunk.metadata["start_offset"]
+            end = chunk.metadata["end_offset"]
+            self.assertEqual(chunk.page_content, text[start:end])
+        # The chunks cover the page in order, overlapping within a section
+        starts = [chunk.metadata["start_offset"] for chunk in chunks]
+        self.assertEqual(starts, sorted(starts))
+        self.assertEqual(chunks[0].metadata["start_offset"], 0)
+        self.assertEqual(chunks[-1].metadata["end_offset"], len(text) - 1)
+
+    def test_chunks_stay_under_the_token_bound(self):
+        long_sentence = " ".join(f"word{i}" for i in range(400))
+        text = (
+            f"# Spells\n\n{paragraph('spell', 30)}\n\n{long_sentence}\n\n"
+            + "\n".join(f"| {i} | {paragraph('row', 1)} |" for i in range(40))
+        )
+        chunks = MarkdownChunker(max_tokens=50, overlap_tokens=10)(page(text))
+
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks:
+            self.assertLessEqual(estimate_tokens(chunk.page_content), 50)
+        # Sentences longer than the bound are split between words
+        contents = "".join(chunk.page_content for chunk in chunks)
+        self.assertIn("word0 ", contents)
+        self.assertIn("word399", contents)
+
+    def test_heading_paths_carry_over_pages(self):
+        chunker = MarkdownChunker(max_tokens=64, min_tokens=0)
+        first = chunker(
+            page(f"# Combat\n\n## Dodge\n\n{paragraph('dodge', 2)}\n")
+        )
+        second = chunker(page(f"{paragraph('parry', 2)}\n", page_number=2))
+
+        self.assertEqual(first[-1].heading_path, "Combat > Dodge")
+        self.assertEqual(second[0].heading_path, "Combat > Dodge")
+
+        # A new file starts without headings
+        other = Document(
+            filepath="Dragonbane/bestiary.pdf",
+            page_content=paragraph("monster", 2),
+            title="Bestiary",
+            game_system="Dragonbane",
+        )
+        self.assertEqual(chunker(other)[0].heading_path, "")
+
+    def test_short_sections_are_merged(self):
+        text = (
+            "# Armor\n\nLeather armor.\n\n# Helmets\n\nOpen helmet.\n\n"
+            f"# Weapons\n\n{paragraph('weapon', 8)}\n"
+        )
+        chunks = MarkdownChunker(max_tokens=256, min_tokens=8)(page(text))
+
+        self.assertIn("# Helmets", chunks[0].page_content)
+        self.assertTrue(chunks[-1].page_content.startswith("# Weapons"))
+
+    def test_split_tables_repeat_their_header(self):
+        header = "| Roll | Monster |\n|---|---|\n"
+        rows = "".join(
+            f"| {i} | A hungry monster number {i} from the deep woods |\n"
+            for i in range(30)
+        )
+        text = f"# Encounters\n\n{header}{rows}"
+        chunks = MarkdownChunker(max_tokens=80, overlap_tokens=0)(page(text))
+
+        tables = [chunk for chunk in chunks if "hungry" in chunk.page_content]
+        self.assertGreater(len(tables), 2)
+        for chunk in tables:
+            self.assertLessEqual(estimate_tokens(chunk.page_content), 80)
+            self.assertIn(header, chunk.page_content)
+            # The offsets locate the rows after the repeated header
+            start = chunk.metadata["start_offset"]
+            end = chunk.metadata["end_offset"]
+            self.assertTrue(chunk.page_content.endswith(text[start:end]))
+        self.assertEqual(
+            sum(chunk.page_content.count("hungry") for chunk in tables), 30
+        )
+
+    def test_joins_the_parts_of_a_page(self):
+        chunks = MarkdownChunker()(page(["# Combat", "Roll to hit."]))
+
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0].page_content, "# Combat\n\nRoll to hit.")
+        self.assertEqual(chunks[0].heading_path, "Combat")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+"""Tests of the deduplication, diversification and packing of the retrieved
+chunks into the prompt context.
+"""
+import unittest
+
+from models.retrieval import RetrievedChunk
+from services.context_builder import ContextBuilder
+from services.embedding_client import estimate_tokens
+
+PAGE = (
+    "Roll EVADE to dodge an attack. A dodge costs your action for the "
+    "round. You may parry instead with a weapon or a shield, which can "
+    "break. Monsters cannot be parried or dodged when they breathe fire."
+)
+
+
+def chunk(
+    chunk_id: str,
+    text: str,
+    page_number: int = 1,
+    start: int = None,
+    embedding=None,
+    end: int = None,
+) -> RetrievedChunk:
+    metadata = {}
+    if start is not None:
+        end = start + len(text) if end is None else end
+        metadata = {"start_offset": start, "end_offset": end}
+    return RetrievedChunk(
+        id=chunk_id,
+        text=text,
+        title="Core Rules",
+        filepath="Dragonbane/core.pdf",
+        page_number=page_number,
+        metadata=metadata,
+        embedding=embedding,
+    )
+
+
+def sentence(topic: str) -> str:
+    return " ".join(f"{topic} rule number {i} applies." for i in range(8))
+
+
+class TestContextBuilder(unittest.TestCase):
+    def setUp(self):
+        self.builder = ContextBuilder(token_budget=None)
+
+    def test_drops_exact_and_near_duplicates(self):
+        text = sentence("dodge")
+        chunks = [
+            chunk("a", text),
+            chunk("b", f"  {text.upper()} "),
+            chunk("c", text.replace("number 7", "number 8"), page_number=2),
+            chunk("d", sentence("parry"), page_number=3),
+            chunk("e", "   "),
+        ]
+
+        distinct = self.builder.deduplicate(chunks)
+
+        self.assertEqual([c.id for c in distinct], ["a", "d"])
+
+    def test_merges_overlapping_chunks_of_a_page(self):
+        first = chunk("first", PAGE[:90], start=0)
+        second = chunk("second", PAGE[60:150], start=60)
+        other_page = chunk("other", PAGE[90:180], page_number=2, start=90)
+
+        merged = self.builder.deduplicate([second, first, other_page])
+
+        # Merged into the position of the most relevant one
+        self.assertEqual([c.id for c in merged], ["second", "other"])
+        self.assertEqual(merged[0].text, PAGE[:150])
+        self.assertEqual(
+            (
+                merged[0].metadata["start_offset"],
+                merged[0].metadata["end_offset"],
+            ),
+            (0, 150),
+        )
+
+    def test_merging_keeps_a_repeated_table_header_in_front(self):
+        header = "| Roll | Monster |\n|---|---|\n"
+        rows = "".join(f"| {i} | Monster {i} |\n" for i in range(6))
+        first = chunk("first", rows[:40], start=100)
+        # The offsets of a chunk exclude its repeated header
+        second = chunk(
+            "second", header + rows[30:], start=130, end=100 + len(rows)
+        )
+
+        (merged,) = self.builder.deduplicate([first, second])
+
+        self.assertEqual(merged.text, rows)
+
+    def test_mmr_prefers_diverse_chunks(self):
+        chunks = [
+            chunk("dodge", "dodge", embedding=[1.0, 0.0]),
+            chunk("dodge again", "dodge again", embedding=[0.99, 0.1]),
+            chunk("parry", "parry", embedding=[0.0, 1.0]),
+        ]
+
+        selected = ContextBuilder(mmr_lambda=0.5).select(chunks)
+        self.assertEqual(
+            [c.id for c in selected], ["dodge", "parry", "dodge again"]
+        )
+        # Relevance alone keeps the retrieval order
+        selected = ContextBuilder(mmr_lambda=1.0).select(chunks)
+        self.assertEqual([c.id for c in selected], [c.id for c in chunks])
+
+    def test_mmr_falls_back_to_shingles_without_embeddings(self):
+        dodge = sentence("dodge")
+        chunks = [
+            chunk("dodge", dodge),
+            chunk("dodge again", dodge.replace("rule number 7", "x y z")),
+            chunk("parry", sentence("parry")),
+        ]
+
+        selected = ContextBuilder(mmr_lambda=0.5).select(chunks)
+
+        self.assertEqual(
+            [c.id for c in selected], ["dodge", "parry", "dodge again"]
+        )
+
+    def test_packs_chunks_under_the_token_budget(self):
+        chunks = [
+            chunk("long", "spell " * 200, page_number=1),
+            chunk("short", "dodge " * 20, page_number=2),
+            chunk("medium", "parry " * 60, page_number=3),
+        ]
+        budget = 150
+
+        context = ContextBuilder(token_budget=budget, mmr_lambda=1.0).build(
+            "How do I dodge?", chunks
+        )
+
+        self.assertLessEqual(estimate_tokens(context), budget)
+        self.assertTrue(context.startswith("User query: How do I dodge?"))
+        # The long chunk does not fit, the shorter ones further down do
+        self.assertNotIn("spell", context)
+        self.assertIn("[Core Rules, p. 2]\ndodge", context)
+        self.assertIn("[Core Rules, p. 3]\nparry", context)
+
+    def test_without_a_budget_every_distinct_chunk_is_kept(self):
+        chunks = [chunk(str(i), f"{sentence(str(i))}") for i in range(5)]
+
+        context = self.builder.build("query", chunks)
+
+        self.assertEqual(context.count("[Core Rules, p. 1]"), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Tests of the lazily constructed clients and the paths of the index."""
+import os
+import time
+import unittest
+import importlib.util
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import enums
+from services import dependencies
+
+MISSING = [
+    name for name in ("chromadb",) if importlib.util.find_spec(name) is None
+]
+
+
+class TestShardPath(unittest.TestCase):
+    def shard_path(self, path, shard=None, backend="gemini"):
+        with mock.patch.object(enums, "EMBEDDING_BACKEND", backend):
+            return dependencies.shard_path(path, shard)
+
+    def test_default_backend_keeps_the_paths(self):
+        self.assertEqual(
+            self.shard_path(enums.INDEX_MANIFEST_PATH),
+            enums.INDEX_MANIFEST_PATH,
+        )
+        self.assertEqual(dependencies.collection_name(), "ttrpg_documents")
+
+    def test_paths_are_namespaced_by_backend(self):
+        paths = {
+            backend: [
+                self.shard_path(path, backend=backend)
+                for path in (
+                    enums.INDEX_MANIFEST_PATH,
+                    enums.LEXICAL_INDEX_PATH,
+                    enums.VECTOR_INDEX_PATH,
+                )
+            ]
+            for backend in ("gemini", "local")
+        }
+
+        self.assertEqual(
+            paths["local"][0],
+            os.path.join(
+                enums.CHROMA_DB_PATH,
+                "ttrpg_documents_local",
+                "index_manifest.json",
+            ),
+        )
+        for gemini, local in zip(paths["gemini"], paths["local"]):
+            self.assertNotEqual(gemini, local)
+
+    @unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+    def test_shard_paths_are_namespaced_by_backend(self):
+        self.assertEqual(
+            self.shard_path(enums.LEXICAL_INDEX_PATH, "Mörk Borg", "local"),
+            os.path.join(
+                enums.CHROMA_DB_PATH,
+                "ttrpg_documents_local_m-rk-borg",
+                "lexical_index",
+            ),
+        )
+        self.assertNotEqual(
+            self.shard_path(enums.LEXICAL_INDEX_PATH, "Mörk Borg"),
+            self.shard_path(enums.LEXICAL_INDEX_PATH, "Mörk Borg", "local"),
+        )
+
+    def test_paths_follow_the_served_folder(self):
+        with mock.patch.object(dependencies, "_index_root", "generations/7"):
+            self.assertEqual(
+                self.shard_path(enums.VECTOR_INDEX_PATH, backend="local"),
+                os.path.join(
+                    "generations",
+                    "7",
+                    "ttrpg_documents_local",
+                    "vector_index",
+                ),
+            )
+
+
+class TestSingleton(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        @dependencies._singleton
+        def get_client(shard=None, timeout=30):
+            self.calls.append((shard, timeout))
+            time.sleep(0.01)
+            return object()
+
+        self.get_client = get_client
+
+    def test_equivalent_arguments_share_an_instance(self):
+        client = self.get_client()
+
+        self.assertIs(self.get_client(None), client)
+        self.assertIs(self.get_client(shard=None, timeout=30), client)
+        self.assertEqual(self.calls, [(None, 30)])
+
+    def test_instances_are_kept_per_argument(self):
+        clients = {
+            shard: self.get_client(shard) for shard in (None, "A", "B")
+        }
+
+        self.assertEqual(len(set(map(id, clients.values()))), 3)
+        self.assertIs(self.get_client("A"), clients["A"])
+        self.assertIsNot(self.get_client("A", timeout=5), clients["A"])
+        self.assertEqual(
+            self.get_client.cached(),
+            list(clients.values()) + [self.get_client("A", timeout=5)],
+        )
+
+    def test_cache_clear(self):
+        client = self.get_client()
+
+        self.get_client.cache_clear()
+
+        self.assertEqual(self.get_client.cached(), [])
+        self.assertIsNot(self.get_client(), client)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_calls_construct_once(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(
+                executor.map(lambda _: self.get_client("A"), range(16))
+            )
+
+        self.assertEqual(len(set(map(id, clients))), 1)
+        self.assertEqual(self.calls, [("A", 30)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Tests of the extraction of one Document per page of the pdf files of a
+game system folder.
+"""
+import os
+import tempfile
+import unittest
+import importlib.util
+
+MISSING = [
+    name
+    for name in ("pymupdf", "pymupdf4llm")
+    if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from benchmarks.corpus import generate_rulebooks
+    from services.document_processor import DocumentProcessor
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestDocumentProcessor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        cls.folder = os.path.join(directory.name, "Dragonbane 2e")
+        cls.filepaths = generate_rulebooks(cls.folder, books=2, pages=3)
+
+    def test_edition_and_title_come_from_the_paths(self):
+        processor = DocumentProcessor(self.folder)
+
+        self.assertEqual(processor.game_system, "Dragonbane 2e")
+        self.assertEqual(processor.edition, "2e")
+        self.assertEqual(DocumentProcessor("pdfs/Dragonbane").edition, "1e")
+        self.assertEqual(
+            processor._extract_title(self.filepaths[0]), "Rulebook 1"
+        )
+
+    def test_one_document_per_page(self):
+        processor = DocumentProcessor(self.folder, mode="text")
+
+        documents = processor.process_documents()
+
+        self.assertEqual(
+            [(doc.filepath, doc.page_number) for doc in documents],
+            [
+                (filepath, page)
+                for filepath in sorted(self.filepaths)
+                for page in (1, 2, 3)
+            ],
+        )
+        for document in documents:
+            self.assertEqual(document.game_system, "Dragonbane 2e")
+            self.assertEqual(document.edition, "2e")
+            self.assertEqual(
+                document.file_hash,
+                processor.get_file_hash(document.filepath),
+            )
+            self.assertTrue(document.page_content.strip())
+
+    def test_markdown_keeps_the_headings(self):
+        processor = DocumentProcessor(self.folder, mode="markdown")
+
+        documents = list(processor.iter_documents(filepaths=self.filepaths))
+
+        self.assertEqual(len(documents), 6)
+        self.assertTrue(any("#" in doc.page_content for doc in documents))
+        self.assertEqual(
+            processor.extraction_stats[self.filepaths[0]]["pages"], 3
+        )
+
+    def test_parallel_extraction_matches_the_serial_one(self):
+        serial = DocumentProcessor(self.folder, mode="text")
+        parallel = DocumentProcessor(
+            self.folder, max_workers=2, pages_per_task=2, mode="text"
+        )
+
+        expected = serial.process_documents()
+        documents = parallel.process_documents(parallel=True)
+
+        self.assertEqual(
+            [(d.filepath, d.page_number, d.page_content) for d in documents],
+            [(d.filepath, d.page_number, d.page_content) for d in expected],
+        )
+
+    def test_empty_folder(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with self.assertLogs("services.document_processor", "ERROR"):
+                documents = DocumentProcessor(folder).process_documents()
+
+        self.assertEqual(documents, [])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            DocumentProcessor(self.folder, mode="ocr")
+
+
+if __name__ == "__main__":
+    unittest.main()
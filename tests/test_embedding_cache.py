@@ -0,0 +1,134 @@
+"""Tests of the persistent embedding cache."""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from services.embedding_cache import EmbeddingCache, embed_with_cache
+
+
+def key(text: str) -> bytes:
+    return EmbeddingCache.make_key(text, "model", 4, "RETRIEVAL_DOCUMENT")
+
+
+def vector(value: float) -> np.ndarray:
+    return np.full(4, value, dtype=np.float32)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cache.sqlite3")
+
+    def open(self, **kwargs) -> EmbeddingCache:
+        cache = EmbeddingCache(path=self.path, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_keys_depend_on_every_setting(self):
+        keys = {
+            key("text"),
+            key("other text"),
+            EmbeddingCache.make_key("text", "other", 4, "RETRIEVAL_DOCUMENT"),
+            EmbeddingCache.make_key("text", "model", 8, "RETRIEVAL_DOCUMENT"),
+            EmbeddingCache.make_key("text", "model", 4, "RETRIEVAL_QUERY"),
+            EmbeddingCache.make_key(
+                "text", "model", 4, "RETRIEVAL_DOCUMENT", quantized=True
+            ),
+            EmbeddingCache.make_key(
+                "text", "model", 4, "RETRIEVAL_DOCUMENT", normalized=True
+            ),
+        }
+        self.assertEqual(len(keys), 7)
+
+    def test_hits_and_misses(self):
+        cache = self.open()
+        cache.put_many([(key("a"), vector(1)), (key("b"), vector(2))])
+
+        found = cache.get_many([key("a"), key("c"), key("a")])
+
+        self.assertEqual(list(found), [key("a")])
+        np.testing.assert_array_equal(found[key("a")], vector(1))
+        self.assertEqual(
+            cache.stats(),
+            {"entries": 2, "hits": 2, "misses": 1, "evictions": 0},
+        )
+
+    def test_lookups_do_not_write(self):
+        cache = self.open()
+        cache.put_many([(key("a"), vector(1))])
+        before = cache._connection.total_changes
+        for _ in range(10):
+            cache.get_many([key("a"), key("b")])
+        self.assertEqual(cache._connection.total_changes, before)
+        self.assertFalse(cache._connection.in_transaction)
+
+    def test_evicts_the_least_recently_used_entries(self):
+        cache = self.open(max_entries=3)
+        cache.put_many([(key("a"), vector(1)), (key("b"), vector(2))])
+        cache.put_many([(key("c"), vector(3))])
+        # Reading "a" makes "b" the least recently used entry
+        cache.get_many([key("a")])
+
+        cache.put_many([(key("d"), vector(4))])
+
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.evictions, 1)
+        found = cache.get_many([key(text) for text in "abcd"])
+        self.assertEqual(set(found), {key("a"), key("c"), key("d")})
+
+    def test_persists_across_reopening(self):
+        cache = self.open(max_entries=2)
+        cache.put_many([(key("a"), vector(1))])
+        cache.put_many([(key("b"), vector(2))])
+        cache.get_many([key("a")])
+        cache.close()
+
+        cache = self.open(max_entries=2)
+        self.assertEqual(len(cache), 2)
+        np.testing.assert_array_equal(
+            cache.get_many([key("b")])[key("b")], vector(2)
+        )
+        # The access times buffered before closing were written
+        cache = self.open(max_entries=2)
+        cache.put_many([(key("c"), vector(3))])
+        found = cache.get_many([key(text) for text in "abc"])
+        self.assertEqual(set(found), {key("a"), key("c")})
+
+    def test_flushes_access_times_after_flush_size_lookups(self):
+        cache = self.open(flush_size=2)
+        cache.put_many([(key("a"), vector(1)), (key("b"), vector(2))])
+        before = cache._connection.total_changes
+        cache.get_many([key("a")])
+        self.assertEqual(cache._connection.total_changes, before)
+        cache.get_many([key("b")])
+        self.assertEqual(cache._connection.total_changes, before + 2)
+
+    def test_embeds_only_missing_texts(self):
+        cache = self.open()
+        calls = []
+
+        def embed(texts):
+            calls.append(list(texts))
+            return np.array([vector(len(text)) for text in texts])
+
+        settings = dict(
+            model_name="model",
+            output_dimensionality=4,
+            task_type="RETRIEVAL_DOCUMENT",
+        )
+        embed_with_cache(cache, ["a", "bb"], embed, **settings)
+        matrix = embed_with_cache(
+            cache, ["bb", "ccc", "ccc"], embed, **settings
+        )
+
+        self.assertEqual(calls, [["a", "bb"], ["ccc"]])
+        np.testing.assert_array_equal(
+            matrix, np.stack([vector(2), vector(3), vector(3)])
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+"""Tests for the EmbeddingClient against a local fake embedding server."""
+import json
+import time
+import threading
+import unittest
+import urllib.request
+from typing import List
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.embedding_client import EmbeddingClient
+
+
+class FakeEmbeddingServer(ThreadingHTTPServer):
+    """A local HTTP server that embeds every text as `[len(text), hash]`,
+    fails the first requests with a 503 and records the peak concurrency of
+    its callers.
+    """
+
+    def __init__(self, failures: int = 0, latency: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), FakeEmbeddingHandler)
+        self.failures = failures
+        self.latency = latency
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%s/embed" % self.server_address[1]
+
+
+class FakeEmbeddingHandler(BaseHTTPRequestHandler):
+    def do_POST(self) -> None:
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.requests <= server.failures
+        length = int(self.headers["Content-Length"])
+        texts = json.loads(self.rfile.read(length))["texts"]
+        time.sleep(server.latency)
+        if fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+        with server.lock:
+            server.batch_sizes.append(len(texts))
+        embeddings = [
+            [float(len(text)), float(sum(map(ord, text)))] for text in texts
+        ]
+        body = json.dumps({"embeddings": embeddings}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class TestEmbeddingClient(unittest.TestCase):
+    def start_server(self, **kwargs) -> FakeEmbeddingServer:
+        server = FakeEmbeddingServer(**kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def make_embed_batch(self, server: FakeEmbeddingServer):
+        def embed_batch(texts: List[str]) -> List[List[float]]:
+            request = urllib.request.Request(
+                server.url,
+                data=json.dumps({"texts": texts}).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            # Counted by the caller, since the server only finishes handling
+            # a request after the client has read the response
+            with server.lock:
+                server.in_flight += 1
+                server.max_in_flight = max(
+                    server.max_in_flight, server.in_flight
+                )
+            try:
+                with urllib.request.urlopen(request, timeout=5) as response:
+                    return json.loads(response.read())["embeddings"]
+            finally:
+                with server.lock:
+                    server.in_flight -= 1
+
+        return embed_batch
+
+    def test_returns_vectors_in_input_order(self):
+        server = self.start_server(latency=0.01)
+        client = EmbeddingClient(
+            self.make_embed_batch(server),
+            batch_size=7,
+            max_in_flight=4,
+            requests_per_minute=None,
+        )
+        self.addCleanup(client.close)
+        texts = ["text %s" % ("x" * i) for i in range(50)]
+        embeddings = client.embed(texts)
+        self.assertEqual(
+            embeddings.tolist(),
+            [[float(len(t)), float(sum(map(ord, t)))] for t in texts],
+        )
+        self.assertEqual(len(server.batch_sizes), 8)
+        self.assertLessEqual(max(server.batch_sizes), 7)
+
+    def test_caps_requests_in_flight(self):
+        server = self.start_server(latency=0.05)
+        client = EmbeddingClient(
+            self.make_embed_batch(server),
+            batch_size=1,
+            max_in_flight=3,
+            requests_per_minute=None,
+        )
+        self.addCleanup(client.close)
+        client.embed(["text"] * 12)
+        self.assertGreater(server.max_in_flight, 1)
+        self.assertLessEqual(server.max_in_flight, 3)
+
+    def test_splits_batches_by_tokens(self):
+        client = EmbeddingClient(
+            lambda texts: [[0.0]] * len(texts),
+            batch_size=100,
+            max_batch_tokens=30,
+            requests_per_minute=None,
+        )
+        batches = client._split_batches(["x" * 40] * 5)
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+    def test_retries_transient_failures(self):
+        server = self.start_server(failures=2)
+        client = EmbeddingClient(
+            self.make_embed_batch(server),
+            max_retries=3,
+            base_delay=0.01,
+            requests_per_minute=None,
+        )
+        self.addCleanup(client.close)
+        self.assertEqual(client.embed(["abc"]).tolist(), [[3.0, 294.0]])
+        self.assertEqual(server.requests, 3)
+
+    def test_does_not_retry_permanent_failures(self):
+        calls = []
+
+        def embed_batch(texts: List[str]) -> List[List[float]]:
+            calls.append(texts)
+            raise ValueError("invalid request")
+
+        client = EmbeddingClient(
+            embed_batch, base_delay=0.01, requests_per_minute=None
+        )
+        with self.assertRaises(ValueError):
+            client.embed(["abc"])
+        self.assertEqual(len(calls), 1)
+
+    def test_rate_limits_requests(self):
+        server = self.start_server()
+        client = EmbeddingClient(
+            self.make_embed_batch(server),
+            batch_size=1,
+            max_in_flight=1,
+            requests_per_minute=600,
+        )
+        self.addCleanup(client.close)
+        start = time.perf_counter()
+        client.embed(["text"] * 4)
+        # One burst token, then one request every 0.1s
+        self.assertGreaterEqual(time.perf_counter() - start, 0.25)
+
+
+if __name__ == "__main__":
+    unittest.main()
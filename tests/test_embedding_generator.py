@@ -0,0 +1,89 @@
+"""Tests of the embedding of chunked documents into a float32 matrix."""
+import unittest
+import importlib.util
+
+import numpy as np
+
+MISSING = [
+    name for name in ("chromadb",) if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from models.document import Document
+    from services.embedding_generator import EmbeddingGenerator
+
+
+class ListEmbeddingFunction:
+    """Embeds a text as its length and its number of words, as the lists
+    ChromaDB expects.
+    """
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __call__(self, input):
+        self.calls.append(list(input))
+        return [[len(text), len(text.split())] for text in input]
+
+
+class MatrixEmbeddingFunction(ListEmbeddingFunction):
+    """Also embeds texts straight into a matrix, like the embedding
+    functions of this package.
+    """
+
+    def embed_matrix(self, texts):
+        self.calls.append(list(texts))
+        return np.array(
+            [[len(text), len(text.split())] for text in texts],
+            dtype=np.float32,
+        )
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestEmbeddingGenerator(unittest.TestCase):
+    def test_embeds_texts_in_order(self):
+        function = ListEmbeddingFunction()
+        generator = EmbeddingGenerator(embedding_function=function)
+
+        matrix = generator.generate_embeddings(["dodge", "parry a blow"])
+
+        self.assertEqual(matrix.dtype, np.float32)
+        np.testing.assert_array_equal(matrix, [[5, 1], [12, 3]])
+        np.testing.assert_array_equal(
+            generator.generate_embeddings("dodge"), [[5, 1]]
+        )
+
+    def test_embeds_the_content_of_documents(self):
+        function = MatrixEmbeddingFunction()
+        generator = EmbeddingGenerator(embedding_function=function)
+        documents = [
+            Document(
+                filepath="Dragonbane/core.pdf",
+                page_content=text,
+                title="Core Rules",
+                game_system="Dragonbane",
+                edition="1e",
+                page_number=page,
+            )
+            for page, text in enumerate(["Roll EVADE.", "Parry."], 1)
+        ]
+
+        matrix = generator.generate_embeddings(documents)
+
+        np.testing.assert_array_equal(matrix, [[11, 2], [6, 1]])
+        # The matrix is produced directly, without converting lists
+        self.assertEqual(function.calls, [["Roll EVADE.", "Parry."]])
+
+    def test_no_documents(self):
+        function = MatrixEmbeddingFunction()
+        generator = EmbeddingGenerator(embedding_function=function)
+
+        matrix = generator.generate_embeddings([])
+
+        self.assertEqual(matrix.shape, (0, 0))
+        self.assertEqual(matrix.dtype, np.float32)
+        self.assertEqual(function.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,220 @@
+"""Tests of the persistent cache of the text extracted from pdf files."""
+import os
+import shutil
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+from services.extraction_cache import ExtractionCache
+
+MISSING = [
+    name
+    for name in ("pymupdf", "pymupdf4llm")
+    if importlib.util.find_spec(name) is None
+]
+
+
+class TestExtractionCache(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = ExtractionCache(path=directory.name)
+
+    def test_round_trips_pages(self):
+        pages = [(1, "# Combat\n\nRoll a D20."), (2, "Élan ✓"), (3, "")]
+        key = ExtractionCache.make_key("hash", "extractor", {"mode": "text"})
+        self.assertNotIn(key, self.cache)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, pages)
+        self.assertIn(key, self.cache)
+        with self.cache.get(key) as extraction:
+            self.assertEqual(len(extraction), 3)
+            self.assertEqual(extraction[1], pages[1])
+            self.assertEqual(extraction[-1], pages[2])
+            self.assertEqual(list(extraction), pages)
+        self.assertEqual(
+            self.cache.stats(), {"hits": 1, "misses": 1, "evictions": 0}
+        )
+
+    def test_keys_change_with_options(self):
+        keys = {
+            ExtractionCache.make_key("hash", "v1", {"mode": "markdown"}),
+            ExtractionCache.make_key("hash", "v1", {"mode": "text"}),
+            ExtractionCache.make_key("hash", "v2", {"mode": "markdown"}),
+            ExtractionCache.make_key("other", "v1", {"mode": "markdown"}),
+        }
+        self.assertEqual(len(keys), 4)
+
+    def test_ignores_truncated_entries(self):
+        key = ExtractionCache.make_key("hash", "extractor", {})
+        self.cache.put(key, [(1, "Roll a D20.")])
+        path = self.cache._entry_path(key)
+        with open(os.path.join(path, self.cache.PAGES_FILE), "r+b") as file:
+            file.truncate(4)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_evicts_the_least_recently_used_entries(self):
+        keys = [ExtractionCache.make_key(str(i), "v1", {}) for i in range(3)]
+        pages = [(1, "x" * 100)]
+        for i, key in enumerate(keys[:2]):
+            self.cache.put(key, pages)
+            offsets = os.path.join(
+                self.cache._entry_path(key), self.cache.OFFSETS_FILE
+            )
+            os.utime(offsets, ns=(i, i))
+        self.cache.max_bytes = 300
+        # Reading the first entry makes the second one the oldest
+        self.cache.get(keys[0]).close()
+
+        self.cache.put(keys[2], pages)
+
+        self.assertEqual(
+            [key in self.cache for key in keys], [True, False, True]
+        )
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        # The entry just stored is kept even if it is too large alone
+        self.cache.max_bytes = 1
+        self.assertEqual(self.cache.evict(keep=keys[2]), 1)
+        self.assertEqual(
+            [key in self.cache for key in keys], [False, False, True]
+        )
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestCachedExtraction(unittest.TestCase):
+    def test_parses_every_file_once(self):
+        from benchmarks.corpus import generate_rulebooks
+        from services import document_processor
+        from services.document_processor import DocumentProcessor
+
+        with tempfile.TemporaryDirectory() as root:
+            folder = os.path.join(root, "Dragonbane")
+            generate_rulebooks(folder, books=2, pages=2)
+            cache = ExtractionCache(path=os.path.join(root, "cache"))
+            documents = DocumentProcessor(
+                base_folder=folder, cache=cache
+            ).process_documents()
+            with mock.patch.object(
+                document_processor,
+                "_extract_page_range",
+                side_effect=AssertionError("parsed again"),
+            ):
+                cached = DocumentProcessor(
+                    base_folder=folder, cache=cache
+                ).process_documents()
+            self.assertEqual(
+                [(d.filepath, d.page_number, d.page_content) for d in cached],
+                [
+                    (d.filepath, d.page_number, d.page_content)
+                    for d in documents
+                ],
+            )
+            self.assertEqual(cache.stats()["hits"], 2)
+            self.assertEqual(cache.stats()["misses"], 2)
+
+            # The plain text mode is cached separately
+            text = DocumentProcessor(
+                base_folder=folder, mode="text", cache=cache
+            ).process_documents()
+            self.assertEqual(len(text), len(documents))
+            self.assertNotIn("#", text[0].page_content)
+            self.assertEqual(cache.stats()["misses"], 4)
+
+    def test_cached_files_are_opened_one_at_a_time(self):
+        from benchmarks.corpus import generate_rulebooks
+        from services.document_processor import DocumentProcessor
+
+        with tempfile.TemporaryDirectory() as root:
+            folder = os.path.join(root, "Dragonbane")
+            filepaths = generate_rulebooks(folder, books=3, pages=1)
+            cache = ExtractionCache(path=os.path.join(root, "cache"))
+            processor = DocumentProcessor(
+                base_folder=folder, mode="text", cache=cache
+            )
+            expected = [
+                (d.filepath, d.page_content)
+                for d in processor.process_documents()
+            ]
+            opened = []
+            get = cache.get
+
+            def tracked_get(key):
+                extraction = get(key)
+                opened.append(extraction)
+                # Every file opened before is closed already
+                for previous in filter(None, opened[:-1]):
+                    self.assertIsNone(previous._mmap)
+                return extraction
+
+            # The second file is evicted after it was checked
+            evicted = processor.get_cache_key(sorted(filepaths)[1])
+            with mock.patch.object(cache, "get", tracked_get):
+                documents = (
+                    (d.filepath, d.page_content)
+                    for d in processor.iter_documents()
+                )
+                self.assertEqual(next(documents), expected[0])
+                self.assertEqual(len(opened), 1)
+                shutil.rmtree(cache._entry_path(evicted))
+                self.assertEqual(list(documents), expected[1:])
+
+            self.assertEqual(len(opened), 3)
+            self.assertIsNone(opened[1])
+            # The evicted file is extracted and cached again
+            self.assertIn(evicted, cache)
+
+    def test_parallel_extraction_is_cached_in_page_order(self):
+        from benchmarks.corpus import generate_rulebooks
+        from services.document_processor import DocumentProcessor
+
+        with tempfile.TemporaryDirectory() as root:
+            folder = os.path.join(root, "Dragonbane")
+            (filepath,) = generate_rulebooks(folder, books=1, pages=4)
+            cache = ExtractionCache(path=os.path.join(root, "cache"))
+            processor = DocumentProcessor(
+                base_folder=folder,
+                max_workers=2,
+                pages_per_task=1,
+                mode="text",
+                cache=cache,
+            )
+            processor.process_documents(parallel=True)
+
+            with cache.get(processor.get_cache_key(filepath)) as extraction:
+                self.assertEqual(
+                    [page for page, _ in extraction], [1, 2, 3, 4]
+                )
+
+    def test_known_file_hashes_are_not_computed_again(self):
+        from benchmarks.corpus import generate_rulebooks
+        from services import document_processor
+        from services.document_processor import DocumentProcessor
+
+        with tempfile.TemporaryDirectory() as root:
+            folder = os.path.join(root, "Dragonbane")
+            (filepath,) = generate_rulebooks(folder, books=1, pages=1)
+            cache = ExtractionCache(path=os.path.join(root, "cache"))
+            with mock.patch.object(
+                document_processor,
+                "hash_file",
+                side_effect=AssertionError("hashed again"),
+            ):
+                (document,) = DocumentProcessor(
+                    base_folder=folder,
+                    mode="text",
+                    cache=cache,
+                    file_hashes={filepath: "known"},
+                ).process_documents()
+
+            self.assertEqual(document.file_hash, "known")
+            self.assertIn(
+                ExtractionCache.make_key(
+                    "known", document_processor.EXTRACTOR, {"mode": "text"}
+                ),
+                cache,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,308 @@
+"""Tests of the folder watcher and of the background ingestion yielding to
+queries.
+"""
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils.file_utils import get_pdf_filepaths, scan_pdf_files
+from utils.priority import PriorityLock, QueryTraffic, background
+from services import indexing
+from services.folder_watcher import FolderChanges, FolderWatcher
+
+
+def write_file(path: str, content: bytes = b"%PDF-1.4") -> None:
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+class TestScanPdfFiles(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.folder = directory.name
+
+    def test_lists_pdf_files_only(self):
+        write_file(os.path.join(self.folder, "b.pdf"))
+        write_file(os.path.join(self.folder, "a.pdf"), b"%PDF-1.7 longer")
+        write_file(os.path.join(self.folder, "notes.txt"))
+        os.mkdir(os.path.join(self.folder, "folder.pdf"))
+
+        files = scan_pdf_files(self.folder)
+
+        self.assertEqual(
+            list(files),
+            [
+                os.path.join(self.folder, "a.pdf"),
+                os.path.join(self.folder, "b.pdf"),
+            ],
+        )
+        self.assertEqual(files[os.path.join(self.folder, "a.pdf")][0], 15)
+        self.assertEqual(get_pdf_filepaths(self.folder), list(files))
+
+    def test_missing_folder(self):
+        with self.assertRaises(OSError):
+            scan_pdf_files(os.path.join(self.folder, "missing"))
+        with self.assertLogs("utils.file_utils", "ERROR"):
+            filepaths = get_pdf_filepaths(
+                os.path.join(self.folder, "missing")
+            )
+        self.assertEqual(filepaths, [])
+
+
+class TestFolderWatcher(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.folder = directory.name
+        self.changes = []
+        self.watcher = FolderWatcher(
+            [self.folder],
+            on_change=lambda folder, changes: self.changes.append(changes),
+            debounce_seconds=0,
+        )
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def test_reports_added_changed_and_removed_files(self):
+        write_file(self.path("kept.pdf"))
+        write_file(self.path("changed.pdf"))
+        write_file(self.path("removed.pdf"))
+        self.watcher.scan()
+
+        write_file(self.path("added.pdf"))
+        write_file(self.path("changed.pdf"), b"%PDF-1.4 edited")
+        os.remove(self.path("removed.pdf"))
+        # The first poll sees the changes, the next one that they settled
+        self.assertEqual(self.watcher.poll(), [])
+        self.watcher.poll()
+
+        self.assertEqual(
+            self.changes,
+            [
+                FolderChanges(
+                    added=[self.path("added.pdf")],
+                    changed=[self.path("changed.pdf")],
+                    removed=[self.path("removed.pdf")],
+                )
+            ],
+        )
+        # Reported once
+        self.watcher.poll()
+        self.assertEqual(len(self.changes), 1)
+
+    def test_waits_until_files_stop_changing(self):
+        self.watcher.debounce_seconds = 60
+        self.watcher.scan()
+        write_file(self.path("copying.pdf"))
+        self.watcher.poll()
+        self.watcher.poll()
+        self.assertEqual(self.changes, [])
+
+        # Growing files restart the debounce period
+        now = time.monotonic()
+        with mock.patch("time.monotonic", return_value=now + 61):
+            write_file(self.path("copying.pdf"), b"%PDF-1.4 more pages")
+            self.watcher.poll()
+            self.assertEqual(self.changes, [])
+        with mock.patch("time.monotonic", return_value=now + 122):
+            self.watcher.poll()
+        self.assertEqual(
+            self.changes,
+            [FolderChanges([self.path("copying.pdf")], [], [])],
+        )
+
+    def test_ignores_changes_reverted_before_settling(self):
+        write_file(self.path("book.pdf"))
+        self.watcher.scan()
+        os.rename(self.path("book.pdf"), self.path("book.pdf.part"))
+        self.watcher.poll()
+        os.rename(self.path("book.pdf.part"), self.path("book.pdf"))
+        self.watcher.poll()
+        self.watcher.poll()
+        self.assertEqual(self.changes, [])
+
+    def test_polls_in_the_background(self):
+        self.watcher.poll_seconds = 0.01
+        self.watcher.scan()
+        self.watcher.start()
+        self.addCleanup(self.watcher.stop)
+        write_file(self.path("added.pdf"))
+        deadline = time.monotonic() + 5
+        while not self.changes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.watcher.stop()
+        self.assertEqual(self.changes[0].added, [self.path("added.pdf")])
+
+
+class TestQueryTraffic(unittest.TestCase):
+    def test_does_not_wait_without_queries(self):
+        traffic = QueryTraffic(quiet_seconds=0.05, max_wait_seconds=1.0)
+        self.assertLess(traffic.wait_idle(), 0.01)
+
+    def test_waits_for_queries_in_flight(self):
+        traffic = QueryTraffic(quiet_seconds=0.0, max_wait_seconds=5.0)
+        started = threading.Event()
+
+        def query():
+            with traffic.query():
+                started.set()
+                time.sleep(0.1)
+
+        thread = threading.Thread(target=query)
+        thread.start()
+        started.wait()
+        waited = traffic.wait_idle()
+        thread.join()
+        self.assertGreaterEqual(waited, 0.05)
+        self.assertLess(waited, 5.0)
+        self.assertEqual(traffic.in_flight, 0)
+
+    def test_waits_at_most_max_wait_seconds(self):
+        traffic = QueryTraffic(quiet_seconds=0.0, max_wait_seconds=0.05)
+        with traffic.query():
+            waited = traffic.wait_idle()
+        self.assertGreaterEqual(waited, 0.05)
+        self.assertLess(waited, 1.0)
+
+    def test_pause_waits_for_every_query_in_flight(self):
+        traffic = QueryTraffic(quiet_seconds=0.0, max_wait_seconds=0.01)
+        paused = threading.Event()
+
+        def pause():
+            with traffic.paused():
+                paused.set()
+
+        with traffic.query():
+            thread = threading.Thread(target=pause)
+            thread.start()
+            # The pause outlasts max_wait_seconds
+            self.assertFalse(paused.wait(0.1))
+        thread.join()
+        self.assertTrue(paused.is_set())
+
+    def test_queries_wait_for_the_pause(self):
+        traffic = QueryTraffic(quiet_seconds=0.0, max_wait_seconds=0.01)
+        started = threading.Event()
+
+        def query():
+            with traffic.query():
+                started.set()
+
+        with traffic.paused():
+            self.assertFalse(traffic.begin(blocking=False))
+            thread = threading.Thread(target=query)
+            thread.start()
+            self.assertFalse(started.wait(0.05))
+            self.assertEqual(traffic.in_flight, 0)
+        thread.join()
+        self.assertTrue(started.is_set())
+        self.assertTrue(traffic.begin(blocking=False))
+        traffic.end()
+        self.assertEqual(traffic.in_flight, 0)
+
+
+class TestPriorityLock(unittest.TestCase):
+    def test_queries_go_before_background_work(self):
+        lock = PriorityLock()
+        order = []
+
+        def hold(name, urgent):
+            if urgent:
+                with lock.hold():
+                    order.append(name)
+            else:
+                with background(), lock.hold():
+                    order.append(name)
+
+        with background(), lock.hold():
+            threads = [
+                threading.Thread(target=hold, args=("ingestion", False)),
+                threading.Thread(target=hold, args=("query", True)),
+            ]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.05)
+            self.assertEqual(order, [])
+        for thread in threads:
+            thread.join()
+
+        # The query asked last, but is handed the lock first
+        self.assertEqual(order, ["query", "ingestion"])
+        self.assertFalse(lock.locked)
+
+
+class TestIngestionWorker(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        for folder in ("dnd", "pathfinder"):
+            os.mkdir(os.path.join(self.root, folder))
+        self.synced = []
+        self.ingested = threading.Event()
+
+        def run_ingestion(state, folders, pdf_root):
+            self.synced.append(list(folders))
+            state.start(folders)
+            state.finish()
+            return state
+
+        for name, replacement in (
+            ("run_ingestion", run_ingestion),
+            ("lower_thread_priority", lambda niceness: None),
+        ):
+            patcher = mock.patch.object(indexing, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(
+            indexing.dependencies, "reload_search_indexes"
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_syncs_every_folder_once_without_watching(self):
+        worker = indexing.IngestionWorker(
+            indexing.IndexState(),
+            folders=["dnd", "pathfinder"],
+            pdf_root=self.root,
+            watch=False,
+            on_ingested=self.ingested.set,
+        )
+        worker.run()
+        self.assertEqual(self.synced, [["dnd", "pathfinder"]])
+        self.assertTrue(self.ingested.is_set())
+
+    def test_syncs_the_folders_that_change(self):
+        worker = indexing.IngestionWorker(
+            indexing.IndexState(),
+            folders=["dnd", "pathfinder"],
+            pdf_root=self.root,
+            watch=True,
+        )
+        worker.watcher.poll_seconds = 0.01
+        worker.watcher.debounce_seconds = 0.02
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(worker.stop)
+
+        def wait_for_syncs(count):
+            deadline = time.monotonic() + 5
+            while len(self.synced) < count and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        wait_for_syncs(1)
+        write_file(os.path.join(self.root, "pathfinder", "bestiary.pdf"))
+        wait_for_syncs(2)
+        worker.stop()
+        thread.join()
+        self.assertEqual(self.synced, [["dnd", "pathfinder"], ["pathfinder"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+"""Tests for the GenerativeLLM client against a local stub of the Gemini REST
+API.
+"""
+import json
+import time
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from typing import List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.generative_llm import (
+    GenerationError,
+    GenerativeLLM,
+    RestBackend,
+)
+
+
+class StubGenerationServer(ThreadingHTTPServer):
+    """A local HTTP server answering `generateContent` requests with the
+    reversed prompt, after a configurable latency. The first requests fail
+    with `failure_status`, and the server records its peak concurrency and
+    the number of connections opened.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latencies: Optional[List[float]] = None,
+        failures: int = 0,
+        failure_status: int = 503,
+    ) -> None:
+        super().__init__(("127.0.0.1", 0), StubGenerationHandler)
+        self.latency = latency
+        # The latencies of the first requests, in order
+        self.latencies = list(latencies or [])
+        self.failures = failures
+        self.failure_status = failure_status
+        self.requests = 0
+        self.connections = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> str:
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+
+class StubGenerationHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self) -> None:
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.requests <= server.failures
+            if server.latencies:
+                latency = server.latencies.pop(0)
+            else:
+                latency = server.latency
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        length = int(self.headers["Content-Length"])
+        request = json.loads(self.rfile.read(length))
+        time.sleep(latency)
+        prompt = request["contents"][0]["parts"][0]["text"]
+        parts = [{"text": prompt[::-1]}]
+        body = json.dumps(
+            {"candidates": [{"content": {"parts": parts}}]}
+        ).encode()
+        # Counted before responding, since the client frees its slot as soon
+        # as it has read the response
+        with server.lock:
+            server.in_flight -= 1
+        self.send_response(server.failure_status if fail else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class TestGenerativeLLM(unittest.TestCase):
+    def start_server(self, **kwargs) -> StubGenerationServer:
+        server = StubGenerationServer(**kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def make_client(
+        self, server: StubGenerationServer, **kwargs
+    ) -> GenerativeLLM:
+        kwargs.setdefault("base_delay", 0.01)
+        client = GenerativeLLM(
+            backend=RestBackend(
+                model_name="models/stub",
+                endpoint=server.endpoint,
+                api_key="test",
+            ),
+            **kwargs,
+        )
+        self.addCleanup(client.close)
+        return client
+
+    def test_reuses_pooled_connections(self):
+        server = self.start_server()
+        client = self.make_client(server)
+        for prompt in ("bane", "boon", "roll"):
+            self.assertEqual(
+                client.generate_content(contents=prompt).text, prompt[::-1]
+            )
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(server.connections, 1)
+
+    def test_caps_requests_in_flight(self):
+        server = self.start_server(latency=0.05)
+        client = self.make_client(server, max_concurrency=2)
+        threads = [
+            threading.Thread(target=client.generate_content, args=("x",))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(server.requests, 8)
+        self.assertEqual(server.max_in_flight, 2)
+
+    def test_deadline_bounds_slow_requests(self):
+        server = self.start_server(latency=1.0)
+        client = self.make_client(server, timeout=0.2, max_retries=3)
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            client.generate_content(contents="x")
+        self.assertLess(time.perf_counter() - start, 0.6)
+
+    def test_no_retry_backs_off_past_the_deadline(self):
+        server = self.start_server(failures=1)
+        client = self.make_client(server, timeout=0.5, max_retries=3)
+        start = time.perf_counter()
+        with mock.patch("utils.retry.backoff_delay", return_value=5.0):
+            with self.assertRaises(GenerationError):
+                client.generate_content(contents="x")
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(server.requests, 1)
+
+    def test_retries_transient_failures_only(self):
+        server = self.start_server(failures=2)
+        client = self.make_client(server, max_retries=2)
+        self.assertEqual(client.generate_content(contents="ab").text, "ba")
+        self.assertEqual(server.requests, 3)
+
+        server = self.start_server(failures=1, failure_status=400)
+        client = self.make_client(server, max_retries=2)
+        with self.assertRaises(GenerationError):
+            client.generate_content(contents="ab")
+        self.assertEqual(server.requests, 1)
+
+    def test_hedges_requests_slower_than_usual(self):
+        # Five fast requests set the hedging delay, the sixth stalls and
+        # its duplicate answers
+        server = self.start_server(latency=0.01, latencies=[0.01] * 5 + [1.0])
+        client = self.make_client(server, hedge=True, hedge_min_samples=5)
+        for _ in range(5):
+            client.generate_content(contents="x")
+        start = time.perf_counter()
+        self.assertEqual(client.generate_content(contents="ab").text, "ba")
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(client.hedged, 1)
+
+    def test_streams_asynchronously_and_frees_the_slot(self):
+        server = self.start_server()
+        client = self.make_client(server, max_concurrency=1)
+
+        async def stream() -> List[str]:
+            response = await client.generate_content_async(
+                contents="ab", stream=True
+            )
+            return [fragment.text async for fragment in response]
+
+        self.assertEqual(asyncio.run(stream()), ["ba"])
+        # The slot is free again
+        self.assertEqual(client.generate_content(contents="cd").text, "dc")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+"""Tests of the incremental sync of game system folders into a collection."""
+import os
+import uuid
+import shutil
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+MISSING = [
+    name
+    for name in ("chromadb", "pymupdf", "pymupdf4llm")
+    if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from chromadb import EphemeralClient
+    from chromadb.config import Settings
+
+    from benchmarks.corpus import generate_rulebooks
+    from benchmarks.fakes import HashingEmbeddingFunction
+    from models.document import make_document_id, relative_filepath
+    from services import dependencies, indexing
+    from utils.priority import QueryTraffic
+    from services.index_manifest import IndexManifest
+    from services.vector_index import VectorIndex
+    from services.lexical_index import LexicalIndex
+    from services.embedding_generator import EmbeddingGenerator
+    from services.incremental_indexer import IncrementalIndexer
+
+
+class TestDocumentIds(unittest.TestCase):
+    @unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+    def test_ids_depend_on_the_relative_filepath(self):
+        file_hash = "ab" * 32
+        self.assertEqual(
+            relative_filepath("/data/pdfs/Dragonbane/../Dragonbane/a.pdf"),
+            "Dragonbane/a.pdf",
+        )
+        # Stable wherever the pdf folder is mounted
+        self.assertEqual(
+            make_document_id(file_hash, "/data/Dragonbane/a.pdf", 3, 1),
+            make_document_id(file_hash, "/app/data/Dragonbane/a.pdf", 3, 1),
+        )
+        # Distinct for identical files stored under different paths
+        self.assertNotEqual(
+            make_document_id(file_hash, "/data/Dragonbane/a.pdf", 3, 1),
+            make_document_id(file_hash, "/data/Mork Borg/a.pdf", 3, 1),
+        )
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestIncrementalIndexer(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        client = EphemeralClient(
+            settings=Settings(anonymized_telemetry=False)
+        )
+        function = HashingEmbeddingFunction(dimensions=32)
+        self.collection = client.create_collection(
+            name=f"test-{uuid.uuid4().hex}", embedding_function=function
+        )
+        self.addCleanup(client.delete_collection, self.collection.name)
+        self.indexer = IncrementalIndexer(
+            collection=self.collection,
+            embedding_generator=EmbeddingGenerator(
+                embedding_function=function
+            ),
+            manifest=IndexManifest(
+                os.path.join(self.root, "index_manifest.json")
+            ),
+            parallel=False,
+        )
+
+    def filepaths(self):
+        metadatas = self.collection.get(include=["metadatas"])["metadatas"]
+        return sorted({metadata["filepath"] for metadata in metadatas})
+
+    def test_syncs_added_and_removed_files(self):
+        folder = os.path.join(self.root, "Dragonbane")
+        first, second = generate_rulebooks(folder, books=2, pages=3)
+
+        stats = self.indexer.sync(folder)
+        self.assertEqual((stats["added"], stats["unchanged"]), (2, 0))
+        self.assertEqual(self.filepaths(), [first, second])
+        self.assertEqual(self.indexer.removed_ids, [])
+        self.assertEqual(
+            sorted(self.indexer.indexed_filepaths), [first, second]
+        )
+
+        stats = self.indexer.sync(folder)
+        self.assertEqual((stats["added"], stats["unchanged"]), (0, 2))
+
+        second_ids = self.collection.get(
+            where={"filepath": second}, include=[]
+        )["ids"]
+        os.remove(second)
+        stats = self.indexer.sync(folder)
+        self.assertEqual(stats["removed"], 1)
+        self.assertEqual(self.filepaths(), [first])
+        # The search indexes are updated with the changes of the last sync
+        self.assertEqual(sorted(self.indexer.removed_ids), sorted(second_ids))
+        self.assertEqual(self.indexer.indexed_filepaths, [])
+
+    def test_identical_files_in_different_folders_are_kept_apart(self):
+        folder = os.path.join(self.root, "Dragonbane")
+        (filepath,) = generate_rulebooks(folder, books=1, pages=3)
+        copy_folder = os.path.join(self.root, "Dragonbane Copy")
+        os.makedirs(copy_folder)
+        copy = shutil.copy(filepath, copy_folder)
+
+        self.indexer.sync(folder)
+        chunks = self.collection.count()
+        self.indexer.sync(copy_folder)
+        self.assertEqual(self.collection.count(), 2 * chunks)
+        self.assertEqual(self.filepaths(), sorted([filepath, copy]))
+
+        # Removing the copy keeps the chunks of the original
+        os.remove(copy)
+        self.indexer.sync(copy_folder)
+        self.assertEqual(self.collection.count(), chunks)
+        self.assertEqual(self.filepaths(), [filepath])
+        stats = self.indexer.sync(folder)
+        self.assertEqual(stats["unchanged"], 1)
+
+    def test_search_indexes_are_updated_with_the_changes(self):
+        folder = os.path.join(self.root, "Dragonbane")
+        first, second = generate_rulebooks(folder, books=2, pages=2)
+        patchers = [
+            mock.patch.object(
+                dependencies,
+                "shard_path",
+                lambda path, shard=None: os.path.join(
+                    self.root, os.path.basename(path)
+                ),
+            ),
+            mock.patch.object(
+                dependencies, "get_collection", return_value=self.collection
+            ),
+            mock.patch.object(
+                dependencies,
+                "get_query_traffic",
+                return_value=QueryTraffic(max_wait_seconds=0.0),
+            ),
+            mock.patch.object(indexing.enums, "VECTOR_INDEX_ENABLED", True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        def indexed_ids():
+            ids = []
+            for index_class, path in (
+                (LexicalIndex, "lexical_index"),
+                (VectorIndex, "vector_index"),
+            ):
+                index = index_class.load(os.path.join(self.root, path))
+                ids.append(sorted(index.ids))
+                index.close()
+            return ids
+
+        self.indexer.sync(folder)
+        indexing.rebuild_lexical_index()
+        indexing.rebuild_vector_index()
+
+        os.remove(second)
+        generate_rulebooks(folder, books=3, pages=2)
+        self.indexer.sync(folder)
+        with mock.patch.object(
+            indexing,
+            "iter_collection_texts",
+            wraps=indexing.iter_collection_texts,
+        ) as iter_texts:
+            indexing.update_search_indexes(
+                None, self.indexer.removed_ids, self.indexer.indexed_filepaths
+            )
+
+        expected = sorted(self.collection.get(include=[])["ids"])
+        self.assertEqual(indexed_ids(), [expected, expected])
+        # Only the chunks of the indexed files are read
+        self.assertEqual(
+            iter_texts.call_args.kwargs["where"],
+            {"filepath": {"$in": self.indexer.indexed_filepaths}},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,282 @@
+"""Tests of the leader lock and the published index generations shared by
+the worker processes of a server.
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import unittest
+import subprocess
+import importlib.util
+from unittest import mock
+
+from utils import enums
+from utils.file_lock import FileLock
+from services import dependencies
+from utils.priority import QueryTraffic
+from services.index_generations import IndexGenerations
+from services.index_coordinator import IndexCoordinator
+
+MISSING = [
+    name for name in ("chromadb",) if importlib.util.find_spec(name) is None
+]
+
+HOLD_LOCK_SCRIPT = """
+import sys, time
+from utils.file_lock import FileLock
+lock = FileLock(sys.argv[1])
+lock.acquire()
+print("locked", flush=True)
+time.sleep(60)
+"""
+
+
+class TestFileLock(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "leader.lock")
+
+    def test_single_holder(self):
+        leader = FileLock(self.path)
+        follower = FileLock(self.path)
+        self.assertTrue(leader.acquire(blocking=False))
+        self.assertFalse(follower.acquire(blocking=False))
+        leader.release()
+        self.assertTrue(follower.acquire(blocking=False))
+        self.assertTrue(follower.locked)
+        follower.release()
+
+    def test_shared_holders(self):
+        readers = [FileLock(self.path, shared=True) for _ in range(2)]
+        writer = FileLock(self.path)
+        for reader in readers:
+            self.assertTrue(reader.acquire(blocking=False))
+        self.assertFalse(writer.acquire(blocking=False))
+        for reader in readers:
+            reader.release()
+        self.assertTrue(writer.acquire(blocking=False))
+        self.assertFalse(readers[0].acquire(blocking=False))
+        writer.release()
+
+    def test_released_when_the_holder_dies(self):
+        process = subprocess.Popen(
+            [sys.executable, "-c", HOLD_LOCK_SCRIPT, self.path],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.addCleanup(process.stdout.close)
+        self.assertEqual(process.stdout.readline().strip(), "locked")
+        lock = FileLock(self.path)
+        self.assertFalse(lock.acquire(blocking=False))
+        process.kill()
+        process.wait()
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+
+class TestIndexGenerations(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.source = os.path.join(self.root, "chroma_db")
+        os.makedirs(os.path.join(self.source, "lexical_index"))
+        os.makedirs(os.path.join(self.source, "lexical_index.tmp-1"))
+        self.database = sqlite3.connect(
+            os.path.join(self.source, "chroma.sqlite3")
+        )
+        self.addCleanup(self.database.close)
+        self.database.execute("CREATE TABLE chunks (id TEXT)")
+        self.generations = IndexGenerations(
+            path=os.path.join(self.root, "generations"), keep=2
+        )
+
+    def write(self, chunk_id: str) -> None:
+        self.database.execute("INSERT INTO chunks VALUES (?)", (chunk_id,))
+        self.database.commit()
+
+    def read(self, path: str) -> list:
+        with sqlite3.connect(os.path.join(path, "chroma.sqlite3")) as copy:
+            rows = copy.execute("SELECT id FROM chunks").fetchall()
+        copy.close()
+        return [row[0] for row in rows]
+
+    def test_publishes_snapshots(self):
+        self.assertIsNone(self.generations.current())
+        self.write("a")
+        first = self.generations.publish(self.source)
+        self.assertEqual(self.generations.current(), first)
+        self.write("b")
+        second = self.generations.publish(self.source)
+        self.assertEqual(self.generations.current(), second)
+
+        # Earlier generations are left untouched
+        self.assertEqual(self.read(first), ["a"])
+        self.assertEqual(self.read(second), ["a", "b"])
+        self.assertTrue(os.path.isdir(os.path.join(second, "lexical_index")))
+        self.assertFalse(
+            os.path.exists(os.path.join(second, "lexical_index.tmp-1"))
+        )
+
+    def test_keeps_the_last_generations(self):
+        paths = [self.generations.publish(self.source) for _ in range(3)]
+        self.assertEqual(
+            self.generations.generations(),
+            [os.path.basename(path) for path in paths[1:]],
+        )
+        self.assertFalse(os.path.exists(paths[0]))
+
+    def test_leased_generations_are_kept(self):
+        first = self.generations.publish(self.source)
+        lease = self.generations.lease(first)
+        self.assertIsNotNone(lease)
+
+        paths = [self.generations.publish(self.source) for _ in range(3)]
+
+        # The leased generation outlives the last two
+        self.assertEqual(
+            self.generations.generations(),
+            [os.path.basename(path) for path in [first] + paths[1:]],
+        )
+        self.assertEqual(self.read(first), [])
+        lease.release()
+        self.generations.prune()
+        self.assertFalse(os.path.exists(first))
+        self.assertFalse(os.path.exists(first + ".lease"))
+        # A pruned generation cannot be leased
+        self.assertIsNone(self.generations.lease(first))
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestCloseIndex(unittest.TestCase):
+    def test_clients_are_closed_and_reopened(self):
+        from chromadb.api.shared_system_client import SharedSystemClient
+
+        from benchmarks.fakes import HashingEmbeddingFunction
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = directory.name
+        patchers = [
+            mock.patch.object(dependencies, "_index_root", path),
+            mock.patch.object(
+                dependencies,
+                "get_embedding_function",
+                return_value=HashingEmbeddingFunction(dimensions=8),
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(dependencies.close_index)
+        systems = SharedSystemClient._identifier_to_system
+
+        database = dependencies.get_chroma_db()
+        database.collection.add(ids=["a"], documents=["Roll to dodge."])
+        dependencies.close_index()
+
+        self.assertNotIn(path, systems)
+        self.assertEqual(dependencies.get_chroma_db.cached(), [])
+        # The next use opens the index again
+        reopened = dependencies.get_chroma_db()
+        self.assertIsNot(reopened, database)
+        self.assertEqual(reopened.collection.count(), 1)
+
+
+class TestPublish(unittest.TestCase):
+    def test_waits_for_the_queries_in_flight(self):
+        traffic = QueryTraffic(quiet_seconds=0.0, max_wait_seconds=0.01)
+        in_flight = []
+        patchers = [
+            mock.patch.object(
+                dependencies, "get_query_traffic", return_value=traffic
+            ),
+            mock.patch.object(
+                dependencies,
+                "close_index",
+                side_effect=lambda: in_flight.append(traffic.in_flight),
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        state = mock.Mock()
+        state.to_dict.return_value = {
+            "files": {"added": 1, "changed": 0, "removed": 0}
+        }
+        generations = mock.Mock()
+        generations.publish.return_value = "generations/2"
+        coordinator = IndexCoordinator(
+            state, generations=generations, lock=mock.Mock()
+        )
+        published = threading.Event()
+
+        def publish():
+            coordinator.publish()
+            published.set()
+
+        with traffic.query():
+            thread = threading.Thread(target=publish)
+            thread.start()
+            # The query outlasts the wait of the ingestion for idle queries
+            self.assertFalse(published.wait(0.1))
+            self.assertEqual(in_flight, [])
+            generations.publish.assert_not_called()
+        thread.join()
+
+        self.assertEqual(in_flight, [0])
+        generations.publish.assert_called_once_with(enums.CHROMA_DB_PATH)
+        state.set_role.assert_called_once_with(None, "2")
+
+
+class TestIngestCommand(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "leader.lock")
+        patcher = mock.patch.object(
+            enums, "INDEX_LEADER_LOCK_PATH", self.path
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ingests_holding_the_leader_lock(self):
+        import ingest
+        from services.indexing import IndexState
+
+        held = []
+
+        def run_ingestion(state, folders, pdf_root):
+            held.append(not FileLock(self.path).acquire(blocking=False))
+            state.status = IndexState.READY
+            return state
+
+        with mock.patch.object(ingest, "run_ingestion", run_ingestion):
+            with mock.patch.object(ingest, "IndexGenerations") as generations:
+                self.assertEqual(ingest.main(["--pdf-root", "pdfs"]), 0)
+
+        # The lock is held without --publish too, and nothing is published
+        self.assertEqual(held, [True])
+        generations.assert_not_called()
+        self.assertTrue(FileLock(self.path).acquire(blocking=False))
+
+
+class TestIndexPath(unittest.TestCase):
+    def test_maps_index_files_to_the_served_folder(self):
+        path = f"{enums.CHROMA_DB_PATH}/lexical_index"
+        self.assertEqual(dependencies.index_path(path), path)
+        with mock.patch.object(dependencies, "_index_root", "generations/7"):
+            self.assertEqual(
+                dependencies.index_path(path),
+                os.path.join("generations", "7", "lexical_index"),
+            )
+            self.assertEqual(
+                dependencies.index_path("other/file"), "other/file"
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
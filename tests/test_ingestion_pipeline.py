@@ -0,0 +1,198 @@
+"""Tests of the bounded, threaded extract/chunk/embed/store pipeline."""
+import time
+import hashlib
+import threading
+import unittest
+import importlib.util
+
+import numpy as np
+
+MISSING = [
+    name
+    for name in ("chromadb", "pymupdf4llm", "langchain_google_genai")
+    if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from models.document import Document, make_document_id
+    from services.ingestion_pipeline import IngestionPipeline
+
+
+class FakeProcessor:
+    """Yields `pages` pages per file, optionally failing after `fail_after`
+    pages, and records whether its generator was closed.
+    """
+
+    def __init__(self, pages: int = 10, fail_after: int = None) -> None:
+        self.base_folder = "books"
+        self.pages = pages
+        self.fail_after = fail_after
+        self.yielded = 0
+        self.closed = threading.Event()
+
+    def iter_documents(self, parallel=False, filepaths=None):
+        try:
+            for filepath in filepaths or ["books/a.pdf"]:
+                for page_number in range(1, self.pages + 1):
+                    if self.yielded == self.fail_after:
+                        raise RuntimeError("Extraction failed")
+                    self.yielded += 1
+                    yield Document(
+                        filepath=filepath,
+                        page_content=f"{filepath} page {page_number}",
+                        title="Book",
+                        game_system="Dragonbane",
+                        page_number=page_number,
+                        file_hash=file_hash(filepath),
+                    )
+        finally:
+            self.closed.set()
+
+
+def file_hash(filepath: str) -> str:
+    return hashlib.sha256(filepath.encode()).hexdigest()
+
+
+class FakeEmbeddingGenerator:
+    """Embeds texts as their length, optionally failing on a batch."""
+
+    def __init__(self, fail_on_batch: int = None) -> None:
+        self.fail_on_batch = fail_on_batch
+        self.batches = 0
+
+    def generate_embeddings(self, documents):
+        self.batches += 1
+        if self.batches == self.fail_on_batch:
+            raise RuntimeError("Embedding failed")
+        return np.array(
+            [[len(doc.page_content), 1.0] for doc in documents],
+            dtype=np.float32,
+        )
+
+
+class FakeCollection:
+    """Records the upserted IDs in order, optionally failing on a write."""
+
+    def __init__(self, fail_on_write: int = None) -> None:
+        self.fail_on_write = fail_on_write
+        self.ids = []
+        self.writes = 0
+
+    def upsert(self, ids, embeddings, metadatas=None, documents=None):
+        self.writes += 1
+        if self.writes == self.fail_on_write:
+            raise RuntimeError("Write failed")
+        self.ids.extend(ids)
+
+    def get(self, **kwargs):
+        return {"ids": [], "metadatas": []}
+
+
+def split_in_two(document):
+    """Chunk every page into two chunks."""
+    for index in range(2):
+        yield Document(
+            filepath=document.filepath,
+            page_content=f"{document.page_content} chunk {index}",
+            title=document.title,
+            game_system=document.game_system,
+            page_number=document.page_number,
+            file_hash=document.file_hash,
+            chunk_index=index,
+        )
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestIngestionPipeline(unittest.TestCase):
+    def make_pipeline(self, processor, generator=None, collection=None):
+        return IngestionPipeline(
+            processor=processor,
+            embedding_generator=generator or FakeEmbeddingGenerator(),
+            collection=collection or FakeCollection(),
+            chunker=split_in_two,
+            batch_size=3,
+            queue_size=2,
+            deduplicate=False,
+        )
+
+    def test_stores_every_chunk_in_order(self):
+        collection = FakeCollection()
+        pipeline = self.make_pipeline(
+            FakeProcessor(pages=5), collection=collection
+        )
+        stored = pipeline.run(filepaths=["books/a.pdf", "books/b.pdf"])
+
+        self.assertEqual(stored, 20)
+        self.assertEqual(pipeline.pages, 10)
+        self.assertEqual(
+            pipeline.chunks_per_file, {"books/a.pdf": 10, "books/b.pdf": 10}
+        )
+        self.assertEqual(
+            collection.ids,
+            [
+                make_document_id(file_hash(filepath), filepath, page, index)
+                for filepath in ("books/a.pdf", "books/b.pdf")
+                for page in range(1, 6)
+                for index in range(2)
+            ],
+        )
+
+    def assert_aborts(self, pipeline, processor, message):
+        with self.assertRaisesRegex(RuntimeError, message):
+            pipeline.run()
+        # Every stage thread stopped, and the extraction was closed
+        self.assertTrue(processor.closed.is_set())
+        self.assertFalse(any(t.is_alive() for t in pipeline._threads))
+
+    def test_propagates_extraction_errors(self):
+        processor = FakeProcessor(pages=10, fail_after=4)
+        self.assert_aborts(
+            self.make_pipeline(processor), processor, "Extraction failed"
+        )
+
+    def test_propagates_embedding_errors(self):
+        processor = FakeProcessor(pages=1000)
+        pipeline = self.make_pipeline(
+            processor, generator=FakeEmbeddingGenerator(fail_on_batch=2)
+        )
+        self.assert_aborts(pipeline, processor, "Embedding failed")
+        # Extraction stopped early instead of running to the end
+        self.assertLess(processor.yielded, 1000)
+
+    def test_propagates_store_errors(self):
+        processor = FakeProcessor(pages=1000)
+        pipeline = self.make_pipeline(
+            processor, collection=FakeCollection(fail_on_write=2)
+        )
+        self.assert_aborts(pipeline, processor, "Write failed")
+        self.assertLess(processor.yielded, 1000)
+
+    def test_bounds_the_pages_read_ahead(self):
+        processor = FakeProcessor(pages=1000)
+        stalled = threading.Event()
+        release = threading.Event()
+
+        class StallingGenerator(FakeEmbeddingGenerator):
+            def generate_embeddings(self, documents):
+                stalled.set()
+                release.wait()
+                return super().generate_embeddings(documents)
+
+        pipeline = self.make_pipeline(processor, StallingGenerator())
+        thread = threading.Thread(target=pipeline.run)
+        thread.start()
+        stalled.wait()
+        # Let the upstream stages fill their queues
+        time.sleep(0.2)
+        read_ahead = processor.yielded
+        release.set()
+        thread.join()
+
+        # Two chunks per page, 3 chunks per batch: the chunk queue holds
+        # 6 chunks, the batch queue 2 batches, plus one item per stage
+        self.assertLess(read_ahead, 20)
+        self.assertEqual(processor.yielded, 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
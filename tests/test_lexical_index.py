@@ -0,0 +1,218 @@
+"""Tests of the BM25 lexical index and its fusion with dense retrieval."""
+import os
+import tempfile
+import unittest
+import importlib.util
+
+from services.lexical_index import LexicalIndex, tokenize
+
+MISSING = [
+    name for name in ("chromadb",) if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from services.retriever import Retriever, reciprocal_rank_fusion
+
+CHUNKS = [
+    ("fire", "The fire bolt spell deals fire damage to one target."),
+    ("dodge", "Roll EVADE to dodge an attack, once per round."),
+    ("parry", "Parry an attack with a weapon or a shield."),
+    ("wyrm", "The wyrm breathes fire on every adventurer in the cave."),
+] + [
+    (f"filler-{i}", f"Filler text about travel and camping number {i}.")
+    for i in range(20)
+]
+
+
+class TestLexicalIndex(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "lexical_index")
+
+    def open(self) -> LexicalIndex:
+        index = LexicalIndex.load(self.path)
+        self.addCleanup(index.close)
+        return index
+
+    def test_tokenize_drops_stopwords(self):
+        self.assertEqual(
+            tokenize("How do I Dodge the 2 attacks?"),
+            ["dodge", "2", "attacks"],
+        )
+
+    def test_build_and_load_round_trip(self):
+        self.assertEqual(LexicalIndex.build(self.path, CHUNKS), len(CHUNKS))
+        index = self.open()
+
+        self.assertEqual(len(index), len(CHUNKS))
+        self.assertEqual(index.ids, [chunk_id for chunk_id, _ in CHUNKS])
+        self.assertEqual(index.document_frequency("fire"), 2)
+        self.assertEqual(index.document_frequency("attack"), 2)
+        self.assertEqual(index.document_frequency("missing"), 0)
+        self.assertEqual(index.lengths[0], len(tokenize(CHUNKS[0][1])))
+
+        # Rebuilding replaces the index
+        LexicalIndex.build(self.path, CHUNKS[:2])
+        self.assertEqual(len(self.open()), 2)
+
+    def test_update_matches_a_rebuild(self):
+        LexicalIndex.build(self.path, CHUNKS)
+        added = [
+            ("dodge", "Roll EVADE to dodge, or parry with a shield."),
+            ("spell", "The fire wall spell blocks the cave."),
+        ]
+        removed = ["wyrm", "filler-3", "unknown"]
+
+        index = LexicalIndex.load(self.path)
+        count = index.update(self.path, removed, added)
+        index.close()
+
+        expected = [
+            (chunk_id, text)
+            for chunk_id, text in CHUNKS
+            if chunk_id not in removed and chunk_id != "dodge"
+        ] + added
+        self.assertEqual(count, len(expected))
+        updated = self.open()
+        LexicalIndex.build(self.path + "-rebuilt", expected)
+        rebuilt = LexicalIndex.load(self.path + "-rebuilt")
+        self.addCleanup(rebuilt.close)
+        self.assertEqual(updated.ids, rebuilt.ids)
+        self.assertEqual(updated.terms, rebuilt.terms)
+        self.assertEqual(list(updated.postings), list(rebuilt.postings))
+        self.assertEqual(list(updated.frequencies), list(rebuilt.frequencies))
+        self.assertEqual(list(updated.lengths), list(rebuilt.lengths))
+        self.assertEqual(
+            updated.search("fire cave"), rebuilt.search("fire cave")
+        )
+
+    def test_load_ignores_missing_and_other_versions(self):
+        self.assertIsNone(LexicalIndex.load(self.path))
+
+        LexicalIndex.build(self.path, CHUNKS)
+        meta_path = os.path.join(self.path, LexicalIndex.META_FILE)
+        with open(meta_path, "r") as file:
+            meta = file.read()
+        with open(meta_path, "w") as file:
+            file.write(meta.replace('"version": 1', '"version": 0'))
+        self.assertIsNone(LexicalIndex.load(self.path))
+
+    def test_search_ranks_by_bm25(self):
+        LexicalIndex.build(self.path, CHUNKS)
+        index = self.open()
+
+        hits = index.search("fire bolt", k=3)
+
+        # "fire" appears twice in the first chunk, and "bolt" only there
+        self.assertEqual([hit.id for hit in hits], ["fire", "wyrm"])
+        self.assertGreater(hits[0].score, hits[1].score)
+        self.assertEqual([hit.coverage for hit in hits], [1.0, 0.5])
+        self.assertEqual(index.search("the and of"), [])
+        self.assertEqual(len(index.search("filler", k=5)), 5)
+
+    def test_exact_match_of_few_rare_terms(self):
+        LexicalIndex.build(self.path, CHUNKS)
+        index = self.open()
+
+        def is_exact_match(query_text, **kwargs):
+            hits = index.search(query_text)
+            return index.is_exact_match(query_text, hits, **kwargs)
+
+        self.assertTrue(is_exact_match("wyrm", max_document_ratio=0.05))
+        # Not every term is in the best hit
+        self.assertFalse(is_exact_match("wyrm parry"))
+        # Too many terms
+        self.assertFalse(
+            is_exact_match("wyrm breathes cave adventurer", max_terms=3)
+        )
+        # A term found in too many chunks
+        self.assertFalse(is_exact_match("filler", max_document_ratio=0.05))
+        self.assertFalse(is_exact_match("unknown"))
+
+    def test_empty_index(self):
+        LexicalIndex.build(self.path, [])
+        index = self.open()
+
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.search("fire"), [])
+
+
+class FakeCollection:
+    """Answers dense searches with a fixed ranking of the chunks, and
+    records them.
+    """
+
+    def __init__(self, ranking) -> None:
+        self.texts = dict(CHUNKS)
+        self.ranking = ranking
+        self.queries = 0
+
+    def query(self, query_texts, n_results, include=None, where=None):
+        self.queries += 1
+        ids = self.ranking[:n_results]
+        return {
+            "ids": [ids],
+            "documents": [[self.texts[chunk_id] for chunk_id in ids]],
+            "metadatas": [[{"page_number": 1} for _ in ids]],
+            "distances": [[0.1 * rank for rank in range(len(ids))]],
+            "embeddings": None,
+        }
+
+    def get(self, ids, where=None, include=None):
+        ids = [chunk_id for chunk_id in ids if chunk_id in self.texts]
+        return {
+            "ids": ids,
+            "documents": [self.texts[chunk_id] for chunk_id in ids],
+            "metadatas": [{"page_number": 1} for _ in ids],
+            "embeddings": None,
+        }
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestHybridRetrieval(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "lexical_index")
+        LexicalIndex.build(path, CHUNKS)
+        self.index = LexicalIndex.load(path)
+        self.addCleanup(self.index.close)
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion(
+            [["a", "b", "c"], ["b", "c", "d"]], k=60
+        )
+        # "b" and "c" appear in both rankings, "b" at better ranks
+        self.assertEqual(fused, ["b", "c", "a", "d"])
+        self.assertEqual(reciprocal_rank_fusion([[], ["x"]]), ["x"])
+
+    def test_fuses_lexical_hits_with_dense_results(self):
+        collection = FakeCollection(["filler-0", "dodge", "filler-1"])
+        retriever = Retriever(
+            collection, lexical_index=self.index, hybrid_top_k=4
+        )
+
+        chunks = retriever.retrieve("dodge an attack", top_k=3)
+
+        self.assertEqual(collection.queries, 1)
+        # "dodge" is found by both searches, "parry" only by the lexical
+        # one, and the fused ranking is cut at top_k
+        self.assertEqual(
+            [chunk.id for chunk in chunks], ["dodge", "filler-0", "parry"]
+        )
+        self.assertIn("shield", chunks[2].text)
+
+    def test_exact_match_skips_dense_retrieval(self):
+        collection = FakeCollection(["parry"])
+        retriever = Retriever(collection, lexical_index=self.index)
+
+        chunks = retriever.retrieve("wyrm")
+
+        self.assertEqual(collection.queries, 0)
+        self.assertEqual([chunk.id for chunk in chunks], ["wyrm"])
+        self.assertIn("breathes fire", chunks[0].text)
+
+
+if __name__ == "__main__":
+    unittest.main()
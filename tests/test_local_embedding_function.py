@@ -0,0 +1,191 @@
+"""Tests of the local sentence-transformers embedding backend, with a fake
+model, and of the torch thread count shared by the local models.
+"""
+import time
+import threading
+import unittest
+import importlib.util
+from unittest import mock
+
+import numpy as np
+
+from utils import torch_threads
+from utils.priority import background
+
+MISSING = [
+    name
+    for name in ("chromadb", "torch", "sentence_transformers")
+    if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from services.embedding_cache import EmbeddingCache
+    from services.local_embedding_function import (
+        SentenceTransformerEmbeddingFunction,
+    )
+
+
+class FakeSentenceTransformer:
+    """Embeds a text as its length and its number of words, recording the
+    batches it is given.
+    """
+
+    max_seq_length = 256
+
+    def __init__(self, model_name, device=None) -> None:
+        self.batches = []
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return 2
+
+    def eval(self) -> "FakeSentenceTransformer":
+        return self
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=True, **_):
+        self.batches.append(list(texts))
+        return np.array(
+            [[len(text), len(text.split())] for text in texts],
+            dtype=np.float32,
+        )
+
+
+class TestTorchThreads(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(torch_threads, "_num_threads", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_divides_the_cores_among_the_workers(self):
+        with mock.patch("os.cpu_count", return_value=8):
+            with mock.patch.dict("os.environ", {"WEB_CONCURRENCY": "3"}):
+                self.assertEqual(torch_threads.default_torch_threads(), 2)
+            with mock.patch.dict("os.environ", {"WEB_CONCURRENCY": "16"}):
+                self.assertEqual(torch_threads.default_torch_threads(), 1)
+            with mock.patch.dict("os.environ", {"WEB_CONCURRENCY": "x"}):
+                self.assertEqual(torch_threads.default_torch_threads(), 8)
+
+    @unittest.skipIf(
+        importlib.util.find_spec("torch") is None, "torch not installed"
+    )
+    def test_sets_the_threads_once(self):
+        with mock.patch("torch.set_num_threads") as set_num_threads:
+            self.assertEqual(torch_threads.set_torch_threads(3), 3)
+            with self.assertLogs(torch_threads.logger, "WARNING"):
+                self.assertEqual(torch_threads.set_torch_threads(5), 3)
+            self.assertEqual(torch_threads.set_torch_threads(None), 3)
+        set_num_threads.assert_called_once_with(3)
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestSentenceTransformerEmbeddingFunction(unittest.TestCase):
+    def make_function(self, **kwargs):
+        patchers = [
+            mock.patch(
+                "sentence_transformers.SentenceTransformer",
+                FakeSentenceTransformer,
+            ),
+            mock.patch.object(torch_threads, "_num_threads", None),
+            mock.patch("torch.set_num_threads"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return SentenceTransformerEmbeddingFunction(
+            model_name="fake", **kwargs
+        )
+
+    def test_embeds_in_input_order(self):
+        function = self.make_function(num_threads=2)
+        texts = ["a", "three word text", "two words", ""]
+
+        matrix = function.embed_matrix(texts)
+
+        self.assertEqual(matrix.dtype, np.float32)
+        np.testing.assert_array_equal(
+            matrix, [[1, 1], [15, 3], [9, 2], [0, 0]]
+        )
+        self.assertEqual(function([texts[0]]), [[1.0, 1.0]])
+        self.assertEqual(function.num_threads, 2)
+        self.assertEqual(function.embed_matrix([]).shape, (0, 2))
+
+    def test_batches_texts_of_similar_length(self):
+        function = self.make_function(batch_size=3, max_batch_tokens=None)
+        texts = [f"word {'x' * length}" for length in (1, 80, 2, 90, 3)]
+
+        function.embed_matrix(texts)
+
+        # Longest texts first, so that short ones are not padded
+        self.assertEqual(
+            [
+                [len(text) for text in batch]
+                for batch in function.model.batches
+            ],
+            [[95, 85, 8], [7, 6]],
+        )
+
+    def test_bounds_the_padded_tokens_of_a_batch(self):
+        function = self.make_function(batch_size=64, max_batch_tokens=100)
+        texts = ["x" * 160] * 3 + ["x" * 8] * 20
+
+        function.embed_matrix(texts)
+
+        # 40 tokens per long text, 2 per short text, padded to the longest
+        self.assertEqual(
+            [len(batch) for batch in function.model.batches], [2, 2, 19]
+        )
+        for batch in function.model.batches:
+            self.assertLessEqual(len(batch[0]) // 4 * len(batch), 100)
+
+    def test_skips_cached_texts(self):
+        cache = EmbeddingCache(path=":memory:")
+        self.addCleanup(cache.close)
+        function = self.make_function(cache=cache)
+
+        function.embed_matrix(["dodge", "parry"])
+        matrix = function.embed_matrix(["parry", "spell"])
+
+        self.assertEqual(
+            function.model.batches, [["dodge", "parry"], ["spell"]]
+        )
+        np.testing.assert_array_equal(matrix, [[5, 1], [5, 1]])
+        # Embeddings of other settings are not reused
+        other = self.make_function(cache=cache, normalize=False)
+        other.embed_matrix(["parry"])
+        self.assertEqual(other.model.batches, [["parry"]])
+
+    def test_queries_go_between_ingestion_batches(self):
+        function = self.make_function(batch_size=1)
+        encode = function.model.encode
+        first_batch = threading.Event()
+        query_waiting = threading.Event()
+
+        def blocking_encode(texts, **kwargs):
+            if not first_batch.is_set():
+                first_batch.set()
+                query_waiting.wait(5)
+            return encode(texts, **kwargs)
+
+        function.model.encode = blocking_encode
+
+        def ingest():
+            with background():
+                function.embed_matrix(["page one", "page 2"])
+
+        thread = threading.Thread(target=ingest)
+        thread.start()
+        first_batch.wait(5)
+        query = threading.Thread(target=function.embed_matrix, args=["q"])
+        query.start()
+        while not function._lock._waiting:
+            time.sleep(0.01)
+        query_waiting.set()
+        thread.join()
+        query.join()
+
+        self.assertEqual(
+            function.model.batches, [["page one"], ["q"], ["page 2"]]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
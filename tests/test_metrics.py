@@ -0,0 +1,103 @@
+"""Tests of the Prometheus metrics and the request timing spans."""
+import threading
+import unittest
+
+from utils.metrics import (
+    Registry,
+    add_timings,
+    collect_timings,
+    current_timings,
+    format_server_timing,
+    span,
+)
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_renders_one_sample_per_label_set(self):
+        counter = self.registry.counter(
+            "cache_total", "Cache lookups.", labels=("result",)
+        )
+        counter.inc(3, result="hit")
+        counter.inc(result="miss")
+        counter.inc(result="hit")
+        self.assertEqual(
+            self.registry.render(),
+            "# HELP cache_total Cache lookups.\n"
+            "# TYPE cache_total counter\n"
+            'cache_total{result="hit"} 4\n'
+            'cache_total{result="miss"} 1\n',
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram(
+            "latency_seconds", "Latency.", buckets=(0.1, 1.0)
+        )
+        for value in (0.05, 0.5, 0.7, 5.0):
+            histogram.observe(value)
+        lines = self.registry.render().splitlines()
+        self.assertEqual(
+            lines[2:],
+            [
+                'latency_seconds_bucket{le="0.1"} 1',
+                'latency_seconds_bucket{le="1"} 3',
+                'latency_seconds_bucket{le="+Inf"} 4',
+                "latency_seconds_sum 6.25",
+                "latency_seconds_count 4",
+            ],
+        )
+
+    def test_label_values_are_escaped(self):
+        counter = self.registry.counter("c", "C.", labels=("path",))
+        counter.inc(path='a"b\\c')
+        self.assertIn('c{path="a\\"b\\\\c"} 1', self.registry.render())
+
+    def test_wrong_labels_and_duplicate_names_are_rejected(self):
+        counter = self.registry.counter("c", "C.", labels=("kind",))
+        with self.assertRaises(ValueError):
+            counter.inc(other="x")
+        with self.assertRaises(ValueError):
+            self.registry.counter("c", "C.")
+        with self.assertRaises(ValueError):
+            counter.inc(-1, kind="x")
+
+
+class TestTimings(unittest.TestCase):
+    def test_spans_add_to_the_collected_timings(self):
+        self.assertIsNone(current_timings())
+        with collect_timings() as timings:
+            with span("retrieve"):
+                pass
+            with span("retrieve"):
+                pass
+            with span("generate"):
+                pass
+        self.assertIsNone(current_timings())
+        self.assertEqual(list(timings), ["retrieve", "generate"])
+
+    def test_timings_of_another_thread_can_be_added(self):
+        with collect_timings() as timings:
+            target = current_timings()
+
+            def work():
+                with collect_timings() as batch:
+                    with span("vector_search"):
+                        pass
+                add_timings(target, batch)
+
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.assertIn("vector_search", timings)
+
+    def test_server_timing_is_in_milliseconds(self):
+        self.assertEqual(
+            format_server_timing({"retrieve": 0.0123, "total": 0.5}),
+            "retrieve;dur=12.30, total;dur=500.00",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
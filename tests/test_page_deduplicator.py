@@ -0,0 +1,106 @@
+"""Tests of the detection of empty and near-duplicate pages."""
+import random
+import unittest
+
+from models.document import Document
+from services.page_deduplicator import (
+    PageDeduplicator,
+    format_aliases,
+    parse_aliases,
+)
+
+WORDS = (
+    "dragon bane boon roll skill attack parry dodge weapon armor spell "
+    "magic monster treasure journey camp rest heal damage critical"
+).split()
+
+
+def make_page(
+    filepath: str,
+    page_number: int,
+    text: str,
+    title: str = "Core",
+    edition: str = "1e",
+) -> Document:
+    return Document(
+        filepath=filepath,
+        page_content=text,
+        title=title,
+        game_system="Dragonbane",
+        edition=edition,
+        page_number=page_number,
+    )
+
+
+class TestPageDeduplicator(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.texts = [" ".join(rng.choices(WORDS, k=300)) for _ in range(3)]
+        self.deduplicator = PageDeduplicator()
+
+    def test_skips_empty_and_near_duplicate_pages(self):
+        words = self.texts[0].split()
+        words[100] = "reprinted"
+        pages = [
+            make_page("core.pdf", 1, self.texts[0]),
+            make_page("core.pdf", 2, self.texts[1]),
+            make_page("core.pdf", 3, "Notes 3"),
+            make_page("reprint.pdf", 1, " ".join(words)),
+            make_page("reprint.pdf", 2, self.texts[0].upper()),
+            make_page("reprint.pdf", 3, self.texts[2]),
+        ]
+        kept = list(self.deduplicator.deduplicate(pages))
+        self.assertEqual(
+            [(page.filepath, page.page_number) for page in kept],
+            [("core.pdf", 1), ("core.pdf", 2), ("reprint.pdf", 3)],
+        )
+        self.assertEqual(
+            dict(self.deduplicator.aliases),
+            {("core.pdf", 1): [("reprint.pdf", 1), ("reprint.pdf", 2)]},
+        )
+        self.assertEqual(
+            self.deduplicator.stats(),
+            {"pages": 6, "empty": 1, "duplicate": 2, "pages_saved": 3},
+        )
+
+    def test_pages_of_other_titles_and_editions_are_kept(self):
+        # Filtering on the title or edition of any of these pages finds it
+        pages = [
+            make_page("core.pdf", 1, self.texts[0]),
+            make_page("bestiary.pdf", 1, self.texts[0], title="Bestiary"),
+            make_page("core-2e.pdf", 1, self.texts[0], edition="2e"),
+            make_page("reprint.pdf", 1, self.texts[0]),
+        ]
+        kept = list(self.deduplicator.deduplicate(pages))
+        self.assertEqual(
+            [page.filepath for page in kept],
+            ["core.pdf", "bestiary.pdf", "core-2e.pdf"],
+        )
+        self.assertEqual(
+            dict(self.deduplicator.aliases),
+            {("core.pdf", 1): [("reprint.pdf", 1)]},
+        )
+
+    def test_signatures_estimate_jaccard_similarity(self):
+        words = self.texts[0].split()
+        half = " ".join(words[:150] + self.texts[1].split()[150:])
+        first = self.deduplicator.signature(self.texts[0])
+        second = self.deduplicator.signature(half)
+        similarity = float((first == second).mean())
+        self.assertAlmostEqual(similarity, 0.33, delta=0.1)
+
+    def test_reset_forgets_pages(self):
+        page = make_page("core.pdf", 1, self.texts[0])
+        self.assertEqual(len(list(self.deduplicator.deduplicate([page]))), 1)
+        self.deduplicator.reset()
+        self.assertEqual(len(list(self.deduplicator.deduplicate([page]))), 1)
+        self.assertEqual(self.deduplicator.pages_saved, 0)
+
+    def test_aliases_round_trip(self):
+        aliases = [("reprint.pdf", 1), ("sheet.pdf", 4)]
+        self.assertEqual(parse_aliases(format_aliases(aliases)), aliases)
+        self.assertEqual(parse_aliases(None), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+"""Tests of the coalescing of concurrent queries into batched searches."""
+
+import time
+import threading
+import unittest
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+MISSING = [
+    name for name in ("chromadb",) if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from services.query_batcher import QueryBatcher
+
+
+class FakeCollection:
+    """Answers every query text with `n_results` ranked IDs, recording the
+    searches, or fails every search if `error` is set.
+    """
+
+    def __init__(self, error: Exception = None) -> None:
+        self.error = error
+        self.searches = []
+        self._lock = threading.Lock()
+
+    def query(self, query_texts, n_results, where=None, include=None):
+        with self._lock:
+            self.searches.append(
+                {
+                    "query_texts": list(query_texts),
+                    "n_results": n_results,
+                    "where": where,
+                    "include": include,
+                }
+            )
+        if self.error is not None:
+            raise self.error
+        return {
+            "ids": [
+                [f"{text}-{rank}" for rank in range(n_results)]
+                for text in query_texts
+            ],
+            "distances": [
+                [float(rank) for rank in range(n_results)]
+                for text in query_texts
+            ],
+            "embeddings": None,
+            "included": include,
+        }
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestQueryBatcher(unittest.TestCase):
+    def make_batcher(self, collection, **kwargs) -> "QueryBatcher":
+        # A long window, so that queries sent together share a batch
+        kwargs = {"window_ms": 200, "max_batch_size": 32, **kwargs}
+        batcher = QueryBatcher(collection, **kwargs)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def query_together(self, batcher, queries):
+        """Send every `(query_text, kwargs)` query at the same time."""
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = [
+                executor.submit(batcher.query, text, timeout=5, **kwargs)
+                for text, kwargs in queries
+            ]
+            return [future.result() for future in futures]
+
+    def test_coalesces_compatible_queries(self):
+        collection = FakeCollection()
+        batcher = self.make_batcher(collection)
+
+        results = self.query_together(
+            batcher,
+            [("dodge", {}), ("parry", {}), ("dodge", {}), ("spell", {})],
+        )
+
+        self.assertEqual(len(collection.searches), 1)
+        # Repeated query texts are searched once
+        self.assertEqual(
+            sorted(collection.searches[0]["query_texts"]),
+            ["dodge", "parry", "spell"],
+        )
+        for text, result in zip(["dodge", "parry", "dodge"], results):
+            self.assertEqual(
+                result["ids"], [[f"{text}-{i}" for i in range(10)]]
+            )
+        self.assertEqual(results[0]["embeddings"], None)
+        self.assertEqual((batcher.batches, batcher.queries), (1, 4))
+
+    def test_groups_by_include_and_filter(self):
+        collection = FakeCollection()
+        batcher = self.make_batcher(collection)
+        where = {"game_system": "Dragonbane"}
+
+        self.query_together(
+            batcher,
+            [
+                ("dodge", {}),
+                ("parry", {"where": where}),
+                ("spell", {"where": {"game_system": "Dragonbane"}}),
+                ("armor", {"include": ["documents"]}),
+            ],
+        )
+
+        searches = sorted(
+            collection.searches, key=lambda search: len(search["query_texts"])
+        )
+        self.assertEqual(len(searches), 3)
+        self.assertEqual(
+            sorted(searches[-1]["query_texts"]), ["parry", "spell"]
+        )
+        self.assertEqual(searches[-1]["where"], where)
+        self.assertIn(
+            ["documents"], [search["include"] for search in searches]
+        )
+
+    def test_slices_results_to_each_n_results(self):
+        collection = FakeCollection()
+        batcher = self.make_batcher(collection)
+
+        few, many = self.query_together(
+            batcher,
+            [("dodge", {"n_results": 2}), ("parry", {"n_results": 5})],
+        )
+
+        self.assertEqual(collection.searches[0]["n_results"], 5)
+        self.assertEqual(few["ids"], [["dodge-0", "dodge-1"]])
+        self.assertEqual(few["distances"], [[0.0, 1.0]])
+        self.assertEqual(len(many["ids"][0]), 5)
+
+    def test_fans_errors_out_to_every_query_of_the_batch(self):
+        collection = FakeCollection(error=ValueError("Search failed"))
+        batcher = self.make_batcher(collection)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(batcher.query, text, timeout=5)
+                for text in ("dodge", "parry", "spell")
+            ]
+            for future in futures:
+                with self.assertRaisesRegex(ValueError, "Search failed"):
+                    future.result()
+        self.assertEqual(len(collection.searches), 1)
+
+        # The batcher keeps serving after a failed batch
+        collection.error = None
+        self.assertEqual(len(batcher.query("dodge", timeout=5)["ids"]), 1)
+
+    def test_splits_batches_at_max_batch_size(self):
+        collection = FakeCollection()
+        batcher = self.make_batcher(collection, max_batch_size=2)
+
+        self.query_together(batcher, [(f"query {i}", {}) for i in range(5)])
+
+        self.assertEqual(
+            sorted(
+                len(search["query_texts"]) for search in collection.searches
+            ),
+            [1, 2, 2],
+        )
+
+    def test_close_answers_queued_queries_then_rejects_new_ones(self):
+        collection = FakeCollection()
+        batcher = self.make_batcher(collection, window_ms=5000)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(batcher.query, "dodge", timeout=5)
+            # Close while the batch still waits for more queries
+            while batcher._thread is None or not batcher._queue.empty():
+                time.sleep(0.01)
+            start = time.monotonic()
+            batcher.close()
+            self.assertEqual(len(future.result()["ids"][0]), 10)
+            self.assertLess(time.monotonic() - start, 2.0)
+
+        self.assertFalse(batcher._thread.is_alive())
+        with self.assertRaises(RuntimeError):
+            batcher.query("parry")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""Tests of the cross-encoder rerank stage, with a fake model."""
+import unittest
+import importlib.util
+
+MISSING = [
+    name
+    for name in ("chromadb", "pydantic")
+    if importlib.util.find_spec(name) is None
+]
+
+
+class FakeCrossEncoder:
+    """Scores a pair by the number of query words in the text."""
+
+    def __init__(self) -> None:
+        self.pairs = 0
+
+    def predict(self, pairs, batch_size=32, **kwargs):
+        self.pairs += len(pairs)
+        return [
+            float(sum(word in text.split() for word in query.split()))
+            for query, text in pairs
+        ]
+
+
+class FakeRetriever:
+    """Returns `top_k` chunks, the least relevant first."""
+
+    def __init__(self) -> None:
+        self.top_k = None
+
+    def retrieve(self, query_text, top_k=15, where=None):
+        from models.retrieval import RetrievedChunk
+
+        self.top_k = top_k
+        return [
+            RetrievedChunk(
+                id=f"chunk-{i}", text=" ".join(["bane"] * i + ["boon"])
+            )
+            for i in range(top_k)
+        ]
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestReranker(unittest.TestCase):
+    def setUp(self):
+        from services.reranker import (
+            CrossEncoderReranker,
+            RerankingRetriever,
+        )
+
+        self.model = FakeCrossEncoder()
+        self.reranker = CrossEncoderReranker(
+            top_n=3, cache_size=100, model=self.model
+        )
+        self.retriever = FakeRetriever()
+        self.reranking_retriever = RerankingRetriever(
+            retriever=self.retriever, reranker=self.reranker, oversample=4
+        )
+
+    def test_oversampled_candidates_are_reranked(self):
+        chunks = self.reranking_retriever.retrieve("bane die", top_k=15)
+        self.assertEqual(self.retriever.top_k, 12)
+        self.assertEqual(
+            [chunk.id for chunk in chunks],
+            ["chunk-1", "chunk-2", "chunk-3"],
+        )
+        self.assertEqual(chunks[0].rerank_score, 1.0)
+        self.assertIsNone(chunks[0].distance)
+
+    def test_pair_scores_are_cached(self):
+        chunks = self.retriever.retrieve("bane", top_k=10)
+        self.reranker.rerank("bane", chunks)
+        self.reranker.rerank("bane", chunks[:5])
+        self.assertEqual(self.model.pairs, 10)
+        self.reranker.rerank("boon", chunks)
+        self.assertEqual(self.model.pairs, 20)
+
+    def test_cache_evicts_least_recently_used(self):
+        self.reranker.cache_size = 4
+        chunks = self.retriever.retrieve("bane", top_k=6)
+        self.reranker.rerank("bane", chunks)
+        self.reranker.rerank("bane", chunks[4:])
+        self.assertEqual(self.model.pairs, 6)
+        self.reranker.rerank("bane", chunks[:2])
+        self.assertEqual(self.model.pairs, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
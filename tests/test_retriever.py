@@ -0,0 +1,83 @@
+"""Tests of the Retriever with the results of recent ChromaDB versions,
+which return embeddings as NumPy arrays.
+"""
+import unittest
+import importlib.util
+
+import numpy as np
+
+MISSING = [
+    name for name in ("chromadb",) if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from services.retriever import Retriever
+    from services.query_batcher import QueryBatcher
+
+TEXTS = {"dodge": "Roll EVADE to dodge.", "parry": "Parry with a shield."}
+
+
+class ArrayCollection:
+    """Returns embeddings as NumPy arrays, and omits the fields that are
+    not included.
+    """
+
+    def query(self, query_texts, n_results, include=None, where=None):
+        ids = list(TEXTS)[:n_results]
+        results = {
+            "ids": [ids for _ in query_texts],
+            "embeddings": np.ones((len(query_texts), len(ids), 3)),
+            "documents": None,
+            "metadatas": None,
+            "distances": None,
+        }
+        if "documents" in include:
+            results["documents"] = [
+                [TEXTS[chunk_id] for chunk_id in ids] for _ in query_texts
+            ]
+        if "distances" in include:
+            results["distances"] = np.zeros((len(query_texts), len(ids)))
+        return results
+
+    def get(self, ids, where=None, include=None):
+        return {
+            "ids": ids,
+            "documents": [TEXTS[chunk_id] for chunk_id in ids],
+            "metadatas": [{"page_number": 1} for _ in ids],
+            "embeddings": np.ones((len(ids), 3)),
+        }
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestArrayResults(unittest.TestCase):
+    def assert_chunks(self, chunks, ids):
+        self.assertEqual([chunk.id for chunk in chunks], ids)
+        for chunk in chunks:
+            self.assertEqual(chunk.text, TEXTS[chunk.id])
+            self.assertEqual(chunk.embedding.dtype, np.float32)
+            np.testing.assert_array_equal(chunk.embedding, [1.0, 1.0, 1.0])
+
+    def test_dense_retrieval(self):
+        chunks = Retriever(ArrayCollection()).retrieve("dodge", top_k=2)
+
+        self.assert_chunks(chunks, ["dodge", "parry"])
+        self.assertEqual(chunks[0].distance, 0.0)
+        # A missing field leaves the attribute empty
+        self.assertIsNone(chunks[0].metadata.get("page_number"))
+
+    def test_dense_retrieval_through_the_query_batcher(self):
+        batcher = QueryBatcher(ArrayCollection(), window_ms=1)
+        self.addCleanup(batcher.close)
+        retriever = Retriever(ArrayCollection(), query_batcher=batcher)
+
+        self.assert_chunks(retriever.retrieve("dodge", top_k=1), ["dodge"])
+
+    def test_get_chunks(self):
+        chunks = Retriever(ArrayCollection()).get_chunks(["parry", "dodge"])
+
+        self.assert_chunks(chunks, ["parry", "dodge"])
+        self.assertEqual(chunks[0].page_number, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+"""Tests of the metadata filters of queries and of their routing to the
+shards of the game systems they are restricted to.
+"""
+import threading
+import unittest
+import importlib.util
+from unittest import mock
+
+from utils import enums
+
+MISSING = [
+    name
+    for name in ("chromadb", "pydantic")
+    if importlib.util.find_spec(name) is None
+]
+
+if not MISSING:
+    from models.query import Query
+    from models.retrieval import RetrievedChunk
+    from services.shard_router import ShardRouter, filtered_game_systems
+
+
+class FakeRetriever:
+    """Returns the given chunk IDs, recording the searches it runs and the
+    threads it runs them on.
+    """
+
+    def __init__(self, ids) -> None:
+        self.ids = ids
+        self.searches = []
+        self.threads = set()
+
+    def retrieve(self, query_text, top_k=15, where=None):
+        self.searches.append((query_text, top_k, where))
+        self.threads.add(threading.get_ident())
+        return [
+            RetrievedChunk(id=chunk_id, text=chunk_id)
+            for chunk_id in self.ids[:top_k]
+        ]
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestQueryFilter(unittest.TestCase):
+    def test_no_filter(self):
+        self.assertIsNone(Query(query="dodge").to_where())
+
+    def test_single_filter(self):
+        self.assertEqual(
+            Query(query="dodge", edition="1e").to_where(), {"edition": "1e"}
+        )
+
+    def test_several_filters_are_combined(self):
+        query = Query(query="dodge", title="Core Rules", edition="1e")
+        self.assertEqual(
+            query.to_where(),
+            {"$and": [{"edition": "1e"}, {"title": "Core Rules"}]},
+        )
+
+    def test_game_system_matches_its_folder(self):
+        with mock.patch.object(
+            enums, "GAME_SYSTEM_FOLDERS", ["Dragonbane", "Mork Borg"]
+        ):
+            query = Query(query="dodge", game_system="  mork BORG ")
+            self.assertEqual(query.game_system, "Mork Borg")
+            self.assertEqual(
+                Query(query="dodge", game_system="Other ").game_system,
+                "Other",
+            )
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestFilteredGameSystems(unittest.TestCase):
+    def test_unrestricted_filters(self):
+        for where in (None, {}, {"edition": "1e"}, {"game_system": 3}):
+            self.assertIsNone(filtered_game_systems(where))
+
+    def test_equality_and_membership(self):
+        self.assertEqual(filtered_game_systems({"game_system": "A"}), {"A"})
+        self.assertEqual(
+            filtered_game_systems({"game_system": {"$eq": "A"}}), {"A"}
+        )
+        self.assertEqual(
+            filtered_game_systems({"game_system": {"$in": ["A", "B"]}}),
+            {"A", "B"},
+        )
+
+    def test_and_intersects_the_conditions(self):
+        where = {
+            "$and": [
+                {"game_system": {"$in": ["A", "B"]}},
+                {"edition": "1e"},
+                {"game_system": {"$in": ["B", "C"]}},
+            ]
+        }
+        self.assertEqual(filtered_game_systems(where), {"B"})
+        self.assertIsNone(
+            filtered_game_systems({"$and": [{"edition": "1e"}]})
+        )
+
+    def test_or_unites_the_conditions(self):
+        where = {"$or": [{"game_system": "A"}, {"game_system": "B"}]}
+        self.assertEqual(filtered_game_systems(where), {"A", "B"})
+        # A branch without a game system may match any shard
+        where = {"$or": [{"game_system": "A"}, {"edition": "1e"}]}
+        self.assertIsNone(filtered_game_systems(where))
+
+
+@unittest.skipIf(MISSING, f"{', '.join(MISSING)} not installed")
+class TestShardRouter(unittest.TestCase):
+    def setUp(self):
+        self.retrievers = {
+            "Dragonbane": FakeRetriever(["d1", "shared", "d2"]),
+            "Mork Borg": FakeRetriever(["shared", "m1"]),
+            "Pathfinder": FakeRetriever(["p1"]),
+        }
+        self.router = ShardRouter(self.retrievers, max_workers=3)
+
+    def test_filtered_queries_only_search_their_shards(self):
+        where = {"game_system": "Mork Borg"}
+
+        chunks = self.router.retrieve("dodge", top_k=5, where=where)
+
+        self.assertEqual([chunk.id for chunk in chunks], ["shared", "m1"])
+        self.assertEqual(
+            self.retrievers["Mork Borg"].searches, [("dodge", 5, where)]
+        )
+        for name in ("Dragonbane", "Pathfinder"):
+            self.assertEqual(self.retrievers[name].searches, [])
+
+    def test_unknown_game_system_matches_no_shard(self):
+        chunks = self.router.retrieve(
+            "dodge", where={"game_system": "Unknown"}
+        )
+
+        self.assertEqual(chunks, [])
+        for retriever in self.retrievers.values():
+            self.assertEqual(retriever.searches, [])
+
+    def test_unfiltered_queries_fuse_every_shard(self):
+        chunks = self.router.retrieve("dodge", top_k=4)
+
+        # "shared" is ranked by two shards, the first chunks of the others
+        # tie ahead of the second ones
+        self.assertEqual(
+            [chunk.id for chunk in chunks], ["shared", "d1", "p1", "m1"]
+        )
+        for retriever in self.retrievers.values():
+            self.assertEqual(retriever.searches, [("dodge", 4, None)])
+            self.assertNotIn(threading.get_ident(), retriever.threads)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+"""Tests that importing the API is fast and does not construct any client or
+index any document.
+"""
+import os
+import sys
+import json
+import unittest
+import subprocess
+import importlib.util
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be imported once a client is first used
+HEAVY_MODULES = [
+    "chromadb",
+    "pymupdf",
+    "pymupdf4llm",
+    "google.generativeai",
+    "langchain_google_genai",
+]
+
+IMPORT_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "seconds": elapsed,
+    "loaded": [name for name in sys.argv[1:] if name in sys.modules],
+}))
+"""
+
+
+@unittest.skipIf(
+    importlib.util.find_spec("fastapi") is None, "fastapi is not installed"
+)
+class TestStartup(unittest.TestCase):
+    def import_app(self) -> dict:
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT, *HEAVY_MODULES],
+            cwd=REPO_ROOT,
+            env={**os.environ, "GOOGLE_API_KEY": "fake"},
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_import_does_not_load_heavy_modules(self):
+        self.assertEqual(self.import_app()["loaded"], [])
+
+    def test_import_is_fast(self):
+        self.assertLess(self.import_app()["seconds"], 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Tests of the two-stage vector index."""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from services.vector_index import VectorIndex
+
+
+class TestVectorIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "vector_index")
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(500, 32)).astype(np.float32)
+        self.ids = [f"chunk-{i}" for i in range(len(self.vectors))]
+
+    def build(self, **kwargs) -> VectorIndex:
+        VectorIndex.build(self.path, zip(self.ids, self.vectors), **kwargs)
+        index = VectorIndex.load(self.path)
+        self.addCleanup(index.close)
+        return index
+
+    def exact(self, query: np.ndarray, k: int) -> list:
+        norms = np.linalg.norm(self.vectors, axis=1)
+        scores = self.vectors @ query / norms
+        return [self.ids[i] for i in np.argsort(-scores)[:k]]
+
+    def test_rescoring_every_chunk_matches_exact_search(self):
+        index = self.build(prefilter_dimensions=8, quantize=True)
+        query = self.vectors[7] + 0.1
+        hits = index.search(query, k=10, oversample=len(self.ids))
+        self.assertEqual([hit.id for hit in hits], self.exact(query, 10))
+        best = self.vectors[self.ids.index(hits[0].id)]
+        self.assertAlmostEqual(
+            hits[0].score,
+            float(best @ query)
+            / float(np.linalg.norm(best) * np.linalg.norm(query)),
+            places=5,
+        )
+
+    def test_finds_the_query_embedding_with_a_truncated_prefilter(self):
+        for quantize in (False, True):
+            index = self.build(prefilter_dimensions=16, quantize=quantize)
+            for row in (0, 123, 499):
+                hits = index.search(self.vectors[row], k=5, oversample=10)
+                self.assertEqual(hits[0].id, self.ids[row])
+                self.assertAlmostEqual(hits[0].score, 1.0, places=5)
+
+    def test_quantized_prefilter_is_smaller(self):
+        full = self.build(prefilter_dimensions=16, quantize=False)
+        quantized = self.build(prefilter_dimensions=16, quantize=True)
+        self.assertEqual(full.prefilter_dimensions, 16)
+        self.assertLess(quantized.prefilter_bytes, full.prefilter_bytes / 3)
+
+    def test_update_keeps_the_prefilter_settings(self):
+        index = self.build(prefilter_dimensions=8, quantize=True)
+        removed = self.ids[:100]
+        added = [("chunk-200", -self.vectors[7]), ("new", self.vectors[0])]
+
+        self.assertEqual(index.update(self.path, removed, added), 401)
+        updated = VectorIndex.load(self.path)
+        self.addCleanup(updated.close)
+
+        self.assertEqual(
+            updated.ids,
+            [i for i in self.ids[100:] if i != "chunk-200"]
+            + ["chunk-200", "new"],
+        )
+        self.assertEqual(updated.prefilter_dimensions, 8)
+        self.assertIsNotNone(updated.scales)
+        # The replaced chunk has its new embedding
+        hits = updated.search(-self.vectors[7], k=1, oversample=10)
+        self.assertEqual(hits[0].id, "chunk-200")
+        self.assertEqual(updated.search(self.vectors[0], k=1)[0].id, "new")
+
+    def test_missing_or_empty_index_is_not_loaded(self):
+        self.assertIsNone(VectorIndex.load(self.path))
+        VectorIndex.build(self.path, [])
+        self.assertIsNone(VectorIndex.load(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,11 +3,117 @@ global VECTOR_STORE
 VECTOR_STORE = None
 
 # Static variables
+GAME_SYSTEM_FOLDERS = [
+    "Dragonbane",
+    # "Kids on Bikes 2e",
+    # "Star Wars 5e",
+    # "Risus The Anything RPG",
+    # "Gamma Wolves",
+]
+# PATH_TO_TTRPG_PDFS = "/app/data"
+PATH_TO_TTRPG_PDFS = "../../Documents/Tabletop RPGs"
 COLLECTION_NAME = "ttrpg_documents"
+# Store each game system in its own collection and route queries to them
+SHARD_BY_GAME_SYSTEM = False
 CHROMA_DB_PATH = "chroma_db"
+CHROMA_MAX_BATCH_BYTES = 32 * 1024 * 1024  # Estimated payload per write
+CHROMA_WRITE_QUEUE_SIZE = 2
 EMBEDDING_MODEL = "models/text-embedding-004"
 OUTPUT_DIMENSIONALITY = 768
+EMBEDDING_TASK_TYPE = "retrieval_document"
+# "gemini" for Google's Text Embedding API, "local" for sentence-transformers
+EMBEDDING_BACKEND = "gemini"
+LOCAL_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+LOCAL_EMBEDDING_BATCH_SIZE = 64
+LOCAL_EMBEDDING_MAX_BATCH_TOKENS = 16384
+LOCAL_EMBEDDING_QUANTIZE = False
 LLM_MODEL = "models/gemini-1.5-pro"
+# "gemini" for the google-generativeai SDK, "rest" for the REST API
+LLM_BACKEND = "gemini"
+LLM_ENDPOINT = "https://generativelanguage.googleapis.com"
+LLM_MAX_CONCURRENCY = 8  # Generation requests in flight per process
+LLM_TIMEOUT_SECONDS = 60.0  # Deadline of a generation, retries included
+LLM_MAX_RETRIES = 2
+LLM_HEDGE_ENABLED = False  # Duplicate requests slower than usual
+LLM_HEDGE_QUANTILE = 0.95
+LLM_HEDGE_MIN_SAMPLES = 20
 LANGCHAIN_OWNER_REPO_COMMIT = "rlm/rag-prompt"
-CHUNK_SIZE = 1000
-CHUNK_OVERLAP = 100
+CHUNK_MAX_TOKENS = 256
+CHUNK_OVERLAP_TOKENS = 32
+CHUNK_MIN_TOKENS = 64
+EXTRACTION_MAX_WORKERS = None  # None uses one worker per CPU core
+EXTRACTION_PAGES_PER_TASK = 16
+# "markdown" keeps headings and tables, "text" is faster plain text
+EXTRACTION_MODE = "markdown"
+EXTRACTION_CACHE_PATH = "extraction_cache"
+# The least recently used pdf files are evicted past this size of text
+EXTRACTION_CACHE_MAX_BYTES = 1 << 30
+INGESTION_BATCH_SIZE = 64
+INGESTION_QUEUE_SIZE = 4
+DEDUP_PAGES = True  # Skip empty and near-duplicate pages at ingestion
+DEDUP_MIN_WORDS = 8  # Pages with fewer words are skipped as empty
+DEDUP_SHINGLE_SIZE = 5
+DEDUP_NUM_PERMUTATIONS = 128
+DEDUP_BANDS = 16
+DEDUP_THRESHOLD = 0.9  # Estimated Jaccard similarity of near duplicates
+EMBEDDING_BATCH_SIZE = 100  # Maximum texts per batchEmbedContents request
+EMBEDDING_MAX_BATCH_TOKENS = 20000
+EMBEDDING_MAX_IN_FLIGHT = 4
+EMBEDDING_REQUESTS_PER_MINUTE = 1500
+EMBEDDING_MAX_RETRIES = 5
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite3"
+EMBEDDING_CACHE_MAX_ENTRIES = 1_000_000
+# Keys looked up before their access times are written, so that lookups on
+# the query path do not write
+EMBEDDING_CACHE_FLUSH_SIZE = 1000
+INDEX_MANIFEST_PATH = f"{CHROMA_DB_PATH}/index_manifest.json"
+QUERY_BATCH_WINDOW_MS = 5
+QUERY_MAX_BATCH_SIZE = 32
+QUERY_MAX_CONCURRENT_BATCHES = 4
+INGEST_ON_STARTUP = True
+# Watch the game system folders after the ingestion on startup, and ingest
+# the pdf files added, changed or removed without a restart
+WATCH_FOLDERS = True
+WATCH_POLL_SECONDS = 2.0
+WATCH_DEBOUNCE_SECONDS = 2.0  # Files must stop changing for this long
+INGEST_NICENESS = 10  # Added to the niceness of the ingestion thread
+# Ingestion pauses until no query ran for this long, but at most for
+# INGEST_YIELD_MAX_WAIT_SECONDS per batch, so steady traffic cannot starve it
+INGEST_YIELD_QUIET_SECONDS = 0.05
+INGEST_YIELD_MAX_WAIT_SECONDS = 1.0
+# Elect one ingestion leader among the worker processes of the server, the
+# others serve read-only snapshots of the index published by the leader
+MULTI_WORKER = False
+INDEX_GENERATIONS_PATH = "index_generations"
+INDEX_GENERATIONS_KEEP = 2
+INDEX_GENERATION_POLL_SECONDS = 5.0
+INDEX_LEADER_LOCK_PATH = f"{INDEX_GENERATIONS_PATH}/leader.lock"
+LEXICAL_INDEX_PATH = f"{CHROMA_DB_PATH}/lexical_index"
+LEXICAL_INDEX_PAGE_SIZE = 1000
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+HYBRID_TOP_K = 8
+EXACT_MATCH_MAX_TERMS = 3
+EXACT_MATCH_MAX_DOCUMENT_RATIO = 0.05
+EXACT_MATCH_TOP_K = 5
+CONTEXT_TOKEN_BUDGET = 3000
+CONTEXT_MMR_LAMBDA = 0.7
+CONTEXT_SHINGLE_SIZE = 5
+CONTEXT_DUPLICATE_THRESHOLD = 0.8
+VECTOR_INDEX_ENABLED = False  # Two-stage search instead of the Chroma HNSW
+VECTOR_INDEX_PATH = f"{CHROMA_DB_PATH}/vector_index"
+VECTOR_PREFILTER_DIMENSIONS = 128
+VECTOR_PREFILTER_INT8 = True
+VECTOR_OVERSAMPLE = 10
+RERANK_ENABLED = False  # Rerank retrieved chunks with a cross-encoder
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_OVERSAMPLE = 4  # Candidates retrieved per chunk kept
+RERANK_TOP_N = 5
+RERANK_BATCH_SIZE = 32
+RERANK_MAX_LENGTH = 512
+RERANK_CACHE_SIZE = 10000  # Cached (query, chunk) pair scores
+# CPU threads of the local models per process, shared by the embedding
+# model and the reranker. None divides the cores among WEB_CONCURRENCY
+# workers
+TORCH_THREADS = None
@@ -0,0 +1,101 @@
+"""Utility class for locking a file across processes."""
+import os
+import fcntl
+import logging
+import threading
+from typing import Any, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    """An exclusive advisory lock on a file, held by at most one process at
+    a time, such as one of the workers of a server, or a shared lock, held
+    by any number of processes while no one holds the exclusive lock.
+
+    The lock is taken with `flock`, so the operating system releases it when
+    the process holding it exits or dies, and another process can take it
+    over. The process ID of the holder of an exclusive lock is written to
+    the file, for debugging.
+    """
+
+    def __init__(self, path: str, shared: bool = False) -> None:
+        """Initializes the FileLock, without taking it.
+
+        Parameters
+        ----------
+        path : str
+            The filepath of the lock file, created if missing.
+        shared : bool, optional
+            Whether to take a shared lock instead of an exclusive one, by
+            default False.
+        """
+        self.path = path
+        self.shared = shared
+        self._file: Optional[Any] = None
+        self._lock = threading.Lock()
+
+    @property
+    def locked(self) -> bool:
+        """Whether this process holds the lock."""
+        return self._file is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take the lock.
+
+        Parameters
+        ----------
+        blocking : bool, optional
+            Whether to wait until the lock is released by its holder, by
+            default True.
+
+        Returns
+        -------
+        bool
+            Whether the lock was taken, which is always the case if
+            `blocking` is True.
+        """
+        with self._lock:
+            if self._file is not None:
+                return True
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            file = open(self.path, "a+")
+            try:
+                fcntl.flock(file.fileno(), flags)
+            except BlockingIOError:
+                file.close()
+                return False
+            except BaseException:
+                file.close()
+                raise
+            if not self.shared:
+                file.truncate(0)
+                file.write(f"{os.getpid()}\n")
+                file.flush()
+            self._file = file
+        logger.debug("Acquired lock %s" % self.path)
+        return True
+
+    def release(self) -> None:
+        """Release the lock, if this process holds it."""
+        with self._lock:
+            if self._file is None:
+                return
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        logger.debug("Released lock %s" % self.path)
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.release()
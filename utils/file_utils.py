@@ -1,7 +1,8 @@
 """Utility functions for file operations."""
 import os
+import hashlib
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,16 +24,62 @@ def get_pdf_filepaths(base_folder: str) -> List[Optional[str]]:
     """
     filepaths = []
     try:
-        files = [
-            f for f in os.listdir(base_folder)
-            if os.path.isfile(os.path.join(base_folder, f))
-        ]
+        filepaths = list(scan_pdf_files(base_folder))
         logger.info(
-            "Found %s files in %s: %s" % (len(files), base_folder, files)
+            "Found %s pdf files in %s" % (len(filepaths), base_folder)
         )
-        for file in files:
-            if file.endswith(".pdf"):
-                filepaths.append(os.path.join(base_folder, file))
     except OSError as e:
         logger.error("Error accessing %s: %s" % (base_folder, e))
     return filepaths
+
+
+def scan_pdf_files(base_folder: str) -> Dict[str, Tuple[int, int]]:
+    """Get the size and modification time of the pdf files in the base
+    folder, in a single pass over its directory entries, so that only the
+    pdf files are stat-ed.
+
+    Parameters
+    ----------
+    base_folder : str
+        The base folder to search for pdf files.
+
+    Returns
+    -------
+    Dict[str, Tuple[int, int]]
+        The `(size, mtime_ns)` tuple of each pdf file, by filepath, sorted
+        by filepath.
+
+    Raises
+    ------
+    OSError
+        If the base folder cannot be read.
+    """
+    files = {}
+    with os.scandir(base_folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(".pdf") and entry.is_file():
+                stat = entry.stat()
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return dict(sorted(files.items()))
+
+
+def hash_file(filepath: str, chunk_size: int = 1 << 20) -> str:
+    """Compute the SHA-256 hex digest of a file's content.
+
+    Parameters
+    ----------
+    filepath : str
+        The filepath of the file to hash.
+    chunk_size : int, optional
+        The number of bytes read at a time, by default 1 MiB.
+
+    Returns
+    -------
+    str
+        The SHA-256 hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
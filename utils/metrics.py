@@ -0,0 +1,386 @@
+"""Utility classes for instrumenting the API and the ingestion with counters,
+histograms and timing spans, exposed in the Prometheus text format.
+
+Only the standard library is used, so that importing this module keeps the
+API startup fast. Recording a value takes a dictionary lookup and a lock, so
+instrumentation can stay on in production.
+"""
+import time
+import math
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets, in seconds, from 1 ms to 1 minute
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+# Size buckets, for batch sizes and token counts
+SIZE_BUCKETS = tuple(2.0**i for i in range(15))
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value or bucket bound."""
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Format the label set of a sample."""
+    if not names:
+        return ""
+    pairs = ",".join(
+        '%s="%s"'
+        % (
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{%s}" % pairs
+
+
+class _Metric:
+    """A named metric, with one series per combination of label values."""
+
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """The label values of a series, in the order of the label names."""
+        if set(labels) != set(self.label_names):
+            raise ValueError(
+                "%s expects the labels %s, got %s"
+                % (self.name, self.label_names, tuple(labels))
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        """The lines of every series of the metric."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """The metric in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+
+    kind = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """Increase the count of a series.
+
+        Parameters
+        ----------
+        amount : float, optional
+            The non-negative increment, by default 1.0.
+        **labels : str
+            The value of every label of the metric.
+        """
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        """The count of a series."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} "
+            f"{_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    """Counts observed values into cumulative buckets, with their sum."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per series, the non-cumulative bucket counts and the sum
+        self._series: Dict[
+            Tuple[str, ...], Tuple[List[int], List[float]]
+        ] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record a value in a series.
+
+        Parameters
+        ----------
+        value : float
+            The observed value.
+        **labels : str
+            The value of every label of the metric.
+        """
+        key = self._key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * len(self.buckets), [0.0])
+            series[0][bucket] += 1
+            series[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        """The number of values observed in a series."""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return sum(series[0]) if series else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            series = sorted(
+                (key, list(counts), total[0])
+                for key, (counts, total) in self._series.items()
+            )
+        lines = []
+        names = self.label_names + ("le",)
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The set of metrics exposed on `/metrics`."""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Add a metric to the registry.
+
+        Raises
+        ------
+        ValueError
+            If a metric of the same name is already registered.
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Duplicate metric {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> Counter:
+        """Create and register a counter."""
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        """Create and register a histogram."""
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_duration_seconds",
+    "Time spent in each stage of querying and ingestion.",
+    labels=("stage",),
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "rag_http_request_duration_seconds",
+    "Time spent handling HTTP requests, until the response starts.",
+    labels=("method", "path", "status"),
+)
+TOKENS = REGISTRY.counter(
+    "rag_tokens_total",
+    "Estimated tokens sent to and received from the models.",
+    labels=("kind",),
+)
+EMBEDDING_CACHE = REGISTRY.counter(
+    "rag_embedding_cache_requests_total",
+    "Embedding cache lookups, by result.",
+    labels=("result",),
+)
+EXTRACTION_CACHE = REGISTRY.counter(
+    "rag_extraction_cache_requests_total",
+    "Extraction cache lookups of pdf files, by result.",
+    labels=("result",),
+)
+RERANK_CACHE = REGISTRY.counter(
+    "rag_rerank_cache_requests_total",
+    "Reranker pair score cache lookups, by result.",
+    labels=("result",),
+)
+DEDUP_PAGES = REGISTRY.counter(
+    "rag_dedup_pages_total",
+    "Extracted pages, by whether they were kept or skipped as empty or "
+    "duplicate.",
+    labels=("result",),
+)
+BATCH_SIZE = REGISTRY.histogram(
+    "rag_batch_size",
+    "Number of items per batch, by kind of batch.",
+    labels=("batch",),
+    buckets=SIZE_BUCKETS,
+)
+
+# Time spent per stage by the request being handled, if any
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a block of code as a stage.
+
+    The duration is recorded in `rag_stage_duration_seconds`, and added to
+    the `Server-Timing` header of the request being handled, if any.
+
+    Parameters
+    ----------
+    stage : str
+        The name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """Collect the time spent per stage by the spans of a request.
+
+    The spans run in threads started from the request, such as the
+    threadpool of synchronous endpoints, add to the same timings.
+
+    Yields
+    ------
+    Dict[str, float]
+        The seconds spent per stage, filled in as spans end.
+    """
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def current_timings() -> Optional[Dict[str, float]]:
+    """The timings collected for the request being handled, if any, so that
+    work done on its behalf in another thread can add to them.
+    """
+    return _request_timings.get()
+
+
+def add_timings(
+    target: Optional[Dict[str, float]], timings: Dict[str, float]
+) -> None:
+    """Add stage timings to those of a request.
+
+    Parameters
+    ----------
+    target : Optional[Dict[str, float]]
+        The timings of the request, or None if not collected.
+    timings : Dict[str, float]
+        The seconds spent per stage to add.
+    """
+    if target is None:
+        return
+    for stage, seconds in timings.items():
+        target[stage] = target.get(stage, 0.0) + seconds
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    """Format stage timings as a `Server-Timing` header value.
+
+    Parameters
+    ----------
+    timings : Dict[str, float]
+        The seconds spent per stage.
+
+    Returns
+    -------
+    str
+        The header value, with durations in milliseconds.
+    """
+    return ", ".join(
+        f"{stage};dur={seconds * 1000.0:.2f}"
+        for stage, seconds in timings.items()
+    )
@@ -0,0 +1,230 @@
+"""Utility functions and classes to run background work, such as the
+ingestion, at a lower priority than the queries served by the API.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums, metrics
+
+
+def lower_thread_priority(niceness: int = enums.INGEST_NICENESS) -> None:
+    """Raise the niceness of the calling thread, which the threads and
+    processes it starts afterwards inherit, so that the CPU goes to query
+    handling first.
+
+    Only Linux schedules threads by their own niceness, so this does nothing
+    on other platforms.
+
+    Parameters
+    ----------
+    niceness : int, optional
+        The increment of the niceness, by default INGEST_NICENESS.
+    """
+    if niceness <= 0 or not sys.platform.startswith("linux"):
+        return
+    thread_id = threading.get_native_id()
+    try:
+        current = os.getpriority(os.PRIO_PROCESS, thread_id)
+        os.setpriority(
+            os.PRIO_PROCESS, thread_id, min(19, current + niceness)
+        )
+    except OSError as e:
+        logger.warning("Could not lower the thread priority: %s" % e)
+
+
+class QueryTraffic:
+    """Tracks the queries being served, so that background work can yield
+    to them.
+
+    Queries run inside `query()`, and background work calls `wait_idle()`
+    between its units of work, which pauses it while queries are in flight
+    and until `quiet_seconds` after the last one. A pause lasts at most
+    `max_wait_seconds`, so that steady traffic slows background work down
+    without starving it.
+
+    Work that must not run alongside any query, such as closing the clients
+    the queries use, runs inside `paused()` instead, which holds new queries
+    back and waits for the ones in flight however long they take.
+    """
+
+    def __init__(
+        self,
+        quiet_seconds: float = enums.INGEST_YIELD_QUIET_SECONDS,
+        max_wait_seconds: float = enums.INGEST_YIELD_MAX_WAIT_SECONDS,
+    ) -> None:
+        """Initializes the QueryTraffic, with no query in flight.
+
+        Parameters
+        ----------
+        quiet_seconds : float, optional
+            The time without queries after which background work resumes, by
+            default INGEST_YIELD_QUIET_SECONDS.
+        max_wait_seconds : float, optional
+            The longest pause of background work, by default
+            INGEST_YIELD_MAX_WAIT_SECONDS.
+        """
+        self.quiet_seconds = quiet_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.in_flight = 0
+        self._last_query = -float("inf")
+        self._paused = False
+        self._condition = threading.Condition()
+
+    def begin(self, blocking: bool = True) -> bool:
+        """Record the start of a query, once queries are not paused.
+
+        Parameters
+        ----------
+        blocking : bool, optional
+            Whether to wait while queries are paused, by default True.
+
+        Returns
+        -------
+        bool
+            Whether the query was recorded, which is always the case if
+            `blocking` is True.
+        """
+        with self._condition:
+            while self._paused:
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self.in_flight += 1
+        return True
+
+    def end(self) -> None:
+        """Record the end of a query."""
+        with self._condition:
+            self.in_flight -= 1
+            self._last_query = time.monotonic()
+            self._condition.notify_all()
+
+    @contextmanager
+    def query(self) -> Iterator[None]:
+        """Record a query in flight for the duration of a block."""
+        self.begin()
+        try:
+            yield
+        finally:
+            self.end()
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """Hold new queries back for the duration of a block, which starts
+        once every query in flight is done, without a time limit.
+        """
+        with self._condition:
+            while self._paused:
+                self._condition.wait()
+            self._paused = True
+            try:
+                while self.in_flight:
+                    self._condition.wait()
+            except BaseException:
+                self._paused = False
+                self._condition.notify_all()
+                raise
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._paused = False
+                self._condition.notify_all()
+
+    def wait_idle(self) -> float:
+        """Wait until no query is in flight or ran in the last
+        `quiet_seconds`, or at most `max_wait_seconds`.
+
+        Returns
+        -------
+        float
+            The time waited, in seconds.
+        """
+        start = time.monotonic()
+        deadline = start + self.max_wait_seconds
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if self.in_flight == 0:
+                    quiet_at = self._last_query + self.quiet_seconds
+                    if now >= quiet_at:
+                        break
+                    timeout = min(quiet_at, deadline) - now
+                else:
+                    timeout = deadline - now
+                self._condition.wait(timeout)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            metrics.STAGE_SECONDS.observe(waited, stage="ingest_yield")
+        return waited
+
+
+# Whether the current thread runs background work, see `background()`
+_local = threading.local()
+
+
+@contextmanager
+def background() -> Iterator[None]:
+    """Mark the work the calling thread does in a block, such as embedding
+    the chunks of the ingestion, as background work, which lets queries go
+    first at a `PriorityLock`.
+    """
+    previous = in_background()
+    _local.background = True
+    try:
+        yield
+    finally:
+        _local.background = previous
+
+
+def in_background() -> bool:
+    """Whether the calling thread runs background work."""
+    return getattr(_local, "background", False)
+
+
+class PriorityLock:
+    """A lock that is handed to the threads serving queries before those
+    running background work, whichever asked first.
+
+    Background work should hold it for short steps, e.g. one batch at a
+    time, so that a query waits for one step at most.
+    """
+
+    def __init__(self) -> None:
+        """Initializes the PriorityLock, unlocked."""
+        self.locked = False
+        # The queries waiting for the lock
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        """Hold the lock for the duration of a block."""
+        urgent = not in_background()
+        with self._condition:
+            if urgent:
+                self._waiting += 1
+            try:
+                while self.locked or (not urgent and self._waiting):
+                    self._condition.wait()
+            finally:
+                if urgent:
+                    self._waiting -= 1
+            self.locked = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.locked = False
+                self._condition.notify_all()
@@ -0,0 +1,67 @@
+"""Utility classes for rate limiting calls to remote APIs."""
+import time
+import threading
+from typing import Optional
+
+
+class TokenBucket:
+    """A thread-safe token bucket rate limiter.
+
+    Tokens are refilled continuously at `rate` tokens per second up to
+    `capacity`, and every call to `acquire` blocks until enough tokens are
+    available.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        """Initializes the TokenBucket with a refill rate and a capacity.
+
+        Parameters
+        ----------
+        rate : float
+            The number of tokens added to the bucket per second.
+        capacity : Optional[float], optional
+            The maximum number of tokens the bucket holds, which bounds the
+            size of a burst. If None, one second worth of tokens is used, by
+            default None.
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = max(1.0, capacity if capacity else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        """Add the tokens accumulated since the last refill."""
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Block until the requested number of tokens is available and take
+        them from the bucket.
+
+        Parameters
+        ----------
+        tokens : float, optional
+            The number of tokens to take, by default 1.0.
+
+        Returns
+        -------
+        float
+            The number of seconds spent waiting.
+        """
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
@@ -0,0 +1,146 @@
+"""Utility functions to retry transient failures of remote API calls."""
+import time
+import random
+import logging
+from typing import Any, Callable, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Exception class names raised by google-api-core and HTTP clients for
+# failures that are worth retrying
+TRANSIENT_ERROR_NAMES = {
+    "Aborted",
+    "DeadlineExceeded",
+    "GatewayTimeout",
+    "InternalServerError",
+    "ResourceExhausted",
+    "ServiceUnavailable",
+    "TooManyRequests",
+}
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Check whether an error, or any error it was raised from, is a transient
+    failure worth retrying.
+
+    Parameters
+    ----------
+    error : BaseException
+        The error to check.
+
+    Returns
+    -------
+    bool
+        True if the error is a timeout, connection error, rate limit or
+        server-side error.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        if type(error).__name__ in TRANSIENT_ERROR_NAMES:
+            return True
+        code = getattr(error, "code", None)
+        if code is None:
+            code = getattr(error, "status_code", None)
+        if isinstance(code, int) and code in TRANSIENT_STATUS_CODES:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def backoff_delay(
+    attempt: int, base_delay: float = 0.5, max_delay: float = 30.0
+) -> float:
+    """Compute an exponential backoff delay with full jitter.
+
+    Parameters
+    ----------
+    attempt : int
+        The 0-based number of the retry.
+    base_delay : float, optional
+        The delay cap of the first retry in seconds, by default 0.5.
+    max_delay : float, optional
+        The maximum delay in seconds, by default 30.0.
+
+    Returns
+    -------
+    float
+        A random delay of at most `min(max_delay, base_delay * 2**attempt)`.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def call_with_retry(
+    function: Callable[..., Any],
+    *args: Any,
+    max_retries: int = 5,
+    base_delay: float = 0.5,
+    max_delay: float = 30.0,
+    is_retryable: Optional[Callable[[BaseException], bool]] = None,
+    deadline: Optional[float] = None,
+    **kwargs: Any,
+) -> Any:
+    """Call a function, retrying transient failures with jittered exponential
+    backoff.
+
+    Parameters
+    ----------
+    function : Callable[..., Any]
+        The function to call.
+    *args : Any
+        The positional arguments of the function.
+    max_retries : int, optional
+        The maximum number of retries after the first attempt, by default 5.
+    base_delay : float, optional
+        The delay cap of the first retry in seconds, by default 0.5.
+    max_delay : float, optional
+        The maximum delay between two attempts in seconds, by default 30.0.
+    is_retryable : Optional[Callable[[BaseException], bool]], optional
+        Decides whether an error is retried, by default is_transient_error.
+    deadline : Optional[float], optional
+        The `time.monotonic()` time after which no retry starts, so that an
+        error is raised rather than retried if the backoff would end past
+        it, by default None.
+    **kwargs : Any
+        The keyword arguments of the function.
+
+    Returns
+    -------
+    Any
+        The return value of the function.
+
+    Raises
+    ------
+    Exception
+        The last error raised by the function once it is not retryable or
+        the retries are exhausted.
+    """
+    is_retryable = is_retryable or is_transient_error
+    attempt = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            logger.warning(
+                "Transient error calling %s (attempt %s of %s), retrying in "
+                "%.2fs: %s"
+                % (
+                    getattr(function, "__name__", function),
+                    attempt + 1,
+                    max_retries + 1,
+                    delay,
+                    e,
+                )
+            )
+            time.sleep(delay)
+            attempt += 1
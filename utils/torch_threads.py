@@ -0,0 +1,66 @@
+"""Utility functions to size the CPU thread pool of torch once per process,
+shared by every local model.
+"""
+import os
+import logging
+import threading
+from typing import Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from utils import enums
+
+_lock = threading.Lock()
+# The number of threads torch was set to, or None if it was not set yet
+_num_threads: Optional[int] = None
+
+
+def default_torch_threads() -> int:
+    """Divide the CPU cores among the worker processes of the server, given
+    by WEB_CONCURRENCY, so that the workers do not oversubscribe them.
+
+    Returns
+    -------
+    int
+        The number of threads per process, at least 1.
+    """
+    try:
+        workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    except ValueError:
+        workers = 1
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def set_torch_threads(
+    num_threads: Optional[int] = enums.TORCH_THREADS,
+) -> int:
+    """Set the number of CPU threads torch runs inference on, once per
+    process, since the setting is global to the process. Later calls keep
+    the number set first.
+
+    Parameters
+    ----------
+    num_threads : Optional[int], optional
+        The number of threads. If None, the CPU cores are divided among the
+        worker processes, by default TORCH_THREADS.
+
+    Returns
+    -------
+    int
+        The number of threads torch runs on.
+    """
+    global _num_threads
+    with _lock:
+        if _num_threads is None:
+            import torch
+
+            _num_threads = num_threads or default_torch_threads()
+            torch.set_num_threads(_num_threads)
+        elif num_threads and num_threads != _num_threads:
+            logger.warning(
+                "Ignoring %s torch threads, already set to %s"
+                % (num_threads, _num_threads)
+            )
+        return _num_threads